@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+
+"""Измеряет экономию места и время востановления версий с дельтами.
+
+Файл заданного размера удаляется в корзину несколько раз, каждый раз
+с небольшими изменениями. Для корзины с дельтами и без них выводится
+размер корзины, а затем время востановления версии
+в зависимости от ее глубины (how_old).
+
+Запуск из папки lab2:
+    python benchmarks/delta_benchmark.py --size 8 --versions 8
+
+"""
+
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from myrm.trash import Trash
+
+
+DEFAULT_SIZE = 8
+DEFAULT_VERSIONS = 8
+DEFAULT_CHANGES = 16
+CHANGE_SIZE = 64
+
+
+def make_versions(size, count, changes, seed=0):
+    """Возвращает список версий файла от старой к новой.
+
+    Каждая версия получается из предыдущей заменой, вставкой
+    или удалением changes кусков по CHANGE_SIZE байт.
+
+    """
+    rand = random.Random(seed)
+    data = bytearray(rand.getrandbits(8) for _ in xrange(size))
+    versions = [str(data)]
+    for _ in xrange(count - 1):
+        for _ in xrange(changes):
+            pos = rand.randrange(len(data) - CHANGE_SIZE)
+            chunk = bytearray(rand.getrandbits(8)
+                              for _ in xrange(CHANGE_SIZE))
+            action = rand.randrange(3)
+            if action == 0:
+                data[pos:pos + CHANGE_SIZE] = chunk
+            elif action == 1:
+                data[pos:pos] = chunk
+            else:
+                del data[pos:pos + CHANGE_SIZE]
+        versions.append(str(data))
+    return versions
+
+
+def run(directory, versions, use_delta):
+    """Удаляет версии в корзину и востанавливает каждую из них.
+
+    Возвращает размер корзины, время добавления и список времен
+    востановления по глубине версии.
+
+    """
+    trash = Trash(directory=os.path.join(directory, ".trash"),
+                  max_size=sys.maxint, delta=use_delta)
+    path = os.path.join(directory, "data.bin")
+
+    with trash.lock():
+        start = time.time()
+        for data in versions:
+            with open(path, "wb") as output_file:
+                output_file.write(data)
+            trash.add(path)
+        add_time = time.time() - start
+        size = trash.get_size()
+
+    # Востанавливается самая старая версия, поэтому глубина
+    # остальных версий не меняется
+    latencies = []
+    for how_old in reversed(xrange(len(versions))):
+        with trash.lock():
+            start = time.time()
+            trash.restore(path, how_old=how_old)
+            latencies.append(time.time() - start)
+        with open(path, "rb") as input_file:
+            assert input_file.read() == versions[-1 - how_old]
+    latencies.reverse()
+    return size, add_time, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE,
+                        help="размер файла в мегабайтах")
+    parser.add_argument("--versions", type=int, default=DEFAULT_VERSIONS,
+                        help="число версий")
+    parser.add_argument("--changes", type=int, default=DEFAULT_CHANGES,
+                        help="число изменений между версиями")
+    args = parser.parse_args()
+
+    versions = make_versions(args.size * 1024 * 1024, args.versions,
+                             args.changes)
+    raw_size = sum(len(data) for data in versions)
+
+    results = {}
+    for use_delta in (False, True):
+        directory = tempfile.mkdtemp(prefix="myrm_delta_")
+        try:
+            results[use_delta] = run(directory, versions, use_delta)
+        finally:
+            shutil.rmtree(directory)
+
+    print "versions: {0}, raw size: {1} bytes".format(len(versions), raw_size)
+    for use_delta in (False, True):
+        size, add_time, _ = results[use_delta]
+        print "delta={0}: trash size {1} bytes ({2:.1%}), add {3:.3f}s".format(
+            use_delta, size, float(size) / raw_size, add_time)
+
+    print "how_old  plain, s  delta, s"
+    for how_old in xrange(len(versions)):
+        print "{0:7d}  {1:8.4f}  {2:8.4f}".format(
+            how_old, results[False][2][how_old], results[True][2][how_old])
+
+
+if __name__ == "__main__":
+    main()
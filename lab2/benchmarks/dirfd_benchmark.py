@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+
+"""Сравнивает работу с полными путями и с дескрипторами папок.
+
+Строится глубокое дерево (depth вложенных папок с длинными именами,
+в каждой files файлов), которое затем перемещается в корзину,
+обходится для подсчета размера и удаляется из нее. Каждая операция
+выполняется с полными путями и относительно дескрипторов папок
+(см. myrm.dirfd).
+
+Запуск из папки lab2:
+    python benchmarks/dirfd_benchmark.py --depth 32 --files 200
+
+"""
+
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import myrm.dirfd as dirfd
+import myrm.purge as purge
+import myrm.utils as utils
+
+from myrm.trash import Trash
+
+
+DEFAULT_DEPTH = 32
+DEFAULT_FILES = 200
+NAME_FORMAT = "deep_directory_level_{0:03d}"
+
+
+def make_tree(directory, depth, files):
+    """Создает дерево. Возвращает его корень и число файлов.
+    """
+    root = os.path.join(directory, "tree")
+    path = root
+    count = 0
+    for level in xrange(depth):
+        path = os.path.join(path, NAME_FORMAT.format(level))
+        os.makedirs(path)
+        for i in xrange(files):
+            with open(os.path.join(path, "file_{0:05d}".format(i)), "w") as f:
+                f.write("x" * (i % 64))
+            count += 1
+    return root, count
+
+
+def measure(function):
+    """Возвращает время выполнения функции и ее результат.
+    """
+    start = time.time()
+    result = function()
+    return time.time() - start, result
+
+
+def run(directory, depth, files, use_dir_fd):
+    """Выполняет операции. Возвращает список (операция, время).
+    """
+    dirfd.SUPPORTED = use_dir_fd
+    tree, count = make_tree(directory, depth, files)
+    trash = Trash(directory=os.path.join(directory, ".trash"),
+                  max_size=sys.maxint, max_count=sys.maxint)
+    trash.common_namespace.process_max = 1
+
+    results = []
+    with trash.lock():
+        add_time, _ = measure(lambda: trash.add(tree))
+        results.append(("add", add_time))
+
+        trash._size = None
+        size_time, size = measure(trash.get_size)
+        results.append(("size", size_time))
+
+        tree_int = trash.to_internal(tree)
+        remove_time, (removed, _) = measure(
+            lambda: purge.remove_tree(tree_int, workers=1,
+                                      use_dir_fd=use_dir_fd))
+        results.append(("remove", remove_time))
+    assert removed == count
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--depth", type=int, default=DEFAULT_DEPTH,
+                        help="глубина дерева")
+    parser.add_argument("--files", type=int, default=DEFAULT_FILES,
+                        help="число файлов в каждой папке")
+    args = parser.parse_args()
+
+    if not dirfd.SUPPORTED:
+        print "dir_fd calls are unsupported on this platform"
+        return
+
+    results = {}
+    for use_dir_fd in (False, True):
+        directory = tempfile.mkdtemp(prefix="myrm_dirfd_")
+        try:
+            results[use_dir_fd] = run(directory, args.depth, args.files,
+                                      use_dir_fd)
+        finally:
+            shutil.rmtree(directory)
+
+    print "depth: {0}, files: {1}".format(args.depth,
+                                          args.depth * args.files)
+    print "operation  paths, s  dir_fd, s"
+    for (name, plain), (_, relative) in zip(results[False], results[True]):
+        print "{0:9s}  {1:8.4f}  {2:9.4f}".format(name, plain, relative)
+
+
+if __name__ == "__main__":
+    main()
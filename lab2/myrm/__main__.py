@@ -15,73 +15,151 @@
 import sys
 import argparse
 import logging
+import datetime
 
 import myrm.config as config
+import myrm.ttl as ttl
+import myrm.stats as statistics
+import myrm.oplog as oplog
 
 from myrm.remover import Remover
 
 
+AS_OF_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M",
+                 "%Y-%m-%d")
+
+
+COMMANDS = (("rm", "remove file by mask"),
+            ("rs", "restore file  by mask"),
+            ("ls", "list of file in trash by mask"),
+            ("clear", "clear files from trash by mask"),
+            ("du", "size of files in trash by mask"),
+            ("stats", "summary of trash (or of a folder)"),
+            ("undo", "restore files removed by an operation "
+                     "(the last one by default)"))
+
+OPTIONAL_MASK_COMMANDS = ("clear", "stats", "undo")
+
+
 def _get_argument_parcer(remove_only=False):
     """Возвращает настроееный парсер аргументов.
 
     Непозиционные аргументы:
     * remove_only -- короткая точка входа
 
+    Каждая команда имеет свой подпарсер, поэтому ключи можно указывать
+    как до команды, так и между командой и масками. Маски обязательны
+    для всех команд, кроме OPTIONAL_MASK_COMMANDS.
+
     """
     description = ("Utility that help to remove file.  Use bucket. All "
                    "operation(except autoclean) use Unix filemask "
                    "to select targect. You can use all operration like if "
                    "all files present in folder.")
     parser = argparse.ArgumentParser(prog="myrm", description=description)
+    _add_options(parser)
+
+    if remove_only:
+        parser.add_argument("filemasks", nargs='+',
+                            help="unix-style regular expression to select "
+                            "targect.")
+        return parser
+
+    # Ключи подпарсеров не имеют значений по-умолчанию, иначе они
+    # затерли бы ключи, указанные до команды
+    options = argparse.ArgumentParser(add_help=False)
+    _add_options(options, suppress=True)
+
+    commands = parser.add_subparsers(dest="command",
+                                     help="operation to perform.")
+    for name, command_help in COMMANDS:
+        command_parser = commands.add_parser(name, parents=[options],
+                                             help=command_help)
+        if name in OPTIONAL_MASK_COMMANDS:
+            nargs = '*'
+        else:
+            nargs = '+'
+        command_parser.add_argument("filemasks", nargs=nargs,
+                                    help="unix-style regular expression "
+                                    "to select targect. "
+                                    "clear without masks empties the whole "
+                                    "trash. stats takes folders instead of "
+                                    "masks, undo takes operation ids.")
+    return parser
+
+
+def _add_options(parser, suppress=False):
+    """Добавляет в парсер ключи командной строки.
 
-    if not remove_only:
-        parser.add_argument("command",
-                            choices=["rm", "rs", "ls", "clear"],
-                            help="rm - remove file by mask | "
-                            "rs - restore file  by mask | "
-                            "clear - clear files from trash by mask | "
-                            "ls - list of file in trash by mask")
+    Позицонные аргументы:
+    parser -- парсер аргументов
 
-    parser.add_argument("filemasks", nargs='+',
-                        help="unix-style regular expression to select targect.")
+    Непозиционные аргументы:
+    suppress -- не задавать значения по-умолчанию
+
+    """
+    def default(value):
+        return argparse.SUPPRESS if suppress else value
 
     parser.add_argument("-r", "-R", "--recursive",
                         dest="recursive", action="store_true",
+                        default=default(False),
                         help="perfom recursive search.")
 
-    parser.add_argument("-o", "--old", dest="how_old", default=0,
+    parser.add_argument("-o", "--old", dest="how_old", default=default(0),
                         help="choose version of file.")
 
+    parser.add_argument("--as-of", dest="as_of", default=default(None),
+                        help="restore files as they were at AS_OF: "
+                        "the newest version removed at or before it "
+                        "(YYYY-MM-DD[ HH:MM[:SS]] or an age like 1d).")
+
     parser.add_argument("-a", "--all", dest="versions",
-                        action="store_true",
+                        action="store_true", default=default(False),
                         help="display all versions of files.")
 
-    parser.add_argument("--config", default=None,
+    parser.add_argument("-t", "--ttl", dest="ttl", default=default(None),
+                        help="time to live of removed files in trash "
+                        "(e.g. 30m, 2h, 7d).")
+
+    parser.add_argument("--top", dest="top",
+                        default=default(statistics.DEFAULT_TOP), type=int,
+                        help="number of largest files in stats.")
+
+    parser.add_argument("-w", "--wait", dest="wait", default=default(None),
+                        type=float,
+                        help="wait up to WAIT seconds for a locked trash "
+                        "(negative - wait forever).")
+
+    parser.add_argument("--config", default=default(None),
                         help="use configuration file.")
 
-    parser.add_argument("--jsonconfig", default=None,
+    parser.add_argument("--jsonconfig", default=default(None),
                         help="use configuration file.")
 
     parser.add_argument("-s", "--silence", dest="silence",
-                        action="store_true",
+                        action="store_true", default=default(False),
                         help="don't show info messages.")
 
     parser.add_argument("-d", "--dryrun", dest="dryrun",
                         action="store_const", const=True,
+                        default=default(None),
                         help="just emulate work.")
 
     parser.add_argument("-f", "--force", dest="force",
                         action="store_const", const=True,
+                        default=default(None),
                         help="igrnore errors.")
 
     parser.add_argument("-i", "--interactive", dest="interactive",
                         action="store_const", const=True,
+                        default=default(None),
                         help="ask you before operation.")
-    return parser
 
 
 def _perfome(remover, operation, file_mask, how_old=0,
-             recursive=False, versions=False):
+             recursive=False, versions=False, ttl=None,
+             top=statistics.DEFAULT_TOP, operation_id=None, as_of=None):
     """Выполняет операции с помощью объекта Remover.
 
     Позиционные аргументы:
@@ -91,6 +169,9 @@ def _perfome(remover, operation, file_mask, how_old=0,
         + rs -- востановить
         + ls -- список файлов
         + clear -- очистка файлов
+        + du -- размер файлов
+        + stats -- сводка содержимого корзины
+        + undo -- отменить операцию удаления
 
     * file_mask -- маска в Unix формате
 
@@ -98,14 +179,22 @@ def _perfome(remover, operation, file_mask, how_old=0,
     * how_old -- указывает на версию файла
     * recursive -- проводить рекурсивный поиск
     * versions выводить все версии файла
+    * ttl -- время жизни удаленных файлов в секундах
+    * top -- сколько самых больших файлов показать в сводке
+    * operation_id -- идентификатор операции удаления
+    * as_of -- момент, на который востанавливаются файлы
 
     """
     if operation == "rm":
-        dcount, dsize, dfiles = remover.remove(file_mask, recursive=recursive)
+        dcount, dsize, dfiles = remover.remove(file_mask, recursive=recursive,
+                                               ttl=ttl, operation=operation_id)
+
+    elif operation == "undo":
+        dcount, dsize, dfiles = remover.undo(file_mask)
 
     elif operation == "rs":
         dcount, dsize, dfiles = remover.restore(file_mask, recursive=recursive,
-                                        how_old=how_old)
+                                        how_old=how_old, as_of=as_of)
 
     elif operation == "ls":
         files = remover.lst(file_mask, recursive=recursive, versions=versions)
@@ -118,6 +207,16 @@ def _perfome(remover, operation, file_mask, how_old=0,
             print(msg)
         return 0, 0, 0
 
+    elif operation == "du":
+        for path, size, count in remover.du(file_mask, recursive=recursive):
+            print("{size}\t{count}\t{path}".format(size=size, count=count,
+                                                    path=path))
+        return 0, 0, 0
+
+    elif operation == "stats":
+        _print_stats(remover.stats(file_mask, top=top))
+        return 0, 0, 0
+
     elif operation == "clear":
         dcount, dsize, dfiles = remover.clean(file_mask, recursive=recursive,
                                       how_old=how_old)
@@ -127,6 +226,61 @@ def _perfome(remover, operation, file_mask, how_old=0,
     return dcount, dsize, dfiles
 
 
+def _parse_as_of(text, now=None):
+    """Возвращает момент времени (datetime) из командной строки.
+
+    Позицонные аргументы:
+    text -- дата в одном из форматов AS_OF_FORMATS или возраст
+            в формате времени жизни (см. ttl.parse_ttl), отсчитываемый
+            от now
+
+    Выбрасывает ValueError если строка имеет плохой формат.
+
+    """
+    for time_format in AS_OF_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, time_format)
+        except ValueError:
+            continue
+    try:
+        age = ttl.parse_ttl(text)
+    except ValueError:
+        raise ValueError("Bad time format.")
+    if now is None:
+        now = datetime.datetime.now()
+    return now - datetime.timedelta(seconds=age)
+
+
+def _print_stats(report):
+    """Выводит сводку содержимого корзины (см. Remover.stats).
+    """
+    time_fmt = "%d.%m.%Y %I:%M"
+    print("{count} files ({size} bytes)".format(**report))
+    if report["oldest"] is not None:
+        print("removed from {oldest} to {newest}".format(
+            oldest=report["oldest"].strftime(time_fmt),
+            newest=report["newest"].strftime(time_fmt)))
+    print("growth: {rate:.0f} bytes/day".format(rate=report["growth_rate"]))
+
+    print("largest:")
+    for path, dtime, size in report["largest"]:
+        print("  {size}\t{path} (removed {dtime})".format(
+            size=size, path=path, dtime=dtime.strftime(time_fmt)))
+
+    for title, key in (("sizes (bytes):", "sizes"),
+                       ("ages (seconds):", "ages")):
+        print(title)
+        for low, high, count, size in report[key]:
+            high = "..." if high is None else high
+            print("  {low}-{high}: {count} files ({size} bytes)".format(
+                low=low, high=high, count=count, size=size))
+
+    print("versions:")
+    for versions, count in sorted(report["versions"].iteritems()):
+        print("  {versions}: {count} files".format(versions=versions,
+                                                   count=count))
+
+
 def _log_summ(operation, count, size):
     """Логирует результат проведенных операций.
     """
@@ -135,7 +289,7 @@ def _log_summ(operation, count, size):
         log_msg = log_fmt.format(count=count, size=size)
         logging.info(log_msg)
 
-    elif operation == "rs":
+    elif operation in ("rs", "undo"):
         log_fmt = "{count} files ({size} bytes) was restored."
         log_msg = log_fmt.format(count=count, size=size)
         logging.info(log_msg)
@@ -145,13 +299,23 @@ def _log_summ(operation, count, size):
         log_msg = log_fmt.format(count=count, size=size)
         logging.info(log_msg)
 
-    elif operation == "ls":
+    elif operation in ("ls", "du", "stats"):
         pass
 
     else:
         raise ValueError("Unsoported operation {}".format(operation))
 
 
+def _log_lock_wait(trash):
+    """Логирует время ожидания блокировки корзины.
+    """
+    stats = trash.get_lock_stats()
+    if stats["waited"]:
+        log_fmt = "Waited {wait:.2f}s for the trash lock."
+        log_msg = log_fmt.format(wait=stats["wait_time"])
+        logging.info(log_msg)
+
+
 def main(remove_only=False):
     """Главная точка входа.
 
@@ -160,6 +324,20 @@ def main(remove_only=False):
     parser = _get_argument_parcer(remove_only=remove_only)
     args = parser.parse_args()
 
+    ttl_sec = None
+    if args.ttl is not None:
+        try:
+            ttl_sec = ttl.parse_ttl(args.ttl)
+        except ValueError as error:
+            parser.error(str(error))
+
+    as_of = None
+    if args.as_of is not None:
+        try:
+            as_of = _parse_as_of(args.as_of)
+        except ValueError as error:
+            parser.error(str(error))
+
     remover_parametrs = {}
 
     if args.config is not None:
@@ -176,6 +354,10 @@ def main(remove_only=False):
         remover_parametrs["dryrun"] = args.dryrun
     if args.interactive is not None:
         remover_parametrs["interactive"] = args.interactive
+    if args.wait is not None:
+        trash_parametrs = dict(remover_parametrs.get("trash", {}))
+        trash_parametrs["lock_timeout"] = args.wait if args.wait >= 0 else None
+        remover_parametrs["trash"] = trash_parametrs
 
 
     if not args.silence:
@@ -193,14 +375,24 @@ def main(remove_only=False):
     else:
         operation = args.command
 
+    file_masks = args.filemasks
+    if not file_masks:
+        file_masks = [None]
+
+    operation_id = oplog.new_operation_id()
+
     try:
         count = 0
         size = 0
-        for file_mask in args.filemasks:
+        for file_mask in file_masks:
             dcount, dsize, dfiles = _perfome(mrm, operation, file_mask,
                                                 how_old=args.how_old,
                                                 recursive=args.recursive,
-                                                versions=args.versions)
+                                                versions=args.versions,
+                                                ttl=ttl_sec,
+                                                top=args.top,
+                                                operation_id=operation_id,
+                                                as_of=as_of)
             count += dcount
             size += dsize
     except Exception as error:
@@ -209,6 +401,9 @@ def main(remove_only=False):
         sys.exit(1)
 
     _log_summ(operation, count, size)
+    if operation == "rm" and count:
+        logging.info("Operation {0} (myrm undo {0}).".format(operation_id))
+    _log_lock_wait(mrm.trash)
 
 def remove():
     """Краткая точка входа. Выполняет удаление в корзину.
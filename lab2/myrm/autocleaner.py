@@ -7,12 +7,16 @@
 import logging
 import datetime
 import myrm.stamp as stamp
+import myrm.rules as rules
+
+from myrm.rules import RulesMatcher
 
 
 DEFAULT_CLEAN_COUNT = 1000*1000
 DEFAULT_CLEAN_SIZE = 512*1024*1024
 DEFAULT_CLEAN_DAYS = 90
 DEFAULT_CLEAN_SAME_COUNT = 10
+DEFAULT_CLEAN_RULES = ()
 
 
 class Autocleaner(object):
@@ -26,12 +30,23 @@ class Autocleaner(object):
     * size -- размер
     * days -- количество дней
     * same_count -- число файлов
+    * rules -- правила хранения файлов (см. модуль rules)
+
+    Файлы, попадающие под правило keep, не очищаются
+    ни по одному из критериев.
 
     Методы класса:
+    * clean_by_ttl -- очиска по времени жизни элементов
+    * clean_by_quotas -- очиска арендаторов, превысивших квоту
+    * clean_tenant -- очиска файлов арендатора
+    * clean_by_rules -- очиска по правилам хранения
     * clean_by_date -- очиска по дате удаления
     * clean_by_files_count -- очиска по числу файлов
     * clean_by_trash_size -- очиска по размеру файлов
     * clean_by_same_count -- очиска файлов с одинаковым именем
+    * autocompress -- сжатие давно удаленных файлов
+    * autopack -- упаковка давно удаленных файлов
+    * automigrate -- перенос файлов на емкий уровень корзины
     * autoclean -- очистка по всем критериям
 
     """
@@ -40,7 +55,8 @@ class Autocleaner(object):
                  count=DEFAULT_CLEAN_COUNT,
                  size=DEFAULT_CLEAN_SIZE,
                  days=DEFAULT_CLEAN_DAYS,
-                 same_count=DEFAULT_CLEAN_SAME_COUNT
+                 same_count=DEFAULT_CLEAN_SAME_COUNT,
+                 rules=DEFAULT_CLEAN_RULES
                 ):
         """Создает объект для определенной корзины.
 
@@ -49,16 +65,18 @@ class Autocleaner(object):
         * size -- размер для очистки
         * days -- количество дней для очистки
         * same_count -- число файлов для очистки
+        * rules -- список правил хранения или строка правил через запятую
 
         """
         self.trash = trash
-        self.configurate(count, size, days, same_count)
+        self.configurate(count, size, days, same_count, rules)
 
     def configurate(self,
                     count=DEFAULT_CLEAN_COUNT,
                     size=DEFAULT_CLEAN_SIZE,
                     days=DEFAULT_CLEAN_DAYS,
-                    same_count=DEFAULT_CLEAN_SAME_COUNT
+                    same_count=DEFAULT_CLEAN_SAME_COUNT,
+                    rules=DEFAULT_CLEAN_RULES
                    ):
         """Обновляет поля объекта.
 
@@ -67,20 +85,141 @@ class Autocleaner(object):
         * size -- размер для очистки
         * days -- количество дней для очистки
         * same_count -- число файлов для очистки
+        * rules -- список правил хранения или строка правил через запятую
+
+        Выбрасывает ValueError если правило имеет плохой формат.
 
         """
         self.count = count
         self.size = size
         self.days = days
         self.same_count = same_count
+        self.rules = RulesMatcher(rules)
+
+    def _get_file_time_list(self, buckets=True):
+        """Возвращает список файлов корзины, кроме защищенных keep.
+
+        Список сотоит из кортежей (путь, время удаления) и
+        сортируется по дате удаления.
+
+        Непозиционные аргументы:
+        buckets -- включать временные разделы корзины
+
+        """
+        file_time_list = self.trash.get_file_time_list(buckets=buckets)
+        if not self.rules:
+            return file_time_list
+        return [(path, dtime) for path, dtime in file_time_list
+                if self.rules.classify(path)[0] != rules.KEEP]
+
+    def autoclean_by_ttl(self):
+        """Очищает элементы корзины с истекшим временем жизни.
+        """
+        with self.trash.lock():
+            self.trash.expire()
+
+    def autoclean_tenant(self, tenant, size=0, count=0):
+        """Очищает самые старые файлы арендатора.
+
+        Возвращает количество очищенных файлов и их размер.
+
+        Позиционные аргументы:
+        tenant -- арендатор (см. myrm.quotas)
+
+        Непозиционные аргументы:
+        size -- сколько места освободить сверх квоты
+        count -- сколько файлов освободить сверх квоты
+
+        Файлы удаляются, пока место арендатора вместе с size и count
+        превышает его квоту. Файлы, защищенные keep, не очищаются.
+
+        """
+        max_size, max_count = self.trash.get_quota_limit(tenant)
+
+        def fits():
+            used_size, used_count = self.trash.get_quota_usage(tenant)
+            return ((max_size is None or used_size + size <= max_size) and
+                    (max_count is None or used_count + count <= max_count))
+
+        file_time_list = self._get_file_time_list()
+
+        delta_count = 0
+        delta_size = 0
+        with self.trash.lock():
+            for path, dtime in file_time_list:
+                if fits():
+                    break
+                if tenant not in self.trash.get_entry_tenants(path, dtime):
+                    continue
+                debug_fmt = ("Removing {path}(removed time: {dtime}) "
+                             "to free quota of {kind} {key}")
+                debug_line = debug_fmt.format(path=path, dtime=dtime,
+                                              kind=tenant[0], key=tenant[1])
+                logging.debug(debug_line)
+                dcount, dsize = self.trash.remove_stamped(path, dtime)
+                delta_count += dcount
+                delta_size += dsize
+        return delta_count, delta_size
+
+    def autoclean_by_quotas(self):
+        """Очищает арендаторов, превысивших квоту.
+        """
+        with self.trash.lock():
+            over_quota = self.trash.get_over_quota()
+            for tenant, _, _ in over_quota:
+                self.autoclean_tenant(tenant)
+
+    def autoclean_by_rules(self):
+        """Очищает корзину по правилам хранения.
+
+        Все файлы корзины классифицируются за один проход.
+        """
+        if not self.rules:
+            return
+
+        now = datetime.datetime.now()
+        old_files = []
+        versions = {}
+
+        for path, dtime in self.trash.get_file_time_list():
+            action, value = self.rules.classify(path)
+            if action == rules.MAX_AGE:
+                if (now - dtime).total_seconds() > value:
+                    old_files.append((path, dtime))
+            elif action == rules.MAX_VERSIONS:
+                versions.setdefault(path, (value, []))[1].append(dtime)
+
+        # Список отсортирован по дате, первыми идут старые версии
+        for path, (max_count, dtimes) in versions.iteritems():
+            excess = max(len(dtimes) - max_count, 0)
+            old_files.extend((path, dtime) for dtime in dtimes[:excess])
+
+        with self.trash.lock():
+            for path, dtime in old_files:
+                debug_fmt = ("Removing {path}(removed time: {dtime}) "
+                             "by retention rule.")
+                debug_line = debug_fmt.format(path=path, dtime=dtime)
+                logging.debug(debug_line)
+                self.trash.remove_stamped(path, dtime)
 
     def autoclean_by_date(self):
         """Очищает корзину по дате удаления.
+
+        Временные разделы корзины удаляются целиком, когда устаревает
+        весь их период. Файлы разделов проверяются по отдельности
+        только если заданы правила keep.
         """
         clear_days = self.days
-
-        file_time_list = self.trash.get_file_time_list()
         now = datetime.datetime.utcnow()
+
+        if self.rules.has_action(rules.KEEP):
+            file_time_list = self._get_file_time_list()
+        else:
+            before = now - datetime.timedelta(days=clear_days + 1)
+            with self.trash.lock():
+                self.trash.remove_buckets(before)
+            file_time_list = self._get_file_time_list(buckets=False)
+
         old_files = ((f, t) for f, t in file_time_list
                      if (now - t).days > clear_days)
 
@@ -90,8 +229,7 @@ class Autocleaner(object):
                              "becouse it's too old.")
                 debug_line = debug_fmt.format(path=path, dtime=dtime)
                 logging.debug(debug_line)
-                path_int = self.trash.to_internal(path)
-                last_version = len(stamp.get_versions_list(path_int)) - 1
+                last_version = len(self.trash.get_versions_list(path)) - 1
                 self.trash.remove(path, last_version)
 
     def autoclean_by_files_count(self):
@@ -99,11 +237,12 @@ class Autocleaner(object):
         """
         clean_count = self.count
 
-        file_time_list = self.trash.get_file_time_list()
+        file_time_list = self._get_file_time_list()
 
         with self.trash.lock():
             index = 0
-            while clean_count <= self.trash.get_count():
+            while (clean_count <= self.trash.get_count() and
+                   index < len(file_time_list)):
                 path, dtime = file_time_list[index]
                 debug_fmt = ("Removing {path}(removed time: {dtime}) "
                              "to free bukkit({excess} files excess)")
@@ -111,8 +250,7 @@ class Autocleaner(object):
                 debug_line = debug_fmt.format(path=path, dtime=dtime,
                                               excess=excess)
                 logging.debug(debug_line)
-                path_int = self.trash.to_internal(path)
-                last_version = len(stamp.get_versions_list(path_int)) - 1
+                last_version = len(self.trash.get_versions_list(path)) - 1
                 self.trash.remove(path, last_version)
                 index += 1
 
@@ -121,11 +259,12 @@ class Autocleaner(object):
         """
         clean_size = self.size
 
-        file_time_list = self.trash.get_file_time_list()
+        file_time_list = self._get_file_time_list()
 
         with self.trash.lock():
             index = 0
-            while  clean_size <= self.trash.get_size():
+            while (clean_size <= self.trash.get_size() and
+                   index < len(file_time_list)):
                 path, dtime = file_time_list[index]
                 debug_fmt = ("Removing {path} (removed time: {dtime})"
                              "to free bukkit({excess} bytes excess)")
@@ -133,8 +272,7 @@ class Autocleaner(object):
                 debug_line = debug_fmt.format(path=path, dtime=dtime,
                                               excess=excess)
                 logging.debug(debug_line)
-                path_int = self.trash.to_internal(path)
-                last_version = len(stamp.get_versions_list(path_int)) - 1
+                last_version = len(self.trash.get_versions_list(path)) - 1
                 self.trash.remove(path, last_version)
                 index += 1
 
@@ -143,7 +281,7 @@ class Autocleaner(object):
         """
         clean_same_count = self.same_count
 
-        file_time = self.trash.get_file_time_list()
+        file_time = self._get_file_time_list()
         dct = stamp.get_file_list_dict(file_time)
 
         with self.trash.lock():
@@ -154,20 +292,64 @@ class Autocleaner(object):
                                      "becouse  there are a lot of same file")
                         debug_line = debug_fmt.format(path=path, dtime=dtime)
                         logging.debug(debug_line)
-                        path_int = self.trash.to_internal(path)
-                        last_version = len(stamp.get_versions_list(path_int))
+                        last_version = len(self.trash.get_versions_list(path))
                         self.trash.remove(path, last_version)
                         last_version -= 1
 
+    def autocompress(self):
+        """Сжимает давно удаленные файлы (см. Trash.compress_cold).
+
+        Возвращает количество сжатых файлов и сэкономленное место.
+
+        Блокирует корзину.
+
+        """
+        with self.trash.lock():
+            return self.trash.compress_cold()
+
+    def autopack(self):
+        """Упаковывает давно удаленные файлы (см. Trash.pack_cold).
+
+        Возвращает количество упакованных файлов и размер пакета.
+
+        Блокирует корзину.
+
+        """
+        with self.trash.lock():
+            return self.trash.pack_cold()
+
+    def automigrate(self):
+        """Переносит файлы на емкий уровень (см. Trash.migrate).
+
+        Возвращает количество перенесенных файлов и их размер.
+
+        Блокирует корзину.
+
+        """
+        with self.trash.lock():
+            return self.trash.migrate()
+
     def autoclean(self):
         """Производт очиску корзины. Возвращает кол-во файлов и размер.
 
         Критерии очистки:
+        * по времени жизни элементов
+        * по квотам арендаторов
+        * по правилам хранения
         * по дате удаления
         * по числу файлов
         * по размеру файлов
         * очиска файлов с одинаковым именем
 
+        Перед очисткой по размеру давно удаленные файлы сжимаются,
+        если корзина использует сжатие. После очистки файлы переносятся
+        на емкий уровень, если он задан, а оставшиеся давно удаленные
+        файлы упаковываются, если задан pack_age.
+
+        Арендаторы, превысившие квоту, очищаются раньше остальных
+        критериев, поэтому место освобождается в первую очередь
+        за их счет.
+
         Блокирует корзину.
 
         """
@@ -175,10 +357,20 @@ class Autocleaner(object):
         delta_count = self.trash.get_count()
         delta_size = self.trash.get_size()
 
+        self.autoclean_by_ttl()
+        if self.trash.quotas:
+            self.autoclean_by_quotas()
+        self.autoclean_by_rules()
         self.autoclean_by_date()
         self.autoclean_by_same_count()
         self.autoclean_by_files_count()
+        if self.trash.compression is not None:
+            self.autocompress()
         self.autoclean_by_trash_size()
+        if self.trash.capacity_directory is not None:
+            self.automigrate()
+        if self.trash.pack_age is not None:
+            self.autopack()
 
         delta_count -= self.trash.get_count()
         delta_size -= self.trash.get_size()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит функции для сжатия файлов корзины.
+
+Сжатый файл начинается с заголовка "{MAGIC}{кодек}\\n", за которым
+следуют сжатые данные. Сжатие и распаковка идут блоками по CHUNK_SIZE,
+поэтому расход памяти не зависит от размера файла.
+
+Кодеки zlib и bz2 доступны всегда, lzma и zstd -- если установлены
+соответствующие модули.
+
+Список экспортируемых функций:
+    * get_codec -- возвращает кодек сжатого файла
+    * compress_file -- сжимает файл на месте
+    * decompress_file -- распаковывает файл по заданному пути
+
+"""
+
+
+import os
+import bz2
+import zlib
+import shutil
+import logging
+
+
+MAGIC = "\x00myrm-compressed:"
+CHUNK_SIZE = 64*1024
+DEFAULT_CODEC = "zlib"
+ZLIB_LEVEL = 6
+
+# Кодек -- пара фабрик (компрессор, декомпрессор)
+CODECS = {
+    "zlib": (lambda: zlib.compressobj(ZLIB_LEVEL), zlib.decompressobj),
+    "bz2": (bz2.BZ2Compressor, bz2.BZ2Decompressor),
+}
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+if lzma is not None:
+    CODECS["lzma"] = (lzma.LZMACompressor, lzma.LZMADecompressor)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+if zstandard is not None:
+    CODECS["zstd"] = (lambda: zstandard.ZstdCompressor().compressobj(),
+                      lambda: zstandard.ZstdDecompressor().decompressobj())
+
+_MAX_HEADER = len(MAGIC) + max(len(name) for name in CODECS) + 1
+
+
+def get_codec(path):
+    """Возвращает имя кодека сжатого файла или None.
+
+    Позицонные аргументы:
+    path -- путь к файлу
+
+    Читается только заголовок файла.
+
+    """
+    if os.path.islink(path) or not os.path.isfile(path):
+        return None
+    with open(path, "rb") as input_file:
+        header = input_file.read(_MAX_HEADER)
+    if not header.startswith(MAGIC):
+        return None
+    codec, sep, _ = header[len(MAGIC):].partition("\n")
+    if not sep or codec not in CODECS:
+        return None
+    return codec
+
+
+def compress_file(path, codec=DEFAULT_CODEC, chunk_size=CHUNK_SIZE,
+                  limiter=None):
+    """Сжимает файл на месте. Возвращает сэкономленное место.
+
+    Позицонные аргументы:
+    path -- путь к файлу
+
+    Непозиционные аргументы:
+    codec -- имя кодека (см. CODECS)
+    chunk_size -- размер блока
+    limiter -- ограничение скорости чтения (см. throttle.Throttle)
+
+    Сжатые данные пишутся во временный файл рядом, который затем
+    заменяет исходный. Если сжатие не уменьшает файл, файл
+    остается без изменений и возвращается 0.
+
+    """
+    compressor = CODECS[codec][0]()
+    temp_path = path + ".compress"
+    with open(path, "rb") as input_file:
+        with open(temp_path, "wb") as output_file:
+            output_file.write(MAGIC + codec + "\n")
+            chunk = input_file.read(chunk_size)
+            while chunk:
+                if limiter is not None:
+                    limiter.transfer(len(chunk))
+                output_file.write(compressor.compress(chunk))
+                chunk = input_file.read(chunk_size)
+            output_file.write(compressor.flush())
+
+    old_size = os.lstat(path).st_size
+    new_size = os.lstat(temp_path).st_size
+    if new_size >= old_size:
+        os.remove(temp_path)
+        return 0
+
+    debug_fmt = "Compress {path} with {codec}: {old_size} -> {new_size}"
+    debug_msg = debug_fmt.format(path=path, codec=codec,
+                                 old_size=old_size, new_size=new_size)
+    logging.debug(debug_msg)
+
+    shutil.copystat(path, temp_path)
+    os.rename(temp_path, path)
+    return old_size - new_size
+
+
+def decompress_file(path, new_path, codec=None, chunk_size=CHUNK_SIZE):
+    """Распаковывает сжатый файл по заданному пути.
+
+    Позицонные аргументы:
+    path -- путь к сжатому файлу
+    new_path -- путь распакованного файла
+
+    Непозиционные аргументы:
+    codec -- имя кодека, которым сжат файл
+             По умолчанию: None (прочитать из заголовка)
+    chunk_size -- размер блока
+
+    Исходный файл не удаляется. Права и время изменения
+    переносятся на распакованный файл.
+
+    """
+    if codec is None:
+        codec = get_codec(path)
+    decompressor = CODECS[codec][1]()
+    with open(path, "rb") as input_file:
+        input_file.seek(len(MAGIC) + len(codec) + 1)
+        with open(new_path, "wb") as output_file:
+            chunk = input_file.read(chunk_size)
+            while chunk:
+                output_file.write(decompressor.decompress(chunk))
+                chunk = input_file.read(chunk_size)
+            if hasattr(decompressor, "flush"):
+                output_file.write(decompressor.flush())
+    shutil.copystat(path, new_path)
@@ -12,6 +12,10 @@
 import json
 
 
+# Ключи, значения которых загружаются из CFG файла как списки
+LIST_KEYS = ("rules",)
+
+
 def save_to_json(cfg, filename):
     """Сохраняет объект конфигурации в JSON файл.
 
@@ -44,6 +48,7 @@ def _recursive_save_to_cfg(output_file, dct, prefix=""):
     prefix -- префикс для всех ключей
 
     Значение преобразуется в строку через repr. Ключ через str.
+    Элементы списка записываются через запятую (см. LIST_KEYS).
 
     """
     for key in dct:
@@ -54,11 +59,41 @@ def _recursive_save_to_cfg(output_file, dct, prefix=""):
         if isinstance(dct[key], dict):
             _recursive_save_to_cfg(output_file, dct[key], node)
         else:
+            value = dct[key]
+            if isinstance(value, (list, tuple)):
+                value = ", ".join(str(item) for item in value)
             fmt = "\n{node!s} = {value!s}\n"
-            line = fmt.format(node=node, value=dct[key])
+            line = fmt.format(node=node, value=value)
             output_file.write(line)
 
 
+def _parse_cfg_value(value_str, as_list=False):
+    """Преобразует строковое значение CFG файла.
+
+    Позицонные аргументы:
+    value_str -- значение
+
+    Непозиционные аргументы:
+    as_list -- разбить значение по запятым в список
+
+    Целые числа и логические значения (true/false) преобразуются
+    в соответствующие типы.
+
+    """
+    if as_list:
+        return [_parse_cfg_value(item.strip())
+                for item in value_str.split(",") if item.strip()]
+    try:
+        return int(value_str)
+    except ValueError:
+        if value_str.lower() == "true":
+            return True
+        elif value_str.lower() == "false":
+            return False
+        else:
+            return value_str
+
+
 def save_to_cfg(cfg, filename):
     """Сохраняет объект конфигурации в CFG подобный формат.
 
@@ -83,6 +118,9 @@ def load_from_cfg(filename):
     Ключ[.субключ[.субключ]] = Значение
     При использовании субключей создается вложенный слорварь.
     Символ # обозначает коментарии.
+    Значения ключей из LIST_KEYS загружаются как списки:
+    Ключ = Значение1, Значение2
+    Запятые в остальных значениях (например, путях) сохраняются.
 
     Позицонные аргументы:
     filename -- имя входного файла
@@ -106,15 +144,8 @@ def load_from_cfg(filename):
             node = node_value[0]
             value_str = node_value[1].strip()
             node_path = node.split(".")
-            try:
-                value = int(value_str)
-            except ValueError:
-                if value_str.lower() == "true":
-                    value = True
-                elif value_str.lower() == "false":
-                    value = False
-                else:
-                    value = value_str
+            key = node_path[-1].strip()
+            value = _parse_cfg_value(value_str, as_list=key in LIST_KEYS)
 
             point = result
             for key in node_path[0:-1]:
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит индекс содержимого для дедупликации файлов корзины.
+
+Одинаковые файлы корзины хранятся один раз: все элементы корзины
+с одинаковым содержимым являются жесткими ссылками на один файл.
+
+Список экспортируемых функций:
+    * get_file_hash -- возвращает SHA-1 содержимого файла
+
+Классы модуля:
+    * DedupIndex -- индекс содержимого файлов корзины
+
+"""
+
+
+import os
+import stat
+import shutil
+import hashlib
+import logging
+import multiprocessing
+import multiprocessing.pool
+
+
+DEFAULT_WORKERS = multiprocessing.cpu_count()
+CHUNK_SIZE = 1024*1024
+
+# Ссылка на единственный (еще не хешированный) файл данного размера
+PENDING_NAME = "pending"
+
+
+def get_file_hash(path, chunk_size=CHUNK_SIZE):
+    """Возвращает SHA-1 содержимого файла.
+
+    Позицонные аргументы:
+    path -- путь к файлу
+
+    Непозиционные аргументы:
+    chunk_size -- размер блока чтения
+
+    """
+    file_hash = hashlib.sha1()
+    with open(path, "rb") as input_file:
+        chunk = input_file.read(chunk_size)
+        while chunk:
+            file_hash.update(chunk)
+            chunk = input_file.read(chunk_size)
+    return file_hash.hexdigest()
+
+
+class DedupIndex(object):
+
+    """Индекс содержимого файлов корзины.
+
+    Индекс -- папка с подпапками по размеру файлов. Подпапка
+    "{размер}" содержит жесткие ссылки "{sha1}" на хранимое содержимое
+    или одну ссылку "pending" на единственный файл этого размера.
+
+    Файл хешируется, только если в корзине есть другой файл того же
+    размера, поэтому большинство файлов не читается вовсе. Файлы
+    хешируются параллельно.
+
+    Содержимое удаляется из индекса вместе с последним элементом
+    корзины, который на него ссылается.
+
+    Методы класса:
+    * add -- дедуплицирует добавленные в корзину файлы
+    * release -- удаляет файл корзины
+    * extract -- перемещает файл из корзины
+
+    """
+
+    def __init__(self, directory, workers=DEFAULT_WORKERS):
+        """Создает индекс в заданной папке.
+
+        Позицонные аргументы:
+        directory -- папка индекса
+
+        Непозиционные аргументы:
+        workers -- число потоков для хеширования
+
+        """
+        self.directory = directory
+        self.workers = workers
+
+    def _get_bucket(self, size):
+        """Возвращает папку индекса для файлов заданного размера.
+        """
+        return os.path.join(self.directory, str(size))
+
+    def _hash_files(self, paths):
+        """Возвращает список хешей файлов, вычисленных параллельно.
+        """
+        if len(paths) < 2 or self.workers < 2:
+            return [get_file_hash(path) for path in paths]
+        pool = multiprocessing.pool.ThreadPool(min(self.workers, len(paths)))
+        try:
+            return pool.map(get_file_hash, paths)
+        finally:
+            pool.close()
+            pool.join()
+
+    def add(self, paths):
+        """Дедуплицирует файлы корзины. Возвращает сэкономленное место.
+
+        Позицонные аргументы:
+        paths -- пути к только что добавленным файлам корзины
+
+        Файл, содержимое которого уже есть в индексе, заменяется
+        жесткой ссылкой на это содержимое. Папки, пустые
+        и отсутствующие файлы пропускаются.
+
+        """
+        by_size = {}
+        for path in paths:
+            try:
+                file_stat = os.lstat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_size == 0:
+                continue
+            by_size.setdefault(file_stat.st_size, []).append(path)
+
+        to_hash = []
+        for size, group in by_size.iteritems():
+            bucket = self._get_bucket(size)
+            if not os.path.isdir(bucket):
+                os.makedirs(bucket)
+
+            pending = os.path.join(bucket, PENDING_NAME)
+            if os.path.exists(pending) and os.lstat(pending).st_nlink < 2:
+                # Файл удален из корзины в обход индекса
+                os.remove(pending)
+            if os.path.exists(pending):
+                to_hash.append((pending, bucket))
+            elif len(group) == 1 and not os.listdir(bucket):
+                os.link(group[0], pending)
+                continue
+            to_hash.extend((path, bucket) for path in group)
+
+        saved = 0
+        hashes = self._hash_files([path for path, _ in to_hash])
+        for (path, bucket), file_hash in zip(to_hash, hashes):
+            content = os.path.join(bucket, file_hash)
+
+            if path == os.path.join(bucket, PENDING_NAME):
+                # Других ссылок в папке нет, пока в ней есть pending
+                os.rename(path, content)
+            elif not os.path.exists(content):
+                os.link(path, content)
+            elif not os.path.samefile(path, content):
+                debug_fmt = "Replace {path} by link to {content}"
+                logging.debug(debug_fmt.format(path=path, content=content))
+
+                saved += os.lstat(path).st_size
+                temp_path = path + ".dedup"
+                os.link(content, temp_path)
+                os.rename(temp_path, path)
+
+        return saved
+
+    def _find_content(self, file_stat):
+        """Возвращает ссылку индекса на файл или None.
+        """
+        bucket = self._get_bucket(file_stat.st_size)
+        if not os.path.isdir(bucket):
+            return None
+        for name in os.listdir(bucket):
+            content = os.path.join(bucket, name)
+            content_stat = os.lstat(content)
+            if (content_stat.st_ino == file_stat.st_ino and
+                    content_stat.st_dev == file_stat.st_dev):
+                return content
+        return None
+
+    def release(self, path, file_stat=None, remove=None):
+        """Удаляет файл корзины. Возвращает освобожденное место.
+
+        Позицонные аргументы:
+        path -- путь к файлу корзины
+
+        Непозиционные аргументы:
+        file_stat -- уже полученный результат os.lstat(path)
+        remove -- функция без аргументов, удаляющая файл
+                  (по умолчанию: os.remove(path))
+
+        Если на содержимое больше не ссылается ни один элемент
+        корзины, оно удаляется из индекса. Пока ссылки остаются,
+        место не освобождается. Файлы с общим содержимым нельзя
+        удалять параллельно: число ссылок в file_stat должно
+        быть актуальным.
+
+        """
+        if file_stat is None:
+            file_stat = os.lstat(path)
+        if remove is None:
+            os.remove(path)
+        else:
+            remove()
+
+        if file_stat.st_nlink < 2 or not stat.S_ISREG(file_stat.st_mode):
+            return file_stat.st_size
+
+        content = self._find_content(file_stat)
+        if content is None:
+            return file_stat.st_size
+        if file_stat.st_nlink > 2:
+            return 0
+
+        os.remove(content)
+        bucket = os.path.dirname(content)
+        if not os.listdir(bucket):
+            os.rmdir(bucket)
+        return file_stat.st_size
+
+    def extract(self, path, new_path):
+        """Перемещает файл из корзины. Возвращает освобожденное место.
+
+        Позицонные аргументы:
+        path -- путь к файлу корзины
+        new_path -- путь назначения
+
+        Файл с общим содержимым копируется, чтобы востановленный
+        файл не разделял содержимое с элементами корзины.
+
+        """
+        file_stat = os.lstat(path)
+        if file_stat.st_nlink < 2 or not stat.S_ISREG(file_stat.st_mode):
+            os.rename(path, new_path)
+            return file_stat.st_size
+
+        shutil.copy2(path, new_path)
+        return self.release(path)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит функции для хранения версий файла в виде дельт.
+
+Дельта описывает файл через более новую версию (базу): файл
+собирается из кусков базы и вставок новых данных. Файл дельты
+начинается с заголовка "{MAGIC}{секунды}.{микросекунды}\\n", где
+указан штамп времени базы, за которым следуют операции:
+    * "C" {смещение} {длина} -- копировать кусок базы
+    * "I" {длина} {данные} -- вставить данные
+
+Совпадения ищутся по блокам базы. Оба файла отображаются в память
+(mmap), поэтому размер файла не ограничен памятью.
+
+Список экспортируемых функций:
+    * get_base_stamp -- возвращает штамп базы файла дельты
+    * make_delta -- строит дельту файла относительно базы
+    * apply_delta -- собирает файл из базы и дельты
+
+"""
+
+
+import os
+import mmap
+import zlib
+import struct
+
+
+MAGIC = "\x00myrm-delta:"
+CHUNK_SIZE = 64*1024
+
+MIN_BLOCK_SIZE = 32
+MAX_BLOCK_SIZE = 64*1024
+# Желаемое число блоков базы в индексе
+INDEX_BLOCKS = 16*1024
+
+# Предел новых данных, после которого дельта не строится
+MAX_LITERAL = 16*1024*1024
+
+_COPY = "C"
+_INSERT = "I"
+_COPY_FORMAT = "<QQ"
+_INSERT_FORMAT = "<Q"
+_MAX_HEADER = len(MAGIC) + 64
+
+
+def get_base_stamp(path):
+    """Возвращает штамп базы (секунды, микросекунды) или None.
+
+    Позицонные аргументы:
+    path -- путь к файлу
+
+    None возвращается, если файл не является дельтой.
+
+    """
+    if os.path.islink(path) or not os.path.isfile(path):
+        return None
+    with open(path, "rb") as input_file:
+        header = input_file.read(_MAX_HEADER)
+    if not header.startswith(MAGIC):
+        return None
+    base_stamp, sep, _ = header[len(MAGIC):].partition("\n")
+    sec, dot, msec = base_stamp.partition(".")
+    if not sep or not dot:
+        return None
+    try:
+        return int(sec), int(msec)
+    except ValueError:
+        return None
+
+
+def _get_block_size(size):
+    """Возвращает размер блока для базы заданного размера.
+    """
+    return min(max(size // INDEX_BLOCKS, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def _map_file(input_file):
+    """Отображает файл в память. Пустой файл -- пустая строка.
+    """
+    if os.fstat(input_file.fileno()).st_size == 0:
+        return ""
+    return mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _match_length(target, target_pos, base, base_pos, block_size):
+    """Возвращает длину совпадения target и base с заданных позиций.
+    """
+    length = 0
+    limit = min(len(target) - target_pos, len(base) - base_pos)
+    while length < limit:
+        step = min(block_size, limit - length)
+        start = length
+        if (target[target_pos + start:target_pos + start + step] ==
+                base[base_pos + start:base_pos + start + step]):
+            length += step
+            continue
+        while (length < start + step and
+               target[target_pos + length] == base[base_pos + length]):
+            length += 1
+        break
+    return length
+
+
+def _write_insert(output_file, data):
+    """Записывает операцию вставки.
+    """
+    if data:
+        output_file.write(_INSERT + struct.pack(_INSERT_FORMAT, len(data)))
+        output_file.write(data)
+
+
+def make_delta(base_path, target_path, delta_path, base_stamp):
+    """Строит дельту target относительно base. Возвращает ее размер.
+
+    Позицонные аргументы:
+    base_path -- путь к базе (более новой версии)
+    target_path -- путь к файлу, для которого строится дельта
+    delta_path -- путь к файлу дельты
+    base_stamp -- штамп времени базы (секунды, микросекунды)
+
+    Если файлы слишком различаются (новых данных больше четверти
+    файла или больше MAX_LITERAL), дельта не строится
+    и возвращается None.
+
+    """
+    with open(base_path, "rb") as base_file:
+        with open(target_path, "rb") as target_file:
+            base = _map_file(base_file)
+            target = _map_file(target_file)
+            try:
+                return _make_delta(base, target, delta_path, base_stamp)
+            finally:
+                for mapped in (base, target):
+                    if isinstance(mapped, mmap.mmap):
+                        mapped.close()
+
+
+def _make_delta(base, target, delta_path, base_stamp):
+    """Строит дельту для отображенных в память файлов.
+    """
+    block_size = _get_block_size(len(base))
+    index = {}
+    for offset in xrange(0, len(base) - block_size + 1, block_size):
+        block_hash = zlib.crc32(base[offset:offset + block_size])
+        index.setdefault(block_hash, offset)
+
+    max_literal = min(len(target) // 4, MAX_LITERAL)
+    literal = 0
+
+    header = "{magic}{sec}.{msec}\n".format(magic=MAGIC, sec=base_stamp[0],
+                                            msec=base_stamp[1])
+    with open(delta_path, "wb") as output_file:
+        output_file.write(header)
+
+        pos = 0
+        literal_start = 0
+        while pos + block_size <= len(target):
+            block = target[pos:pos + block_size]
+            offset = index.get(zlib.crc32(block))
+            if offset is None or base[offset:offset + block_size] != block:
+                pos += 1
+                if pos - literal_start + literal > max_literal:
+                    break
+                continue
+
+            length = _match_length(target, pos, base, offset, block_size)
+            literal += pos - literal_start
+            _write_insert(output_file, target[literal_start:pos])
+            output_file.write(_COPY + struct.pack(_COPY_FORMAT,
+                                                  offset, length))
+            pos += length
+            literal_start = pos
+
+        literal += len(target) - literal_start
+        if literal > max_literal:
+            output_file.close()
+            os.remove(delta_path)
+            return None
+        _write_insert(output_file, target[literal_start:])
+
+    return os.path.getsize(delta_path)
+
+
+def apply_delta(base_path, delta_path, new_path, chunk_size=CHUNK_SIZE):
+    """Собирает файл из базы и дельты.
+
+    Позицонные аргументы:
+    base_path -- путь к базе
+    delta_path -- путь к файлу дельты
+    new_path -- путь собранного файла
+
+    Непозиционные аргументы:
+    chunk_size -- размер блока копирования
+
+    Выбрасывает ValueError, если файл дельты поврежден.
+
+    """
+    copy_size = struct.calcsize(_COPY_FORMAT)
+    insert_size = struct.calcsize(_INSERT_FORMAT)
+
+    with open(base_path, "rb") as base_file, \
+            open(delta_path, "rb") as delta_file, \
+            open(new_path, "wb") as output_file:
+        delta_file.readline()
+        while True:
+            operation = delta_file.read(1)
+            if not operation:
+                break
+            if operation == _COPY:
+                offset, length = struct.unpack(_COPY_FORMAT,
+                                               delta_file.read(copy_size))
+                base_file.seek(offset)
+            elif operation == _INSERT:
+                length, = struct.unpack(_INSERT_FORMAT,
+                                        delta_file.read(insert_size))
+            else:
+                raise ValueError("Bad delta operation.")
+
+            source = base_file if operation == _COPY else delta_file
+            while length > 0:
+                chunk = source.read(min(chunk_size, length))
+                if not chunk:
+                    raise ValueError("Unexpected end of delta source.")
+                output_file.write(chunk)
+                length -= len(chunk)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит операции с путями относительно дескриптора папки.
+
+Корзина повторяет исходные пути ("~/.trash/47/home/user/..."), поэтому
+каждый lstat, rename или unlink по полному пути заставляет ядро заново
+разбирать длинный путь. Функции модуля работают с именем внутри
+открытой папки (openat, unlinkat, renameat), как os.fwalk и аргумент
+dir_fd в Python 3. В Python 2 эти вызовы берутся из libc через ctypes,
+а lstat и listdir выполняются через "/proc/self/fd".
+
+Если платформа их не поддерживает, SUPPORTED ложно, и вызывающий
+код должен работать с полными путями.
+
+Список экспортируемых функций:
+    * open_dir -- открывает папку относительно дескриптора
+    * listdir -- содержимое открытой папки
+    * lstat -- lstat имени в открытой папке
+    * unlink -- удаляет файл в открытой папке
+    * rmdir -- удаляет пустую папку в открытой папке
+    * rename -- переименовывает файл между открытыми папками
+    * fwalk -- обходит дерево с дескрипторами папок
+    * walk -- обходит дерево как os.walk
+    * walk_stats -- обходит дерево, возвращая lstat файлов
+
+"""
+
+
+import os
+import sys
+import stat
+import errno
+import ctypes
+import ctypes.util
+
+
+AT_FDCWD = -100
+AT_REMOVEDIR = 0x200
+_FD_DIRECTORY = "/proc/self/fd"
+_OPEN_FLAGS = (os.O_RDONLY | getattr(os, "O_DIRECTORY", 0) |
+               getattr(os, "O_NOFOLLOW", 0))
+
+
+def _load_libc():
+    """Возвращает libc с нужными функциями или None.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        for name in ("openat", "unlinkat", "renameat"):
+            getattr(libc, name)
+    except (OSError, AttributeError, TypeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+SUPPORTED = (_libc is not None and hasattr(os, "O_DIRECTORY") and
+             os.path.isdir(_FD_DIRECTORY))
+
+
+def _check(result, name):
+    """Выбрасывает OSError, если системный вызов вернул ошибку.
+    """
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error), name)
+    return result
+
+
+def _encode(name):
+    """Возвращает имя в кодировке файловой системы для libc.
+    """
+    if isinstance(name, unicode):
+        return name.encode(sys.getfilesystemencoding())
+    return name
+
+
+def _fd_path(dir_fd, name=None):
+    """Возвращает путь к открытой папке (или имени в ней) через /proc.
+    """
+    path = "{directory}/{fd}".format(directory=_FD_DIRECTORY, fd=dir_fd)
+    if name is None:
+        return path
+    return path + "/" + name
+
+
+def open_dir(name, dir_fd=AT_FDCWD):
+    """Открывает папку. Возвращает дескриптор.
+
+    Позицонные аргументы:
+    name -- путь к папке (относительно dir_fd)
+
+    Непозиционные аргументы:
+    dir_fd -- дескриптор папки (по умолчанию: текущая папка)
+
+    Ссылки не разыменовываются. Дескриптор закрывается os.close.
+
+    """
+    return _check(_libc.openat(dir_fd, _encode(name), _OPEN_FLAGS), name)
+
+
+def listdir(dir_fd):
+    """Возвращает список имен в открытой папке.
+    """
+    return os.listdir(_fd_path(dir_fd))
+
+
+def lstat(name, dir_fd):
+    """Возвращает lstat имени в открытой папке.
+    """
+    return os.lstat(_fd_path(dir_fd, name))
+
+
+def unlink(name, dir_fd):
+    """Удаляет файл в открытой папке.
+    """
+    _check(_libc.unlinkat(dir_fd, _encode(name), 0), name)
+
+
+def rmdir(name, dir_fd):
+    """Удаляет пустую папку в открытой папке.
+    """
+    _check(_libc.unlinkat(dir_fd, _encode(name), AT_REMOVEDIR), name)
+
+
+def rename(name, dir_fd, new_name, new_dir_fd):
+    """Переименовывает name из dir_fd в new_name в new_dir_fd.
+    """
+    _check(_libc.renameat(dir_fd, _encode(name), new_dir_fd,
+                          _encode(new_name)), name)
+
+
+def fwalk(top, topdown=True):
+    """Обходит дерево, возвращая дескрипторы папок.
+
+    Позицонные аргументы:
+    top -- путь к корню обхода
+
+    Непозиционные аргументы:
+    topdown -- возвращать папку раньше вложенных в нее
+
+    Возвращает кортежи (путь, папки, файлы, дескриптор).
+    В отличие от os.fwalk, файлы -- список пар (имя, lstat), так как
+    lstat все равно нужен, чтобы отличить папку от файла. Ссылки
+    на папки считаются файлами. Дескриптор действителен только до
+    следующего шага обхода. Исчезнувшие во время обхода элементы
+    пропускаются.
+
+    """
+    dir_fd = open_dir(top)
+    try:
+        for result in _fwalk(top, dir_fd, topdown):
+            yield result
+    finally:
+        os.close(dir_fd)
+
+
+def _fwalk(top, dir_fd, topdown):
+    """Обходит дерево с уже открытым корнем.
+    """
+    dirnames = []
+    files = []
+    for name in listdir(dir_fd):
+        try:
+            file_stat = lstat(name, dir_fd)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            continue
+        if stat.S_ISDIR(file_stat.st_mode):
+            dirnames.append(name)
+        else:
+            files.append((name, file_stat))
+
+    if topdown:
+        yield top, dirnames, files, dir_fd
+
+    for name in dirnames:
+        try:
+            sub_fd = open_dir(name, dir_fd)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            continue
+        try:
+            for result in _fwalk(os.path.join(top, name), sub_fd, topdown):
+                yield result
+        finally:
+            os.close(sub_fd)
+
+    if not topdown:
+        yield top, dirnames, files, dir_fd
+
+
+def walk_stats(top, topdown=True):
+    """Обходит дерево, возвращая lstat файлов.
+
+    Позицонные аргументы:
+    top -- путь к корню обхода
+
+    Непозиционные аргументы:
+    topdown -- возвращать папку раньше вложенных в нее
+
+    Возвращает кортежи (путь, папки, файлы) как fwalk, но без
+    дескриптора. Без поддержки платформы использует os.walk и lstat
+    по полному пути. Изменение списка папок при topdown
+    ограничивает обход, как в os.walk.
+
+    """
+    if SUPPORTED and os.path.isdir(top) and not os.path.islink(top):
+        for dirpath, dirnames, files, _ in fwalk(top, topdown=topdown):
+            yield dirpath, dirnames, files
+        return
+
+    for dirpath, dirnames, filenames in os.walk(top, topdown=topdown):
+        links = [name for name in dirnames
+                 if os.path.islink(os.path.join(dirpath, name))]
+        if links:
+            dirnames[:] = [name for name in dirnames if name not in links]
+        files = []
+        for name in filenames + links:
+            try:
+                files.append((name, os.lstat(os.path.join(dirpath, name))))
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+        yield dirpath, dirnames, files
+
+
+def walk(top, topdown=True):
+    """Обходит дерево как os.walk, но ссылки на папки считает файлами.
+
+    Позицонные аргументы:
+    top -- путь к корню обхода
+
+    Непозиционные аргументы:
+    topdown -- возвращать папку раньше вложенных в нее
+
+    Возвращает кортежи (путь, папки, файлы).
+
+    """
+    for dirpath, dirnames, files in walk_stats(top, topdown=topdown):
+        yield dirpath, dirnames, [name for name, _ in files]
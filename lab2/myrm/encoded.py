@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит индекс закодированных файлов корзины.
+
+Сжатый файл и дельта начинаются с заголовков (см. myrm.compress
+и myrm.delta), но такое же начало может оказаться и у обычного
+удаленного файла. Поэтому корзина записывает каждый сжатый ею файл
+и каждую дельту в индекс (SQLite) и распаковывает или собирает при
+востановлении только записанные файлы. Кодек и штамп базы дельты
+берутся из индекса, а не из содержимого файла.
+
+Файл записывается по внешнему пути и штампу времени удаления,
+поэтому запись не меняется при переносе файла между разделами
+и уровнями корзины.
+
+Классы модуля:
+    * EncodedIndex -- индекс закодированных файлов корзины
+
+"""
+
+
+import sqlite3
+
+
+INDEX_FILE = "encoded.db"
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS encoded ("
+    " path TEXT NOT NULL,"
+    " sec INTEGER NOT NULL,"
+    " msec INTEGER NOT NULL,"
+    " codec TEXT,"
+    " base_sec INTEGER,"
+    " base_msec INTEGER,"
+    " PRIMARY KEY (path, sec, msec))",
+)
+
+
+class EncodedIndex(object):
+
+    """Индекс закодированных файлов корзины.
+
+    Изменения сохраняются сразу: процессы, востанавливающие папки
+    параллельно, удаляют записи из одного индекса.
+
+    Методы класса:
+    * commit -- сохраняет изменения
+    * close -- закрывает индекс
+
+    * set_compressed -- записывает сжатый файл
+    * set_delta -- записывает дельту
+    * get -- возвращает кодек или базу записанного файла
+    * remove -- удаляет запись файла
+
+    """
+
+    def __init__(self, filename):
+        """Открывает индекс, при необходимости создавая его.
+
+        Позицонные аргументы:
+        filename -- файл индекса
+
+        """
+        self.filename = filename
+        self._connection = sqlite3.connect(filename, timeout=60)
+        # Пути хранятся как есть, без преобразования в unicode
+        self._connection.text_factory = str
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        for statement in _SCHEMA:
+            self._connection.execute(statement)
+        self._connection.commit()
+
+    def commit(self):
+        """Сохраняет изменения индекса.
+        """
+        self._connection.commit()
+
+    def close(self):
+        """Сохраняет изменения и закрывает индекс.
+        """
+        self._connection.commit()
+        self._connection.close()
+
+    def set_compressed(self, path, sec, msec, codec):
+        """Записывает сжатый файл.
+
+        Позицонные аргументы:
+        path -- внешний путь файла
+        sec, msec -- штамп времени удаления (см. stamp.get_time_stamp)
+        codec -- имя кодека (см. compress.CODECS)
+
+        """
+        self._connection.execute("INSERT OR REPLACE INTO encoded "
+                                 "VALUES (?, ?, ?, ?, NULL, NULL)",
+                                 (path, sec, msec, codec))
+        self._connection.commit()
+
+    def set_delta(self, path, sec, msec, base_sec, base_msec):
+        """Записывает дельту.
+
+        Позицонные аргументы:
+        path -- внешний путь файла
+        sec, msec -- штамп времени удаления (см. stamp.get_time_stamp)
+        base_sec, base_msec -- штамп времени удаления базы дельты
+
+        """
+        self._connection.execute("INSERT OR REPLACE INTO encoded "
+                                 "VALUES (?, ?, ?, NULL, ?, ?)",
+                                 (path, sec, msec, base_sec, base_msec))
+        self._connection.commit()
+
+    def get(self, path, sec, msec):
+        """Возвращает пару (кодек, штамп базы) или None.
+
+        Позицонные аргументы:
+        path -- внешний путь файла
+        sec, msec -- штамп времени удаления
+
+        У сжатого файла штамп базы равен None, у дельты -- кодек.
+        None возвращается, если файл не записан.
+
+        """
+        row = self._connection.execute(
+            "SELECT codec, base_sec, base_msec FROM encoded "
+            "WHERE path = ? AND sec = ? AND msec = ?",
+            (path, sec, msec)).fetchone()
+        if row is None:
+            return None
+        codec, base_sec, base_msec = row
+        if base_sec is None:
+            return codec, None
+        return codec, (base_sec, base_msec)
+
+    def remove(self, path, sec, msec):
+        """Удаляет запись файла, если она есть.
+
+        Позицонные аргументы:
+        path -- внешний путь файла
+        sec, msec -- штамп времени удаления
+
+        """
+        self._connection.execute("DELETE FROM encoded WHERE path = ? AND "
+                                 "sec = ? AND msec = ?", (path, sec, msec))
+        self._connection.commit()
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит индекс путей корзины, хранящихся вне ее папок.
+
+Индекс (SQLite) хранит внешние пути файлов со штампами времени
+и папки, в которых они лежат, поэтому поиск и обход корзины
+не требуют чтения ее папок.
+
+Классы модуля:
+    * ObjectIndex -- индекс путей и объектов корзины
+
+"""
+
+
+import os
+import sqlite3
+
+import myrm.stamp as stamp
+
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS objects ("
+    " id TEXT PRIMARY KEY,"
+    " path TEXT NOT NULL,"
+    " parent TEXT NOT NULL,"
+    " sec INTEGER NOT NULL,"
+    " msec INTEGER NOT NULL,"
+    " size INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS objects_path ON objects (path, sec, msec)",
+    "CREATE INDEX IF NOT EXISTS objects_parent ON objects (parent)",
+    "CREATE TABLE IF NOT EXISTS dirs ("
+    " path TEXT PRIMARY KEY,"
+    " parent TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)",
+)
+
+
+def _get_subtree_range(path):
+    """Возвращает границы путей, лежащих внутри папки path.
+
+    Путь p лежит внутри папки, если low <= p < high.
+    """
+    low = path.rstrip(os.sep) + os.sep
+    high = low[:-1] + chr(ord(os.sep) + 1)
+    return low, high
+
+
+class ObjectIndex(object):
+
+    """Индекс путей и объектов корзины.
+
+    Таблица objects хранит для каждого объекта внешний путь,
+    штамп времени удаления и размер. Таблица dirs хранит внешние
+    пути папок корзины: удаленных папок и папок, содержащих объекты.
+
+    Методы класса:
+    * commit -- сохраняет изменения
+    * close -- закрывает индекс
+
+    * add_object -- добавляет объект
+    * remove_object -- удаляет объект
+    * get_object -- ищет объект по пути и штампу
+    * get_versions -- возвращает версии файла
+    * get_version_as_of -- версия, удаленная не позже штампа
+    * get_all -- возвращает все объекты
+    * get_count -- возвращает число объектов
+
+    * add_dir -- добавляет папку
+    * is_dir -- есть ли в корзине папка
+    * list_dir -- содержимое папки
+    * walk_objects -- объекты внутри папки
+    * iter_objects -- итератор объектов, упорядоченных по пути
+    * walk_dirs -- папки внутри папки
+    * remove_tree -- удаляет папку с подпапками
+    * prune -- удаляет опустевшие папки
+    * search -- ищет объекты и папки по маске
+
+    """
+
+    def __init__(self, filename):
+        """Открывает индекс, при необходимости создавая его.
+
+        Позицонные аргументы:
+        filename -- файл индекса
+
+        """
+        self.filename = filename
+        self._connection = sqlite3.connect(filename)
+        # Пути хранятся как есть, без преобразования в unicode
+        self._connection.text_factory = str
+        for statement in _SCHEMA:
+            self._connection.execute(statement)
+        self._connection.commit()
+
+    def _execute(self, sql, args=()):
+        """Выполняет запрос. Возвращает курсор.
+        """
+        return self._connection.execute(sql, args)
+
+    def commit(self):
+        """Сохраняет изменения индекса.
+        """
+        self._connection.commit()
+
+    def close(self):
+        """Сохраняет изменения и закрывает индекс.
+        """
+        self._connection.commit()
+        self._connection.close()
+
+    def add_object(self, object_id, path, sec, msec, size):
+        """Добавляет объект и все папки на пути к нему.
+
+        Позицонные аргументы:
+        object_id -- идентификатор объекта
+        path -- внешний путь файла
+        sec, msec -- штамп времени удаления (см. stamp.get_time_stamp)
+        size -- размер файла
+
+        """
+        parent = os.path.dirname(path)
+        self._execute("INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?)",
+                      (object_id, path, parent, sec, msec, size))
+        self.add_dir(parent)
+
+    def remove_object(self, object_id):
+        """Удаляет объект из индекса.
+        """
+        self._execute("DELETE FROM objects WHERE id = ?", (object_id,))
+
+    def get_object(self, path, sec, msec):
+        """Возвращает (идентификатор, размер) объекта или None.
+
+        Позицонные аргументы:
+        path -- внешний путь файла
+        sec, msec -- штамп времени удаления
+
+        """
+        cursor = self._execute("SELECT id, size FROM objects "
+                               "WHERE path = ? AND sec = ? AND msec = ?",
+                               (path, sec, msec))
+        return cursor.fetchone()
+
+    def get_object_by_id(self, object_id):
+        """Возвращает (путь, секунды, микросекунды) объекта или None.
+        """
+        cursor = self._execute("SELECT path, sec, msec FROM objects "
+                               "WHERE id = ?", (object_id,))
+        return cursor.fetchone()
+
+    def get_versions(self, path):
+        """Возвращает версии файла от новой к старой.
+
+        Версия -- кортеж (секунды, микросекунды, идентификатор, размер).
+        """
+        cursor = self._execute("SELECT sec, msec, id, size FROM objects "
+                               "WHERE path = ? "
+                               "ORDER BY sec DESC, msec DESC", (path,))
+        return cursor.fetchall()
+
+    def get_version_as_of(self, path, sec, msec):
+        """Возвращает самую новую версию, удаленную не позже штампа.
+
+        Версия -- кортеж (секунды, микросекунды, идентификатор, размер)
+        или None. Поиск идет по индексу (path, sec, msec).
+
+        """
+        cursor = self._execute("SELECT sec, msec, id, size FROM objects "
+                               "WHERE path = ? AND "
+                               "(sec < ? OR (sec = ? AND msec <= ?)) "
+                               "ORDER BY sec DESC, msec DESC LIMIT 1",
+                               (path, sec, sec, msec))
+        return cursor.fetchone()
+
+    def get_all(self):
+        """Возвращает все объекты, упорядоченные по времени удаления.
+
+        Элемент -- кортеж (путь, секунды, микросекунды).
+        """
+        cursor = self._execute("SELECT path, sec, msec FROM objects "
+                               "ORDER BY sec, msec")
+        return cursor.fetchall()
+
+    def get_count(self):
+        """Возвращает число объектов в индексе.
+        """
+        return self._execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+    def add_dir(self, path):
+        """Добавляет папку и все папки на пути к ней.
+
+        Позицонные аргументы:
+        path -- внешний путь папки
+
+        Подъем к корню прекращается на первой уже известной папке.
+
+        """
+        parent, name = os.path.split(path)
+        while name:
+            cursor = self._execute("INSERT OR IGNORE INTO dirs VALUES (?, ?)",
+                                   (path, parent))
+            if cursor.rowcount == 0:
+                break
+            path = parent
+            parent, name = os.path.split(path)
+
+    def is_dir(self, path):
+        """Возвращает, есть ли в корзине папка с данным внешним путем.
+        """
+        cursor = self._execute("SELECT 1 FROM dirs WHERE path = ?", (path,))
+        return cursor.fetchone() is not None
+
+    def list_dir(self, path):
+        """Возвращает содержимое папки.
+
+        Возвращает список объектов (путь, секунды, микросекунды)
+        и список путей вложенных папок.
+
+        """
+        objects = self._execute("SELECT path, sec, msec FROM objects "
+                                "WHERE parent = ?", (path,)).fetchall()
+        dirs = self._execute("SELECT path FROM dirs WHERE parent = ?",
+                             (path,)).fetchall()
+        return objects, [dir_path for dir_path, in dirs]
+
+    def walk_objects(self, path, as_of=None):
+        """Возвращает все объекты внутри папки.
+
+        Элемент -- кортеж (путь, секунды, микросекунды, идентификатор,
+        размер). Объекты упорядочены по пути, версии одного файла --
+        от новой к старой.
+
+        Непозиционные аргументы:
+        as_of -- штамп (секунды, микросекунды): вернуть только версии,
+                 удаленные не позже него
+
+        """
+        low, high = _get_subtree_range(path)
+        if as_of is None:
+            cursor = self._execute("SELECT path, sec, msec, id, size "
+                                   "FROM objects "
+                                   "WHERE path >= ? AND path < ? "
+                                   "ORDER BY path, sec DESC, msec DESC",
+                                   (low, high))
+            return cursor.fetchall()
+        sec, msec = as_of
+        cursor = self._execute("SELECT path, sec, msec, id, size "
+                               "FROM objects "
+                               "WHERE path >= ? AND path < ? AND "
+                               "(sec < ? OR (sec = ? AND msec <= ?)) "
+                               "ORDER BY path, sec DESC, msec DESC",
+                               (low, high, sec, sec, msec))
+        return cursor.fetchall()
+
+    def iter_objects(self, path=None):
+        """Возвращает итератор объектов, упорядоченных по пути.
+
+        Элемент -- кортеж (путь, секунды, микросекунды, размер).
+        Строки читаются по мере обхода, а не загружаются целиком.
+
+        Непозиционные аргументы:
+        path -- внешний путь папки (по умолчанию: все объекты)
+
+        """
+        if path is None:
+            return self._execute("SELECT path, sec, msec, size FROM objects "
+                                 "ORDER BY path, sec DESC, msec DESC")
+        low, high = _get_subtree_range(path)
+        return self._execute("SELECT path, sec, msec, size "
+                             "FROM objects WHERE path >= ? AND path < ? "
+                             "ORDER BY path, sec DESC, msec DESC",
+                             (low, high))
+
+    def walk_dirs(self, path):
+        """Возвращает пути папки и всех ее подпапок в корзине.
+
+        Родительская папка идет раньше вложенных.
+        """
+        low, high = _get_subtree_range(path)
+        cursor = self._execute("SELECT path FROM dirs "
+                               "WHERE path = ? OR (path >= ? AND path < ?) "
+                               "ORDER BY path", (path, low, high))
+        return [dir_path for dir_path, in cursor.fetchall()]
+
+    def _is_empty(self, path):
+        """Возвращает, нет ли в папке объектов и подпапок.
+        """
+        for table in ("objects", "dirs"):
+            sql = "SELECT 1 FROM {table} WHERE parent = ? LIMIT 1"
+            if self._execute(sql.format(table=table), (path,)).fetchone():
+                return False
+        return True
+
+    def remove_tree(self, path):
+        """Удаляет папку и все ее подпапки.
+
+        Объекты внутри папки должны быть удалены заранее.
+        """
+        low, high = _get_subtree_range(path)
+        self._execute("DELETE FROM dirs "
+                      "WHERE path = ? OR (path >= ? AND path < ?)",
+                      (path, low, high))
+
+    def prune(self, path, recursive=False):
+        """Удаляет опустевшие папки, поднимаясь от path к корню.
+
+        Позицонные аргументы:
+        path -- внешний путь папки
+
+        Непозиционные аргументы:
+        recursive -- предварительно удалить опустевшие подпапки
+
+        """
+        if recursive:
+            for dir_path in reversed(self.walk_dirs(path)):
+                if self._is_empty(dir_path):
+                    self._execute("DELETE FROM dirs WHERE path = ?",
+                                  (dir_path,))
+
+        parent, name = os.path.split(path)
+        while name and self._is_empty(path):
+            self._execute("DELETE FROM dirs WHERE path = ?", (path,))
+            path = parent
+            parent, name = os.path.split(path)
+
+    def search(self, directory, mask_re, recursive=False, find_all=False):
+        """Рекурсивно ищет в индексе. Возвращает итератор путей.
+
+        Позицонные аргументы:
+        directory -- внешний путь папки поиска
+        mask_re -- регулярное выражение для имени
+
+        Непозиционные аргументы:
+        recursive -- производить ли поиск в подпапках
+        find_all -- углублять в подпапки, если они соответствуют маске
+
+        Пути файлов возвращаются со штампом времени.
+
+        """
+        objects, dirs = self.list_dir(directory)
+        for path, sec, msec in objects:
+            if mask_re.match(os.path.basename(path)):
+                yield stamp.add_stamp(path, stamp.get_datetime(sec, msec))
+        for dir_path in dirs:
+            matched = mask_re.match(os.path.basename(dir_path))
+            if matched:
+                yield dir_path
+            if recursive and (not matched or find_all):
+                for found in self.search(dir_path, mask_re,
+                                         recursive, find_all):
+                    yield found
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит очередь ожидания блокировки корзины.
+
+fcntl.flock не гарантирует порядок ожидающих процессов, поэтому поток
+коротких удалений может бесконечно откладывать долгое востановление.
+Перед блокировкой корзины процесс получает билет -- файл с номером
+по порядку в папке очереди -- и пробует заблокировать корзину, только
+когда перед ним не осталось конфликтующих билетов. Разделяемые
+блокировки конфликтуют только с монопольными, поэтому соседние
+читатели проходят вместе.
+
+Владелец держит flock на своем билете, поэтому билет умершего процесса
+определяется по отсутствию блокировки и удаляется.
+
+Классы модуля:
+    * LockQueue -- очередь билетов
+
+Список экспортируемых функций:
+    * try_flock -- пробует заблокировать файл без ожидания
+
+"""
+
+
+import os
+import errno
+import fcntl
+
+
+COUNTER_FILE = "counter"
+TICKET_FORMAT = "{number:020d}_{mode}"
+SHARED = "sh"
+EXCLUSIVE = "ex"
+POLL_INTERVAL = 0.02
+
+
+def try_flock(fd, operation):
+    """Пробует заблокировать файл без ожидания. Возвращает успех.
+
+    Позицонные аргументы:
+    fd -- дескриптор файла
+    operation -- fcntl.LOCK_SH или fcntl.LOCK_EX
+
+    """
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+    except IOError as error:
+        if error.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+    return True
+
+
+def _remove_missing_ok(path):
+    """Удаляет файл, если он еще существует.
+    """
+    try:
+        os.remove(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+
+class LockQueue(object):
+
+    """Очередь ожидания блокировки корзины.
+
+    Поля класса:
+    * directory -- папка очереди
+
+    Методы класса:
+    * enter -- встает в очередь, возвращает билет
+    * is_turn -- подошла ли очередь билета
+    * leave -- выходит из очереди
+    * has_waiters -- есть ли в очереди живые билеты
+
+    """
+
+    def __init__(self, directory):
+        """Создает очередь в указанной папке.
+        """
+        self.directory = directory
+
+    def enter(self, shared=False):
+        """Встает в очередь. Возвращает билет (путь, дескриптор).
+
+        Непозиционные аргументы:
+        shared -- билет разделяемой блокировки
+
+        Номер берется из счетчика под его блокировкой. Билет
+        создается под временным именем и получает постоянное имя
+        уже заблокированным, чтобы его не приняли за билет
+        умершего процесса.
+
+        """
+        try:
+            os.makedirs(self.directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+        counter_path = os.path.join(self.directory, COUNTER_FILE)
+        counter_fd = os.open(counter_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(counter_fd, fcntl.LOCK_EX)
+            data = os.read(counter_fd, 32).strip()
+            number = int(data) if data else 0
+
+            name = TICKET_FORMAT.format(number=number,
+                                        mode=SHARED if shared else EXCLUSIVE)
+            path = os.path.join(self.directory, name)
+            temp_path = os.path.join(self.directory, "." + name)
+            ticket_fd = os.open(temp_path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(ticket_fd, fcntl.LOCK_EX)
+            os.rename(temp_path, path)
+
+            os.lseek(counter_fd, 0, os.SEEK_SET)
+            os.ftruncate(counter_fd, 0)
+            os.write(counter_fd, str(number + 1))
+        finally:
+            os.close(counter_fd)
+        return path, ticket_fd
+
+    def is_turn(self, ticket):
+        """Возвращает, подошла ли очередь билета.
+
+        Позицонные аргументы:
+        ticket -- билет, полученный от enter
+
+        Очередь подошла, если перед билетом нет живых билетов
+        монопольной блокировки, а для монопольного билета -- никаких.
+        Билеты умерших процессов удаляются.
+
+        """
+        name = os.path.basename(ticket[0])
+        shared = name.endswith(SHARED)
+        for other in sorted(os.listdir(self.directory)):
+            if other >= name:
+                break
+            if other == COUNTER_FILE or other.startswith("."):
+                continue
+            if shared and other.endswith(SHARED):
+                continue
+            if self._is_alive(other):
+                return False
+        return True
+
+    def leave(self, ticket):
+        """Выходит из очереди, удаляя билет.
+        """
+        path, ticket_fd = ticket
+        try:
+            _remove_missing_ok(path)
+        finally:
+            os.close(ticket_fd)
+
+    def has_waiters(self):
+        """Возвращает, есть ли в очереди живые билеты.
+
+        Билеты умерших процессов удаляются.
+
+        """
+        try:
+            names = os.listdir(self.directory)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return False
+        for name in names:
+            if name == COUNTER_FILE or name.startswith("."):
+                continue
+            if self._is_alive(name):
+                return True
+        return False
+
+    def _is_alive(self, name):
+        """Возвращает, жив ли владелец билета. Удаляет мертвый билет.
+        """
+        path = os.path.join(self.directory, name)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            return False
+        try:
+            if not try_flock(fd, fcntl.LOCK_SH):
+                return True
+            _remove_missing_ok(path)
+            return False
+        finally:
+            os.close(fd)
@@ -0,0 +1,697 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит корзину с хранением объектов в шардированных папках.
+
+Каждый удаленный файл хранится как объект ".objects/ab/cd/{id}",
+где ab и cd -- первые символы идентификатора. Соответствие внешних
+путей и объектов хранится в индексе (SQLite) в служебной папке.
+
+Классы модуля:
+    * ObjectTrash -- корзина с шардированным хранилищем объектов
+
+"""
+
+
+import os
+import re
+import errno
+import fnmatch
+import hashlib
+import logging
+import datetime
+import itertools
+import collections
+
+import myrm.utils as utils
+import myrm.stamp as stamp
+import myrm.trash as trash
+import myrm.stats as statistics
+
+from myrm.trash import Trash
+from myrm.index import ObjectIndex
+
+
+OBJECTS_DIRECTORY = ".objects"
+INDEX_FILE = "objects.db"
+
+# Шард -- SHARD_DEPTH вложенных папок по SHARD_WIDTH символов
+SHARD_WIDTH = 2
+SHARD_DEPTH = 2
+
+
+class ObjectTrash(Trash):
+
+    """Корзина с шардированным хранилищем объектов.
+
+    В отличие от Trash исходные пути не повторяются внутри корзины.
+    Каждый файл перемещается в объект ".objects/ab/cd/{id}", а его
+    внешний путь и штамп времени записываются в индекс. Поэтому папки
+    корзины остаются небольшими, а добавление файла -- это одно
+    переименование в уже созданный шард.
+
+    Идентификатор объекта -- SHA-1 от внешнего пути со штампом,
+    содержимое файла при добавлении не читается.
+
+    Временные разделы (partition), пакеты (pack_age), емкий
+    уровень (capacity_directory), блокировка поддеревьев (lock_depth),
+    квоты (quotas) и свертка по папкам (rollup) не поддерживаются:
+    размер папки (get_tree_usage) считается запросом к индексу.
+
+    В сессии (см. Trash.session) изменения индекса сохраняются
+    пачками при flush, а не после каждой операции.
+
+    Методы класса (дополнительно к Trash):
+    * get_index -- возвращает индекс путей и объектов
+    * get_object_path -- возвращает путь к объекту
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Создает корзину. Аргументы совпадают с Trash.
+        """
+        self._index = None
+        self._shards = set()
+        super(ObjectTrash, self).__init__(*args, **kwargs)
+
+    def configurate(self,
+                    directory=trash.DEFAULT_DIRECTORY,
+                    lock_file=trash.DEFAULT_LOCK_FILE,
+                    max_size=trash.DEFAULT_MAX_SIZE,
+                    max_count=trash.DEFAULT_MAX_COUNT,
+                    dryrun=trash.DEFAULT_DRYRUN,
+                    max_versions=trash.DEFAULT_MAX_VERSIONS,
+                    partition=trash.DEFAULT_PARTITION,
+                    dedup=trash.DEFAULT_DEDUP,
+                    compression=trash.DEFAULT_COMPRESSION,
+                    compress_min_size=trash.DEFAULT_COMPRESS_MIN_SIZE,
+                    compress_age=trash.DEFAULT_COMPRESS_AGE,
+                    delta=trash.DEFAULT_DELTA,
+                    pack_age=trash.DEFAULT_PACK_AGE,
+                    capacity_directory=trash.DEFAULT_CAPACITY_DIRECTORY,
+                    capacity_max_size=trash.DEFAULT_CAPACITY_MAX_SIZE,
+                    migrate_age=trash.DEFAULT_MIGRATE_AGE,
+                    migrate_size=trash.DEFAULT_MIGRATE_SIZE,
+                    unlink_rate=trash.DEFAULT_UNLINK_RATE,
+                    io_rate=trash.DEFAULT_IO_RATE,
+                    purge_nice=trash.DEFAULT_PURGE_NICE,
+                    purge_ionice=trash.DEFAULT_PURGE_IONICE,
+                    truncate_size=trash.DEFAULT_TRUNCATE_SIZE,
+                    truncate_step=trash.DEFAULT_TRUNCATE_STEP,
+                    truncate_rate=trash.DEFAULT_TRUNCATE_RATE,
+                    lock_timeout=trash.DEFAULT_LOCK_TIMEOUT,
+                    lock_depth=trash.DEFAULT_LOCK_DEPTH,
+                    quotas=trash.DEFAULT_QUOTAS,
+                    rollup=trash.DEFAULT_ROLLUP
+                   ):
+        """Обновляет поля корзины. Аргументы совпадают с Trash.
+
+        Выбрасывает ValueError, если задан partition, pack_age,
+        capacity_directory, lock_depth, quotas или rollup.
+
+        """
+        if partition is not None:
+            raise ValueError("Partition is unsoported by object layout")
+        if pack_age is not None:
+            raise ValueError("Packing is unsoported by object layout")
+        if capacity_directory is not None:
+            raise ValueError("Tiers are unsoported by object layout")
+        if lock_depth is not None:
+            raise ValueError("Subtree locks are unsoported by object layout")
+        if quotas:
+            raise ValueError("Quotas are unsoported by object layout")
+        if rollup:
+            raise ValueError("Rollup is unsoported by object layout")
+        super(ObjectTrash, self).configurate(directory, lock_file, max_size,
+                                             max_count, dryrun, max_versions,
+                                             partition, dedup, compression,
+                                             compress_min_size, compress_age,
+                                             delta, pack_age,
+                                             capacity_directory,
+                                             capacity_max_size, migrate_age,
+                                             migrate_size, unlink_rate,
+                                             io_rate, purge_nice,
+                                             purge_ionice, truncate_size,
+                                             truncate_step, truncate_rate,
+                                             lock_timeout, lock_depth,
+                                             quotas, rollup)
+
+    def get_index(self):
+        """Возвращает индекс путей и объектов корзины.
+
+        Индекс открывается при первом обращении и закрывается
+        при снятии блокировки.
+
+        """
+        filename = self.get_meta_path(INDEX_FILE)
+        if self._index is not None and self._index.filename != filename:
+            self._index.close()
+            self._index = None
+        if self._index is None:
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            self._index = ObjectIndex(filename)
+        return self._index
+
+    def set_lock(self, shared=False, subtree=None):
+        """Производит блокировку корзины. См. Trash.set_lock.
+        """
+        super(ObjectTrash, self).set_lock(shared, subtree)
+        self._shards = set()
+
+    def unset_lock(self):
+        """Производит разблокировку корзины. См. Trash.unset_lock.
+
+        Закрывает индекс.
+
+        """
+        super(ObjectTrash, self).unset_lock()
+        self._shards = set()
+
+    def _close_indexes(self):
+        """Закрывает индекс путей и объектов. См. Trash._close_indexes.
+
+        Созданные шарды забываются, так как после очистки корзины
+        их нужно создавать заново.
+
+        """
+        super(ObjectTrash, self)._close_indexes()
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+        self._shards = set()
+
+    def flush(self):
+        """Сохраняет накопленные изменения. См. Trash.flush.
+
+        Сохраняет изменения индекса.
+
+        """
+        super(ObjectTrash, self).flush()
+        if self._index is not None:
+            self._index.commit()
+
+    def _commit_index(self):
+        """Сохраняет изменения индекса, если они не копятся до flush.
+        """
+        if not self._batched:
+            self.get_index().commit()
+
+    def get_object_path(self, object_id):
+        """Возвращает путь к объекту с заданным идентификатором.
+        """
+        trash_dir = utils.get_absolute_path(self.directory)
+        shard = [object_id[i*SHARD_WIDTH:(i + 1)*SHARD_WIDTH]
+                 for i in xrange(SHARD_DEPTH)]
+        shard.append(object_id)
+        return os.path.join(trash_dir, OBJECTS_DIRECTORY, *shard)
+
+    def _make_object_path(self, object_id):
+        """Возвращает путь к объекту, создавая его шард.
+
+        Созданные шарды запоминаются, поэтому папка шарда
+        проверяется не более одного раза за блокировку.
+
+        """
+        object_path = self.get_object_path(object_id)
+        shard = os.path.dirname(object_path)
+        if shard not in self._shards:
+            if not os.path.isdir(shard):
+                os.makedirs(shard)
+            self._shards.add(shard)
+        return object_path
+
+    def _is_trashed_dir(self, path):
+        """Возвращает, есть ли в корзине папка с данным внешним путем.
+        """
+        return self.get_index().is_dir(path)
+
+    def _get_versions(self, path):
+        """Возвращает версии файла от новой к старой.
+
+        Список состоит из кортежей (штамп времени, путь к объекту).
+        """
+        return [(stamp.get_datetime(sec, msec), self.get_object_path(oid))
+                for sec, msec, oid, _ in self.get_index().get_versions(path)]
+
+    def _get_index_versions(self, path):
+        """Возвращает версии файла из индекса (см. ObjectIndex.get_versions).
+
+        Выбрасывает OSError, если версий нет: например, файл удалил
+        другой процесс.
+
+        """
+        versions = self.get_index().get_versions(path)
+        if not versions:
+            raise OSError(errno.ENOENT, "No such trash entry", path)
+        return versions
+
+    def _get_dir_usage(self, path):
+        """Возвращает размер и число файлов папки по индексу.
+        """
+        objects = self.get_index().walk_objects(path)
+        return sum(size for _, _, _, _, size in objects), len(objects)
+
+    def _collect_entries(self, summary, path=None):
+        """Учитывает объекты корзины в сводке по индексу.
+        """
+        statistics.add_index_objects(summary,
+                                     self.get_index().iter_objects(path))
+
+    def _get_cached_versions(self, path, cache):
+        """Возвращает версии файла от новой к старой.
+
+        Индекс отвечает на запрос без чтения папок, поэтому
+        кэш не используется.
+
+        """
+        return collections.deque(self._get_versions(path))
+
+    def _describe_entry(self, full_path):
+        """Возвращает внешний путь и штамп времени объекта.
+        """
+        found = self.get_index().get_object_by_id(os.path.basename(full_path))
+        if found is None:
+            return full_path, None
+        path, sec, msec = found
+        return path, stamp.get_datetime(sec, msec)
+
+    def get_file_time_list(self, buckets=True):
+        """Возвращает список всех файлов в корзине.
+
+        Список сотоит из кортежей (путь, время удаления)
+        и сортируется по дате удаления.
+
+        """
+        return [(path, stamp.get_datetime(sec, msec))
+                for path, sec, msec in self.get_index().get_all()]
+
+    def _get_object_id(self, path, dtime):
+        """Возвращает идентификатор объекта для файла со штампом dtime.
+        """
+        return hashlib.sha1(stamp.add_stamp(path, dtime)).hexdigest()
+
+    def _get_entry_path(self, path, dtime):
+        """Возвращает путь к объекту файла, добавленного со штампом dtime.
+        """
+        return self.get_object_path(self._get_object_id(path, dtime))
+
+    def _store(self, old_path, dtime):
+        """Перемещает файл в объект и записывает его в индекс.
+
+        Возвращает размер файла.
+        """
+        size = os.lstat(old_path).st_size
+        sec, msec = stamp.get_time_stamp(dtime)
+        object_id = self._get_object_id(old_path, dtime)
+
+        debug_fmt = "Moving file {old_path} to object {object_id}"
+        debug_msg = debug_fmt.format(old_path=old_path, object_id=object_id)
+        logging.debug(debug_msg)
+
+        if not self.dryrun:
+            os.rename(old_path, self._make_object_path(object_id))
+            self.get_index().add_object(object_id, old_path, sec, msec, size)
+        return size
+
+    def _discard(self, object_id):
+        """Удаляет объект с диска и из индекса.
+
+        Возвращает освобожденное место.
+        """
+        object_path = self.get_object_path(object_id)
+        debug_msg = "Removing object {path}".format(path=object_path)
+        logging.debug(debug_msg)
+
+        size = 0
+        if os.path.lexists(object_path):
+            size = self._unlink(object_path)
+        if not self.dryrun:
+            self.get_index().remove_object(object_id)
+        return size
+
+    def _retrieve(self, object_id, new_path):
+        """Перемещает объект по заданному пути и удаляет его из индекса.
+
+        Возвращает размер объекта в корзине.
+        """
+        object_path = self.get_object_path(object_id)
+        debug_fmt = "Moving object {old_path} to {new_path}"
+        debug_msg = debug_fmt.format(old_path=object_path, new_path=new_path)
+        logging.debug(debug_msg)
+
+        if self.dryrun:
+            return os.lstat(object_path).st_size
+
+        if os.path.lexists(new_path):
+            os.remove(new_path)
+        size = self._extract(object_path, new_path)
+        self.get_index().remove_object(object_id)
+        return size
+
+    def add_file(self, file_name, dtime=None):
+        """Перемещает файл в корзину.
+
+        Возвращает колич. удаленх фалов, их размер, список путей.
+
+        Позиционные аргументы:
+        file_name -- исходный путь к файлу
+
+        Непозиционные аргументы:
+        dtime -- штамп времени (по умолчанию: текущее время)
+
+        """
+        old_path = utils.get_absolute_path(file_name)
+        if dtime is None:
+            dtime = datetime.datetime.now()
+
+        try:
+            size = self._store(old_path, dtime)
+        finally:
+            self._commit_index()
+
+        return 1, size, [old_path]
+
+    def add_dir(self, dir_name, dtime=None):
+        """Премещает папку в корзину.
+
+        Возвращает колич. удаленх объектов, их размер, список путей.
+
+        Позиционные аргументы:
+        dir_name -- исходный путь к папке
+
+        Непозиционные аргументы:
+        dtime -- штамп времени всех файлов папки
+                 (по умолчанию: текущее время)
+
+        Папки записываются в индекс, файлы перемещаются в объекты,
+        после чего исходные папки удаляются. Изменения индекса
+        сохраняются одной транзакцией.
+
+        """
+        old_path = utils.get_absolute_path(dir_name)
+        if dtime is None:
+            dtime = datetime.datetime.now()
+
+        count = 0
+        size = 0
+        result_list = []
+        dirs = []
+
+        try:
+            for dirpath, dirnames, filenames in os.walk(old_path):
+                if os.path.ismount(dirpath):
+                    raise IOError("Can't remove mount point.")
+                dirs.append(dirpath)
+                result_list.append(dirpath)
+                if not self.dryrun:
+                    self.get_index().add_dir(dirpath)
+
+                # Ссылки на папки перемещаются как файлы
+                links = [d for d in dirnames
+                         if os.path.islink(os.path.join(dirpath, d))]
+                dirnames[:] = [d for d in dirnames if d not in links]
+
+                for element in filenames + links:
+                    element_path = os.path.join(dirpath, element)
+                    size += self._store(element_path, dtime)
+                    count += 1
+                    result_list.append(element_path)
+        finally:
+            self._commit_index()
+
+        if not self.dryrun:
+            for dirpath in reversed(dirs):
+                os.rmdir(dirpath)
+
+        return count, size, result_list
+
+    def restore_file(self, file_name, how_old=0, as_of=None):
+        """Востанавливает файл из корзины.
+
+        Возвращает колич. вост. объектов, их размер, список путей.
+
+        Позиционные аргументы:
+        file_name -- путь к файлу в корзине
+
+        Непозиционные аргументы:
+        how_old -- версия файла в порядке устарения даты удаления.
+                   По умолчанию: 0 (последняя версия)
+        as_of -- востановить самую новую версию, удаленную не позже
+                 этого момента (см. ObjectIndex.get_version_as_of)
+
+        Выбрасывает OSError, если файла нет в индексе.
+
+        """
+        new_path = utils.get_absolute_path(file_name)
+        if as_of is not None:
+            sec, msec = stamp.get_time_stamp(as_of)
+            version = self.get_index().get_version_as_of(new_path, sec, msec)
+            if version is None:
+                return 0, 0, []
+        else:
+            versions = self._get_index_versions(new_path)
+            version = versions[min(how_old, len(versions) - 1)]
+        _, _, object_id, _ = version
+
+        if not self.dryrun and not os.path.exists(os.path.dirname(new_path)):
+            debug_msg = "Make dir {directory} ".format(directory=new_path)
+            logging.debug(debug_msg)
+            os.makedirs(os.path.dirname(new_path))
+
+        size = self._retrieve(object_id, new_path)
+        if not self.dryrun:
+            self.get_index().prune(os.path.dirname(new_path))
+        self._commit_index()
+
+        return 1, size, [new_path]
+
+    def _find_stamped(self, path, dtime):
+        """Возвращает путь к объекту файла со штампом dtime или None.
+        """
+        object_id = self._get_object_id(path, dtime)
+        if self.get_index().get_object_by_id(object_id) is None:
+            return None
+        return self.get_object_path(object_id)
+
+    def _restore_entries(self, moves, dirs):
+        """Перемещает объекты по заданным путям. Возвращает их размер.
+
+        Объекты извлекаются по одному, так как индекс изменяется
+        из одного потока. Папки создаются заранее, а опустевшие
+        папки удаляются из индекса.
+
+        """
+        self._make_restored_dirs(dirs, moves)
+        size = 0
+        parents = set(dirs)
+        for object_path, new_path in moves:
+            size += self._retrieve(os.path.basename(object_path), new_path)
+            parents.add(os.path.dirname(new_path))
+        if not self.dryrun:
+            for parent in sorted(parents, reverse=True):
+                self.get_index().prune(parent)
+        self._commit_index()
+        return size
+
+    def _has_version_as_of(self, path, as_of):
+        """Возвращает, есть ли в папке файл, удаленный не позже as_of.
+
+        Объекты ищутся в индексе.
+        """
+        return bool(self.get_index().walk_objects(
+            path, as_of=stamp.get_time_stamp(as_of)))
+
+    def restore_dir(self, dir_name, how_old=0, as_of=None):
+        """Востанавливает папку из корзины.
+
+        Возвращает колич. вост. объектов, их размер, список путей.
+
+        Позиционные аргументы:
+        dir_name -- исходный путь к папке
+
+        Непозиционные аргументы:
+        how_old -- версия файлов в порядке устарения даты удаления.
+                   По умолчанию: 0 (последняя версия)
+        as_of -- момент времени: каждый файл востанавливается в самой
+                 новой версии, удаленной не позже него
+
+        Востанавливаются все папки, в том числе пустые, и выбранная
+        версия каждого файла. Остальные версии остаются в корзине.
+        Версии, удаленные позже as_of, отбрасываются запросом
+        к индексу.
+
+        """
+        new_path = utils.get_absolute_path(dir_name)
+        index = self.get_index()
+
+        count = 0
+        size = 0
+        result_list = []
+
+        for dir_path in index.walk_dirs(new_path):
+            result_list.append(dir_path)
+            if not self.dryrun and not os.path.exists(dir_path):
+                debug_msg = "Make dir {directory} ".format(directory=dir_path)
+                logging.debug(debug_msg)
+                os.makedirs(dir_path)
+
+        if as_of is not None:
+            how_old = 0
+            objects = index.walk_objects(new_path,
+                                         as_of=stamp.get_time_stamp(as_of))
+        else:
+            objects = index.walk_objects(new_path)
+        for path, versions in itertools.groupby(objects, lambda obj: obj[0]):
+            versions = list(versions)
+            object_id = versions[min(how_old, len(versions) - 1)][3]
+            count += 1
+            size += self._retrieve(object_id, path)
+            result_list.append(path)
+
+        if not self.dryrun:
+            index.prune(new_path, recursive=True)
+        self._commit_index()
+
+        return count, size, result_list
+
+    def remove(self, path, how_old=-1):
+        """Удаляет элемент из корзины навсегда.
+
+        Возвращает количестов очищенных файлов и их размер,
+        список очищенных объектов (путь, время удаления).
+
+        Позиционные аргументы:
+        path -- путь к элементу в корзине
+
+        Непозиционные аргументы:
+        how_old -- версия файла в порядке устарения даты удаления.
+                   По умолчанию: -1 (все версии)
+
+        """
+        path = utils.get_absolute_path(path)
+        index = self.get_index()
+
+        delta_count = 0
+        delta_size = 0
+        removed = []
+
+        if not index.is_dir(path):
+            if how_old >= 0:
+                versions = self._get_index_versions(path)
+                versions = [versions[min(how_old, len(versions) - 1)]]
+            else:
+                versions = index.get_versions(path)
+            objects = [(path, sec, msec, object_id, size)
+                       for sec, msec, object_id, size in versions]
+        else:
+            objects = index.walk_objects(path)
+            removed.extend((dir_path, None)
+                           for dir_path in index.walk_dirs(path))
+
+        for obj_path, sec, msec, object_id, _ in objects:
+            if how_old >= 0:
+                object_path = self.get_object_path(object_id)
+                delta_size -= self._detach_dependent(object_path)
+            delta_count += 1
+            delta_size += self._discard(object_id)
+            removed.append((obj_path, stamp.get_datetime(sec, msec)))
+
+        if not self.dryrun:
+            index.remove_tree(path)
+            index.prune(os.path.dirname(path))
+        self._commit_index()
+
+        self._account(-delta_size, -delta_count)
+
+        return delta_count, delta_size, removed
+
+    def remove_stamped(self, path, dtime):
+        """Удаляет навсегда элемент, добавленный с заданным штампом.
+
+        Возвращает количестов очищенных файлов и их размер.
+
+        Позиционные аргументы:
+        path -- внешний путь к элементу
+        dtime -- штамп времени, с которым элемент был добавлен
+
+        Для папки удаляются только файлы с заданным штампом,
+        после чего удаляются опустевшие папки.
+        Отсутствующий элемент пропускается.
+
+        """
+        index = self.get_index()
+        sec, msec = stamp.get_time_stamp(dtime)
+
+        found = index.get_object(path, sec, msec)
+        if found is not None:
+            objects = [found]
+        else:
+            objects = [(object_id, size)
+                       for _, obj_sec, obj_msec, object_id, size
+                       in index.walk_objects(path)
+                       if (obj_sec, obj_msec) == (sec, msec)]
+
+        delta_count = 0
+        delta_size = 0
+        for object_id, _ in objects:
+            object_path = self.get_object_path(object_id)
+            delta_size -= self._detach_dependent(object_path)
+            delta_count += 1
+            delta_size += self._discard(object_id)
+
+        if not self.dryrun:
+            if found is not None:
+                index.prune(os.path.dirname(path))
+            else:
+                index.prune(path, recursive=True)
+        self._commit_index()
+
+        self._account(-delta_size, -delta_count)
+
+        return delta_count, delta_size
+
+    def _trim_versions(self, added, dtime):
+        """Удаляет самые старые версии сверх max_versions.
+
+        Позиционные аргументы:
+        added -- список внешних путей только что добавленных объектов
+        dtime -- штамп времени, с которым они были добавлены
+
+        """
+        index = self.get_index()
+        for path in added:
+            versions = index.get_versions(path)
+            for _, _, object_id, _ in versions[self.max_versions:]:
+                debug_fmt = ("Removing {path} becouse there are more "
+                             "than {max_versions} versions")
+                debug_msg = debug_fmt.format(path=path,
+                                             max_versions=self.max_versions)
+                logging.debug(debug_msg)
+
+                size = self._discard(object_id)
+                self._account(-size, -1)
+        self._commit_index()
+
+    def search(self, path_mask, recursive=False, find_all=False):
+        """Поиск в корзине по маске. Возвращает словарь с версиями.
+
+        Маска задается в формате Unix filename pattern.
+        Поиск производится по индексу, без обхода папок корзины.
+
+        Позиионные аргументы:
+        path_mask -- маска
+
+        Непозиционные аргументы:
+        recursive -- производить ли поиск в подпапках.
+        find_all -- углублять в подпапки,
+                если они соответствуют маске (по-умолчанию False)
+
+        """
+        path_mask = utils.get_absolute_path(path_mask)
+        directory, mask = os.path.split(path_mask)
+        mask_re = re.compile(fnmatch.translate(mask))
+
+        files = self.get_index().search(directory, mask_re,
+                                        recursive, find_all)
+        return stamp.files_to_file_dict(files)
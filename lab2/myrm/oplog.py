@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит журнал операций удаления в корзину.
+
+Каждый вызов Remover.remove получает идентификатор операции, а каждый
+добавленный им элемент записывается в журнал одной строкой JSON:
+внешний путь, штамп времени удаления и пути файлов и папок элемента
+относительно него. По записям операции ее элементы востанавливаются
+прямо по внутренним путям (см. Trash.undo), без поиска по маске
+и чтения папок корзины.
+
+Журнал только дописывается. Когда он вырастает больше max_size,
+он переименовывается в "{имя}.1" (предыдущий такой файл теряется),
+поэтому на диске хранится не больше двух поколений записей.
+
+Список экспортируемых функций:
+    * new_operation_id -- возвращает новый идентификатор операции
+
+Классы модуля:
+    * OperationLog -- журнал операций
+
+"""
+
+
+import os
+import json
+import errno
+import fcntl
+import datetime
+
+import myrm.stamp as stamp
+
+
+DEFAULT_MAX_SIZE = 64*1024*1024
+ROTATED_SUFFIX = ".1"
+
+
+def new_operation_id():
+    """Возвращает новый идентификатор операции.
+
+    Идентификатор состоит из времени создания с микросекундами
+    и pid процесса, поэтому идентификаторы упорядочены по времени.
+
+    """
+    now = datetime.datetime.now()
+    return "{time}-{pid}".format(time=now.strftime("%Y%m%d-%H%M%S-%f"),
+                                 pid=os.getpid())
+
+
+class OperationLog(object):
+
+    """Журнал операций удаления в корзину.
+
+    Поля класса:
+    * filename -- файл журнала
+    * max_size -- размер, после которого журнал ротируется
+
+    Методы класса:
+    * append -- записывает добавленный операцией элемент
+    * mark_undone -- отмечает операцию отмененной
+    * get_records -- элементы операции
+    * get_last -- последняя не отмененная операция
+
+    """
+
+    def __init__(self, filename, max_size=DEFAULT_MAX_SIZE):
+        """Создает журнал в указанном файле.
+
+        Файл создается при первой записи.
+
+        """
+        self.filename = filename
+        self.max_size = max_size
+
+    def append(self, operation, path, dtime, files, dirs):
+        """Записывает добавленный операцией элемент.
+
+        Позицонные аргументы:
+        operation -- идентификатор операции
+        path -- внешний путь элемента
+        dtime -- штамп времени удаления
+        files -- внешние пути файлов элемента
+        dirs -- внешние пути папок элемента
+
+        """
+        sec, msec = stamp.get_time_stamp(dtime)
+        record = {
+            "op": operation,
+            "path": path,
+            "sec": sec,
+            "msec": msec,
+            "files": [os.path.relpath(f, path) for f in files],
+            "dirs": [os.path.relpath(d, path) for d in dirs],
+        }
+        self._write(record)
+
+    def mark_undone(self, operation):
+        """Отмечает операцию отмененной (см. get_last).
+        """
+        self._write({"undo": operation})
+
+    def get_records(self, operation):
+        """Возвращает элементы операции в порядке добавления.
+
+        Элемент -- кортеж (внешний путь, штамп времени удаления,
+        внешние пути файлов, внешние пути папок).
+
+        """
+        result = []
+        for record in self._read():
+            if record.get("op") != operation:
+                continue
+            path = record["path"].encode("utf-8")
+            dtime = stamp.get_datetime(record["sec"], record["msec"])
+            files = [os.path.normpath(os.path.join(path, f.encode("utf-8")))
+                     for f in record["files"]]
+            dirs = [os.path.normpath(os.path.join(path, d.encode("utf-8")))
+                    for d in record["dirs"]]
+            result.append((path, dtime, files, dirs))
+        return result
+
+    def get_last(self):
+        """Возвращает последнюю не отмененную операцию или None.
+        """
+        operations = []
+        undone = set()
+        for record in self._read():
+            if "undo" in record:
+                undone.add(record["undo"])
+            elif not operations or operations[-1] != record["op"]:
+                operations.append(record["op"])
+        for operation in reversed(operations):
+            if operation not in undone:
+                return operation
+        return None
+
+    def _write(self, record):
+        """Дописывает запись в журнал.
+
+        Запись пишется одним вызовом write в файл, открытый
+        на дозапись, под блокировкой журнала, поэтому процессы,
+        заблокировавшие разные поддеревья, пишут одновременно.
+        Если журнал ротировали, пока процесс ждал блокировку,
+        он открывается заново.
+
+        """
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        fd = self._open_locked()
+        try:
+            if os.fstat(fd).st_size + len(line) > self.max_size:
+                os.rename(self.filename, self.filename + ROTATED_SUFFIX)
+                os.close(fd)
+                fd = self._open_locked()
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def _open_locked(self):
+        """Открывает журнал на дозапись и блокирует его.
+        """
+        while True:
+            fd = os.open(self.filename,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.filename).st_ino:
+                    return fd
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    os.close(fd)
+                    raise
+            os.close(fd)
+
+    def _read(self):
+        """Возвращает итератор записей журнала от старых к новым.
+
+        Оборванные записи (например, после сбоя) пропускаются.
+
+        """
+        for filename in (self.filename + ROTATED_SUFFIX, self.filename):
+            try:
+                log_file = open(filename, "r")
+            except IOError:
+                continue
+            with log_file:
+                for line in log_file:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
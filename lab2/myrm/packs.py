@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит пакеты, в которые упаковываются старые элементы корзины.
+
+Пакет -- файл ".meta/packs/{имя}.pack", в котором подряд записано
+содержимое упакованных файлов. Пакет записывается один раз и больше
+не изменяется. Смещение, размер, права и время изменения каждого
+файла хранятся в индексе пакетов (SQLite), поэтому файл извлекается
+из пакета одним чтением с заданного смещения.
+
+Удаленный из корзины файл удаляется только из индекса. Пакет
+удаляется целиком вместе с последним файлом в нем.
+
+Список экспортируемых функций:
+    * write_pack -- записывает файлы в новый пакет
+    * read_member -- извлекает файл из пакета
+
+Классы модуля:
+    * PackIndex -- индекс упакованных файлов корзины
+
+"""
+
+
+import os
+
+import myrm.throttle as throttle
+
+from myrm.index import ObjectIndex
+
+
+PACKS_DIRECTORY = "packs"
+INDEX_FILE = "packs.db"
+PACK_SUFFIX = ".pack"
+CHUNK_SIZE = 1024*1024
+
+_PACK_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS members ("
+    " id TEXT PRIMARY KEY,"
+    " pack TEXT NOT NULL,"
+    " offset INTEGER NOT NULL,"
+    " mode INTEGER NOT NULL,"
+    " mtime REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS members_pack ON members (pack)",
+)
+
+
+def write_pack(pack_path, paths, chunk_size=CHUNK_SIZE, limiter=None):
+    """Записывает файлы в новый пакет.
+
+    Возвращает список пар (смещение, размер) в порядке paths.
+
+    Позицонные аргументы:
+    pack_path -- путь к файлу пакета
+    paths -- пути к упаковываемым файлам
+
+    Непозиционные аргументы:
+    chunk_size -- размер блока копирования
+    limiter -- ограничение скорости копирования (см. throttle.Throttle)
+
+    Пакет сбрасывается на диск до возврата, поэтому исходные
+    файлы можно удалять сразу после записи индекса.
+
+    """
+    result = []
+    with open(pack_path, "wb") as output_file:
+        for path in paths:
+            offset = output_file.tell()
+            with open(path, "rb") as input_file:
+                throttle.copy_file_obj(input_file, output_file, limiter,
+                                       chunk_size)
+            result.append((offset, output_file.tell() - offset))
+        output_file.flush()
+        os.fsync(output_file.fileno())
+    return result
+
+
+def read_member(pack_path, offset, size, new_path, chunk_size=CHUNK_SIZE):
+    """Извлекает файл из пакета.
+
+    Позицонные аргументы:
+    pack_path -- путь к файлу пакета
+    offset -- смещение файла в пакете
+    size -- размер файла
+    new_path -- путь извлеченного файла
+
+    Непозиционные аргументы:
+    chunk_size -- размер блока копирования
+
+    Выбрасывает IOError, если пакет короче ожидаемого.
+
+    """
+    with open(pack_path, "rb") as input_file:
+        input_file.seek(offset)
+        with open(new_path, "wb") as output_file:
+            while size > 0:
+                chunk = input_file.read(min(chunk_size, size))
+                if not chunk:
+                    raise IOError("Unexpected end of pack " + pack_path)
+                output_file.write(chunk)
+                size -= len(chunk)
+
+
+class PackIndex(ObjectIndex):
+
+    """Индекс упакованных файлов корзины.
+
+    Упакованные файлы хранятся как объекты ObjectIndex с
+    идентификатором "{пакет}:{штамп}:{путь}", поэтому поиск и обход
+    работают так же, как в ObjectIndex. Таблица members хранит
+    пакет, смещение, права и время изменения файла.
+
+    Индекс использует журнал WAL: изменения сохраняются после
+    каждого удаления файла, а процессы, востанавливающие папки
+    параллельно, не блокируют друг друга надолго.
+
+    Методы класса (дополнительно к ObjectIndex):
+    * add_member -- добавляет упакованный файл
+    * get_member -- ищет упакованный файл по пути и штампу
+    * remove_member -- удаляет упакованный файл
+
+    """
+
+    def __init__(self, filename):
+        """Открывает индекс, при необходимости создавая его.
+
+        Позицонные аргументы:
+        filename -- файл индекса
+
+        """
+        super(PackIndex, self).__init__(filename)
+        self._execute("PRAGMA journal_mode=WAL")
+        self._execute("PRAGMA synchronous=NORMAL")
+        for statement in _PACK_SCHEMA:
+            self._execute(statement)
+        self.commit()
+
+    def add_member(self, pack, offset, path, sec, msec, size, mode, mtime):
+        """Добавляет упакованный файл.
+
+        Позицонные аргументы:
+        pack -- имя пакета
+        offset -- смещение файла в пакете
+        path -- внешний путь файла
+        sec, msec -- штамп времени удаления (см. stamp.get_time_stamp)
+        size -- размер файла
+        mode, mtime -- права и время изменения файла
+
+        """
+        object_id = "{pack}:{sec}.{msec}:{path}".format(pack=pack, sec=sec,
+                                                        msec=msec, path=path)
+        self.add_object(object_id, path, sec, msec, size)
+        self._execute("INSERT INTO members VALUES (?, ?, ?, ?, ?)",
+                      (object_id, pack, offset, mode, mtime))
+
+    def get_member(self, path, sec, msec):
+        """Возвращает упакованный файл или None.
+
+        Позицонные аргументы:
+        path -- внешний путь файла
+        sec, msec -- штамп времени удаления
+
+        Файл -- кортеж (идентификатор, пакет, смещение, размер,
+        права, время изменения).
+
+        """
+        cursor = self._execute("SELECT objects.id, pack, offset, size, "
+                               "mode, mtime FROM objects JOIN members "
+                               "ON objects.id = members.id "
+                               "WHERE path = ? AND sec = ? AND msec = ?",
+                               (path, sec, msec))
+        return cursor.fetchone()
+
+    def remove_member(self, object_id, path):
+        """Удаляет упакованный файл и сохраняет индекс.
+
+        Позицонные аргументы:
+        object_id -- идентификатор файла
+        path -- внешний путь файла
+
+        Возвращает имя пакета, если в нем не осталось файлов,
+        иначе None.
+
+        """
+        pack, = self._execute("SELECT pack FROM members WHERE id = ?",
+                              (object_id,)).fetchone()
+        self.remove_object(object_id)
+        self._execute("DELETE FROM members WHERE id = ?", (object_id,))
+        self.prune(os.path.dirname(path))
+
+        left = self._execute("SELECT 1 FROM members WHERE pack = ? LIMIT 1",
+                             (pack,)).fetchone()
+        self.commit()
+        return pack if left is None else None
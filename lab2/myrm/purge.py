@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит функции фонового удаления очищенной корзины.
+
+При полной очистке содержимое корзины переименовывается в надгробие
+(tombstone) -- папку в ".meta/tombstones". Переименование мгновенно,
+поэтому корзина сразу становится пустой, а надгробие удаляется
+с диска отдельным процессом. Процесс отсоединяется от терминала,
+работает с пониженным приоритетом (nice и ionice) и ограничивает
+скорость удаления (см. myrm.throttle), чтобы не мешать остальной
+работе с диском.
+
+Тот же механизм удаления папок используется при очистке элементов
+корзины (Trash.remove). Размер файлов берется из lstat, сделанного
+при обходе, а соседние поддеревья удаляются параллельно пулом
+потоков: на SSD одиночный цикл unlink не загружает устройство.
+Поддеревья обходятся через дескрипторы папок (см. myrm.dirfd),
+поэтому ядро не разбирает полный путь каждого файла.
+
+Освобождение экстентов очень большого файла при unlink может надолго
+занять файловую систему. Файлы не меньше truncate_size перед удалением
+постепенно уменьшаются ftruncate шагами по truncate_step байт.
+
+Список экспортируемых функций:
+    * remove_tree -- удаляет папку, параллельно по поддеревьям
+    * truncate_file -- постепенно уменьшает файл до нуля
+    * make_remove -- возвращает функцию удаления файла
+    * remove_tombstones -- удаляет надгробия
+    * spawn -- запускает удаление надгробий в фоновом процессе
+
+"""
+
+
+import os
+import sys
+import stat
+import errno
+import logging
+import functools
+import multiprocessing
+import multiprocessing.pool
+
+import myrm.dirfd as dirfd
+import myrm.throttle as throttle
+
+
+TOMBSTONES_DIRECTORY = "tombstones"
+TOMBSTONE_NAME = "purge"
+
+DEFAULT_NICE = 10
+DEFAULT_WORKERS = multiprocessing.cpu_count()
+DEFAULT_TRUNCATE_STEP = 256*1024*1024
+MAX_FD = 1024
+
+
+def _ignore_missing(function, *args):
+    """Вызывает function(*args), игнорируя уже удаленный путь.
+
+    Возвращает результат function или None, если пути нет.
+    """
+    try:
+        return function(*args)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def _remove_file(path, file_stat, remove):
+    """Удаляет файл. Возвращает его размер.
+    """
+    remove()
+    return file_stat.st_size
+
+
+def truncate_file(path, file_stat, step=DEFAULT_TRUNCATE_STEP, limiter=None):
+    """Постепенно уменьшает файл до нуля. Возвращает число шагов.
+
+    Позицонные аргументы:
+    path -- путь к файлу
+    file_stat -- lstat файла, сделанный при обходе
+
+    Непозиционные аргументы:
+    step -- на сколько байт уменьшать файл за шаг
+    limiter -- ограничение скорости (см. throttle.Throttle.truncate)
+
+    Файл обрезается с конца, поэтому каждый шаг освобождает только
+    часть экстентов. Файл с несколькими жесткими ссылками и файл,
+    замененный после обхода, не обрезаются: их содержимое
+    может быть нужно другим путям.
+
+    """
+    try:
+        fd = os.open(path, os.O_WRONLY | getattr(os, "O_NOFOLLOW", 0))
+    except OSError as error:
+        debug_fmt = "Unable to truncate {path}: {error}"
+        logging.debug(debug_fmt.format(path=path, error=error))
+        return 0
+
+    steps = 0
+    try:
+        current_stat = os.fstat(fd)
+        if (current_stat.st_ino != file_stat.st_ino or
+                current_stat.st_dev != file_stat.st_dev or
+                current_stat.st_nlink > 1):
+            return 0
+        size = current_stat.st_size
+        while size > 0:
+            new_size = max(0, size - step)
+            if limiter is not None:
+                limiter.truncate(size - new_size)
+            os.ftruncate(fd, new_size)
+            size = new_size
+            steps += 1
+    finally:
+        os.close(fd)
+    return steps
+
+
+def make_remove(path, file_stat, remove=None, truncate_size=None,
+                truncate_step=DEFAULT_TRUNCATE_STEP, limiter=None):
+    """Возвращает функцию без аргументов, удаляющую файл.
+
+    Позицонные аргументы:
+    path -- путь к файлу
+    file_stat -- lstat файла
+
+    Непозиционные аргументы:
+    remove -- функция без аргументов, удаляющая файл
+              (по умолчанию: os.remove по полному пути)
+    truncate_size -- обрезать перед удалением обычные файлы
+                     не меньше этого размера (None -- не обрезать)
+    truncate_step -- шаг обрезания в байтах
+    limiter -- ограничение скорости обрезания
+
+    Размер файла для учета берется из file_stat до обрезания,
+    поэтому освобожденное место считается так же, как без него.
+    Ошибка обрезания не мешает удалению.
+
+    """
+    if remove is None:
+        remove = functools.partial(os.remove, path)
+    if (truncate_size is None or file_stat.st_size < truncate_size or
+            file_stat.st_nlink > 1 or not stat.S_ISREG(file_stat.st_mode)):
+        return remove
+
+    def truncate_and_remove():
+        try:
+            steps = truncate_file(path, file_stat, truncate_step, limiter)
+        except OSError as error:
+            debug_fmt = "Truncating {path} failed: {error}"
+            logging.debug(debug_fmt.format(path=path, error=error))
+        else:
+            debug_fmt = "Truncated {path} in {steps} steps"
+            logging.debug(debug_fmt.format(path=path, steps=steps))
+        remove()
+
+    return truncate_and_remove
+
+
+class _Walker(object):
+    """Удаляет файлы и папки одного вызова remove_tree.
+    """
+
+    def __init__(self, release, limiter, remove_dirs, removed, use_dir_fd,
+                 truncate_size, truncate_step):
+        self.release = release
+        self.limiter = limiter
+        self.remove_dirs = remove_dirs
+        self.removed = removed
+        self.use_dir_fd = use_dir_fd
+        self.truncate_size = truncate_size
+        self.truncate_step = truncate_step
+
+    def remove_file(self, path, file_stat=None, remove=None):
+        """Удаляет файл. Возвращает кол-во файлов и размер.
+
+        remove -- функция без аргументов, удаляющая файл
+                  (по умолчанию: os.remove по полному пути)
+        """
+        if file_stat is None:
+            file_stat = _ignore_missing(os.lstat, path)
+            if file_stat is None:
+                return 0, 0
+        remove = make_remove(path, file_stat, remove, self.truncate_size,
+                             self.truncate_step, self.limiter)
+        if self.limiter is not None:
+            self.limiter.unlink()
+        size = _ignore_missing(self.release, path, file_stat, remove)
+        if size is None:
+            return 0, 0
+        if self.removed is not None:
+            self.removed.append(path)
+        return 1, size
+
+    def remove_subtree(self, path):
+        """Последовательно удаляет поддерево. Возвращает кол-во и размер.
+        """
+        count = 0
+        size = 0
+        for dirpath, dirnames, files, dir_fd in self._walk(path):
+            # Папка попадает в список удаленных раньше своих файлов
+            if self.removed is not None:
+                self.removed.append(dirpath)
+            for name, file_stat in files:
+                if dir_fd is None:
+                    remove = None
+                else:
+                    remove = functools.partial(dirfd.unlink, name, dir_fd)
+                delta_count, delta_size = self.remove_file(
+                    os.path.join(dirpath, name), file_stat, remove)
+                count += delta_count
+                size += delta_size
+            if self.remove_dirs:
+                # Вложенные папки уже пусты: обход идет снизу вверх
+                for name in dirnames:
+                    if dir_fd is None:
+                        _ignore_missing(os.rmdir, os.path.join(dirpath, name))
+                    else:
+                        _ignore_missing(dirfd.rmdir, name, dir_fd)
+        if self.remove_dirs:
+            _ignore_missing(os.rmdir, path)
+        return count, size
+
+    def _walk(self, path):
+        """Обходит поддерево снизу вверх.
+
+        Возвращает кортежи (путь, папки, файлы с lstat, дескриптор).
+        Без дескрипторов папок дескриптор равен None.
+
+        """
+        if not self.use_dir_fd:
+            for dirpath, dirnames, files in dirfd.walk_stats(path,
+                                                              topdown=False):
+                yield dirpath, dirnames, files, None
+            return
+        try:
+            walker = dirfd.fwalk(path, topdown=False)
+            for result in walker:
+                yield result
+        except OSError as error:
+            # Поддерево удалено другим процессом
+            if error.errno != errno.ENOENT:
+                raise
+
+    def split(self, path, workers):
+        """Разбивает дерево на поддеревья для параллельного удаления.
+
+        Папки обходятся в ширину, пока поддеревьев меньше workers.
+        Файлы пройденных папок удаляются сразу. Возвращает
+        поддеревья, пройденные папки, кол-во файлов и размер.
+
+        """
+        frontier = [path]
+        expanded = []
+        count = 0
+        size = 0
+        while frontier and len(frontier) < workers:
+            next_frontier = []
+            for directory in frontier:
+                expanded.append(directory)
+                if self.removed is not None:
+                    self.removed.append(directory)
+                for name in os.listdir(directory):
+                    full_path = os.path.join(directory, name)
+                    file_stat = _ignore_missing(os.lstat, full_path)
+                    if file_stat is None:
+                        continue
+                    if stat.S_ISDIR(file_stat.st_mode):
+                        next_frontier.append(full_path)
+                    else:
+                        delta_count, delta_size = self.remove_file(full_path,
+                                                                   file_stat)
+                        count += delta_count
+                        size += delta_size
+            frontier = next_frontier
+        return frontier, expanded, count, size
+
+
+def remove_tree(path, release=_remove_file, workers=DEFAULT_WORKERS,
+                limiter=None, remove_dirs=True, removed=None,
+                use_dir_fd=dirfd.SUPPORTED, truncate_size=None,
+                truncate_step=DEFAULT_TRUNCATE_STEP):
+    """Удаляет папку со всем содержимым. Возвращает кол-во и размер.
+
+    Позицонные аргументы:
+    path -- путь к папке или файлу
+
+    Непозиционные аргументы:
+    release -- функция release(path, file_stat, remove), удаляющая
+               файл вызовом remove() и возвращающая освобожденное место
+    workers -- число потоков удаления
+    limiter -- ограничение скорости удаления (см. throttle.Throttle)
+    remove_dirs -- удалять опустевшие папки
+    removed -- список, в который добавляются удаленные пути
+    use_dir_fd -- обходить и удалять относительно дескрипторов папок
+    truncate_size -- постепенно обрезать перед удалением файлы
+                     не меньше этого размера (None -- не обрезать)
+    truncate_step -- шаг обрезания в байтах (см. truncate_file)
+
+    Соседние поддеревья удаляются параллельно, поэтому release
+    вызывается из нескольких потоков. Файлы, удаленные
+    другим процессом, пропускаются.
+
+    """
+    walker = _Walker(release, limiter, remove_dirs, removed, use_dir_fd,
+                     truncate_size, truncate_step)
+    if not os.path.isdir(path) or os.path.islink(path):
+        return walker.remove_file(path)
+
+    subtrees, expanded, count, size = walker.split(path, workers)
+    if len(subtrees) < 2:
+        results = [walker.remove_subtree(subtree) for subtree in subtrees]
+    else:
+        pool = multiprocessing.pool.ThreadPool(min(workers, len(subtrees)))
+        try:
+            results = pool.map(walker.remove_subtree, subtrees)
+        finally:
+            pool.close()
+            pool.join()
+
+    for delta_count, delta_size in results:
+        count += delta_count
+        size += delta_size
+    if remove_dirs:
+        for directory in reversed(expanded):
+            _ignore_missing(os.rmdir, directory)
+    return count, size
+
+
+def remove_tombstones(paths, limiter=None, truncate_size=None,
+                      truncate_step=DEFAULT_TRUNCATE_STEP):
+    """Удаляет надгробия. Возвращает кол-во удаленных файлов и размер.
+
+    Позицонные аргументы:
+    paths -- пути к надгробиям
+
+    Непозиционные аргументы:
+    limiter -- ограничение скорости удаления (см. throttle.Throttle)
+    truncate_size -- постепенно обрезать перед удалением файлы
+                     не меньше этого размера (None -- не обрезать)
+    truncate_step -- шаг обрезания в байтах
+
+    """
+    count = 0
+    size = 0
+    for path in paths:
+        debug_fmt = "Removing tombstone {path}"
+        debug_msg = debug_fmt.format(path=path)
+        logging.debug(debug_msg)
+        delta_count, delta_size = remove_tree(path, limiter=limiter,
+                                              truncate_size=truncate_size,
+                                              truncate_step=truncate_step)
+        count += delta_count
+        size += delta_size
+    return count, size
+
+
+def _close_fds():
+    """Закрывает все дескрипторы процесса, кроме стандартных потоков.
+    """
+    try:
+        fds = [int(name) for name in os.listdir("/proc/self/fd")]
+    except OSError:
+        os.closerange(3, MAX_FD)
+        return
+    for fd in fds:
+        if fd > 2:
+            # Дескриптор самого listdir уже закрыт
+            try:
+                os.close(fd)
+            except OSError as error:
+                if error.errno != errno.EBADF:
+                    raise
+
+
+def spawn(paths, limiter=None, nice=DEFAULT_NICE, ionice=None,
+          truncate_size=None, truncate_step=DEFAULT_TRUNCATE_STEP):
+    """Удаляет надгробия в отсоединенном фоновом процессе.
+
+    Позицонные аргументы:
+    paths -- пути к надгробиям
+
+    Непозиционные аргументы:
+    limiter -- ограничение скорости удаления (см. throttle.Throttle)
+    nice -- на сколько понизить приоритет процесса
+    ionice -- приоритет ввода-вывода (см. throttle.set_io_priority,
+              None -- не менять)
+    truncate_size -- постепенно обрезать перед удалением файлы
+                     не меньше этого размера (None -- не обрезать)
+    truncate_step -- шаг обрезания в байтах
+
+    Процесс запускается двойным fork в новой сессии, поэтому он
+    не остается зомби и не завершается вместе с терминалом.
+    Функция возвращается сразу после запуска процесса. Счетчики
+    limiter сохраняются по ходу удаления и в конце с полем done.
+
+    """
+    pid = os.fork()
+    if pid != 0:
+        os.waitpid(pid, 0)
+        return
+
+    try:
+        os.setsid()
+        if os.fork() == 0:
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for stream in (sys.stdin, sys.stdout, sys.stderr):
+                os.dup2(devnull, stream.fileno())
+            # Унаследованный дескриптор файла блокировки держал бы
+            # блокировку корзины до конца удаления
+            _close_fds()
+            if nice:
+                os.nice(nice)
+            if ionice is not None:
+                throttle.set_io_priority(ionice)
+            remove_tombstones(paths, limiter=limiter,
+                              truncate_size=truncate_size,
+                              truncate_step=truncate_step)
+            if limiter is not None:
+                limiter.save_stats(done=True)
+    finally:
+        # Дочерний процесс не должен выполнять код родителя
+        os._exit(0)
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит учет места в корзине по владельцам и префиксам путей.
+
+Общая корзина (например, на сборочном сервере) делится между
+арендаторами. Арендатор -- пара (вид, ключ): владелец файлов
+("uid", "1000") или префикс исходных путей ("prefix", "/srv/build").
+Каждый файл корзины учитывается у своего владельца (st_uid) и у всех
+заданных префиксов, внутри которых лежит его внешний путь.
+
+Занятое место хранится в индексе квот (SQLite) и изменяется на каждом
+добавлении, востановлении и удалении, поэтому проверка квоты --
+один поиск по первичному ключу без обхода корзины.
+
+Если включена свертка (rollup), каждый файл учитывается еще и у всех
+папок на пути к нему (арендатор ("dir", путь папки)). Изменение файла
+затрагивает O(глубины) строк индекса, зато размер и число файлов любой
+папки корзины тоже находятся одним поиском.
+
+Список экспортируемых функций:
+    * parse_quotas -- разбирает квоты из конфигурации
+    * get_tenants -- арендаторы файла
+    * collect_usage -- место, занятое арендаторами в пути
+    * add_usage -- учитывает файл в словаре места арендаторов
+
+Классы модуля:
+    * QuotaIndex -- индекс занятого арендаторами места
+
+"""
+
+
+import os
+import json
+import stat
+import sqlite3
+
+import myrm.dirfd as dirfd
+import myrm.utils as utils
+
+
+INDEX_FILE = "quotas.db"
+UID = "uid"
+PREFIX = "prefix"
+DIR = "dir"
+KINDS = (UID, PREFIX)
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS usage ("
+    " kind TEXT NOT NULL,"
+    " tenant TEXT NOT NULL,"
+    " size INTEGER NOT NULL,"
+    " count INTEGER NOT NULL,"
+    " PRIMARY KEY (kind, tenant))",
+    "CREATE TABLE IF NOT EXISTS state ("
+    " name TEXT PRIMARY KEY,"
+    " value TEXT NOT NULL)",
+)
+
+
+def parse_quotas(quotas):
+    """Разбирает квоты. Возвращает словарь {арендатор: (размер, число)}.
+
+    Позицонные аргументы:
+    quotas -- словарь {вид: {ключ: {"max_size": n, "max_count": n}}}
+              или None
+
+    Отсутствующее ограничение равно None. Префиксы приводятся
+    к абсолютным путям. Выбрасывает ValueError при неизвестном
+    виде арендатора или ограничении.
+
+    """
+    limits = {}
+    for kind, tenants in (quotas or {}).iteritems():
+        if kind not in KINDS:
+            raise ValueError("Unsoported quota kind {0!r}".format(kind))
+        for key, quota in tenants.iteritems():
+            unknown = set(quota) - set(("max_size", "max_count"))
+            if unknown:
+                error_fmt = "Unsoported quota limit {0!r}"
+                raise ValueError(error_fmt.format(sorted(unknown)[0]))
+            if kind == UID:
+                key = str(int(key))
+            else:
+                key = utils.get_absolute_path(key)
+            limits[(kind, key)] = (quota.get("max_size"),
+                                   quota.get("max_count"))
+    return limits
+
+
+def get_tenants(path, uid, prefixes, rollup=False):
+    """Возвращает список арендаторов файла.
+
+    Позицонные аргументы:
+    path -- внешний путь файла
+    uid -- владелец файла (None -- не учитывать владельца)
+    prefixes -- отслеживаемые префиксы
+
+    Непозиционные аргументы:
+    rollup -- учитывать файл у всех папок на пути к нему
+
+    """
+    tenants = [] if uid is None else [(UID, str(uid))]
+    for prefix in prefixes:
+        if path == prefix or path.startswith(prefix.rstrip(os.sep) + os.sep):
+            tenants.append((PREFIX, prefix))
+    if rollup:
+        parent, name = os.path.split(path)
+        while name:
+            tenants.append((DIR, parent))
+            parent, name = os.path.split(parent)
+    return tenants
+
+
+def collect_usage(path, prefixes, to_external=None, usage=None,
+                  rollup=False):
+    """Возвращает место, занятое арендаторами в пути.
+
+    Позицонные аргументы:
+    path -- файл или папка
+    prefixes -- отслеживаемые префиксы
+
+    Непозиционные аргументы:
+    to_external -- функция, возвращающая внешний путь файла
+                   (по умолчанию: сам путь)
+    usage -- словарь, в который добавляется результат
+    rollup -- учитывать файлы у папок (см. get_tenants)
+
+    Результат -- словарь {арендатор: [размер, число файлов]}.
+    Папки не учитываются.
+
+    """
+    if usage is None:
+        usage = {}
+    if to_external is None:
+        to_external = lambda full_path: full_path
+    if not os.path.isdir(path) or os.path.islink(path):
+        if os.path.lexists(path):
+            add_usage(usage, to_external(path), os.lstat(path), prefixes,
+                      rollup=rollup)
+        return usage
+    for dirpath, _, files in dirfd.walk_stats(path):
+        for name, file_stat in files:
+            full_path = os.path.join(dirpath, name)
+            add_usage(usage, to_external(full_path), file_stat, prefixes,
+                      rollup=rollup)
+    return usage
+
+
+def add_usage(usage, path, file_stat, prefixes, sign=1, rollup=False):
+    """Учитывает файл в словаре места арендаторов.
+
+    Позицонные аргументы:
+    usage -- словарь {арендатор: [размер, число файлов]}
+    path -- внешний путь файла
+    file_stat -- lstat файла
+    prefixes -- отслеживаемые префиксы
+
+    Непозиционные аргументы:
+    sign -- 1 для добавления, -1 для удаления
+    rollup -- учитывать файл у папок (см. get_tenants)
+
+    """
+    if stat.S_ISDIR(file_stat.st_mode):
+        return
+    for tenant in get_tenants(path, file_stat.st_uid, prefixes, rollup):
+        totals = usage.setdefault(tenant, [0, 0])
+        totals[0] += sign*file_stat.st_size
+        totals[1] += sign
+
+
+class QuotaIndex(object):
+
+    """Индекс занятого арендаторами места.
+
+    Таблица usage хранит размер и число файлов каждого арендатора,
+    а таблица state -- отслеживаемые префиксы, включена ли свертка
+    по папкам и признак того, что значения нужно пересчитать
+    обходом корзины.
+
+    Методы класса:
+    * commit -- сохраняет изменения
+    * close -- закрывает индекс
+
+    * get_usage -- место, занятое арендатором
+    * get_all -- место всех арендаторов
+    * update -- изменяет место арендаторов
+    * replace -- заменяет все значения
+    * get_prefixes -- префиксы, по которым ведется учет
+    * get_rollup -- ведется ли учет по папкам
+    * is_stale -- нужно ли пересчитать значения
+    * set_stale -- отмечает, что значения нужно пересчитать
+
+    """
+
+    def __init__(self, filename):
+        """Открывает индекс, при необходимости создавая его.
+
+        Позицонные аргументы:
+        filename -- файл индекса
+
+        Процессы, заблокировавшие разные поддеревья корзины, изменяют
+        индекс одновременно, поэтому запись ждет освобождения базы.
+
+        """
+        self.filename = filename
+        self._connection = sqlite3.connect(filename, timeout=60)
+        self._connection.text_factory = str
+        for statement in _SCHEMA:
+            self._connection.execute(statement)
+        self._connection.commit()
+
+    def commit(self):
+        """Сохраняет изменения индекса.
+        """
+        self._connection.commit()
+
+    def close(self):
+        """Сохраняет изменения и закрывает индекс.
+        """
+        self._connection.commit()
+        self._connection.close()
+
+    def get_usage(self, tenant):
+        """Возвращает пару (размер, число файлов) арендатора.
+        """
+        row = self._connection.execute(
+            "SELECT size, count FROM usage WHERE kind = ? AND tenant = ?",
+            tenant).fetchone()
+        return tuple(row) if row is not None else (0, 0)
+
+    def get_all(self):
+        """Возвращает словарь {арендатор: (размер, число файлов)}.
+        """
+        cursor = self._connection.execute(
+            "SELECT kind, tenant, size, count FROM usage")
+        return dict(((kind, tenant), (size, count))
+                    for kind, tenant, size, count in cursor)
+
+    def update(self, usage):
+        """Изменяет место арендаторов.
+
+        Позицонные аргументы:
+        usage -- словарь {арендатор: (изменение размера, числа файлов)}
+
+        """
+        for (kind, tenant), (size, count) in usage.iteritems():
+            cursor = self._connection.execute(
+                "UPDATE usage SET size = size + ?, count = count + ? "
+                "WHERE kind = ? AND tenant = ?", (size, count, kind, tenant))
+            if cursor.rowcount == 0:
+                self._connection.execute(
+                    "INSERT INTO usage VALUES (?, ?, ?, ?)",
+                    (kind, tenant, size, count))
+
+    def replace(self, usage, prefixes, rollup=False):
+        """Заменяет все значения и сохраняет индекс.
+
+        Позицонные аргументы:
+        usage -- словарь {арендатор: (размер, число файлов)}
+        prefixes -- префиксы, по которым велся подсчет
+
+        Непозиционные аргументы:
+        rollup -- велся ли подсчет по папкам
+
+        Снимает признак пересчета.
+
+        """
+        self._connection.execute("DELETE FROM usage")
+        self.update(usage)
+        self._set_state("prefixes", json.dumps(sorted(prefixes)))
+        self._set_state("rollup", "1" if rollup else "0")
+        self._set_state("stale", "0")
+        self.commit()
+
+    def get_prefixes(self):
+        """Возвращает префиксы, по которым ведется учет, или None.
+        """
+        value = self._get_state("prefixes")
+        return json.loads(value) if value is not None else None
+
+    def get_rollup(self):
+        """Возвращает, ведется ли учет по папкам.
+        """
+        return self._get_state("rollup") == "1"
+
+    def is_stale(self):
+        """Возвращает, нужно ли пересчитать значения обходом корзины.
+        """
+        return self._get_state("stale") == "1"
+
+    def set_stale(self):
+        """Отмечает, что значения нужно пересчитать.
+
+        Вызывается после операций, меняющих размер файлов корзины
+        (сжатие, дельты, упаковка).
+
+        """
+        self._set_state("stale", "1")
+
+    def _get_state(self, name):
+        """Возвращает значение из таблицы state или None.
+        """
+        row = self._connection.execute(
+            "SELECT value FROM state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_state(self, name, value):
+        """Записывает значение в таблицу state.
+        """
+        self._connection.execute("INSERT OR REPLACE INTO state VALUES (?, ?)",
+                                 (name, value))
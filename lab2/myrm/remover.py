@@ -11,9 +11,13 @@ import logging
 
 import myrm.control as control
 import myrm.utils as utils
+import myrm.stats as statistics
+import myrm.oplog as oplog
 
 from myrm.trash import Trash
 from myrm.trash import LimitExcessException
+from myrm.trash import QuotaExcessException
+from myrm.objects import ObjectTrash
 from myrm.autocleaner import Autocleaner
 
 
@@ -23,6 +27,13 @@ DEFAULT_INTERACTIVE = False
 DEFAULT_AUTO_REPLACE = False
 DEFAULT_ALLOW_AUTOCLEAN = True
 
+# Раскладка корзины задается ключом "layout" конфигурации корзины
+DEFAULT_LAYOUT = "mirror"
+TRASH_LAYOUTS = {
+    "mirror": Trash,
+    "objects": ObjectTrash,
+}
+
 
 class Remover(object):
 
@@ -37,15 +48,20 @@ class Remover(object):
     * interactive -- режим подробного опроса пользвателя
     * auto_replace -- автоматическая замена при востановлении
     * allow_autoclean -- разрешить автоочистку
+    * last_operation -- идентификатор последней операции удаления
 
     Методы класса:
     * __init__ -- создает корзину по заданным параметрам
     * configurate -- конфигурирует корзину заданными параметрами
     * remove -- удаляет файлы по регулярному выражению
     * restore -- востанавливает файлы по регулярному выражению
+    * undo -- востанавливает файлы, удаленные операцией
     * clean -- удаляет с диска по регулярному выражению
     * lst -- список файлов по регулярному выражению
+    * du -- размер элементов корзины по регулярному выражению
+    * stats -- сводка содержимого корзины
     * autoclean -- выполняет автоочистку корзины
+    * session -- возвращает сессию под долгой блокировкой корзины
 
     """
 
@@ -70,6 +86,7 @@ class Remover(object):
         """
         self.trash = Trash()
         self.autocleaner = Autocleaner(self.trash)
+        self.last_operation = None
         self.configurate(force, dryrun, interactive, auto_replace,
                          allow_autoclean, trash, autoclean)
 
@@ -91,7 +108,20 @@ class Remover(object):
         * auto_replace -- автоматическая замена при востановлении
         * allow_autoclean -- разрешить автоочистку
 
+        Ключ "layout" конфигурации корзины выбирает ее класс
+        (см. TRASH_LAYOUTS). Выбрасывает ValueError при неизвестной
+        раскладке.
+
         """
+        trash = dict(trash)
+        layout = trash.pop("layout", DEFAULT_LAYOUT)
+        if layout not in TRASH_LAYOUTS:
+            error_fmt = "Unsoported trash layout {layout}"
+            raise ValueError(error_fmt.format(layout=layout))
+        if type(self.trash) is not TRASH_LAYOUTS[layout]:
+            self.trash = TRASH_LAYOUTS[layout]()
+            self.autocleaner.trash = self.trash
+
         self.force = force
         self.dryrun = dryrun
         self.interactive = interactive
@@ -101,7 +131,7 @@ class Remover(object):
         self.trash.configurate(**trash)
         self.autocleaner.configurate(**autoclean)
 
-    def remove(self, path_mask, recursive=False):
+    def remove(self, path_mask, recursive=False, ttl=None, operation=None):
         """Удаляет фалйы по маске в корзину.
 
         Возвращает количестов удаленных файлов и их размер.
@@ -115,18 +145,32 @@ class Remover(object):
         Непозиционные аргументы:
         recursive -- производить ли поиск в подпапках.
                      По умолчанию: False
+        ttl -- время жизни удаленных файлов в корзине в секундах.
+               По умолчанию: None (без ограничения)
+        operation -- идентификатор операции, под которым удаленные
+                     элементы записываются в журнал (см. undo).
+                     По умолчанию: новый идентификатор
+
+        Идентификатор операции сохраняется в last_operation.
 
-        Корзина блокируется.
+        Корзина блокируется. Если задан trash.lock_depth, блокируется
+        только поддерево маски, а автоочистка при превышении лимита
+        выполняется после снятия блокировки поддерева под блокировкой
+        всей корзины.
 
         """
+        if operation is None:
+            operation = oplog.new_operation_id()
+        self.last_operation = operation
         path_mask = os.path.expanduser(path_mask)
         path_mask = os.path.abspath(path_mask)
         size = 0
         count = 0
         files = []
+        deferred = []
         directory, mask = os.path.split(path_mask)
 
-        with self.trash.lock():
+        with self.trash.lock(subtree=directory):
             found = utils.search(directory, mask, mask, recursive=recursive)
             for path in found:
 
@@ -137,27 +181,21 @@ class Remover(object):
                     try:
                         if self.dryrun:
                             with self.trash.dryrun_mode():
-                                dcount, dsize, dfiles = self.trash.add(path)
-                        else:
-                            dcount, dsize, dfiles = self.trash.add(path)
-
-                    except LimitExcessException:
-                        if self.allow_autoclean and not self.dryrun:
-                            log_msg = ("Bukkit limit excess. "
-                                       "Trying to autoclean.")
-                            logging.info(log_msg)
-
-                            dcount, dsize = self.autocleaner.autoclean()
-                            log_fmt = "{count} files({size} bytes) cleaned."
-                            log_msg = log_fmt.format(count=dcount, size=dsize)
-
-                            if self.dryrun:
-                                with self.trash.dryrun_mode():
-                                    dcount, dsize, dfiles = self.trash.add(path)
-                            else:
-                                dcount, dsize, dfiles = self.trash.add(path)
+                                dcount, dsize, dfiles = self.trash.add(path,
+                                                                       ttl=ttl)
                         else:
+                            dcount, dsize, dfiles = self.trash.add(
+                                path, ttl=ttl, operation=operation)
+
+                    except LimitExcessException as error:
+                        if not self.allow_autoclean or self.dryrun:
                             raise
+                        if self.trash.get_subtree() is not None:
+                            # Автоочистке нужна вся корзина
+                            deferred.append((path, error))
+                            continue
+                        dcount, dsize, dfiles = self._autoclean_add(
+                            path, ttl, error, operation)
                 except Exception:
                     if not self.force:
                         raise
@@ -165,9 +203,66 @@ class Remover(object):
                 count += dcount
                 size += dsize
                 files.extend(dfiles)
+
+        if deferred:
+            with self.trash.lock():
+                for path, error in deferred:
+                    try:
+                        dcount, dsize, dfiles = self._autoclean_add(
+                            path, ttl, error, operation)
+                    except Exception:
+                        if not self.force:
+                            raise
+                        continue
+                    count += dcount
+                    size += dsize
+                    files.extend(dfiles)
         return count, size, files
 
-    def restore(self, path_mask, recursive=False, how_old=0):
+    def _autoclean_add(self, path, ttl, error=None, operation=None):
+        """Выполняет автоочистку и повторно добавляет элемент в корзину.
+
+        Возвращает результат Trash.add.
+
+        Непозиционные аргументы:
+        error -- исключение, с которым не удалось добавить элемент
+        operation -- идентификатор операции удаления
+
+        При превышении квоты сначала очищаются файлы арендатора
+        (см. Autocleaner.autoclean_tenant), а вся корзина
+        очищается, только если превышен ее общий лимит.
+
+        """
+        cleaned = set()
+        while (isinstance(error, QuotaExcessException) and
+               error.tenant not in cleaned):
+            cleaned.add(error.tenant)
+            log_fmt = "Quota of {kind} {key} excess. Trying to autoclean it."
+            logging.info(log_fmt.format(kind=error.tenant[0],
+                                        key=error.tenant[1]))
+            dcount, dsize = self.autocleaner.autoclean_tenant(
+                error.tenant, error.size, error.count)
+            log_fmt = "{count} files({size} bytes) cleaned."
+            logging.info(log_fmt.format(count=dcount, size=dsize))
+            try:
+                return self.trash.add(path, ttl=ttl, operation=operation)
+            except LimitExcessException as new_error:
+                error = new_error
+        if isinstance(error, QuotaExcessException):
+            raise error
+
+        log_msg = ("Bukkit limit excess. "
+                   "Trying to autoclean.")
+        logging.info(log_msg)
+
+        dcount, dsize = self.autocleaner.autoclean()
+        log_fmt = "{count} files({size} bytes) cleaned."
+        log_msg = log_fmt.format(count=dcount, size=dsize)
+        logging.info(log_msg)
+
+        return self.trash.add(path, ttl=ttl, operation=operation)
+
+    def restore(self, path_mask, recursive=False, how_old=0, as_of=None):
         """Удаляет файлы в корзину по заданной маске.
 
         Возвращает количестов удаленных файлов и их размер.
@@ -183,15 +278,20 @@ class Remover(object):
         how_old -- версия файла в порядке устарения даты удаления.
                    Если больше числа файлов, берется последняя версия.
                    По умолчанию: 0 (последняя версия)
+        as_of -- момент времени (datetime). Востанавливаются самые
+                 новые версии, удаленные не позже него, поэтому папки
+                 собираются такими, какими были в этот момент
+                 (см. Trash.restore_dir). how_old не учитывается.
 
-        Корзина блокируется.
+        Корзина (или поддерево маски, см. remove) блокируется.
 
         """
         size = 0
         count = 0
         files = []
+        directory = os.path.dirname(utils.get_absolute_path(path_mask))
 
-        with self.trash.lock():
+        with self.trash.lock(subtree=directory):
             files_versions = self.trash.search(path_mask, recursive=recursive)
             for path in files_versions:
 
@@ -206,9 +306,11 @@ class Remover(object):
                 try:
                     if self.dryrun:
                         with self.trash.dryrun_mode():
-                            delta = self.trash.restore(path, how_old=how_old)
+                            delta = self.trash.restore(path, how_old=how_old,
+                                                       as_of=as_of)
                     else:
-                        delta = self.trash.restore(path, how_old=how_old)
+                        delta = self.trash.restore(path, how_old=how_old,
+                                                   as_of=as_of)
                 except Exception:
                     if not self.force:
                         raise
@@ -218,6 +320,48 @@ class Remover(object):
 
         return count, size, files
 
+    def undo(self, operation=None):
+        """Востанавливает файлы, удаленные операцией remove.
+
+        Возвращает количестов востановленных файлов, их размер
+        и список востановленных путей.
+
+        Непозиционные аргументы:
+        operation -- идентификатор операции (см. last_operation).
+                     По умолчанию: последняя не отмененная операция
+
+        Элементы востанавливаются по журналу операций без поиска
+        (см. Trash.undo). Корзина блокируется целиком. Выбрасывает
+        ValueError, если отменять нечего.
+
+        """
+        with self.trash.lock():
+            operation_log = self.trash.get_operation_log()
+            if operation is None:
+                operation = operation_log.get_last()
+            records = []
+            if operation is not None:
+                records = operation_log.get_records(operation)
+            if not records:
+                raise ValueError("Nothing to undo.")
+
+            paths = []
+            for path, _, _, _ in records:
+                if not control.restore(path, interactive=self.interactive):
+                    continue
+                if os.path.exists(path):
+                    if not control.replace(path,
+                                           auto_replace=self.auto_replace):
+                        continue
+                paths.append(path)
+
+            if len(paths) == len(records):
+                paths = None
+            if self.dryrun:
+                with self.trash.dryrun_mode():
+                    return self.trash.undo(operation, paths)
+            return self.trash.undo(operation, paths)
+
     def lst(self, path_mask="*", recursive=False, versions=True):
         """Возвращает список файлоzв в корзине по заданной маске.
 
@@ -229,12 +373,13 @@ class Remover(object):
         recursive -- производить лиpath поиск в подпапках.
         versions -- показывать все версии файла (По-умолчанию: True)
 
-        Корзина блокируется.
+        Корзина блокируется для чтения, поэтому несколько
+        просмотров выполняются одновременно.
 
         """
         result = []
 
-        with self.trash.lock():
+        with self.trash.lock(shared=True):
             files_versions = self.trash.search(path_mask, recursive=recursive,
                                                find_all=True)
             files = files_versions.keys()
@@ -246,6 +391,50 @@ class Remover(object):
                         break
         return result
 
+    def du(self, path_mask="*", recursive=False):
+        """Возвращает размер элементов корзины по заданной маске.
+
+        Список состоит из кортежей (путь, размер, число файлов).
+        Учитываются все версии файлов. Только последний элемент
+        пути может быть маской.
+
+        Непозиционные аргументы:
+        path_mask -- маска (по умолчанию: '*')
+        recursive -- производить ли поиск в подпапках.
+
+        Корзина блокируется для чтения. Если включен trash.rollup,
+        размер папки берется из индекса без ее обхода
+        (см. Trash.get_tree_usage).
+
+        """
+        result = []
+
+        with self.trash.lock(shared=True):
+            files_versions = self.trash.search(path_mask, recursive=recursive)
+            files = files_versions.keys()
+            files.sort(key=lambda f: (f.count(os.sep), f))
+            for path in files:
+                size, count = self.trash.get_tree_usage(path)
+                result.append((path, size, count))
+        return result
+
+    def stats(self, path=None, top=statistics.DEFAULT_TOP):
+        """Возвращает сводку содержимого корзины.
+
+        Сводка -- словарь TrashStats.get_report: самые большие файлы,
+        гистограммы размеров и возраста, распределение числа версий
+        и рост корзины в байтах за сутки.
+
+        Непозиционные аргументы:
+        path -- папка (по умолчанию: вся корзина)
+        top -- сколько самых больших файлов включить в сводку
+
+        Корзина блокируется для чтения.
+
+        """
+        with self.trash.lock(shared=True):
+            return self.trash.collect_stats(path, top=top).get_report()
+
     def clean(self, path_mask=None, recursive=False, how_old=-1):
         """Удаляет файлы из корзины навсегда.
 
@@ -260,7 +449,11 @@ class Remover(object):
                    Если больше числа файлов, берется последняя версия.
                    По умолчанию: -1 (все версии)
 
-        Корзина блокируется.
+        Корзина (или поддерево маски, см. remove) блокируется.
+
+        Если маска не задана, корзина очищается целиком
+        (см. Trash.purge): функция не ждет удаления файлов с диска,
+        а в списке очищенных объектов возвращается только корзина.
 
         """
         size = 0
@@ -268,9 +461,18 @@ class Remover(object):
         files = []
 
         if path_mask is None:
-            path_mask = self.trash.directory
-
-        with self.trash.lock():
+            if not control.clean(self.trash.directory,
+                                 interactive=self.interactive):
+                return count, size, files
+            if self.dryrun:
+                with self.trash.dryrun_mode():
+                    count, size = self.trash.purge()
+            else:
+                count, size = self.trash.purge()
+            return count, size, [(self.trash.directory, None)]
+
+        directory = os.path.dirname(utils.get_absolute_path(path_mask))
+        with self.trash.lock(subtree=directory):
             files_versions = self.trash.search(path_mask, recursive=recursive,
                                                find_all=True)
 
@@ -295,6 +497,17 @@ class Remover(object):
 
         return count, size, files
 
+    def session(self, **kwargs):
+        """Возвращает сессию корзины (см. Trash.session).
+
+        Пока сессия открыта, remove, restore и clean не блокируют
+        корзину заново, поэтому ее размер и кэши сохраняются между
+        вызовами. Сессия поддерева допускает только операции
+        в этом поддереве.
+
+        """
+        return self.trash.session(**kwargs)
+
     def autoclean(self):
         """Выполняет очистку. Возвращает кол-во очищ файлов и размер.
 
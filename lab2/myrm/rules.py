@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит правила хранения файлов в корзине.
+
+Правило записывается как "{маска}:{действие}". Действия:
+    * keep -- никогда не очищать файл автоматически
+    * max{N} -- хранить не более N последних версий файла
+    * {время} -- хранить не дольше заданного времени (см. ttl.parse_ttl)
+
+Маска задается в формате Unix filename pattern, '*' не совпадает
+с '/', '**' совпадает с любой частью пути. Маска без '/' проверяется
+по имени файла, иначе -- по полному пути.
+
+Как и в .gitignore, при совпадении нескольких масок действует
+последнее правило: сначала записываются общие правила, затем
+исключения из них.
+
+Список экспортируемых функций:
+    * parse_rule -- разбирает правило
+
+Классы модуля:
+    * RulesMatcher -- классифицирует пути по списку правил
+
+"""
+
+
+import re
+
+import myrm.ttl as ttl
+
+
+KEEP = "keep"
+MAX_VERSIONS = "max"
+MAX_AGE = "age"
+
+# Ограничение модуля re на число групп в выражении
+_GROUPS_PER_PATTERN = 90
+
+
+def _translate(mask):
+    """Возвращает регулярное выражение для маски.
+
+    Позицонные аргументы:
+    mask -- маска в формате Unix filename pattern
+
+    """
+    result = []
+    index = 0
+    length = len(mask)
+    while index < length:
+        char = mask[index]
+        index += 1
+        if char == "*":
+            if index < length and mask[index] == "*":
+                index += 1
+                if index < length and mask[index] == "/":
+                    index += 1
+                    result.append("(?:.*/)?")
+                else:
+                    result.append(".*")
+            else:
+                result.append("[^/]*")
+        elif char == "?":
+            result.append("[^/]")
+        elif char == "[":
+            end = index
+            if end < length and mask[end] == "!":
+                end += 1
+            if end < length and mask[end] == "]":
+                end += 1
+            while end < length and mask[end] != "]":
+                end += 1
+            if end >= length:
+                result.append("\\[")
+            else:
+                chars = mask[index:end].replace("\\", "\\\\")
+                index = end + 1
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                elif chars.startswith("^"):
+                    chars = "\\" + chars
+                result.append("[{chars}]".format(chars=chars))
+        else:
+            result.append(re.escape(char))
+
+    regex = "".join(result)
+    if "/" not in mask:
+        regex = "(?:.*/)?" + regex
+    return regex
+
+
+def parse_rule(rule):
+    """Разбирает правило. Возвращает маску, действие и его параметр.
+
+    Позицонные аргументы:
+    rule -- строка вида "{маска}:{действие}"
+
+    Выбрасывает ValueError если правило имеет плохой формат.
+
+    """
+    mask, sep, action = str(rule).strip().rpartition(":")
+    mask = mask.strip()
+    action = action.strip().lower()
+    if not sep or not mask:
+        raise ValueError("Bad rule '{rule}'.".format(rule=rule))
+
+    if action == KEEP:
+        return mask, KEEP, None
+
+    if action.startswith(MAX_VERSIONS):
+        try:
+            count = int(action[len(MAX_VERSIONS):])
+        except ValueError:
+            raise ValueError("Bad rule '{rule}'.".format(rule=rule))
+        return mask, MAX_VERSIONS, count
+
+    return mask, MAX_AGE, ttl.parse_ttl(action)
+
+
+class RulesMatcher(object):
+
+    """Классифицирует пути по списку правил.
+
+    Все маски компилируются в одно регулярное выражение
+    (объединение именованных групп), поэтому классификация пути --
+    один проход выражения, а не проверка каждой маски по очереди.
+    При совпадении нескольких масок действует последнее правило,
+    поэтому в выражении правила перечисляются в обратном порядке.
+
+    Методы класса:
+    * classify -- возвращает действие и параметр для пути
+    * has_action -- есть ли правила с данным действием
+
+    """
+
+    def __init__(self, rules=()):
+        """Компилирует список правил.
+
+        Позицонные аргументы:
+        rules -- список правил или строка правил через запятую
+
+        """
+        if isinstance(rules, basestring):
+            rules = [rule for rule in rules.split(",") if rule.strip()]
+
+        self.rules = [parse_rule(rule) for rule in rules]
+        self._patterns = []
+
+        numbered = list(enumerate(self.rules))
+        numbered.reverse()
+        for start in xrange(0, len(numbered), _GROUPS_PER_PATTERN):
+            chunk = numbered[start:start + _GROUPS_PER_PATTERN]
+            groups = ["(?P<r{num}>{regex})\\Z".format(num=num,
+                                                      regex=_translate(mask))
+                      for num, (mask, _, _) in chunk]
+            self._patterns.append(re.compile("|".join(groups)))
+
+    def __len__(self):
+        """Возвращает число правил.
+        """
+        return len(self.rules)
+
+    def has_action(self, action):
+        """Возвращает, есть ли правила с данным действием.
+        """
+        return any(rule_action == action for _, rule_action, _ in self.rules)
+
+    def classify(self, path):
+        """Возвращает (действие, параметр) последнего подходящего правила.
+
+        Позицонные аргументы:
+        path -- полный путь к файлу
+
+        Если ни одно правило не подходит, возвращает (None, None).
+
+        """
+        for pattern in self._patterns:
+            match = pattern.match(path)
+            if match is not None:
+                _, action, value = self.rules[int(match.lastgroup[1:])]
+                return action, value
+        return None, None
@@ -5,11 +5,13 @@
 
 Список экспортируемых функций:
     * get_time_stamp -- преобразует объект datetime в штамп
+    * get_datetime -- преобразует штамп в объект datetime
     * add_stamp -- добавляет штамп к имени файла
     * split_stamp -- отделяет имя файла и штамп
     * extend_mask_by_stamp -- расширяет маску маской штампа
     * get_versions_list  -- возвращает список версий файла
     * get_version -- возвращает путь к файлу с заданной версией
+    * find_version_as_of -- ищет версию, удаленную не позже момента
     * get_file_list_dict -- создает словарь версий файлов
     * files_to_file_dict -- преобразует список файлов в словарь версий
 
@@ -36,6 +38,19 @@ def get_time_stamp(dtime):
     return sec, dtime.microsecond
 
 
+def get_datetime(sec, msec):
+    """Возвращает объект datetime по POSIX времени и микросекундам.
+
+     Позицонные аргументы:
+    sec -- POSIX время
+    msec -- количество микросекунд
+
+    """
+    dtime = datetime.datetime.utcfromtimestamp(sec)
+    dtime += datetime.timedelta(microseconds=msec)
+    return dtime
+
+
 def add_stamp(path, dtime):
     """Возвращает Путь файла рассширенный штампом времени
 
@@ -79,9 +94,7 @@ def split_stamp(path):
     try:
         sec = int(rm_dt)
         msec = int(rm_msec)
-        dtime = datetime.datetime.utcfromtimestamp(sec)
-        dtime += datetime.timedelta(microseconds=msec)
-        return filename, dtime
+        return filename, get_datetime(sec, msec)
     except ValueError:
         return path, None
 
@@ -134,6 +147,29 @@ def get_version(path, how_old):
     return add_stamp(path, versions[how_old])
 
 
+def find_version_as_of(versions, dtime):
+    """Возвращает номер самой новой версии, удаленной не позже dtime.
+
+    Позицонные аргументы:
+    versions -- список кортежей (штамп времени, ...), упорядоченный
+                от новой версии к старой
+    dtime -- Объект datetime
+
+    Поиск двоичный. Если все версии удалены позже dtime,
+    возвращается None.
+
+    """
+    low = 0
+    high = len(versions)
+    while low < high:
+        middle = (low + high) // 2
+        if versions[middle][0] > dtime:
+            low = middle + 1
+        else:
+            high = middle
+    return low if low < len(versions) else None
+
+
 def get_file_list_dict(file_time_list):
     """get_file_list_dict(file_time_list) -> словарь версий
 
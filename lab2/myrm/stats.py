@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит сводку содержимого корзины для планирования места.
+
+Сводка собирается за один проход по файлам корзины (или по индексу)
+и не хранит список всех файлов: самые большие элементы держатся
+в куче из top элементов, а размеры и возраст раскладываются
+по гистограммам с фиксированными границами. Поэтому память сводки
+не зависит от числа файлов в корзине.
+
+Классы модуля:
+    * Histogram -- потоковая гистограмма
+    * TrashStats -- сводка содержимого корзины
+
+Список экспортируемых функций:
+    * add_index_objects -- учитывает объекты индекса в сводке
+
+"""
+
+
+import bisect
+import heapq
+import datetime
+import itertools
+
+import myrm.stamp as stamp
+
+
+DEFAULT_TOP = 10
+DEFAULT_GROWTH_PERIOD = 7*24*60*60
+DAY = 24*60*60
+
+SIZE_BOUNDS = (1024, 64*1024, 1024*1024, 16*1024*1024, 256*1024*1024,
+               1024*1024*1024)
+AGE_BOUNDS = (60*60, DAY, 7*DAY, 30*DAY, 365*DAY)
+
+
+class Histogram(object):
+
+    """Потоковая гистограмма с фиксированными границами.
+
+    Поля класса:
+    * bounds -- возрастающие границы интервалов
+    * counts -- число значений в каждом интервале
+    * sizes -- суммарный размер файлов в каждом интервале
+
+    Методы класса:
+    * add -- учитывает значение
+    * get_buckets -- список интервалов
+
+    """
+
+    def __init__(self, bounds):
+        """Создает пустую гистограмму.
+
+        Позицонные аргументы:
+        bounds -- возрастающие границы интервалов
+
+        """
+        self.bounds = list(bounds)
+        self.counts = [0]*(len(self.bounds) + 1)
+        self.sizes = [0]*(len(self.bounds) + 1)
+
+    def add(self, value, size=0):
+        """Учитывает значение.
+
+        Позицонные аргументы:
+        value -- значение
+
+        Непозиционные аргументы:
+        size -- размер файла, добавляемый к интервалу
+
+        """
+        index = bisect.bisect_right(self.bounds, value)
+        self.counts[index] += 1
+        self.sizes[index] += size
+
+    def get_buckets(self):
+        """Возвращает список интервалов.
+
+        Элемент -- кортеж (нижняя граница, верхняя граница, число
+        значений, размер). Верхняя граница последнего интервала -- None.
+
+        """
+        lows = [0] + self.bounds
+        highs = self.bounds + [None]
+        return zip(lows, highs, self.counts, self.sizes)
+
+
+class TrashStats(object):
+
+    """Сводка содержимого корзины.
+
+    Поля класса:
+    * top -- сколько самых больших элементов хранить
+    * now -- время, от которого считается возраст
+    * growth_period -- за сколько последних секунд считается рост
+    * count -- число файлов
+    * size -- суммарный размер
+    * oldest -- время удаления самого старого файла (или None)
+    * newest -- время удаления самого нового файла (или None)
+    * sizes -- гистограмма размеров
+    * ages -- гистограмма возраста в секундах
+    * versions -- словарь {число версий: число путей}
+    * recent_size -- размер файлов, удаленных за growth_period
+
+    Методы класса:
+    * add -- учитывает файл корзины
+    * add_versions -- учитывает число версий одного пути
+    * get_largest -- самые большие файлы
+    * get_growth_rate -- рост корзины в байтах за сутки
+    * get_report -- сводка в виде словаря
+
+    """
+
+    def __init__(self, top=DEFAULT_TOP, now=None,
+                 growth_period=DEFAULT_GROWTH_PERIOD):
+        """Создает пустую сводку.
+
+        Непозиционные аргументы:
+        top -- сколько самых больших элементов хранить
+        now -- время, от которого считается возраст
+               (по умолчанию: текущее)
+        growth_period -- за сколько последних секунд считается рост
+
+        """
+        self.top = top
+        self.now = now if now is not None else datetime.datetime.now()
+        self.growth_period = growth_period
+        self.count = 0
+        self.size = 0
+        self.oldest = None
+        self.newest = None
+        self.sizes = Histogram(SIZE_BOUNDS)
+        self.ages = Histogram(AGE_BOUNDS)
+        self.versions = {}
+        self.recent_size = 0
+        self._largest = []
+
+    def add(self, path, dtime, size):
+        """Учитывает файл корзины.
+
+        Позицонные аргументы:
+        path -- внешний путь файла
+        dtime -- время удаления
+        size -- размер файла в корзине
+
+        """
+        self.count += 1
+        self.size += size
+        if self.oldest is None or dtime < self.oldest:
+            self.oldest = dtime
+        if self.newest is None or dtime > self.newest:
+            self.newest = dtime
+
+        age = max((self.now - dtime).total_seconds(), 0)
+        self.sizes.add(size, size)
+        self.ages.add(age, size)
+        if age <= self.growth_period:
+            self.recent_size += size
+
+        if self.top > 0:
+            item = (size, path, dtime)
+            if len(self._largest) < self.top:
+                heapq.heappush(self._largest, item)
+            elif item > self._largest[0]:
+                heapq.heapreplace(self._largest, item)
+
+    def add_versions(self, count):
+        """Учитывает число версий одного пути.
+        """
+        self.versions[count] = self.versions.get(count, 0) + 1
+
+    def get_largest(self):
+        """Возвращает самые большие файлы от большего к меньшему.
+
+        Элемент -- кортеж (путь, время удаления, размер).
+        """
+        return [(path, dtime, size)
+                for size, path, dtime in sorted(self._largest, reverse=True)]
+
+    def get_growth_rate(self):
+        """Возвращает рост корзины в байтах за сутки.
+
+        Считается по файлам, удаленным за последние growth_period
+        секунд, которые еще лежат в корзине.
+
+        """
+        return self.recent_size * DAY / float(self.growth_period)
+
+    def get_report(self):
+        """Возвращает сводку в виде словаря.
+
+        Ключи: count, size, oldest, newest, largest (см. get_largest),
+        sizes и ages (см. Histogram.get_buckets), versions, growth_rate.
+
+        """
+        return {
+            "count": self.count,
+            "size": self.size,
+            "oldest": self.oldest,
+            "newest": self.newest,
+            "largest": self.get_largest(),
+            "sizes": self.sizes.get_buckets(),
+            "ages": self.ages.get_buckets(),
+            "versions": dict(self.versions),
+            "growth_rate": self.get_growth_rate(),
+        }
+
+
+def add_index_objects(summary, rows):
+    """Учитывает объекты индекса в сводке.
+
+    Позицонные аргументы:
+    summary -- сводка (TrashStats)
+    rows -- итератор кортежей (путь, секунды, микросекунды, размер),
+            упорядоченных по пути (см. ObjectIndex.iter_objects)
+
+    Версии одного пути идут подряд, поэтому в памяти держится
+    только текущий путь.
+
+    """
+    for path, versions in itertools.groupby(rows, key=lambda row: row[0]):
+        count = 0
+        for _, sec, msec, size in versions:
+            summary.add(path, stamp.get_datetime(sec, msec), size)
+            count += 1
+        summary.add_versions(count)
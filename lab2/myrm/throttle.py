@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит ограничение скорости операций ввода-вывода корзины.
+
+Очистка, автоочистка и фоновое удаление надгробий могут занять весь
+диск и помешать остальным программам на том же разделе. Throttle
+ограничивает число удалений файлов, объем копируемых (сжимаемых)
+данных и объем обрезаемых перед удалением данных в секунду с помощью
+корзин токенов (TokenBucket) и считает время, проведенное в ожидании.
+
+Счетчики доступны во время работы (Throttle.get_stats), а фоновый
+процесс периодически сохраняет их в файл (см. stats_path).
+
+Список экспортируемых функций:
+    * copy_file_obj -- копирует данные с ограничением скорости
+    * set_io_priority -- понижает приоритет ввода-вывода процесса
+    * load_stats -- загружает сохраненные счетчики
+
+Классы модуля:
+    * TokenBucket -- корзина токенов
+    * Throttle -- ограничение удалений и объема данных
+
+"""
+
+
+import os
+import json
+import time
+import ctypes
+import logging
+import threading
+import ctypes.util
+
+
+CHUNK_SIZE = 1024*1024
+STATS_INTERVAL = 1.0
+
+# Классы приоритета ввода-вывода Linux (см. ioprio_set(2))
+IOPRIO_CLASS_BEST_EFFORT = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IDLE = "idle"
+_IOPRIO_SET = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+}
+
+
+class TokenBucket(object):
+
+    """Корзина токенов.
+
+    Токены пополняются со скоростью rate в секунду, но не больше
+    burst. consume забирает токены и, если их не хватает, ждет,
+    пока недостача не восполнится. Безопасна для потоков.
+
+    Поля класса:
+    * rate -- токенов в секунду (None -- без ограничения)
+    * burst -- наибольший запас токенов
+    * consumed -- всего забрано токенов
+    * throttled_time -- всего секунд ожидания
+
+    Методы класса:
+    * consume -- забирает токены, при необходимости ожидая
+
+    """
+
+    def __init__(self, rate=None, burst=None):
+        """Создает корзину.
+
+        Непозиционные аргументы:
+        rate -- токенов в секунду (None -- без ограничения)
+        burst -- наибольший запас токенов (по умолчанию: rate)
+
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.consumed = 0
+        self.throttled_time = 0.0
+
+        self._tokens = self.burst
+        self._time = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, amount=1):
+        """Забирает токены. Возвращает время ожидания в секундах.
+
+        Непозиционные аргументы:
+        amount -- число токенов (может быть больше burst)
+
+        """
+        with self._lock:
+            self.consumed += amount
+            if not self.rate:
+                return 0
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._time) * self.rate)
+            self._time = now
+            self._tokens -= amount
+            wait = 0
+            if self._tokens < 0:
+                wait = -self._tokens / float(self.rate)
+                self.throttled_time += wait
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class Throttle(object):
+
+    """Ограничение удалений и объема данных в секунду.
+
+    Поля класса:
+    * unlinks -- корзина токенов удалений файлов
+    * io -- корзина токенов копируемых и сжимаемых байт
+    * truncates -- корзина токенов обрезаемых байт
+    * stats_path -- файл, в который сохраняются счетчики (или None)
+
+    Методы класса:
+    * unlink -- учитывает удаление файлов
+    * transfer -- учитывает копируемые данные
+    * truncate -- учитывает обрезаемые данные
+    * get_throttled_time -- время ожидания в секундах
+    * get_stats -- текущие счетчики
+    * save_stats -- сохраняет счетчики в stats_path
+
+    """
+
+    def __init__(self, unlink_rate=None, io_rate=None, truncate_rate=None,
+                 stats_path=None):
+        """Создает ограничение.
+
+        Непозиционные аргументы:
+        unlink_rate -- удалений в секунду (None -- без ограничения)
+        io_rate -- байт в секунду (None -- без ограничения)
+        truncate_rate -- обрезаемых байт в секунду
+                         (None -- без ограничения)
+        stats_path -- файл, в который периодически сохраняются
+                      счетчики (None -- не сохранять)
+
+        """
+        self.unlinks = TokenBucket(unlink_rate)
+        self.io = TokenBucket(io_rate)
+        self.truncates = TokenBucket(truncate_rate)
+        self.stats_path = stats_path
+        self._saved = 0
+        self._save_lock = threading.Lock()
+
+    def unlink(self, count=1):
+        """Учитывает удаление файлов. Возвращает время ожидания.
+        """
+        wait = self.unlinks.consume(count)
+        self._save_periodically()
+        return wait
+
+    def transfer(self, size):
+        """Учитывает копируемые данные. Возвращает время ожидания.
+        """
+        wait = self.io.consume(size)
+        self._save_periodically()
+        return wait
+
+    def truncate(self, size):
+        """Учитывает обрезаемые данные. Возвращает время ожидания.
+        """
+        wait = self.truncates.consume(size)
+        self._save_periodically()
+        return wait
+
+    def get_throttled_time(self):
+        """Возвращает общее время ожидания в секундах.
+        """
+        return (self.unlinks.throttled_time + self.io.throttled_time +
+                self.truncates.throttled_time)
+
+    def get_stats(self):
+        """Возвращает словарь текущих счетчиков.
+
+        Ключи: unlinked -- удалено файлов, transferred -- скопировано
+        байт, truncated -- обрезано байт, throttled -- секунд ожидания.
+
+        """
+        return {
+            "unlinked": self.unlinks.consumed,
+            "transferred": self.io.consumed,
+            "truncated": self.truncates.consumed,
+            "throttled": self.get_throttled_time(),
+        }
+
+    def save_stats(self, **extra):
+        """Сохраняет счетчики в stats_path.
+
+        Непозиционные аргументы:
+        extra -- дополнительные поля
+
+        Файл заменяется атомарно, поэтому его можно читать
+        во время работы.
+
+        """
+        if self.stats_path is None:
+            return
+        stats = self.get_stats()
+        stats.update(pid=os.getpid(), updated=time.time())
+        stats.update(extra)
+        temp_path = "{path}.{pid}".format(path=self.stats_path,
+                                          pid=os.getpid())
+        with self._save_lock:
+            with open(temp_path, "w") as output_file:
+                json.dump(stats, output_file)
+            os.rename(temp_path, self.stats_path)
+            self._saved = time.time()
+
+    def _save_periodically(self):
+        """Сохраняет счетчики не чаще раза в STATS_INTERVAL секунд.
+        """
+        if (self.stats_path is not None and
+                time.time() - self._saved >= STATS_INTERVAL):
+            self.save_stats()
+
+
+def load_stats(path):
+    """Загружает сохраненные счетчики. Возвращает словарь или None.
+
+    Позицонные аргументы:
+    path -- файл счетчиков (см. Throttle.save_stats)
+
+    """
+    try:
+        with open(path, "r") as input_file:
+            return json.load(input_file)
+    except (IOError, ValueError):
+        return None
+
+
+def copy_file_obj(input_file, output_file, throttle=None,
+                  chunk_size=CHUNK_SIZE):
+    """Копирует данные между файлами. Возвращает их объем.
+
+    Позицонные аргументы:
+    input_file -- исходный файл
+    output_file -- файл назначения
+
+    Непозиционные аргументы:
+    throttle -- ограничение скорости (None -- без ограничения)
+    chunk_size -- размер блока копирования
+
+    """
+    size = 0
+    chunk = input_file.read(chunk_size)
+    while chunk:
+        if throttle is not None:
+            throttle.transfer(len(chunk))
+        output_file.write(chunk)
+        size += len(chunk)
+        chunk = input_file.read(chunk_size)
+    return size
+
+
+def set_io_priority(ionice):
+    """Понижает приоритет ввода-вывода процесса. Возвращает успех.
+
+    Позицонные аргументы:
+    ionice -- "idle" или уровень 0-7 класса best-effort
+
+    Работает только в Linux. Выбрасывает ValueError
+    при неизвестном значении.
+
+    """
+    if ionice == IDLE:
+        value = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+    elif isinstance(ionice, int) and 0 <= ionice <= 7:
+        value = (IOPRIO_CLASS_BEST_EFFORT << IOPRIO_CLASS_SHIFT) | ionice
+    else:
+        raise ValueError("Unsoported ionice {0!r}".format(ionice))
+
+    syscall_number = _IOPRIO_SET.get(os.uname()[4])
+    if syscall_number is None:
+        logging.debug("ioprio_set is unsoported on this platform")
+        return False
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, value) != 0:
+        debug_fmt = "ioprio_set failed: {error}"
+        logging.debug(debug_fmt.format(error=os.strerror(ctypes.get_errno())))
+        return False
+    return True
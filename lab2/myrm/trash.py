@@ -5,27 +5,131 @@
 
 Вспомогательный класс:
     * TrashLocker - для блокировки корзины через менеджер контента.
+    * TrashSession - для работы с корзиной под долгой блокировкой.
     * Dryruner - для включения dryrun через менеджер контента.
 
+Функции модуля:
+    * get_bucket_period -- возвращает период временного раздела корзины
+
 Исключения модуля:
     LimitExcessException -- выбрасывается при превышении лимита
+    QuotaExcessException -- выбрасывается при превышении квоты арендатора
 
 """
 
 
 import os
+import re
+import stat
+import urllib
+import errno
+import fcntl
+import fnmatch
+import shutil
 import datetime
 import logging
+import threading
+import time
+import collections
 import multiprocessing
+import multiprocessing.pool
 import myrm.utils as utils
 import myrm.stamp as stamp
+import myrm.delta as delta
+import myrm.dirfd as dirfd
+import myrm.purge as purge
+import myrm.throttle as throttle
+import myrm.locking as locking
+import myrm.packs as packs
+import myrm.compress as compress
+import myrm.encoded as encoded
+import myrm.quotas as quota
+import myrm.stats as statistics
+
+from myrm.ttl import TtlIndex
+from myrm.dedup import DedupIndex
+from myrm.packs import PackIndex
+from myrm.encoded import EncodedIndex
+from myrm.locking import LockQueue
+from myrm.usage import UsageCounter
+from myrm.quotas import QuotaIndex
+from myrm.stats import TrashStats
+from myrm.oplog import OperationLog
 
 
 DEFAULT_DIRECTORY = "~/.trash"
 DEFAULT_LOCK_FILE = "lock"
+DEFAULT_LOCK_TIMEOUT = 0
+DEFAULT_LOCK_DEPTH = None
+DEFAULT_QUOTAS = None
+DEFAULT_ROLLUP = False
 DEFAULT_MAX_SIZE = 1024*1024*1024
 DEFAULT_MAX_COUNT = 10*1000*1000
 DEFAULT_DRYRUN = False
+DEFAULT_MAX_VERSIONS = None
+DEFAULT_DEDUP = False
+DEFAULT_COMPRESSION = None
+DEFAULT_COMPRESS_MIN_SIZE = 16*1024*1024
+DEFAULT_COMPRESS_AGE = 7*24*60*60
+DEFAULT_DELTA = False
+DEFAULT_PACK_AGE = None
+DEFAULT_CAPACITY_DIRECTORY = None
+DEFAULT_CAPACITY_MAX_SIZE = 16*1024*1024*1024
+DEFAULT_MIGRATE_AGE = None
+DEFAULT_MIGRATE_SIZE = None
+DEFAULT_UNLINK_RATE = None
+DEFAULT_IO_RATE = None
+DEFAULT_PURGE_NICE = purge.DEFAULT_NICE
+DEFAULT_PURGE_IONICE = None
+DEFAULT_TRUNCATE_SIZE = 1024*1024*1024
+DEFAULT_TRUNCATE_STEP = purge.DEFAULT_TRUNCATE_STEP
+DEFAULT_TRUNCATE_RATE = None
+DEFAULT_SESSION_FLUSH_INTERVAL = 5.0
+DEFAULT_SESSION_LEASE = None
+DEFAULT_SESSION_RENEW_TIMEOUT = None
+
+# Служебная папка корзины. Не содержит удаленных файлов.
+META_DIRECTORY = ".meta"
+TTL_DIRECTORY = "ttl"
+DEDUP_DIRECTORY = "dedup"
+PURGE_STATS_FILE = "purge.json"
+LOCK_QUEUE_DIRECTORY = "lock_queue"
+SUBTREE_LOCKS_DIRECTORY = "locks"
+USAGE_FILE = "usage"
+OPERATION_LOG_FILE = "operations.log"
+
+# Временные разделы корзины: "@{год}{месяц}{день}[{час}]"
+DEFAULT_PARTITION = None
+BUCKET_PREFIX = "@"
+PARTITION_FORMATS = {
+    "day": "%Y%m%d",
+    "hour": "%Y%m%d%H",
+}
+PARTITION_PERIODS = {
+    "day": datetime.timedelta(days=1),
+    "hour": datetime.timedelta(hours=1),
+}
+
+
+def get_bucket_period(name):
+    """Возвращает начало и конец периода временного раздела корзины.
+
+    Позиционные аргументы:
+    name -- имя папки раздела
+
+    Если имя не является именем раздела, возвращает None.
+
+    """
+    if not name.startswith(BUCKET_PREFIX):
+        return None
+    for partition, fmt in PARTITION_FORMATS.iteritems():
+        try:
+            start = datetime.datetime.strptime(name[len(BUCKET_PREFIX):], fmt)
+        except ValueError:
+            continue
+        if start.strftime(fmt) == name[len(BUCKET_PREFIX):]:
+            return start, start + PARTITION_PERIODS[partition]
+    return None
 
 class LimitExcessException(Exception):
     """Возбуждается при превышения пользовательского лимита.
@@ -33,25 +137,59 @@ class LimitExcessException(Exception):
     pass
 
 
+class QuotaExcessException(LimitExcessException):
+    """Возбуждается при превышении квоты арендатора (см. myrm.quotas).
+
+    Поля класса:
+    * tenant -- арендатор, квота которого превышена
+    * size -- размер добавляемых файлов арендатора
+    * count -- число добавляемых файлов арендатора
+
+    """
+
+    def __init__(self, tenant, size, count):
+        error_fmt = "Quota of {kind} {key} excess."
+        super(QuotaExcessException, self).__init__(
+            error_fmt.format(kind=tenant[0], key=tenant[1]))
+        self.tenant = tenant
+        self.size = size
+        self.count = count
+
+
 class TrashLocker(object):
     """Используется для блокировки корзины через менеджер контента.
     """
 
-    def __init__(self, trash):
+    def __init__(self, trash, shared=False, subtree=None):
         """Создает объект для указанной корзины.
+
+        Непозиционные аргументы:
+        shared -- разделяемая блокировка для чтения
+        subtree -- путь, поддерево которого блокируется для изменения
+
         """
         self.trash = trash
+        self.shared = shared
+        self.subtree = subtree
         self._was_locked = None
 
     def __enter__(self):
         """Блокирует корзину.
 
         Корзина не блокирется если она уже заблокированна.
+        Выбрасывает IOError, если для изменения нужна
+        монопольная блокировка, а корзина заблокирована для чтения.
         """
         self._was_locked = self.trash.is_locked()
 
         if not self._was_locked:
-            self.trash.set_lock()
+            self.trash.set_lock(shared=self.shared, subtree=self.subtree)
+        elif self.trash.is_shared() and not self.shared:
+            raise IOError("Trash is locked for reading only.")
+        elif (self.trash.get_subtree() is not None and not self.shared and
+              self.trash.get_subtree() != self.trash.get_subtree_key(
+                  self.subtree)):
+            raise IOError("Trash is locked for another subtree only.")
 
     def __exit__(self, exp_type, exp_value, traceback):
         """Разблокирует корзину.
@@ -62,6 +200,194 @@ class TrashLocker(object):
             self.trash.unset_lock()
 
 
+class TrashSession(object):
+
+    """Держит блокировку корзины на протяжении многих операций.
+
+    Обычный вызов блокирует корзину, обходит ее для подсчета размера
+    и сбрасывает все кэши при снятии блокировки. Сессия блокирует
+    корзину один раз, поэтому размер, число файлов, кэш версий
+    и созданных папок сохраняются между вызовами add, restore
+    и remove. Изменения индексов сохраняются пачками (см. Trash.flush)
+    не реже раза в flush_interval секунд и при закрытии сессии.
+
+    Поля класса:
+    * trash -- корзина
+    * shared -- разделяемая блокировка для чтения
+    * subtree -- путь, поддерево которого блокируется (см. Trash.set_lock)
+    * flush_interval -- наибольший промежуток между сохранениями, с
+    * lease -- сколько секунд держать блокировку, если ее ждут
+               другие процессы (None -- до закрытия сессии)
+    * renew_timeout -- сколько секунд ждать блокировку снова после
+                       истечения lease (None -- без ограничения)
+
+    Методы класса:
+    * open -- блокирует корзину
+    * close -- сохраняет изменения и снимает блокировку
+    * flush -- сохраняет изменения, продлевает аренду блокировки
+    * is_open -- открыта ли сессия
+    * get_stats -- счетчики сессии
+    * add, restore, remove, search -- операции корзины
+
+    По истечении lease блокировка при очередном сохранении
+    снимается и берется снова, если ее ждут другие процессы:
+    они проходят по очереди (см. myrm.locking), а кэши
+    сессии строятся заново. Ожидающие стоят в очереди раньше
+    сессии, поэтому блокировка берется снова с renew_timeout,
+    а не с lock_timeout корзины. Если взять ее не удалось,
+    сессия закрывается.
+
+    """
+
+    def __init__(self, trash, shared=False, subtree=None,
+                 flush_interval=DEFAULT_SESSION_FLUSH_INTERVAL,
+                 lease=DEFAULT_SESSION_LEASE,
+                 renew_timeout=DEFAULT_SESSION_RENEW_TIMEOUT):
+        """Создает сессию для указанной корзины. См. поля класса.
+        """
+        self.trash = trash
+        self.shared = shared
+        self.subtree = subtree
+        self.flush_interval = flush_interval
+        self.lease = lease
+        self.renew_timeout = renew_timeout
+        self._open = False
+        self._acquired = None
+        self._flushed = None
+        self._stats = {"operations": 0, "flushes": 0, "renewals": 0}
+
+    def open(self):
+        """Блокирует корзину.
+
+        Выбрасывает IOError, если корзина уже заблокирована
+        этим объектом.
+
+        """
+        if self._open:
+            return
+        if self.trash.is_locked():
+            raise IOError("Trash is already locked.")
+        self._acquire()
+        self._open = True
+
+    def close(self):
+        """Сохраняет изменения и снимает блокировку.
+        """
+        if not self._open:
+            return
+        self._open = False
+        try:
+            self.trash.flush()
+            self._stats["flushes"] += 1
+        finally:
+            self._release()
+
+    def flush(self):
+        """Сохраняет изменения. Продлевает аренду блокировки.
+        """
+        if not self._open:
+            raise IOError("Trash session is closed.")
+        self.trash.flush()
+        self._stats["flushes"] += 1
+        self._flushed = time.time()
+
+        if (self.lease is not None and
+                time.time() - self._acquired >= self.lease and
+                self.trash.has_lock_waiters()):
+            debug_fmt = "Trash session lease expired after {held:.3f}s"
+            logging.debug(debug_fmt.format(held=time.time() - self._acquired))
+            self._release()
+            try:
+                self._acquire(renew=True)
+            except Exception:
+                self._open = False
+                self._acquired = None
+                self._flushed = None
+                raise
+            self._stats["renewals"] += 1
+
+    def is_open(self):
+        """Возвращает, открыта ли сессия.
+        """
+        return self._open
+
+    def get_stats(self):
+        """Возвращает словарь счетчиков сессии.
+
+        Ключи: operations -- выполнено операций, flushes -- сохранений,
+        renewals -- повторных блокировок по истечении аренды.
+
+        """
+        return dict(self._stats)
+
+    def add(self, path, ttl=None, operation=None):
+        """Добавляет элемент в корзину. См. Trash.add.
+        """
+        return self._call(self.trash.add, path, ttl=ttl, operation=operation)
+
+    def restore(self, path, how_old=0, as_of=None):
+        """Востанавливает элемент из корзины. См. Trash.restore.
+        """
+        return self._call(self.trash.restore, path, how_old=how_old,
+                          as_of=as_of)
+
+    def remove(self, path, how_old=-1):
+        """Удаляет элемент навсегда. См. Trash.remove.
+        """
+        return self._call(self.trash.remove, path, how_old=how_old)
+
+    def search(self, path_mask, recursive=False, find_all=False):
+        """Ищет в корзине по маске. См. Trash.search.
+        """
+        return self._call(self.trash.search, path_mask,
+                          recursive=recursive, find_all=find_all)
+
+    def _call(self, method, *args, **kwargs):
+        """Выполняет операцию и при необходимости сохраняет изменения.
+        """
+        if not self._open:
+            raise IOError("Trash session is closed.")
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._stats["operations"] += 1
+            if time.time() - self._flushed >= self.flush_interval:
+                self.flush()
+
+    def _acquire(self, renew=False):
+        """Блокирует корзину и включает сохранение пачками.
+
+        Непозиционные аргументы:
+        renew -- блокировка берется снова после истечения lease:
+                 ждать renew_timeout вместо lock_timeout корзины
+
+        """
+        if not renew:
+            self.trash.set_lock(shared=self.shared, subtree=self.subtree)
+        else:
+            lock_timeout = self.trash.lock_timeout
+            self.trash.lock_timeout = self.renew_timeout
+            try:
+                self.trash.set_lock(shared=self.shared, subtree=self.subtree)
+            finally:
+                self.trash.lock_timeout = lock_timeout
+        self.trash._batched = True
+        self._acquired = self._flushed = time.time()
+
+    def _release(self):
+        """Выключает сохранение пачками и снимает блокировку.
+        """
+        self.trash._batched = False
+        self.trash.unset_lock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exp_type, exp_value, traceback):
+        self.close()
+
+
 class Dryruner(object):
     """Используется для активации dryrun через менеджер контента.
     """
@@ -90,31 +416,99 @@ class Trash(object):
 
     Поля класса:
     * locked -- заблокированна ли корзина в текущий момент
+    * shared -- заблокированна ли корзина только для чтения
 
     Следующие поля используются только на протяжении блокировки:
     * directory -- путь к папке с корзиной
     * lock_file -- имя файла блокировки
     * max_size -- максимальный размер
     * max_count -- максимальное число файлов
+    * max_versions -- максимальное число версий одного файла
+    * partition -- временные разделы для новых элементов:
+                   None, "day" или "hour"
+    * dedup -- хранить одинаковые файлы один раз
+    * compression -- кодек сжатия (None -- без сжатия)
+    * compress_min_size -- размер, начиная с которого файл
+                           сжимается сразу при добавлении
+    * compress_age -- возраст в секундах, начиная с которого
+                      файл сжимается при compress_cold
+    * delta -- хранить старые версии файла в виде дельт
+    * pack_age -- возраст в секундах, начиная с которого
+                  файл упаковывается при pack_cold
+    * capacity_directory -- папка емкого уровня корзины
+    * capacity_max_size -- максимальный размер емкого уровня
+    * migrate_age -- возраст в секундах, начиная с которого
+                     файл переносится на емкий уровень
+    * migrate_size -- размер, начиная с которого файл
+                      переносится на емкий уровень
+    * unlink_rate -- наибольшее число удалений файлов в секунду
+    * io_rate -- наибольшая скорость копирования и сжатия, байт/с
+    * purge_nice -- понижение приоритета фонового удаления
+    * purge_ionice -- приоритет ввода-вывода фонового удаления
+    * truncate_size -- размер, начиная с которого файл перед
+                       удалением постепенно обрезается
+    * truncate_step -- шаг обрезания в байтах
+    * truncate_rate -- наибольшая скорость обрезания, байт/с
+    * throttle -- ограничение скорости (см. myrm.throttle)
+    * lock_timeout -- сколько секунд ждать блокировку корзины
+    * lock_depth -- глубина блокировки поддеревьев
+    * quotas -- квоты арендаторов (см. myrm.quotas)
+    * rollup -- вести свертку размера по папкам корзины
 
     Методы класса:
     * get_lock_file_path -- возвращает полный путь к файлу блокировки
+    * get_meta_path -- возвращает путь в служебной папке корзины
+    * get_dedup_index -- возвращает индекс содержимого корзины
+    * get_pack_index -- возвращает индекс упакованных файлов
+    * get_encoded_index -- возвращает индекс сжатых файлов и дельт
+    * get_capacity_root -- возвращает корень емкого уровня
+    * get_purge_stats -- счетчики фонового удаления
+    * get_quota_index -- возвращает индекс квот арендаторов
+    * get_operation_log -- возвращает журнал операций удаления
 
     * set_lock -- блокирует корзину
     * unset_lock -- разблокирует корзину
+    * is_shared -- заблокированна ли корзина только для чтения
+    * get_lock_stats -- счетчики ожидания блокировки
+    * get_subtree -- заблокированное поддерево
+    * get_subtree_key -- имя блокировки поддерева пути
+    * get_usage_counter -- общий для процессов счетчик размера
     * lock -- возвращает менеджер контента для блокировки
+    * session -- возвращает сессию под долгой блокировкой
+    * flush -- сохраняет накопленные за блокировку изменения
+    * has_lock_waiters -- ждут ли блокировку другие процессы
 
     * dryrun -- возвращает менеджер контента для dryrun режима
 
     * get_size -- текущий размер корзины
     * get_count -- текущее число файлов в корзине
+    * get_capacity_size -- текущий размер емкого уровня
+    * get_quota_usage -- место, занятое арендатором
+    * get_quota_limit -- квота арендатора
+    * get_over_quota -- арендаторы, превысившие квоту
+    * get_entry_tenants -- арендаторы элемента корзины
+    * rebuild_quotas -- пересчитывает место арендаторов обходом корзины
+    * get_tree_usage -- размер и число файлов элемента корзины
+    * collect_stats -- сводка содержимого корзины
 
     * to_internal -- преобразует путь во внутренний путь корзины
     * to_external -- преобразует путь во внешний путь корзины
 
+    * get_buckets -- список временных разделов корзины
+    * get_roots -- список корней корзины
+    * get_versions_list -- список версий файла во всех корнях
+
     * add -- добавляет элемент в корзину
     * restore -- востанавливает элемент из корзины
     * remove -- удаляет элемент навсегда
+    * remove_stamped -- удаляет элемент, добавленный с заданным штампом
+    * undo -- востанавливает элементы, добавленные операцией
+    * expire -- удаляет элементы с истекшим временем жизни
+    * remove_buckets -- удаляет устаревшие временные разделы
+    * compress_cold -- сжимает давно удаленные элементы
+    * pack_cold -- упаковывает давно удаленные элементы
+    * migrate -- переносит элементы на емкий уровень
+    * purge -- очищает всю корзину
 
     Не следует использовать следущие функции вне класса
     во время блокировки:
@@ -124,11 +518,82 @@ class Trash(object):
     * restore_dir -- востанавливает папку из корзины
 
     Блокировка ускоряет вычисление размера корзины
-    и количество файлов в ней.
+    и количество файлов в ней. Сессия (см. session) сохраняет
+    эти значения и кэши между многими операциями.
 
     При превышение ограничений на корзину
     возбуждается LimitExcessException
 
+    Лишние версии файла (сверх max_versions) удаляются сразу при
+    добавлении, начиная с самой старой.
+
+    Корнем называется папка, в которой повторяется структура
+    исходных путей. Сама корзина является корнем. Если задан partition,
+    новые элементы добавляются в корень временного раздела
+    ("@20171231" или "@2017123123") по штампу времени удаления.
+    Поиск, востановление и удаление работают во всех корнях,
+    а устаревший раздел удаляется целиком.
+
+    Если включен dedup, добавленные файлы с уже имеющимся в корзине
+    содержимым заменяются жесткими ссылками на него (см. DedupIndex).
+    Размер корзины учитывает общее содержимое один раз.
+
+    Если задан compression, большие файлы сжимаются при добавлении,
+    а давно удаленные -- при вызове compress_cold. Сжатые файлы
+    распаковываются при востановлении, а размер корзины и ее лимиты
+    учитывают их сжатый размер. Файлы с общим содержимым
+    не сжимаются.
+
+    Если включен delta, при добавлении новой версии файла предыдущая
+    версия заменяется дельтой относительно новой (см. myrm.delta).
+    Последняя версия всегда хранится целиком, а версия how_old
+    собирается цепочкой из how_old дельт. Перед удалением или
+    востановлением версии зависящая от нее дельта собирается целиком.
+    Файлы с общим содержимым и сжатые файлы дельтами не заменяются.
+
+    Сжатые файлы и дельты записываются в индекс (см. myrm.encoded)
+    вместе с кодеком и штампом базы. Удаленный пользователем файл
+    с таким же заголовком востанавливается как есть.
+
+    Если задан pack_age, pack_cold переносит давно удаленные файлы
+    в пакеты (см. myrm.packs), освобождая их inode. Упакованные файлы
+    находятся поиском и востанавливаются так же, как остальные,
+    а пакет удаляется вместе с последним своим файлом.
+
+    Если задан capacity_directory, корзина состоит из двух уровней:
+    быстрого (папка корзины), куда добавляются новые элементы,
+    и емкого, например на другом диске. migrate переносит на емкий
+    уровень файлы старше migrate_age или не меньше migrate_size.
+    Емкий уровень является еще одним корнем корзины, поэтому поиск,
+    версии и востановление работают с обоими уровнями сразу.
+    max_size ограничивает быстрый уровень, а capacity_max_size --
+    емкий. get_size возвращает размер обоих уровней.
+
+    purge очищает корзину целиком за время нескольких переименований:
+    содержимое переносится в надгробие (см. myrm.purge), которое
+    удаляется с диска фоновым процессом.
+
+    Удаление файлов (clean, автоочистка, фоновое удаление) ограничено
+    unlink_rate, а копирование и сжатие -- io_rate. Время ожидания
+    считается в throttle, а фоновый процесс сохраняет свои счетчики
+    в служебную папку (см. get_purge_stats). Файлы не меньше
+    truncate_size перед удалением обрезаются шагами по truncate_step
+    байт со скоростью не больше truncate_rate, чтобы освобождение
+    экстентов не останавливало файловую систему.
+
+    Если заданы quotas, место в корзине учитывается по владельцам
+    файлов и префиксам исходных путей (см. myrm.quotas). Занятое
+    место меняется на каждом добавлении, востановлении и удалении,
+    а добавление сверх квоты возбуждает QuotaExcessException.
+    Значения пересчитываются обходом корзины при монопольной
+    блокировке, если изменился набор префиксов или операции
+    (сжатие, дельты, упаковка, востановление общего содержимого)
+    изменили размер файлов корзины.
+
+    Если включен rollup, в том же индексе каждый файл учитывается
+    у всех папок на пути к нему, поэтому get_tree_usage возвращает
+    размер папки без ее обхода.
+
     """
     
     mp_manager = multiprocessing.Manager()
@@ -141,7 +606,30 @@ class Trash(object):
                  lock_file=DEFAULT_LOCK_FILE,
                  max_size=DEFAULT_MAX_SIZE,
                  max_count=DEFAULT_MAX_COUNT,
-                 dryrun=DEFAULT_DRYRUN
+                 dryrun=DEFAULT_DRYRUN,
+                 max_versions=DEFAULT_MAX_VERSIONS,
+                 partition=DEFAULT_PARTITION,
+                 dedup=DEFAULT_DEDUP,
+                 compression=DEFAULT_COMPRESSION,
+                 compress_min_size=DEFAULT_COMPRESS_MIN_SIZE,
+                 compress_age=DEFAULT_COMPRESS_AGE,
+                 delta=DEFAULT_DELTA,
+                 pack_age=DEFAULT_PACK_AGE,
+                 capacity_directory=DEFAULT_CAPACITY_DIRECTORY,
+                 capacity_max_size=DEFAULT_CAPACITY_MAX_SIZE,
+                 migrate_age=DEFAULT_MIGRATE_AGE,
+                 migrate_size=DEFAULT_MIGRATE_SIZE,
+                 unlink_rate=DEFAULT_UNLINK_RATE,
+                 io_rate=DEFAULT_IO_RATE,
+                 purge_nice=DEFAULT_PURGE_NICE,
+                 purge_ionice=DEFAULT_PURGE_IONICE,
+                 truncate_size=DEFAULT_TRUNCATE_SIZE,
+                 truncate_step=DEFAULT_TRUNCATE_STEP,
+                 truncate_rate=DEFAULT_TRUNCATE_RATE,
+                 lock_timeout=DEFAULT_LOCK_TIMEOUT,
+                 lock_depth=DEFAULT_LOCK_DEPTH,
+                 quotas=DEFAULT_QUOTAS,
+                 rollup=DEFAULT_ROLLUP
                 ):
         """Создает с укзанными парметрами.
 
@@ -150,22 +638,115 @@ class Trash(object):
         * lock_file -- путь к файлу блокировки относительно корзины
         * max_size -- максимальный суммарный размер корзины
         * max_count -- максимальное количество файлов корзины
+        * max_versions -- максимальное число версий одного файла
+                          (None -- без ограничений)
+        * partition -- временные разделы: None, "day" или "hour"
+        * dedup -- хранить одинаковые файлы один раз
+        * compression -- кодек сжатия: None, "zlib", "bz2",
+                         "lzma" или "zstd" (см. compress.CODECS)
+        * compress_min_size -- сжимать при добавлении файлы
+                               не меньше этого размера
+        * compress_age -- сжимать при compress_cold файлы,
+                          удаленные больше compress_age секунд назад
+        * delta -- хранить старые версии файла в виде дельт
+        * pack_age -- упаковывать при pack_cold файлы, удаленные
+                      больше pack_age секунд назад (None -- никогда)
+        * capacity_directory -- папка емкого уровня (None -- без него)
+        * capacity_max_size -- максимальный размер емкого уровня
+        * migrate_age -- переносить на емкий уровень файлы, удаленные
+                         больше migrate_age секунд назад
+        * migrate_size -- переносить на емкий уровень файлы
+                          не меньше этого размера
+        * unlink_rate -- удалений файлов в секунду
+                         (None -- без ограничения)
+        * io_rate -- байт в секунду при копировании и сжатии
+                     (None -- без ограничения)
+        * purge_nice -- на сколько понизить приоритет
+                        фонового удаления
+        * purge_ionice -- приоритет ввода-вывода фонового удаления:
+                          None, "idle" или уровень 0-7
+        * truncate_size -- постепенно обрезать перед удалением файлы
+                           не меньше этого размера (None -- не обрезать)
+        * truncate_step -- на сколько байт обрезать файл за шаг
+        * truncate_rate -- обрезаемых байт в секунду
+                           (None -- без ограничения)
+        * lock_timeout -- сколько секунд ждать блокировку корзины
+                          (0 -- не ждать, None -- без ограничения)
+        * lock_depth -- число верхних составляющих пути, по которым
+                        блокируются поддеревья (None -- блокировать
+                        всю корзину)
+        * quotas -- квоты арендаторов: {"uid": {uid: квота},
+                    "prefix": {путь: квота}}, где квота --
+                    {"max_size": n, "max_count": n} (None -- без квот)
+        * rollup -- вести свертку размера и числа файлов по папкам
 
         """
-        self.configurate(directory, lock_file, max_size, max_count)
+        self.configurate(directory, lock_file, max_size, max_count,
+                         dryrun, max_versions, partition, dedup,
+                         compression, compress_min_size, compress_age,
+                         delta, pack_age, capacity_directory,
+                         capacity_max_size, migrate_age, migrate_size,
+                         unlink_rate, io_rate, purge_nice, purge_ionice,
+                         truncate_size, truncate_step, truncate_rate,
+                         lock_timeout, lock_depth, quotas, rollup)
 
         self._locked = False
+        self._shared = False
+        self._lock_fd = None
+        self._subtree = None
+        self._subtree_fd = None
+        self._lock_stats = {"acquired": 0, "waited": 0, "wait_time": 0.0,
+                            "max_wait": 0.0, "timeouts": 0}
 
         # Значения известны только во время блокировки
         self._size = None
         self._count = None
+        self._versions = None
+        self._roots = None
+        self._packs = None
+        self._encoded = None
+        self._usage = None
+        self._quota_index = None
+        self._dirs = None
+        self._capacity_size = None
+        self._release_lock = threading.Lock()
+
+        # Изменения места арендаторов до записи в индекс квот
+        self._quota_pending = {}
+        self._quota_lock = threading.Lock()
+
+        # Изменения индексов сохраняются в flush (см. TrashSession)
+        self._batched = False
 
     def configurate(self,
                     directory=DEFAULT_DIRECTORY,
                     lock_file=DEFAULT_LOCK_FILE,
                     max_size=DEFAULT_MAX_SIZE,
                     max_count=DEFAULT_MAX_COUNT,
-                    dryrun=DEFAULT_DRYRUN
+                    dryrun=DEFAULT_DRYRUN,
+                    max_versions=DEFAULT_MAX_VERSIONS,
+                    partition=DEFAULT_PARTITION,
+                    dedup=DEFAULT_DEDUP,
+                    compression=DEFAULT_COMPRESSION,
+                    compress_min_size=DEFAULT_COMPRESS_MIN_SIZE,
+                    compress_age=DEFAULT_COMPRESS_AGE,
+                    delta=DEFAULT_DELTA,
+                    pack_age=DEFAULT_PACK_AGE,
+                    capacity_directory=DEFAULT_CAPACITY_DIRECTORY,
+                    capacity_max_size=DEFAULT_CAPACITY_MAX_SIZE,
+                    migrate_age=DEFAULT_MIGRATE_AGE,
+                    migrate_size=DEFAULT_MIGRATE_SIZE,
+                    unlink_rate=DEFAULT_UNLINK_RATE,
+                    io_rate=DEFAULT_IO_RATE,
+                    purge_nice=DEFAULT_PURGE_NICE,
+                    purge_ionice=DEFAULT_PURGE_IONICE,
+                    truncate_size=DEFAULT_TRUNCATE_SIZE,
+                    truncate_step=DEFAULT_TRUNCATE_STEP,
+                    truncate_rate=DEFAULT_TRUNCATE_RATE,
+                    lock_timeout=DEFAULT_LOCK_TIMEOUT,
+                    lock_depth=DEFAULT_LOCK_DEPTH,
+                    quotas=DEFAULT_QUOTAS,
+                    rollup=DEFAULT_ROLLUP
                    ):
         """Обновляет поля корзины.
 
@@ -174,13 +755,93 @@ class Trash(object):
         * lock_file -- путь к файлу блокировки относительно корзины
         * max_size -- максимальный суммарный размер корзины
         * max_count -- максимальное количество файлов корзины
+        * max_versions -- максимальное число версий одного файла
+                          (None -- без ограничений)
+        * partition -- временные разделы: None, "day" или "hour"
+        * dedup -- хранить одинаковые файлы один раз
+        * compression -- кодек сжатия: None, "zlib", "bz2",
+                         "lzma" или "zstd" (см. compress.CODECS)
+        * compress_min_size -- сжимать при добавлении файлы
+                               не меньше этого размера
+        * compress_age -- сжимать при compress_cold файлы,
+                          удаленные больше compress_age секунд назад
+        * delta -- хранить старые версии файла в виде дельт
+        * pack_age -- упаковывать при pack_cold файлы, удаленные
+                      больше pack_age секунд назад (None -- никогда)
+        * capacity_directory -- папка емкого уровня (None -- без него)
+        * capacity_max_size -- максимальный размер емкого уровня
+        * migrate_age -- переносить на емкий уровень файлы, удаленные
+                         больше migrate_age секунд назад
+        * migrate_size -- переносить на емкий уровень файлы
+                          не меньше этого размера
+        * unlink_rate -- удалений файлов в секунду
+                         (None -- без ограничения)
+        * io_rate -- байт в секунду при копировании и сжатии
+                     (None -- без ограничения)
+        * purge_nice -- на сколько понизить приоритет
+                        фонового удаления
+        * purge_ionice -- приоритет ввода-вывода фонового удаления:
+                          None, "idle" или уровень 0-7
+        * truncate_size -- постепенно обрезать перед удалением файлы
+                           не меньше этого размера (None -- не обрезать)
+        * truncate_step -- на сколько байт обрезать файл за шаг
+        * truncate_rate -- обрезаемых байт в секунду
+                           (None -- без ограничения)
+        * lock_timeout -- сколько секунд ждать блокировку корзины
+                          (0 -- не ждать, None -- без ограничения)
+        * lock_depth -- число верхних составляющих пути, по которым
+                        блокируются поддеревья (None -- блокировать
+                        всю корзину)
+        * quotas -- квоты арендаторов: {"uid": {uid: квота},
+                    "prefix": {путь: квота}}, где квота --
+                    {"max_size": n, "max_count": n} (None -- без квот)
+        * rollup -- вести свертку размера и числа файлов по папкам
+
+        Выбрасывает ValueError при неизвестном типе разделов,
+        кодеке сжатия, приоритете ввода-вывода или виде квоты.
 
         """
+        if partition is not None and partition not in PARTITION_FORMATS:
+            error_fmt = "Unsoported partition {partition}"
+            raise ValueError(error_fmt.format(partition=partition))
+        if compression is not None and compression not in compress.CODECS:
+            error_fmt = "Unsoported compression {compression}"
+            raise ValueError(error_fmt.format(compression=compression))
+        if purge_ionice not in (None, throttle.IDLE) + tuple(xrange(8)):
+            error_fmt = "Unsoported ionice {ionice}"
+            raise ValueError(error_fmt.format(ionice=purge_ionice))
+        quota_limits = quota.parse_quotas(quotas)
+
         self.directory = directory
         self.lock_file = lock_file
 
         self.max_size = max_size
         self.max_count = max_count
+        self.max_versions = max_versions
+        self.partition = partition
+        self.dedup = dedup
+        self.compression = compression
+        self.compress_min_size = compress_min_size
+        self.compress_age = compress_age
+        self.delta = delta
+        self.pack_age = pack_age
+        self.capacity_directory = capacity_directory
+        self.capacity_max_size = capacity_max_size
+        self.migrate_age = migrate_age
+        self.migrate_size = migrate_size
+        self.unlink_rate = unlink_rate
+        self.io_rate = io_rate
+        self.purge_nice = purge_nice
+        self.purge_ionice = purge_ionice
+        self.truncate_size = truncate_size
+        self.truncate_step = truncate_step
+        self.truncate_rate = truncate_rate
+        self.lock_timeout = lock_timeout
+        self.lock_depth = lock_depth
+        self.quotas = quotas
+        self.rollup = rollup
+        self.throttle = throttle.Throttle(unlink_rate, io_rate, truncate_rate)
+        self._quota_limits = quota_limits
 
         self.dryrun = dryrun
 
@@ -188,17 +849,27 @@ class Trash(object):
         """Возвращает размер корзины.
 
         Если корзина заблокированна, возвращает кэшированное значение.
+
+        Содержимое, на которое ведут несколько жестких ссылок,
+        учитывается один раз.
+
         """
-        if self._locked:
+        if self._locked and self._size is not None:
             return self._size
-        else:
-            lock_file = self.get_lock_file_path()
-            size = utils.get_files_size(self.directory)
 
-            # Файл блокировки также содержиться в корзине
-            size -= utils.get_files_size(lock_file)
+        trash_dir = utils.get_absolute_path(self.directory)
+
+        # Файл блокировки и служебная папка также содержаться в корзине
+        exclude = (self.get_lock_file_path(), self.get_meta_path())
+        size = utils.get_disk_usage(trash_dir, exclude)
+        size += utils.get_files_size(self.get_meta_path(packs.PACKS_DIRECTORY))
+        capacity_root = self.get_capacity_root()
+        if capacity_root is not None:
+            size += utils.get_disk_usage(capacity_root)
 
-            return size
+        if self._locked:
+            self._size = size
+        return size
 
     def get_count(self):
         """Возвращает количество файлов в корзине.
@@ -209,24 +880,536 @@ class Trash(object):
         if self._locked:
             return self._count
         else:
-            lock_file = self.get_lock_file_path()
-            count = utils.get_files_count(self.directory)
-
-            # Файл блокировки также содержиться в корзине
-            count -= utils.get_files_count(lock_file)
+            trash_dir = utils.get_absolute_path(self.directory)
+            exclude = (self.get_lock_file_path(), self.get_meta_path())
+
+            # Файл блокировки и служебная папка также содержаться
+            # в корзине. Служебная папка не обходится, так как надгробия
+            # в ней может удалять фоновый процесс.
+            count = 0
+            if os.path.isdir(trash_dir):
+                for name in os.listdir(trash_dir):
+                    path = os.path.join(trash_dir, name)
+                    if path not in exclude:
+                        count += utils.get_files_count(path)
+
+            pack_index = self.get_pack_index()
+            if pack_index is not None:
+                count += pack_index.get_count()
+            capacity_root = self.get_capacity_root()
+            if capacity_root is not None:
+                count += utils.get_files_count(capacity_root)
 
             return count
 
+    def get_capacity_size(self):
+        """Возвращает размер емкого уровня корзины.
+
+        Если корзина заблокированна, возвращает кэшированное значение.
+        Без емкого уровня возвращает 0.
+
+        """
+        capacity_root = self.get_capacity_root()
+        if capacity_root is None:
+            return 0
+        if self._locked and self._capacity_size is not None:
+            return self._capacity_size
+
+        size = utils.get_disk_usage(capacity_root)
+        if self._locked:
+            self._capacity_size = size
+        return size
+
+    def get_quota_usage(self, tenant):
+        """Возвращает пару (размер, число файлов), занятую арендатором.
+
+        Позиционные аргументы:
+        tenant -- арендатор, например ("uid", "1000") (см. myrm.quotas)
+
+        Учитывает еще не записанные в индекс изменения.
+        Без квот возвращает (0, 0).
+
+        """
+        quota_index = self.get_quota_index()
+        if quota_index is None:
+            return 0, 0
+        size, count = quota_index.get_usage(tenant)
+        with self._quota_lock:
+            pending_size, pending_count = self._quota_pending.get(tenant,
+                                                                  (0, 0))
+        return size + pending_size, count + pending_count
+
+    def get_quota_limit(self, tenant):
+        """Возвращает квоту арендатора: пару (размер, число файлов).
+
+        Отсутствующее ограничение равно None.
+
+        """
+        return self._quota_limits.get(tenant, (None, None))
+
+    def get_over_quota(self):
+        """Возвращает список арендаторов, превысивших квоту.
+
+        Элемент списка -- кортеж (арендатор, превышение размера,
+        превышение числа файлов).
+
+        """
+        result = []
+        for tenant in sorted(self._quota_limits):
+            max_size, max_count = self._quota_limits[tenant]
+            size, count = self.get_quota_usage(tenant)
+            excess_size = size - max_size if max_size is not None else 0
+            excess_count = count - max_count if max_count is not None else 0
+            if excess_size > 0 or excess_count > 0:
+                result.append((tenant, max(excess_size, 0),
+                               max(excess_count, 0)))
+        return result
+
+    def get_entry_tenants(self, path, dtime):
+        """Возвращает список арендаторов элемента корзины.
+
+        Позиционные аргументы:
+        path -- внешний путь к файлу
+        dtime -- штамп времени удаления
+
+        Владелец определяется по файлу в корзине. Упакованные файлы
+        учитываются только у префиксов.
+
+        """
+        for root in self.get_roots():
+            full_path = stamp.add_stamp(self.to_internal(path, root), dtime)
+            if os.path.lexists(full_path):
+                return self._get_tenants(path, os.lstat(full_path).st_uid)
+        return self._get_tenants(path, None)
+
+    def get_tree_usage(self, path):
+        """Возвращает пару (размер, число файлов) элемента корзины.
+
+        Позиционные аргументы:
+        path -- внешний путь к файлу или папке
+
+        Учитываются все версии файла и все файлы папки во всех
+        корнях корзины. Если включен rollup и индекс не устарел,
+        размер папки берется из индекса квот, иначе папка обходится.
+
+        """
+        path = utils.get_absolute_path(path)
+        versions = self._get_versions(path)
+        size = sum(self._get_entry_size(full_path)
+                   for _, full_path in versions)
+        count = len(versions)
+        if self._is_trashed_dir(path):
+            if self.rollup and not self._quotas_need_rebuild():
+                dir_size, dir_count = self.get_quota_usage((quota.DIR, path))
+            else:
+                dir_size, dir_count = self._get_dir_usage(path)
+            size += dir_size
+            count += dir_count
+        return size, count
+
+    def _get_dir_usage(self, path):
+        """Возвращает размер и число файлов папки корзины обходом.
+        """
+        size = 0
+        count = 0
+        for root in self.get_roots():
+            path_int = self.to_internal(path, root)
+            usage = quota.collect_usage(path_int, [path_int])
+            dir_size, dir_count = usage.get((quota.PREFIX, path_int), (0, 0))
+            size += dir_size
+            count += dir_count
+        pack_index = self.get_pack_index()
+        if pack_index is not None:
+            members = pack_index.walk_objects(path)
+            size += sum(member[4] for member in members)
+            count += len(members)
+        return size, count
+
+    def collect_stats(self, path=None, top=statistics.DEFAULT_TOP, now=None):
+        """Возвращает сводку содержимого корзины (см. myrm.stats).
+
+        Непозиционные аргументы:
+        path -- внешний путь папки (по умолчанию: вся корзина)
+        top -- сколько самых больших файлов включить в сводку
+        now -- время, от которого считается возраст файлов
+
+        Файлы обходятся один раз без построения их списка
+        (в отличие от get_file_time_list), упакованные файлы
+        читаются из индекса пакетов по мере обхода. Версии одного
+        пути в разных корнях считаются отдельно.
+
+        """
+        if path is not None:
+            path = utils.get_absolute_path(path)
+        summary = TrashStats(top=top, now=now)
+        self._collect_entries(summary, path)
+        pack_index = self.get_pack_index()
+        if pack_index is not None:
+            statistics.add_index_objects(summary,
+                                         pack_index.iter_objects(path))
+        return summary
+
+    def _collect_entries(self, summary, path=None):
+        """Учитывает файлы корзины в сводке (см. collect_stats).
+        """
+        tops = []
+        for root in self.get_roots():
+            if path is not None:
+                tops.append(self.to_internal(path, root))
+            elif os.path.isdir(root):
+                tops.extend(os.path.join(root, name)
+                            for name in os.listdir(root)
+                            if name != META_DIRECTORY and
+                            get_bucket_period(name) is None)
+
+        for top in tops:
+            if not os.path.isdir(top):
+                continue
+            for dirpath, _, files in dirfd.walk_stats(top):
+                ext_dir = self.to_external(dirpath)
+                versions = collections.Counter()
+                for name, file_stat in files:
+                    name, dtime = stamp.split_stamp(name)
+                    if dtime is None:
+                        continue
+                    summary.add(os.path.join(ext_dir, name), dtime,
+                                file_stat.st_size)
+                    versions[name] += 1
+                for count in versions.itervalues():
+                    summary.add_versions(count)
+
+    def rebuild_quotas(self):
+        """Пересчитывает место арендаторов обходом корзины.
+
+        Вызывается при монопольной блокировке, если индекс квот
+        отмечен устаревшим (см. QuotaIndex.set_stale) или изменился
+        набор префиксов. Упакованные файлы учитываются только
+        у префиксов.
+
+        """
+        quota_index = self.get_quota_index()
+        if quota_index is None:
+            return
+        prefixes = self._get_quota_prefixes()
+        to_external = lambda full_path: self.to_external(
+            stamp.split_stamp(full_path)[0])
+        usage = {}
+
+        trash_dir = utils.get_absolute_path(self.directory)
+        exclude = (self.get_lock_file_path(), self.get_meta_path())
+        if os.path.isdir(trash_dir):
+            for name in os.listdir(trash_dir):
+                path = os.path.join(trash_dir, name)
+                if path not in exclude:
+                    quota.collect_usage(path, prefixes, to_external, usage,
+                                        self.rollup)
+        capacity_root = self.get_capacity_root()
+        if capacity_root is not None and os.path.isdir(capacity_root):
+            quota.collect_usage(capacity_root, prefixes, to_external, usage,
+                                self.rollup)
+
+        pack_index = self.get_pack_index()
+        if pack_index is not None:
+            for path, sec, msec in pack_index.get_all():
+                size = pack_index.get_member(path, sec, msec)[3]
+                for tenant in self._get_tenants(path, None):
+                    totals = usage.setdefault(tenant, [0, 0])
+                    totals[0] += size
+                    totals[1] += 1
+
+        debug_fmt = "Rebuilt quota usage of {count} tenants"
+        logging.debug(debug_fmt.format(count=len(usage)))
+        with self._quota_lock:
+            self._quota_pending = {}
+        quota_index.replace(usage, prefixes, self.rollup)
+
+    def _get_quota_prefixes(self):
+        """Возвращает отсортированный список префиксов с квотами.
+        """
+        return sorted(key for kind, key in self._quota_limits
+                      if kind == quota.PREFIX)
+
+    def _get_tenants(self, path, uid):
+        """Возвращает арендаторов файла (см. quota.get_tenants).
+        """
+        return quota.get_tenants(path, uid, self._get_quota_prefixes(),
+                                 self.rollup)
+
+    def _is_accounted(self):
+        """Возвращает, ведется ли учет места в индексе квот.
+        """
+        return bool(self._quota_limits) or self.rollup
+
+    def _quotas_need_rebuild(self):
+        """Возвращает, нужно ли пересчитать место арендаторов.
+        """
+        quota_index = self.get_quota_index()
+        return quota_index is not None and (
+            quota_index.is_stale() or
+            quota_index.get_prefixes() != self._get_quota_prefixes() or
+            quota_index.get_rollup() != bool(self.rollup))
+
+    def _check_quotas(self, usage):
+        """Проверяет квоты арендаторов перед добавлением.
+
+        Позиционные аргументы:
+        usage -- место добавляемых файлов (см. quota.collect_usage)
+
+        При превышении квоты выбрасывает QuotaExcessException.
+
+        """
+        for tenant in sorted(usage):
+            if tenant not in self._quota_limits:
+                continue
+            size, count = usage[tenant]
+            max_size, max_count = self.get_quota_limit(tenant)
+            used_size, used_count = self.get_quota_usage(tenant)
+            if ((max_size is not None and size > 0 and
+                 used_size + size > max_size) or
+                    (max_count is not None and count > 0 and
+                     used_count + count > max_count)):
+                raise QuotaExcessException(tenant, size, count)
+
+    def _charge(self, usage):
+        """Учитывает изменение места арендаторов (см. _save_quotas).
+
+        Позиционные аргументы:
+        usage -- словарь {арендатор: (изменение размера, числа файлов)}
+
+        """
+        if not self._is_accounted() or self.dryrun:
+            return
+        with self._quota_lock:
+            for tenant, (size, count) in usage.iteritems():
+                totals = self._quota_pending.setdefault(tenant, [0, 0])
+                totals[0] += size
+                totals[1] += count
+
+    def _charge_file(self, full_path, file_stat, delta_size, delta_count):
+        """Учитывает изменение файла корзины у его арендаторов.
+
+        Позиционные аргументы:
+        full_path -- внутренний путь файла
+        file_stat -- lstat файла
+        delta_size -- изменение размера
+        delta_count -- изменение числа файлов
+
+        Вызывается из потоков purge.remove_tree.
+
+        """
+        if not self._is_accounted() or self.dryrun:
+            return
+        path = self.to_external(stamp.split_stamp(full_path)[0])
+        tenants = self._get_tenants(path, file_stat.st_uid)
+        self._charge(dict((tenant, (delta_size, delta_count))
+                          for tenant in tenants))
+
+    def _charge_replace(self, full_path, old_stat, new_path=None):
+        """Учитывает замену файла корзины новым (сжатие, дельта, копия).
+
+        Позиционные аргументы:
+        full_path -- внутренний путь файла
+        old_stat -- lstat файла до замены
+
+        Непозиционные аргументы:
+        new_path -- путь нового файла (по умолчанию: full_path)
+
+        Новый файл принадлежит текущему пользователю, поэтому
+        место переносится от прежнего владельца к новому.
+
+        """
+        if not self._is_accounted() or self.dryrun:
+            return
+        if new_path is None:
+            new_path = full_path
+        new_stat = os.lstat(new_path)
+        self._charge_file(full_path, old_stat, -old_stat.st_size, -1)
+        self._charge_file(new_path, new_stat, new_stat.st_size, 1)
+
+    def _save_quotas(self):
+        """Записывает накопленные изменения места арендаторов в индекс.
+
+        Во время сессии (см. TrashSession) индекс сохраняется
+        в flush.
+
+        """
+        with self._quota_lock:
+            pending = self._quota_pending
+            self._quota_pending = {}
+        if not pending:
+            return
+        quota_index = self.get_quota_index()
+        quota_index.update(pending)
+        if not self._batched:
+            quota_index.commit()
+
+    def _mark_quotas_stale(self):
+        """Отмечает, что место арендаторов нужно пересчитать.
+        """
+        quota_index = self.get_quota_index()
+        if quota_index is None or self.dryrun:
+            return
+        quota_index.set_stale()
+        if not self._batched:
+            quota_index.commit()
+
+    def get_purge_stats(self):
+        """Возвращает счетчики последнего фонового удаления или None.
+
+        Словарь содержит поля Throttle.get_stats, pid процесса,
+        время обновления (updated) и done после завершения.
+
+        """
+        return throttle.load_stats(self.get_meta_path(PURGE_STATS_FILE))
+
+    def get_capacity_root(self):
+        """Возвращает абсолютный путь емкого уровня или None.
+        """
+        if self.capacity_directory is None:
+            return None
+        return utils.get_absolute_path(self.capacity_directory)
+
+    def _in_capacity(self, full_path):
+        """Возвращает, лежит ли файл корзины на емком уровне.
+        """
+        capacity_root = self.get_capacity_root()
+        return (capacity_root is not None and
+                full_path.startswith(capacity_root + os.sep))
+
     def get_lock_file_path(self):
         """Возвращает путь к файлу блокировки.
         """
         trash_dir = utils.get_absolute_path(self.directory)
         return os.path.join(trash_dir, self.lock_file)
 
-    def set_lock(self):
+    def get_meta_path(self, *names):
+        """Возвращает путь в служебной папке корзины.
+
+        Позиционные аргументы:
+        names -- составляющие пути относительно служебной папки
+
+        """
+        trash_dir = utils.get_absolute_path(self.directory)
+        return os.path.join(trash_dir, META_DIRECTORY, *names)
+
+    def get_dedup_index(self):
+        """Возвращает индекс содержимого корзины для дедупликации.
+        """
+        return DedupIndex(self.get_meta_path(DEDUP_DIRECTORY))
+
+    def get_pack_index(self, create=False):
+        """Возвращает индекс упакованных файлов или None.
+
+        Непозиционные аргументы:
+        create -- создать индекс, если его нет
+
+        Индекс открывается при первом обращении и закрывается
+        при снятии блокировки. Дочерний процесс открывает
+        собственное соединение с индексом.
+
+        """
+        filename = self.get_meta_path(packs.INDEX_FILE)
+        if self._packs is not None:
+            pid, pack_index = self._packs
+            if pid != os.getpid() or pack_index.filename != filename:
+                self._packs = None
+        if self._packs is None:
+            if not create and not os.path.exists(filename):
+                return None
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            self._packs = (os.getpid(), PackIndex(filename))
+        return self._packs[1]
+
+    def get_encoded_index(self, create=False):
+        """Возвращает индекс сжатых файлов и дельт корзины или None.
+
+        Непозиционные аргументы:
+        create -- создать индекс, если его нет
+
+        Индекс открывается при первом обращении и закрывается
+        при снятии блокировки. Дочерний процесс открывает
+        собственное соединение с индексом.
+
+        """
+        filename = self.get_meta_path(encoded.INDEX_FILE)
+        if self._encoded is not None:
+            pid, encoded_index = self._encoded
+            if pid != os.getpid() or encoded_index.filename != filename:
+                self._encoded = None
+        if self._encoded is None:
+            if not create and not os.path.exists(filename):
+                return None
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            self._encoded = (os.getpid(), EncodedIndex(filename))
+        return self._encoded[1]
+
+    def get_ttl_index(self):
+        """Возвращает индекс времени жизни элементов корзины.
+        """
+        return TtlIndex(self.get_meta_path(TTL_DIRECTORY))
+
+    def get_operation_log(self):
+        """Возвращает журнал операций удаления (см. myrm.oplog).
+        """
+        return OperationLog(self.get_meta_path(OPERATION_LOG_FILE))
+
+    def get_quota_index(self):
+        """Возвращает индекс квот арендаторов или None без учета места.
+
+        Индекс открывается при первом обращении и закрывается
+        при снятии блокировки. Дочерний процесс открывает
+        собственное соединение с индексом.
+
+        """
+        if not self._is_accounted():
+            return None
+        filename = self.get_meta_path(quota.INDEX_FILE)
+        if self._quota_index is not None:
+            pid, quota_index = self._quota_index
+            if pid != os.getpid() or quota_index.filename != filename:
+                self._quota_index = None
+        if self._quota_index is None:
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            self._quota_index = (os.getpid(), QuotaIndex(filename))
+        return self._quota_index[1]
+
+    def set_lock(self, shared=False, subtree=None):
         """Производит блокировку корзины.
 
-        В папке с корзиной создает файл блокировки.
+        Непозиционные аргументы:
+        shared -- разделяемая блокировка для чтения (list, search):
+                  ее одновременно могут держать несколько процессов
+        subtree -- внешний путь, поддерево которого будет изменяться
+                   (add, restore, remove). Учитывается, только если
+                   задан lock_depth.
+
+        Блокируется файл блокировки в папке с корзиной (fcntl.flock).
+        Блокировку умершего процесса снимает ядро, поэтому
+        оставшийся после сбоя файл не мешает следующим вызовам.
+
+        При блокировке поддерева файл блокировки корзины блокируется
+        разделяемо, а монопольно блокируется только файл поддерева
+        (см. get_subtree_key), поэтому процессы, изменяющие разные
+        поддеревья, работают одновременно. Размер и число файлов
+        берутся из общего счетчика (см. get_usage_counter) без обхода
+        корзины. Очистка, автоочистка и другие операции над всей
+        корзиной требуют обычной монопольной блокировки. Если задан
+        lock_depth, монопольная блокировка тоже берет значения
+        из счетчика и обходит корзину, только когда в счетчике
+        остались резервы умерших процессов или прошлая монопольная
+        блокировка не была снята.
+
+        Монопольная блокировка пересчитывает место арендаторов,
+        если индекс квот устарел (см. rebuild_quotas).
+
+        Если корзина заблокирована несовместимой блокировкой, процесс
+        ждет не дольше lock_timeout секунд в очереди (см. myrm.locking):
+        блокировку получают в порядке обращения. По истечении
+        времени выбрасывается IOError. Время ожидания учитывается
+        в get_lock_stats.
 
         Кэшируется текущий размер корзины и количество файлов.
 
@@ -235,128 +1418,960 @@ class Trash(object):
         if not os.path.exists(trash_dir):
             os.makedirs(trash_dir)
 
-        lock_file = self.get_lock_file_path()
+        subtree_key = None
+        if subtree is not None and not shared:
+            subtree_key = self.get_subtree_key(subtree)
+        usage = self.get_usage_counter()
+        if subtree_key is not None and (usage.read() is None or
+                                        self._quotas_need_rebuild()):
+            # Счетчик и индекс квот заполняются при монопольной блокировке
+            self.set_lock()
+            self.unset_lock()
+
+        start = time.time()
+        global_shared = shared or subtree_key is not None
+        queue = LockQueue(self.get_meta_path(LOCK_QUEUE_DIRECTORY))
+        ticket = queue.enter(global_shared)
+        try:
+            while True:
+                lock_fd = None
+                if queue.is_turn(ticket):
+                    lock_fd = self._try_lock_file(global_shared)
+                if lock_fd is not None:
+                    break
+                self._check_lock_timeout(start)
+                time.sleep(locking.POLL_INTERVAL)
+        finally:
+            queue.leave(ticket)
+
+        subtree_fd = None
+        if subtree_key is not None:
+            try:
+                subtree_fd = self._lock_subtree(subtree_key, start)
+            except Exception:
+                os.close(lock_fd)
+                raise
+
+        wait = time.time() - start
+        self._lock_stats["acquired"] += 1
+        self._lock_stats["wait_time"] += wait
+        self._lock_stats["max_wait"] = max(self._lock_stats["max_wait"], wait)
+        if wait >= locking.POLL_INTERVAL:
+            self._lock_stats["waited"] += 1
+            debug_fmt = "Waited {wait:.3f}s for the trash lock"
+            logging.debug(debug_fmt.format(wait=wait))
+
+        self._lock_fd = lock_fd
+        self._shared = shared
+        self._subtree = subtree_key
+        self._subtree_fd = subtree_fd
+
+        stats = usage.get_stats() if self.lock_depth is not None else None
+        if subtree_key is not None:
+            self._size, self._count = stats["size"], stats["count"]
+        elif (stats is not None and stats["synced"] and
+                not stats["reserved_size"] and not stats["reserved_count"]):
+            # Счетчик точен, если нет резервов умерших процессов
+            # и предыдущая монопольная блокировка была снята
+            self._size, self._count = stats["size"], stats["count"]
+        else:
+            self._count = self.get_count()
+            self._size = self.get_size()
+            if self.lock_depth is not None and not shared:
+                usage.reset(self._size, self._count)
+        if self.lock_depth is not None and not shared and subtree_key is None:
+            usage.invalidate()
+        self._versions = {}
+        self._dirs = set()
+        if not shared and subtree_key is None and self._quotas_need_rebuild():
+            self.rebuild_quotas()
 
-        if os.path.exists(lock_file):
-            raise IOError("Lock file already exists.")
+        self._locked = True
 
-        with open(lock_file, "w"):
-            pass
+    def _check_lock_timeout(self, start):
+        """Выбрасывает IOError, если время ожидания блокировки истекло.
+        """
+        if (self.lock_timeout is not None and
+                time.time() - start >= self.lock_timeout):
+            self._lock_stats["timeouts"] += 1
+            raise IOError(errno.EAGAIN, "Trash is already locked.")
 
-        self._count = self.get_count()
-        self._size = self.get_size()
+    def _lock_subtree(self, key, start):
+        """Монопольно блокирует поддерево. Возвращает дескриптор.
 
-        self._locked = True
+        Ждет не дольше оставшегося от lock_timeout времени.
+
+        """
+        locks_dir = self.get_meta_path(SUBTREE_LOCKS_DIRECTORY)
+        if not os.path.exists(locks_dir):
+            try:
+                os.makedirs(locks_dir)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+
+        # Файлы блокировок поддеревьев не удаляются, чтобы
+        # процессы не заблокировали разные файлы одного поддерева
+        subtree_fd = os.open(os.path.join(locks_dir, key),
+                             os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            while not locking.try_flock(subtree_fd, fcntl.LOCK_EX):
+                self._check_lock_timeout(start)
+                time.sleep(locking.POLL_INTERVAL)
+        except Exception:
+            os.close(subtree_fd)
+            raise
+        return subtree_fd
+
+    def get_subtree(self):
+        """Возвращает имя заблокированного поддерева или None.
+        """
+        return self._subtree if self._locked else None
+
+    def get_subtree_key(self, path):
+        """Возвращает имя блокировки поддерева пути или None.
+
+        Позиционные аргументы:
+        path -- внешний путь
+
+        Имя составляется из протокола и lock_depth следующих
+        составляющих пути. Для более короткого пути и без lock_depth
+        возвращает None: тогда блокируется вся корзина.
+
+        """
+        if self.lock_depth is None or path is None:
+            return None
+        parts = utils.split_path(utils.get_absolute_path(path))
+        if len(parts) <= self.lock_depth:
+            return None
+        return urllib.quote(os.path.join(*parts[:self.lock_depth + 1]),
+                            safe="")
+
+    def get_usage_counter(self):
+        """Возвращает общий для процессов счетчик размера корзины.
+
+        Счетчик ведется, только если задан lock_depth: его заполняет
+        монопольная блокировка всей корзины после обхода, а изменяют
+        процессы, заблокировавшие поддеревья. Счетчик открывается
+        при первом обращении и закрывается при снятии блокировки.
+
+        """
+        path = self.get_meta_path(USAGE_FILE)
+        if self._usage is not None:
+            pid, usage = self._usage
+            if pid != os.getpid() or usage.path != path:
+                self._usage = None
+        if self._usage is None:
+            self._usage = (os.getpid(), UsageCounter(path))
+        return self._usage[1]
+
+    def _account(self, delta_size, delta_count):
+        """Учитывает изменение размера и числа файлов корзины.
+
+        Обновляет кэшированные значения, а при блокировке
+        поддерева -- еще и общий счетчик.
+
+        """
+        if not self.is_locked() or self.dryrun:
+            return
+        if self._size is not None:
+            self._size += delta_size
+        self._count += delta_count
+        if self._subtree is not None:
+            self.get_usage_counter().update(delta_size, delta_count)
+
+    def _try_lock_file(self, shared):
+        """Пробует заблокировать файл блокировки без ожидания.
+
+        Возвращает дескриптор заблокированного файла или None.
+
+        """
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        lock_path = self.get_lock_file_path()
+        while True:
+            lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            if not locking.try_flock(lock_fd, operation):
+                os.close(lock_fd)
+                return None
+
+            # Освободивший блокировку процесс мог удалить файл, пока мы
+            # его открывали: тогда блокировка взята на ненужный файл
+            try:
+                path_stat = os.stat(lock_path)
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    os.close(lock_fd)
+                    raise
+                path_stat = None
+            lock_stat = os.fstat(lock_fd)
+            if (path_stat is not None and
+                    path_stat.st_ino == lock_stat.st_ino and
+                    path_stat.st_dev == lock_stat.st_dev):
+                return lock_fd
+            os.close(lock_fd)
+
+    def get_lock_stats(self):
+        """Возвращает словарь счетчиков ожидания блокировки.
+
+        Ключи: acquired -- получено блокировок, waited -- из них
+        с ожиданием, wait_time -- всего секунд ожидания, max_wait --
+        наибольшее ожидание, timeouts -- истекших ожиданий.
+
+        """
+        return dict(self._lock_stats)
 
     def unset_lock(self):
         """Производит разблокировку корзины.
 
-        Удаляет файл блокировки.
-        Очищает все кэшированные ранее значения.
+        Удаляет файл блокировки, если его больше никто не блокирует.
+        Очищает все кэшированные ранее значения. Без блокировки
+        ничего не делает.
 
         """
-        os.remove(self.get_lock_file_path())
+        if self._lock_fd is None:
+            return
+        self._save_quotas()
+        if (self.lock_depth is not None and not self._shared and
+                self._subtree is None and
+                self._size is not None and self._count is not None):
+            self.get_usage_counter().reset(self._size, self._count)
+
+        lock_fd = self._lock_fd
+        self._lock_fd = None
+        try:
+            if self._subtree_fd is not None:
+                os.close(self._subtree_fd)
+            exclusive = not self._shared and self._subtree is None
+            if not exclusive:
+                # Последний читатель может повысить блокировку и удалить файл
+                exclusive = locking.try_flock(lock_fd, fcntl.LOCK_EX)
+            if exclusive:
+                os.remove(self.get_lock_file_path())
+        finally:
+            os.close(lock_fd)
+            self._subtree_fd = None
 
         # Значения известны только во время блокировки
         self._size = None
         self._count = None
+        self._versions = None
+        self._roots = None
+        self._dirs = None
+        self._capacity_size = None
+
+        self._close_indexes()
 
         self._locked = False
+        self._shared = False
+        self._subtree = None
+
+    def flush(self):
+        """Сохраняет накопленные за блокировку изменения.
+
+        Блокировка не снимается. Записывает изменения места
+        арендаторов. При монопольной блокировке с lock_depth сверяет
+        общий счетчик размера с кэшированными значениями
+        (см. unset_lock).
+
+        """
+        if not self._locked:
+            return
+        self._save_quotas()
+        if self._quota_index is not None:
+            self.get_quota_index().commit()
+        if (self.lock_depth is not None and not self._shared and
+                self._subtree is None and
+                self._size is not None and self._count is not None):
+            usage = self.get_usage_counter()
+            usage.reset(self._size, self._count)
+            usage.invalidate()
+
+    def has_lock_waiters(self):
+        """Возвращает, ждут ли блокировку корзины другие процессы.
+        """
+        queue = LockQueue(self.get_meta_path(LOCK_QUEUE_DIRECTORY))
+        return queue.has_waiters()
 
     def is_locked(self):
         """Возвращает, заблокированна ли корзина.
         """
         return self._locked
 
-    def lock(self):
+    def is_shared(self):
+        """Возвращает, заблокированна ли корзина только для чтения.
+        """
+        return self._locked and self._shared
+
+    def lock(self, shared=False, subtree=None):
         """Блокировка через менеджер контента.
+
+        Непозиционные аргументы:
+        shared -- разделяемая блокировка для чтения (см. set_lock)
+        subtree -- путь, поддерево которого блокируется для изменения
+
         """
-        return TrashLocker(self)
+        return TrashLocker(self, shared, subtree)
+
+    def session(self, shared=False, subtree=None,
+                flush_interval=DEFAULT_SESSION_FLUSH_INTERVAL,
+                lease=DEFAULT_SESSION_LEASE,
+                renew_timeout=DEFAULT_SESSION_RENEW_TIMEOUT):
+        """Возвращает сессию под долгой блокировкой (см. TrashSession).
+
+        Непозиционные аргументы:
+        shared -- разделяемая блокировка для чтения
+        subtree -- путь, поддерево которого блокируется для изменения
+        flush_interval -- наибольший промежуток между сохранениями, с
+        lease -- сколько секунд держать блокировку, если ее ждут
+                 другие процессы (None -- до закрытия сессии)
+        renew_timeout -- сколько секунд ждать блокировку снова
+                         после истечения lease (None -- без ограничения)
+
+        """
+        return TrashSession(self, shared, subtree, flush_interval, lease,
+                            renew_timeout)
 
     def dryrun_mode(self):
         """Временное включение dryrun через менеджер контента.
         """
-        return Dryruner(self)
+        return Dryruner(self)
+
+    def to_internal(self, path, root=None):
+        """Возвращает путь файла, переподвешанного к корзине.
+
+        Позиционные аргументы:
+        path -- исходный путь
+
+        Непозиционные аргументы:
+        root -- корень корзины (по умолчанию: папка корзины)
+
+        Определяется как путь к файлу, подвешанный к
+        папке с корзиной.
+
+        Протокол шифруется как последовательность кодов символов.
+
+        """
+        if root is None:
+            root = utils.get_absolute_path(self.directory)
+        path_full = utils.get_absolute_path(path)
+
+        splitted_path = utils.split_path(path_full)
+
+        protocol = splitted_path[0]
+        protocol_code = ' '.join([str(ord(char)) for char in protocol])
+        splitted_path[0] = protocol_code
+
+        int_path = os.path.join(root, *splitted_path)
+        return int_path
+
+    def to_external(self, path):
+        """Возвращает первоначальный путь файла.
+
+        Позиционные аргументы:
+        path -- исходный путь
+
+        Папка с корзином, временный раздел или емкий уровень
+        считается корнем. Протокол дешефруется из последовательности
+        кодов символов.
+
+        """
+        trash_dir = utils.get_absolute_path(self.directory)
+        full_path = utils.get_absolute_path(path)
+        if self._in_capacity(full_path):
+            trash_dir = self.get_capacity_root()
+
+        if os.path.commonprefix((full_path, trash_dir)) != trash_dir:
+            error_fmt = "{path} is'n trash area({trash_dir})."
+            error_msg = error_fmt.format(path=path, trash_dir=trash_dir)
+            raise ValueError(error_msg)
+
+        rel_path = os.path.relpath(full_path, trash_dir)
+        splitted_path = utils.split_path(rel_path)[1:]
+        if get_bucket_period(splitted_path[0]) is not None:
+            splitted_path = splitted_path[1:]
+
+        protocol_code = splitted_path[0]
+        protocol = ''.join(chr(int(s)) for s in protocol_code.split(' '))
+        splitted_path[0] = protocol
+        ext_path = os.path.join(*splitted_path)
+
+        return ext_path
+
+    def get_buckets(self):
+        """Возвращает отсортированный список имен временных разделов.
+        """
+        trash_dir = utils.get_absolute_path(self.directory)
+        if not os.path.isdir(trash_dir):
+            return []
+        buckets = [name for name in os.listdir(trash_dir)
+                   if get_bucket_period(name) is not None]
+        buckets.sort()
+        return buckets
+
+    def get_roots(self, buckets=True):
+        """Возвращает список корней корзины.
+
+        Непозиционные аргументы:
+        buckets -- включать временные разделы (по умолчанию: True)
+
+        Первым идет папка корзины, затем временные разделы
+        и последним -- емкий уровень.
+        Во время блокировки список кэшируется.
+
+        """
+        trash_dir = utils.get_absolute_path(self.directory)
+        capacity_root = self.get_capacity_root()
+        tiers = [capacity_root] if capacity_root is not None else []
+        if not buckets:
+            return [trash_dir] + tiers
+
+        roots = self._roots
+        if roots is None:
+            roots = [trash_dir]
+            roots.extend(os.path.join(trash_dir, name)
+                         for name in self.get_buckets())
+            roots.extend(tiers)
+            if self.is_locked():
+                self._roots = roots
+        return roots
+
+    def _get_add_root(self, dtime):
+        """Возвращает корень для элементов с заданным штампом времени.
+        """
+        trash_dir = utils.get_absolute_path(self.directory)
+        if self.partition is None:
+            return trash_dir
+        fmt = PARTITION_FORMATS[self.partition]
+        bucket = BUCKET_PREFIX + dtime.strftime(fmt)
+        return os.path.join(trash_dir, bucket)
+
+    def _get_entry_path(self, path, dtime):
+        """Возвращает внутренний путь файла, добавленного со штампом dtime.
+        """
+        path_int = self.to_internal(path, self._get_add_root(dtime))
+        return stamp.add_stamp(path_int, dtime)
+
+    def _unlink(self, full_path):
+        """Удаляет файл корзины. Возвращает освобожденное место.
+
+        Общее с другими элементами корзины содержимое
+        не освобождается (см. DedupIndex.release). Индекс содержимого
+        не используется, если dedup выключен и у файла нет других
+        ссылок. Упакованный файл удаляется из индекса пакетов.
+
+        """
+        if not os.path.lexists(full_path):
+            if self._is_accounted() and not self.dryrun:
+                path, _ = self._describe_entry(full_path)
+                size = self._get_member(full_path)[3]
+                tenants = self._get_tenants(path, None)
+                self._charge(dict((t, (-size, -1)) for t in tenants))
+            return self._remove_packed(full_path)
+        if self.dryrun:
+            return utils.get_files_size(full_path)
+        self.throttle.unlink()
+        file_stat = os.lstat(full_path)
+        self._charge_file(full_path, file_stat, -file_stat.st_size, -1)
+        self._forget_encoding(full_path)
+        remove = purge.make_remove(full_path, file_stat,
+                                   truncate_size=self.truncate_size,
+                                   truncate_step=self.truncate_step,
+                                   limiter=self.throttle)
+        if self.dedup or file_stat.st_nlink > 1:
+            size = self.get_dedup_index().release(full_path, file_stat,
+                                                  remove)
+        else:
+            remove()
+            size = file_stat.st_size
+        if self._capacity_size is not None and self._in_capacity(full_path):
+            self._capacity_size -= size
+        return size
+
+    def _release(self, full_path, file_stat, remove):
+        """Удаляет файл корзины по результату lstat.
+
+        Возвращает освобожденное место. Вызывается из потоков
+        purge.remove_tree, поэтому не меняет кэшированные значения.
+        Файлы с общим содержимым удаляются по одному.
+
+        """
+        if self.dryrun:
+            return file_stat.st_size
+        if not stat.S_ISDIR(file_stat.st_mode):
+            self._charge_file(full_path, file_stat, -file_stat.st_size, -1)
+        dedup_index = self.get_dedup_index()
+        if file_stat.st_nlink > 1 and stat.S_ISREG(file_stat.st_mode):
+            with self._release_lock:
+                return dedup_index.release(full_path, remove=remove)
+        return dedup_index.release(full_path, file_stat, remove)
+
+    def _remove_tree(self, path, removed=None):
+        """Удаляет папку корзины. Возвращает кол-во файлов и размер.
+
+        Соседние поддеревья удаляются параллельно (см. purge.remove_tree)
+        с ограничением скорости удаления. Большие файлы перед удалением
+        постепенно обрезаются, но освобожденное место считается
+        по их исходному размеру.
+
+        """
+        limiter = None if self.dryrun else self.throttle
+        delta_count, delta_size = purge.remove_tree(
+            path, release=self._release, limiter=limiter,
+            remove_dirs=not self.dryrun, removed=removed,
+            truncate_size=self.truncate_size,
+            truncate_step=self.truncate_step)
+        if (not self.dryrun and self._capacity_size is not None and
+                self._in_capacity(path)):
+            self._capacity_size -= delta_size
+        return delta_count, delta_size
+
+    def _get_packed_path(self, path, dtime):
+        """Возвращает внутренний путь упакованного файла.
+
+        На диске такого файла нет: путь лишь указывает, что версия
+        хранится в пакете, и преобразуется обратно во внешний путь.
+
+        """
+        return stamp.add_stamp(self.to_internal(path), dtime)
+
+    def _get_packed_versions(self, path):
+        """Возвращает упакованные версии файла от новой к старой.
+        """
+        pack_index = self.get_pack_index()
+        if pack_index is None:
+            return []
+        return [(stamp.get_datetime(sec, msec),
+                 self._get_packed_path(path, stamp.get_datetime(sec, msec)))
+                for sec, msec, _, _ in pack_index.get_versions(path)]
+
+    def _get_member(self, full_path):
+        """Возвращает упакованный файл (см. PackIndex.get_member).
+
+        Выбрасывает OSError, если файла нет ни на диске, ни в пакете.
+
+        """
+        path, dtime = self._describe_entry(full_path)
+        pack_index = self.get_pack_index()
+        member = None
+        if pack_index is not None and dtime is not None:
+            sec, msec = stamp.get_time_stamp(dtime)
+            member = pack_index.get_member(path, sec, msec)
+        if member is None:
+            raise OSError(errno.ENOENT, "No such trash entry", full_path)
+        return member
+
+    def _get_pack_path(self, pack):
+        """Возвращает путь к файлу пакета.
+        """
+        return self.get_meta_path(packs.PACKS_DIRECTORY,
+                                  pack + packs.PACK_SUFFIX)
+
+    def _get_entry_size(self, full_path):
+        """Возвращает размер файла корзины, в том числе упакованного.
+        """
+        if os.path.lexists(full_path):
+            return utils.get_files_size(full_path)
+        return self._get_member(full_path)[3]
+
+    def _unpack(self, full_path, new_path):
+        """Извлекает упакованный файл в new_path.
+        """
+        _, pack, offset, size, mode, mtime = self._get_member(full_path)
+
+        debug_fmt = "Unpacking {path} from pack {pack}"
+        debug_msg = debug_fmt.format(path=full_path, pack=pack)
+        logging.debug(debug_msg)
+
+        packs.read_member(self._get_pack_path(pack), offset, size, new_path)
+        os.chmod(new_path, stat.S_IMODE(mode))
+        os.utime(new_path, (mtime, mtime))
+
+    def _remove_packed(self, full_path):
+        """Удаляет упакованный файл. Возвращает освобожденное место.
+
+        Место освобождается, только когда удаляется весь пакет.
+        """
+        object_id, pack, _, size, _, _ = self._get_member(full_path)
+        if self.dryrun:
+            return size
+
+        path, _ = self._describe_entry(full_path)
+        empty_pack = self.get_pack_index().remove_member(object_id, path)
+        if empty_pack is None:
+            return 0
+
+        pack_path = self._get_pack_path(empty_pack)
+        debug_msg = "Removing empty pack {pack}".format(pack=pack_path)
+        logging.debug(debug_msg)
+
+        pack_size = os.lstat(pack_path).st_size
+        os.remove(pack_path)
+        return pack_size
+
+    def _extract(self, full_path, new_path):
+        """Перемещает файл из корзины. Возвращает его размер в корзине.
+
+        Сжатый файл распаковывается, а дельта собирается
+        прямо в new_path. Упакованный файл извлекается из пакета.
+        Если собрать файл не удалось, недособранный new_path удаляется.
+        """
+        self._detach_dependent(full_path)
+        if not os.path.lexists(full_path):
+            size = self._get_member(full_path)[3]
+            self._unpack(full_path, new_path)
+            self._remove_packed(full_path)
+            return size
+
+        size = os.lstat(full_path).st_size
+        if self._get_encoding(full_path) is not None:
+            try:
+                self._rebuild(full_path, new_path)
+            except Exception:
+                if os.path.lexists(new_path):
+                    os.remove(new_path)
+                raise
+            self._unlink(full_path)
+        else:
+            freed = self.get_dedup_index().extract(full_path, new_path)
+            if (self._capacity_size is not None and
+                    self._in_capacity(full_path)):
+                self._capacity_size -= freed
+        return size
+
+    def _describe_entry(self, full_path):
+        """Возвращает внешний путь и штамп времени файла корзины.
+        """
+        return stamp.split_stamp(self.to_external(full_path))
+
+    def _get_encoding(self, full_path):
+        """Возвращает пару (кодек, штамп базы) файла корзины или None.
+
+        Пара ищется в индексе сжатых файлов и дельт
+        (см. get_encoded_index), содержимое файла не читается.
+        None возвращается для файла, хранящегося как есть.
+
+        """
+        encoded_index = self.get_encoded_index()
+        if encoded_index is None:
+            return None
+        path, dtime = self._describe_entry(full_path)
+        if dtime is None:
+            return None
+        sec, msec = stamp.get_time_stamp(dtime)
+        return encoded_index.get(path, sec, msec)
+
+    def _forget_encoding(self, full_path):
+        """Удаляет файл корзины из индекса сжатых файлов и дельт.
+        """
+        encoded_index = self.get_encoded_index()
+        if encoded_index is None:
+            return
+        path, dtime = self._describe_entry(full_path)
+        if dtime is not None:
+            sec, msec = stamp.get_time_stamp(dtime)
+            encoded_index.remove(path, sec, msec)
+
+    def _is_plain(self, full_path):
+        """Возвращает, хранится ли файл корзины как есть.
+
+        Файл не является ссылкой, дельтой или сжатым файлом
+        и не разделяет содержимое с другими элементами.
+
+        """
+        try:
+            file_stat = os.lstat(full_path)
+        except OSError:
+            return False
+        return (stat.S_ISREG(file_stat.st_mode) and
+                file_stat.st_nlink == 1 and
+                self._get_encoding(full_path) is None)
+
+    def _rebuild(self, full_path, new_path):
+        """Собирает исходное содержимое файла корзины в new_path.
+
+        Дельта собирается из своей базы, которая при необходимости
+        сама собирается рекурсивно. Сжатый файл распаковывается,
+        остальные копируются. Файл корзины не удаляется.
+
+        Выбрасывает IOError, если база дельты отсутствует.
+
+        """
+        if not os.path.lexists(full_path):
+            self._unpack(full_path, new_path)
+            return
+
+        encoding = self._get_encoding(full_path)
+        if encoding is None:
+            shutil.copy2(full_path, new_path)
+            return
+        codec, base_stamp = encoding
+        if base_stamp is None:
+            compress.decompress_file(full_path, new_path, codec)
+            return
+
+        path, _ = self._describe_entry(full_path)
+        base_dtime = stamp.get_datetime(*base_stamp)
+        base_full = dict(self._get_versions(path)).get(base_dtime)
+        if base_full is None:
+            error_fmt = "Delta base of {path} is missing"
+            raise IOError(error_fmt.format(path=full_path))
+
+        debug_fmt = "Rebuilding {path} from {base}"
+        debug_msg = debug_fmt.format(path=full_path, base=base_full)
+        logging.debug(debug_msg)
+
+        if self._is_plain(base_full):
+            delta.apply_delta(base_full, full_path, new_path)
+        else:
+            temp_base = new_path + ".base"
+            self._rebuild(base_full, temp_base)
+            try:
+                delta.apply_delta(temp_base, full_path, new_path)
+            finally:
+                os.remove(temp_base)
+        shutil.copystat(full_path, new_path)
+
+    def _detach_dependent(self, full_path):
+        """Собирает целиком дельту, базой которой является файл.
+
+        Возвращает, на сколько вырос размер корзины.
+
+        Вызывается перед удалением или востановлением отдельной
+        версии файла. Зависеть от версии может только следующая
+        за ней более старая версия.
+
+        """
+        if not self.delta or self.dryrun:
+            return 0
+        path, dtime = self._describe_entry(full_path)
+        if dtime is None:
+            return 0
+        versions = self._get_versions(path)
+        stamps = [version_dtime for version_dtime, _ in versions]
+        if dtime not in stamps:
+            return 0
+        position = stamps.index(dtime) + 1
+        if position >= len(versions):
+            return 0
+        older_full = versions[position][1]
+        encoding = self._get_encoding(older_full)
+        if encoding is None or encoding[1] != stamp.get_time_stamp(dtime):
+            return 0
+
+        old_stat = os.lstat(older_full)
+        temp_path = older_full + ".rebuild"
+        self._rebuild(older_full, temp_path)
+        os.rename(temp_path, older_full)
+        self._forget_encoding(older_full)
+        self._charge_replace(older_full, old_stat)
+        return os.lstat(older_full).st_size - old_stat.st_size
+
+    def _make_deltas(self, added, dtime):
+        """Заменяет предыдущие версии добавленных файлов дельтами.
+
+        Возвращает сэкономленное место.
+
+        Позиционные аргументы:
+        added -- список внешних путей только что добавленных объектов
+        dtime -- штамп времени, с которым они были добавлены
+
+        Дельта строится относительно только что добавленной версии
+        и заменяет предыдущую, только если она меньше.
+
+        """
+        base_stamp = stamp.get_time_stamp(dtime)
+        cache = {}
+        saved = 0
+        for path in added:
+            versions = self._get_cached_versions(path, cache)
+            if len(versions) < 2 or versions[0][0] != dtime:
+                continue
+            base_full = versions[0][1]
+            older_full = versions[1][1]
+            if not self._is_plain(base_full) or not self._is_plain(older_full):
+                continue
+
+            delta_path = older_full + ".delta"
+            delta_size = delta.make_delta(base_full, older_full, delta_path,
+                                          base_stamp)
+            if delta_size is None:
+                continue
+            old_stat = os.lstat(older_full)
+            old_size = old_stat.st_size
+            if delta_size >= old_size:
+                os.remove(delta_path)
+                continue
+
+            debug_fmt = "Replace {path} by delta: {old_size} -> {new_size}"
+            debug_msg = debug_fmt.format(path=older_full, old_size=old_size,
+                                         new_size=delta_size)
+            logging.debug(debug_msg)
+
+            shutil.copystat(older_full, delta_path)
+            os.rename(delta_path, older_full)
+            older_path, older_dtime = self._describe_entry(older_full)
+            sec, msec = stamp.get_time_stamp(older_dtime)
+            self.get_encoded_index(create=True).set_delta(
+                older_path, sec, msec, *base_stamp)
+            self._charge_replace(older_full, old_stat)
+            saved += old_size - delta_size
+        return saved
+
+    def _compress_entries(self, entries, min_size=0):
+        """Сжимает файлы корзины. Возвращает число файлов и экономию.
+
+        Позиционные аргументы:
+        entries -- внутренние пути файлов
+
+        Непозиционные аргументы:
+        min_size -- минимальный размер сжимаемого файла
+
+        Пропускаются папки, ссылки, файлы с общим содержимым,
+        дельты и уже сжатые файлы.
+
+        """
+        count = 0
+        saved = 0
+        for full_path in entries:
+            try:
+                file_stat = os.lstat(full_path)
+            except OSError:
+                continue
+            if (file_stat.st_size == 0 or
+                    file_stat.st_size < min_size or
+                    not self._is_plain(full_path)):
+                continue
+            file_saved = compress.compress_file(full_path, self.compression,
+                                                limiter=self.throttle)
+            if file_saved > 0:
+                path, dtime = self._describe_entry(full_path)
+                sec, msec = stamp.get_time_stamp(dtime)
+                self.get_encoded_index(create=True).set_compressed(
+                    path, sec, msec, self.compression)
+                self._charge_replace(full_path, file_stat)
+                count += 1
+                saved += file_saved
+        return count, saved
+
+    def _is_trashed_dir(self, path):
+        """Возвращает, есть ли в корзине папка с данным внешним путем.
+        """
+        if any(os.path.isdir(self.to_internal(path, root))
+               for root in self.get_roots()):
+            return True
+        pack_index = self.get_pack_index()
+        return pack_index is not None and pack_index.is_dir(path)
 
-    def to_internal(self, path):
-        """Возвращает путь файла, переподвешанного к корзине.
+    def _get_versions(self, path):
+        """Возвращает версии файла во всех корнях корзины.
 
         Позиционные аргументы:
-        path -- исходный путь
+        path -- внешний путь к файлу
 
-        Определяется как путь к файлу, подвешанный к
-        папке с корзиной.
-
-        Протокол шифруется как последовательность кодов символов.
+        Список состоит из кортежей (штамп времени, внутренний путь)
+        и упорядочен от новой версии к старой.
 
         """
-        trash_dir = utils.get_absolute_path(self.directory)
-        path_full = utils.get_absolute_path(path)
-
-        splitted_path = utils.split_path(path_full)
-
-        protocol = splitted_path[0]
-        protocol_code = ' '.join([str(ord(char)) for char in protocol])
-        splitted_path[0] = protocol_code
+        result = []
+        for root in self.get_roots():
+            path_int = self.to_internal(path, root)
+            if not os.path.isdir(os.path.dirname(path_int)):
+                continue
+            result.extend((dtime, stamp.add_stamp(path_int, dtime))
+                          for dtime in stamp.get_versions_list(path_int))
+        result.extend(self._get_packed_versions(path))
+        result.sort(reverse=True)
+        return result
+
+    def _get_version(self, path, how_old):
+        """Возвращает внутренний путь версии файла под номером how_old.
+
+        Если how_old больше числа версий, берется самая старая.
+        Выбрасывает OSError, если версий нет.
 
-        int_path = os.path.join(trash_dir, *splitted_path)
-        return int_path
+        """
+        versions = self._get_versions(path)
+        if not versions:
+            raise OSError(errno.ENOENT, "No such trash entry", path)
+        count = len(versions)
+        how_old = how_old if how_old < count else count - 1
+        return versions[how_old][1]
 
-    def to_external(self, path):
-        """Возвращает первоначальный путь файла.
+    def _select_version(self, versions, how_old=0, as_of=None):
+        """Возвращает внутренний путь выбранной версии файла или None.
 
         Позиционные аргументы:
-        path -- исходный путь
+        versions -- версии файла от новой к старой (см. _get_versions)
+
+        Непозиционные аргументы:
+        how_old -- номер версии. Если больше числа версий, берется
+                   самая старая
+        as_of -- момент времени. Если задан, берется самая новая
+                 версия, удаленная не позже него (см.
+                 stamp.find_version_as_of), а how_old не учитывается
 
-        Папка с корзином считается корнем.
-        Протокол дешефруется из последовательности кодов символов.
+        None возвращается, если подходящей версии нет.
 
         """
-        trash_dir = utils.get_absolute_path(self.directory)
-        full_path = utils.get_absolute_path(path)
+        if not versions:
+            return None
+        if as_of is not None:
+            index = stamp.find_version_as_of(versions, as_of)
+            return versions[index][1] if index is not None else None
+        return versions[min(how_old, len(versions) - 1)][1]
 
-        if os.path.commonprefix((full_path, trash_dir)) != trash_dir:
-            error_fmt = "{path} is'n trash area({trash_dir})."
-            error_msg = error_fmt.format(path=path, trash_dir=trash_dir)
-            raise ValueError(error_msg)
+    def get_versions_list(self, path):
+        """Возвращает список штампов времени версий файла.
 
-        rel_path = os.path.relpath(full_path, trash_dir)
-        splitted_path = utils.split_path(rel_path)[1:]
+        Позиционные аргументы:
+        path -- внешний путь к файлу
 
-        protocol_code = splitted_path[0]
-        protocol = ''.join(chr(int(s)) for s in protocol_code.split(' '))
-        splitted_path[0] = protocol
-        ext_path = os.path.join(*splitted_path)
+        Учитываются все корни корзины. Список упорядочен от новой
+        версии к старой.
 
-        return ext_path
+        """
+        return [dtime for dtime, _ in self._get_versions(path)]
 
-    def get_file_time_list(self):
+    def get_file_time_list(self, buckets=True):
         """Возвращает список всех файлов в корзине.
 
         Список сотоит из кортежей (путь, время удаления).
 
         Список сортируется по дате удаления.
 
-        """
-        trash_dir = utils.get_absolute_path(self.directory)
+        Непозиционные аргументы:
+        buckets -- включать временные разделы (по умолчанию: True)
 
-        root_list = os.listdir(trash_dir)
-        root_list_full = [os.path.join(trash_dir, path)
-                          for path in root_list]
-        trash_protocols = (d for d in root_list_full if os.path.isdir(d))
+        """
         files = []
-        for protocol_path in trash_protocols:
-            for dirpath, _, filenames in os.walk(protocol_path):
-                files.extend([os.path.join(dirpath, f) for f in filenames])
+        for root in self.get_roots(buckets=buckets):
+            if not os.path.isdir(root):
+                continue
+            for name in os.listdir(root):
+                protocol_path = os.path.join(root, name)
+                if name == META_DIRECTORY:
+                    continue
+                if get_bucket_period(name) is not None:
+                    continue
+                if not os.path.isdir(protocol_path):
+                    continue
+                for dirpath, _, filenames in dirfd.walk(protocol_path):
+                    files.extend([os.path.join(dirpath, f)
+                                  for f in filenames])
 
         files_ext = [self.to_external(f) for f in files]
         file_time_list = [stamp.split_stamp(f) for f in files_ext]
 
+        pack_index = self.get_pack_index()
+        if pack_index is not None:
+            file_time_list.extend((path, stamp.get_datetime(sec, msec))
+                                  for path, sec, msec in pack_index.get_all())
+
         file_time_list.sort(key=lambda (file_name, vers): vers)
 
         return file_time_list
 
-    def add_file(self, file_name):
+    def add_file(self, file_name, dtime=None):
         """Перемещает файл в корзину.
 
         Возвращает колич. удаленх фалов, их рself.азмер, список путей.
@@ -367,41 +2382,88 @@ class Trash(object):
         Позиционные аргументы:
         file_name -- исходный путь к файлу
 
+        Непозиционные аргументы:
+        dtime -- штамп времени (по умолчанию: текущее время)
+
         Добаление вроизовдиться путем пермещение файла.
-        Путь файла переподвешивается относительно папки корзины.
+        Путь файла переподвешивается относительно корня корзины.
         Протокол шивруется как последовательность символов.
         К файлу добавляется штамп текущего времени UTC.
 
         """
         old_path = utils.get_absolute_path(file_name)
-        new_path = self.to_internal(old_path)
+
+        if dtime is None:
+            dtime = datetime.datetime.now()
+        new_path = self.to_internal(old_path, self._get_add_root(dtime))
 
         count = 1
         size = utils.get_files_size(old_path)
 
-        now = datetime.datetime.now()
-        full_new_path = stamp.add_stamp(new_path, now)
+        full_new_path = stamp.add_stamp(new_path, dtime)
         debug_fmt = "Moving file {old_path} to {new_path}"
         debug_msg = debug_fmt.format(old_path=old_path, new_path=full_new_path)
         logging.debug(debug_msg)
 
         if not self.dryrun:
-            if not os.path.exists(os.path.dirname(full_new_path)):
-                os.makedirs(os.path.dirname(full_new_path))
-            os.rename(old_path, full_new_path)
+            self._move_into(old_path, full_new_path)
 
         return count, size, [old_path]
 
-    def _fork_add_dir(self, dir_name, common_namespace, delta_namespace):
+    def _move_into(self, old_path, new_path):
+        """Переименовывает файл, создавая недостающие папки назначения.
+
+        Во время блокировки созданные папки запоминаются и повторно
+        не проверяются. Если запомненную папку удалили (например,
+        востановив из нее последний файл), она создается заново.
+
+        """
+        directory = os.path.dirname(new_path)
+        dirs = self._dirs if self._dirs is not None else set()
+        known = directory in dirs
+        if not known and not os.path.exists(directory):
+            os.makedirs(directory)
+        try:
+            os.rename(old_path, new_path)
+        except OSError as error:
+            if error.errno != errno.ENOENT or not known:
+                raise
+            dirs.discard(directory)
+            return self._move_into(old_path, new_path)
+        dirs.add(directory)
+
+    def _add_file_at(self, name, old_path, file_stat, dir_fds, dtime):
+        """Перемещает файл в корзину относительно дескрипторов папок.
+
+        Возвращает то же, что add_file.
+
+        Позиционные аргументы:
+        name -- имя файла
+        old_path -- исходный путь к файлу
+        file_stat -- lstat файла
+        dir_fds -- дескрипторы исходной папки и папки в корзине
+        dtime -- штамп времени
+
+        """
+        new_name = stamp.add_stamp(name, dtime)
+        debug_fmt = "Moving file {old_path} to {new_name}"
+        debug_msg = debug_fmt.format(old_path=old_path, new_name=new_name)
+        logging.debug(debug_msg)
+
+        dirfd.rename(name, dir_fds[0], new_name, dir_fds[1])
+        return 1, file_stat.st_size, [old_path]
+
+    def _fork_add_dir(self, dir_name, common_namespace, delta_namespace,
+                      dtime=None):
         """Парралельно запускает перемещение в корзину.
         """
-        args = (dir_name, common_namespace, delta_namespace)
+        args = (dir_name, common_namespace, delta_namespace, dtime)
         proc = multiprocessing.Process(target=self.add_dir, args=args)
         proc.start()
         return proc
 
     def add_dir(self, dir_name, common_namespace=common_namespace, 
-                    delta_namespace=None):
+                    delta_namespace=None, dtime=None):
         """Премещает папку в корзину.
 
         Возвращает колич. удаленх объектов, их размер, список путей.
@@ -412,6 +2474,10 @@ class Trash(object):
         Позиционные аргументы:
         dir_name -- исходный путь к папке
 
+        Непозиционные аргументы:
+        dtime -- штамп времени всех файлов папки
+                 (по умолчанию: текущее время)
+
         Перемещение происходит рекурсивно.
         Для этого в корзине создаются все недостающие папки и
         перемещаются файлы.
@@ -419,6 +2485,9 @@ class Trash(object):
         """
         old_path = utils.get_absolute_path(dir_name)
 
+        if dtime is None:
+            dtime = datetime.datetime.now()
+
         count = 0
         size = 0
         result_list = [old_path]
@@ -431,7 +2500,7 @@ class Trash(object):
         if os.path.ismount(old_path):
             raise IOError("Can't remove mount point.")
 
-        new_path = self.to_internal(old_path)
+        new_path = self.to_internal(old_path, self._get_add_root(dtime))
 
         if not os.path.exists(new_path):
             debug_msg = "Make dir {directory} ".format(directory=new_path)
@@ -439,25 +2508,46 @@ class Trash(object):
             if not self.dryrun:
                 os.makedirs(new_path)
 
-        for element in os.listdir(old_path):
-            element_path = os.path.join(old_path, element)
-            isdir = os.path.isdir(element_path)
-            if  isdir:
-                process_max = common_namespace.process_max
-                process_count = common_namespace.process_count
-                if process_count >= process_max:
-                    delta_count, delta_size, added = self.add_dir(element_path)
+        # Файлы переносятся переименованием относительно дескрипторов
+        # исходной папки и папки в корзине (см. myrm.dirfd)
+        dir_fds = None
+        if dirfd.SUPPORTED and not self.dryrun:
+            dir_fds = (dirfd.open_dir(old_path), dirfd.open_dir(new_path))
+        try:
+            for element in os.listdir(old_path):
+                element_path = os.path.join(old_path, element)
+                element_stat = None
+                if dir_fds is None:
+                    isdir = os.path.isdir(element_path)
                 else:
-                    dcount, dsize, added = 0, 0, []
-                    common_namespace.process_count += 1
-                    proc = self._fork_add_dir(element_path, common_namespace, 
-                                              sub_tasks_namespace)
-                    sub_tasks.append(proc)    
-            else:
-                delta_count, delta_size, added = self.add_file(element_path)
-            count += delta_count
-            size += delta_size
-            result_list.extend(added)
+                    element_stat = dirfd.lstat(element, dir_fds[0])
+                    isdir = stat.S_ISDIR(element_stat.st_mode)
+                if  isdir:
+                    process_max = common_namespace.process_max
+                    process_count = common_namespace.process_count
+                    if process_count >= process_max:
+                        delta_count, delta_size, added = self.add_dir(
+                            element_path, dtime=dtime)
+                    else:
+                        delta_count, delta_size, added = 0, 0, []
+                        common_namespace.process_count += 1
+                        proc = self._fork_add_dir(element_path,
+                                                  common_namespace,
+                                                  sub_tasks_namespace, dtime)
+                        sub_tasks.append(proc)
+                elif element_stat is None:
+                    delta_count, delta_size, added = self.add_file(
+                        element_path, dtime=dtime)
+                else:
+                    delta_count, delta_size, added = self._add_file_at(
+                        element, element_path, element_stat, dir_fds, dtime)
+                count += delta_count
+                size += delta_size
+                result_list.extend(added)
+        finally:
+            if dir_fds is not None:
+                for dir_fd in dir_fds:
+                    os.close(dir_fd)
 
         for task in sub_tasks:
             task.join()
@@ -477,7 +2567,8 @@ class Trash(object):
 
         return count, size, result_list
 
-    def restore_file(self, file_name, how_old=0):
+    def restore_file(self, file_name, how_old=0, as_of=None,
+                     versions=None):
         """Востанавливает файл из корзины.
 
         Возвращает колич. вост. объектов, их размер, список путей.
@@ -488,20 +2579,34 @@ class Trash(object):
         Непозиционные аргументы:files
         how_old -- версия файла в порядке устарения даты удаления.
                    По умолчанию: 0 (последняя версия)
+        as_of -- востановить самую новую версию, удаленную
+                 не позже этого момента (datetime). Если такой
+                 версии нет, файл не востанавливается.
+                 По умолчанию: None (выбор по how_old)
+        versions -- уже прочитанные версии файла (см. _get_versions).
+                    По умолчанию: None (прочитать папку корзины)
+
+        Выбрасывает OSError, если файла нет в корзине.
 
         Не следует использовать эту функцию вне класса
         во время блокировки.
 
         Из файла удаляется штамп времени.
-        Файл переповешивается из папке корзины в корень.
+        Файл переповешивается из корня корзины в корень.
+        Версии ищутся во всех корнях корзины.
 
         """
         new_path = utils.get_absolute_path(file_name)
-        old_path = self.to_internal(new_path)
-        old_path_full = stamp.get_version(old_path, how_old)
+        if versions is None:
+            versions = self._get_versions(new_path)
+        if not versions:
+            raise OSError(errno.ENOENT, "No such trash entry", new_path)
+        old_path_full = self._select_version(versions, how_old, as_of)
+        if old_path_full is None:
+            return 0, 0, []
 
         count = 1
-        size = utils.get_files_size(old_path_full)
+        size = self._get_entry_size(old_path_full)
 
         if os.path.exists(new_path):
             os.remove(new_path)
@@ -512,30 +2617,32 @@ class Trash(object):
             os.makedirs(os.path.dirname(new_path))
 
         debug_fmt = "Moving file {old_path} to {new_path}"
-        debug_msg = debug_fmt.format(old_path=old_path, new_path=new_path)
+        debug_msg = debug_fmt.format(old_path=old_path_full,
+                                     new_path=new_path)
         logging.debug(debug_msg)
 
         if not self.dryrun:
-            os.rename(old_path_full, new_path)
+            self._extract(old_path_full, new_path)
 
         if not self.dryrun:
-            if utils.is_empty(os.path.dirname(old_path_full)):
-                os.rmdir(os.path.dirname(old_path_full))
+            old_dir = os.path.dirname(old_path_full)
+            if os.path.isdir(old_dir) and utils.is_empty(old_dir):
+                os.rmdir(old_dir)
 
         return count, size, [new_path]
 
     def _fork_restore_dir(self, dir_name, common_namespace, 
-                         delta_namespace, how_old=0):
+                         delta_namespace, how_old=0, as_of=None):
         """Парралельно запускает востановление из корзины.
         """
-        args = (dir_name, how_old, common_namespace, delta_namespace)
+        args = (dir_name, how_old, common_namespace, delta_namespace, as_of)
         proc = multiprocessing.Process(target=self.restore_dir, args=args)
         proc.start()
         return proc
         
     def restore_dir(self, dir_name, how_old=0, 
                     common_namespace=common_namespace, 
-                    delta_namespace=None):
+                    delta_namespace=None, as_of=None):
         """Востанавливает папку из корзины.
 
         Возвращает колич. вост. объектов, их размер, список путей.
@@ -549,14 +2656,21 @@ class Trash(object):
         Непозиционные аргументы:
         how_old -- версия файла в порядке устарения даты удаления.
                    По умолчанию: 0 (последняя версия)
+        as_of -- момент времени (datetime). Каждый файл
+                 востанавливается в самой новой версии, удаленной
+                 не позже него, поэтому папка собирается такой, какой
+                 она была в этот момент. Файлы, все версии которых
+                 удалены позже, остаются в корзине.
+                 По умолчанию: None (выбор по how_old)
 
         Перемещение происходит рекурсивно.
         Для этого в создаются все недостающие папки и
-        востанавливаются файлы.
+        востанавливаются файлы. Версии файлов каждой папки читаются
+        одним проходом по ней (см. _get_cached_versions), а нужная
+        версия ищется в упорядоченном по времени списке.
 
         """
         new_path = utils.get_absolute_path(dir_name)
-        old_path = self.to_internal(new_path)
 
         count = 0
         size = 0
@@ -575,24 +2689,29 @@ class Trash(object):
 
         mask = os.path.join(new_path, "*")
         elements = self.search(mask)
+        versions_cache = {}
         for path in elements:
-            is_dir = os.path.exists(self.to_internal(path))
+            is_dir = self._is_trashed_dir(path)
             if is_dir:
                 process_max = common_namespace.process_max
                 process_count = common_namespace.process_count
                 if process_count >= process_max:
                     dcount, dsize, restored = self.restore_dir(path,
-                                                               how_old=how_old)
+                                                               how_old=how_old,
+                                                               as_of=as_of)
                 else:
                     dcount, dsize, restored = 0, 0, []
                     common_namespace.process_count += 1
                     proc = self._fork_restore_dir(path, common_namespace, 
                                                   sub_tasks_namespace, 
-                                                  how_old=how_old)
+                                                  how_old=how_old,
+                                                  as_of=as_of)
                     sub_tasks.append(proc)
             else:
-                dcount, dsize, restored = self.restore_file(path,
-                                                            how_old=how_old)
+                versions = self._get_cached_versions(path, versions_cache)
+                dcount, dsize, restored = self.restore_file(
+                    path, how_old=how_old, as_of=as_of,
+                    versions=list(versions))
             count += dcount
             size += dsize
             result_list.extend(restored)
@@ -601,9 +2720,12 @@ class Trash(object):
             task.join()
             common_namespace.process_count -= 1
         
-        exist_and_empty = os.path.exists(old_path) and utils.is_empty(old_path) 
-        if exist_and_empty and not self.dryrun:
-            os.rmdir(old_path)
+        for root in self.get_roots():
+            old_path = self.to_internal(new_path, root)
+            exist_and_empty = (os.path.exists(old_path) and
+                               utils.is_empty(old_path))
+            if exist_and_empty and not self.dryrun:
+                os.rmdir(old_path)
             
         count += sub_tasks_namespace.dcount
         size += sub_tasks_namespace.dsize
@@ -616,7 +2738,7 @@ class Trash(object):
 
         return count, size, result_list
 
-    def add(self, path):
+    def add(self, path, ttl=None, operation=None):
         """Добавляет элемент в корзину.
 
         Возвращает количестов удаленных файлов, их размер,
@@ -625,6 +2747,14 @@ class Trash(object):
         Позиционные аргументы:
         path -- исходный путь к элементу
 
+        Непозиционные аргументы:
+        ttl -- время жизни элемента в секундах. Элемент удаляется
+               при вызове expire после его истечения.
+               По умолчанию: None (без ограничения)
+        operation -- идентификатор операции. Элемент записывается
+                     в журнал операций (см. undo).
+                     По умолчанию: None (не записывать)
+
         Перед выполнением операции происходит проверка на
         превышения лимита корзины.
 
@@ -634,33 +2764,213 @@ class Trash(object):
         При превышение ограничений на корзину
         возбуждается LimitExcessException
 
+        При блокировке поддерева место резервируется в общем
+        счетчике до перемещения, подтверждается после него
+        и освобождается при ошибке.
+
+        Если заданы квоты, до перемещения проверяется место каждого
+        арендатора элемента: при превышении возбуждается
+        QuotaExcessException.
+
         """
         delta_size = utils.get_files_size(path)
         delta_count = utils.get_files_count(path)
-        new_size = self.get_size() + delta_size
-        new_count = self.get_count() + delta_count
 
-        trash_dir = utils.get_absolute_path(self.directory)
-        if os.path.commonprefix((path, trash_dir)) == trash_dir:
-            raise ValueError("You can't remove anythin from trash.")
+        trash_dirs = [utils.get_absolute_path(self.directory)]
+        if self.get_capacity_root() is not None:
+            trash_dirs.append(self.get_capacity_root())
+        for trash_dir in trash_dirs:
+            if os.path.commonprefix((path, trash_dir)) == trash_dir:
+                raise ValueError("You can't remove anythin from trash.")
+
+        charged = None
+        if self._is_accounted():
+            charged = quota.collect_usage(utils.get_absolute_path(path),
+                                          self._get_quota_prefixes(),
+                                          rollup=self.rollup)
+            self._check_quotas(charged)
+
+        reservation = self._reserve(delta_size, delta_count)
+        now = datetime.datetime.now()
+        try:
+            if os.path.isdir(path):
+                _, _, added = self.add_dir(path, dtime=now)
+            else:
+                _, _, added = self.add_file(path, dtime=now)
+        except Exception:
+            if reservation is not None:
+                reservation.release()
+            raise
+        if reservation is not None:
+            reservation.commit()
+        if charged is not None:
+            self._charge(charged)
+
+        if self.is_locked() and not self.dryrun:
+            # Общий счетчик уже изменен резервом (см. _reserve),
+            # поэтому обновляются только кэшированные значения
+            self._size += delta_size
+            self._count += delta_count
+            if (self.partition is not None and self._roots is not None and
+                    self._get_add_root(now) not in self._roots):
+                self._roots = None
+
+        if self.max_versions is not None and not self.dryrun:
+            self._trim_versions(added, now)
+
+        if (self.delta or self.dedup or self.compression) and not self.dryrun:
+            entries = [self._get_entry_path(p, now) for p in added]
+            saved = 0
+            if self.delta:
+                saved += self._make_deltas(added, now)
+            if self.compression is not None:
+                _, compress_saved = self._compress_entries(
+                    entries, self.compress_min_size)
+                saved += compress_saved
+            if self.dedup:
+                saved += self.get_dedup_index().add(entries)
+            self._account(-saved, 0)
+
+        if ttl is not None and not self.dryrun:
+            sec, msec = stamp.get_time_stamp(now)
+            abs_path = utils.get_absolute_path(path)
+            self.get_ttl_index().schedule(abs_path, sec, msec, ttl)
+
+        if operation is not None and not self.dryrun:
+            files = []
+            dirs = []
+            for added_path in added:
+                if os.path.lexists(self._get_entry_path(added_path, now)):
+                    files.append(added_path)
+                else:
+                    dirs.append(added_path)
+            self.get_operation_log().append(operation,
+                                            utils.get_absolute_path(path),
+                                            now, files, dirs)
+
+        self._save_quotas()
+        return delta_count, delta_size, added
 
-        if new_size > self.max_size:
-            raise LimitExcessException("Size limit excess.")
-        if new_count > self.max_count:
-            raise LimitExcessException("Files count limit excess.")
+    def _reserve(self, delta_size, delta_count):
+        """Проверяет ограничения корзины перед добавлением.
 
-        if os.path.isdir(path):
-            _, _, added = self.add_dir(path)
+        Возвращает резерв места в общем счетчике (см. myrm.usage)
+        или None. При превышении ограничений выбрасывает
+        LimitExcessException.
+
+        max_size ограничивает только быстрый уровень. При блокировке
+        поддерева проверка и резервирование выполняются атомарно
+        в общем счетчике, иначе используются кэшированные значения.
+
+        """
+        capacity_size = self.get_capacity_size()
+        if self._subtree is None or self.dryrun:
+            new_size = self.get_size() - capacity_size + delta_size
+            new_count = self.get_count() + delta_count
+            if new_size > self.max_size:
+                raise LimitExcessException("Size limit excess.")
+            if new_count > self.max_count:
+                raise LimitExcessException("Files count limit excess.")
+            return None
+
+        reservation = self.get_usage_counter().reserve(
+            delta_size, delta_count, self.max_size + capacity_size,
+            self.max_count)
+        if reservation is None:
+            raise LimitExcessException("Size or files count limit excess.")
+        return reservation
+
+    def _get_cached_versions(self, path, cache):
+        """Возвращает список версий файла в корзине из кэша.
+
+        Позиционные аргументы:
+        path -- внешний путь к файлу
+        cache -- словарь {папка: {путь: версии}}
+
+        Папка файла читается один раз в каждом корне, после чего версии
+        всех ее файлов хранятся в кэше. Версия -- кортеж
+        (штамп времени, внутренний путь). Версии упорядоченны
+        от новой к старой.
+
+        """
+        directory = os.path.dirname(path)
+        if directory not in cache:
+            files_versions = {}
+            for root in self.get_roots():
+                directory_int = self.to_internal(directory, root)
+                if not os.path.isdir(directory_int):
+                    continue
+                for name in os.listdir(directory_int):
+                    file_name, dtime = stamp.split_stamp(name)
+                    if dtime is None:
+                        continue
+                    file_path = os.path.join(directory, file_name)
+                    version = (dtime, os.path.join(directory_int, name))
+                    files_versions.setdefault(file_path, []).append(version)
+            pack_index = self.get_pack_index()
+            if pack_index is not None:
+                for file_path, sec, msec in pack_index.list_dir(directory)[0]:
+                    dtime = stamp.get_datetime(sec, msec)
+                    version = (dtime, self._get_packed_path(file_path, dtime))
+                    files_versions.setdefault(file_path, []).append(version)
+            for versions in files_versions.itervalues():
+                versions.sort(reverse=True)
+            cache[directory] = dict((f, collections.deque(versions))
+                                    for f, versions
+                                    in files_versions.iteritems())
+        return cache[directory].setdefault(path, collections.deque())
+
+    def _forget_versions(self, path=None):
+        """Сбрасывает кэш версий для папки файла или полностью.
+
+        Позиционные аргументы:
+        path -- внешний путь к файлу. Если None, кэш очищается.
+
+        """
+        if self._versions is None:
+            return
+        if path is None:
+            self._versions.clear()
         else:
-            _, _, added = self.add_file(path)
+            self._versions.pop(os.path.dirname(path), None)
 
-        if self.is_locked() and not self.dryrun:
-            self._size = new_size
-            self._count = new_count
+    def _trim_versions(self, added, dtime):
+        """Удаляет самые старые версии сверх max_versions.
 
-        return delta_count, delta_size, added
+        Позиционные аргументы:
+        added -- список внешних путей только что добавленных объектов
+        dtime -- штамп времени, с которым они были добавлены
+
+        Используется кэш версий, поэтому каждая папка корзины читается
+        не более одного раза за блокировку, а удаление лишней версии
+        не требует повторного поиска.
 
-    def restore(self, path, how_old=0):
+        """
+        cache = self._versions if self._versions is not None else {}
+
+        root = self._get_add_root(dtime)
+        for path in added:
+            versions = self._get_cached_versions(path, cache)
+            if not versions or versions[0][0] != dtime:
+                # Папки не имеют версий
+                full_path = stamp.add_stamp(self.to_internal(path, root),
+                                            dtime)
+                if not os.path.lexists(full_path):
+                    continue
+                versions.appendleft((dtime, full_path))
+
+            while len(versions) > self.max_versions:
+                _, full_path = versions.pop()
+                debug_fmt = ("Removing {path} becouse there are more "
+                             "than {max_versions} versions")
+                debug_msg = debug_fmt.format(path=full_path,
+                                             max_versions=self.max_versions)
+                logging.debug(debug_msg)
+
+                size = self._unlink(full_path)
+                self._account(-size, -1)
+
+    def restore(self, path, how_old=0, as_of=None):
         """Востанавливает элемент из корзины.
 
         Возвращает количестов востановленных файлов, их размер,
@@ -674,30 +2984,101 @@ class Trash(object):
         Непозиционные аргументы:
         how_old -- версия файла в порядке устарения даты удаления.
                    По умолчанию: 0 (последняя версия)
+        as_of -- момент времени (datetime): востанавливаются самые
+                 новые версии, удаленные не позже него (см.
+                 restore_dir). По умолчанию: None (выбор по how_old)
 
         Эффективно пересчитывает новый размер корзины и
         количество файлов в ней.
 
+        Выбрасывает OSError, если в папке нет ни одного файла,
+        удаленного не позже as_of. Папка при этом не создается.
+
         """
         new_path = utils.get_absolute_path(path)
-        old_path = self.to_internal(new_path)
+        is_dir = self._is_trashed_dir(new_path)
 
-        if not os.path.isdir(old_path):
-            old_path = stamp.get_version(old_path, how_old)
+        if is_dir and as_of is not None:
+            if not self._has_version_as_of(new_path, as_of):
+                raise OSError(errno.ENOENT, "No such trash entry", new_path)
 
-        if os.path.isdir(old_path):
+        if is_dir:
             dcount, dsize, restored = self.restore_dir(path,
-                                                       how_old=how_old)
+                                                       how_old=how_old,
+                                                       as_of=as_of)
         else:
             dcount, dsize, restored = self.restore_file(path,
-                                                        how_old=how_old)
-
-        if self.is_locked() and not self.dryrun:
-            self._size -= dsize
-            self._count -= dcount
+                                                        how_old=how_old,
+                                                        as_of=as_of)
 
+        self._account_restored(dcount, dsize, restored,
+                               None if is_dir else new_path)
         return dcount, dsize, restored
 
+    def _has_version_as_of(self, path, as_of):
+        """Возвращает, есть ли в папке файл, удаленный не позже as_of.
+
+        Позиционные аргументы:
+        path -- внешний путь папки
+        as_of -- момент времени (datetime)
+
+        """
+        found = self.search(os.path.join(path, "*"), recursive=True)
+        return any(dtime is not None and dtime <= as_of
+                   for versions in found.itervalues()
+                   for dtime in versions)
+
+    def _account_restored(self, dcount, dsize, restored, path=None):
+        """Учитывает востановленные файлы в размере корзины и квотах.
+
+        Позиционные аргументы:
+        dcount -- число востановленных файлов
+        dsize -- их размер в корзине
+        restored -- список востановленных путей
+
+        Непозиционные аргументы:
+        path -- востановленный файл, версии которого нужно забыть
+                (по умолчанию: забыть все версии)
+
+        """
+        if self.is_locked() and not self.dryrun:
+            # Освобожденное место неизвестно, если содержимое было общим,
+            # дельты собирались целиком или файлы извлекались из пакетов.
+            # При блокировке поддерева корзина не обходится: счетчик
+            # отмечается несверенным, и следующая монопольная блокировка
+            # обойдет корзину.
+            size_unknown = (self.dedup or self.delta or
+                            self.get_pack_index() is not None)
+            if self._subtree is None and size_unknown:
+                self._size = None
+                self._size = self.get_size()
+                self._count -= dcount
+            else:
+                self._account(-dsize, -dcount)
+                if self._subtree is not None and (
+                        size_unknown or self.compression is not None):
+                    self.get_usage_counter().invalidate()
+            # Дочерние процессы не обновляют размер емкого уровня
+            self._capacity_size = None
+            self._forget_versions(path)
+
+        if self._is_accounted() and not self.dryrun:
+            # Извлеченные из общего содержимого, дельт, сжатых файлов
+            # и пакетов файлы отличаются от файлов корзины
+            if (self.dedup or self.delta or self.compression is not None or
+                    self.get_pack_index() is not None):
+                self._mark_quotas_stale()
+            else:
+                usage = {}
+                prefixes = self._get_quota_prefixes()
+                for restored_path in restored:
+                    if os.path.lexists(restored_path):
+                        quota.add_usage(usage, restored_path,
+                                        os.lstat(restored_path), prefixes,
+                                        sign=-1, rollup=self.rollup)
+                self._charge(usage)
+            self._save_quotas()
+
     def remove(self, path, how_old=-1):
         """Удаляет элемент из корзины навсегда.
 
@@ -719,55 +3100,719 @@ class Trash(object):
         """
         removed = []
 
-        path = self.to_internal(path)
+        path = utils.get_absolute_path(path)
 
         delta_count = 0
         delta_size = 0
 
-        if not os.path.isdir(path):
+        if not self._is_trashed_dir(path):
             if how_old >= 0:
-                full_path = stamp.get_version(path, how_old)
+                full_paths = [self._get_version(path, how_old)]
+            else:
+                full_paths = [f for _, f in self._get_versions(path)]
+            for full_path in full_paths:
+                if how_old >= 0:
+                    delta_size -= self._detach_dependent(full_path)
                 delta_count += 1
-                delta_size += utils.get_files_size(full_path)
+                delta_size += self._unlink(full_path)
                 removed.append(full_path)
-                if not self.dryrun:
-                    os.remove(full_path)
-            else:
-                for vers in stamp.get_versions_list(path):
-                    full_path = stamp.add_stamp(path, vers)
-                    delta_count += 1
-                    delta_size += utils.get_files_size(full_path)
-                    removed.append(full_path)
-                    if not self.dryrun:
-                        os.remove(full_path)
         else:
-            for dirpath, _, filenames in os.walk(path, topdown=False):
-                removed.append(dirpath)
-                for element in filenames:
-                    full_path = os.path.join(dirpath, element)
+            for root in self.get_roots():
+                path_int = self.to_internal(path, root)
+                if not os.path.isdir(path_int):
+                    continue
+                dcount, dsize = self._remove_tree(path_int, removed)
+                delta_count += dcount
+                delta_size += dsize
+            pack_index = self.get_pack_index()
+            if pack_index is not None:
+                for obj_path, sec, msec, _, _ in pack_index.walk_objects(path):
+                    dtime = stamp.get_datetime(sec, msec)
+                    full_path = self._get_packed_path(obj_path, dtime)
                     delta_count += 1
-                    delta_size += utils.get_files_size(full_path)
+                    delta_size += self._unlink(full_path)
                     removed.append(full_path)
-                    if not self.dryrun:
-                        os.remove(full_path)
-                if not self.dryrun:
-                    os.rmdir(dirpath)
+            self._forget_versions()
 
         if self.is_locked() and not self.dryrun:
-            self._size -= delta_size
-            self._count -= delta_count
+            self._account(-delta_size, -delta_count)
+            self._forget_versions(path)
 
+        self._save_quotas()
         removed_stplited = [stamp.split_stamp(f) for f in removed]
         removed_stplited_ext = [(self.to_external(f), d) 
                                 for f, d in removed_stplited]
         return delta_count, delta_size, removed_stplited_ext
 
+    def remove_stamped(self, path, dtime):
+        """Удаляет навсегда элемент, добавленный с заданным штампом.
+
+        Возвращает количестов очищенных файлов и их размер.
+
+        Позиционные аргументы:
+        path -- внешний путь к элементу
+        dtime -- штамп времени, с которым элемент был добавлен
+
+        Для папки удаляются только файлы с заданным штампом,
+        после чего удаляются опустевшие из-за этого папки.
+        Отсутствующий элемент пропускается.
+
+        """
+        delta_count = 0
+        delta_size = 0
+
+        for root in self.get_roots():
+            path_int = self.to_internal(path, root)
+            full_path = stamp.add_stamp(path_int, dtime)
+
+            if os.path.lexists(full_path):
+                delta_size -= self._detach_dependent(full_path)
+                delta_count += 1
+                delta_size += self._unlink(full_path)
+                if not self.dryrun:
+                    self._forget_versions(path)
+
+            elif os.path.isdir(path_int):
+                # Удаляются только папки, опустевшие после удаления
+                # файлов со штампом: пустые папки других штампов
+                # остаются на месте
+                emptied = set()
+                for dirpath, _, filenames in os.walk(path_int,
+                                                     topdown=False):
+                    for element in filenames:
+                        if stamp.split_stamp(element)[1] != dtime:
+                            continue
+                        full_path = os.path.join(dirpath, element)
+                        delta_size -= self._detach_dependent(full_path)
+                        delta_count += 1
+                        delta_size += self._unlink(full_path)
+                        emptied.add(dirpath)
+                    if (not self.dryrun and dirpath in emptied and
+                            utils.is_empty(dirpath)):
+                        os.rmdir(dirpath)
+                        emptied.add(os.path.dirname(dirpath))
+                self._forget_versions()
+
+        pack_index = self.get_pack_index()
+        if pack_index is not None:
+            sec, msec = stamp.get_time_stamp(dtime)
+            if pack_index.get_object(path, sec, msec) is not None:
+                packed = [path]
+            else:
+                packed = [obj_path for obj_path, obj_sec, obj_msec, _, _
+                          in pack_index.walk_objects(path)
+                          if (obj_sec, obj_msec) == (sec, msec)]
+            for obj_path in packed:
+                full_path = self._get_packed_path(obj_path, dtime)
+                delta_size -= self._detach_dependent(full_path)
+                delta_count += 1
+                delta_size += self._unlink(full_path)
+            if packed and not self.dryrun:
+                self._forget_versions()
+
+        self._account(-delta_size, -delta_count)
+
+        self._save_quotas()
+        return delta_count, delta_size
+
+    def undo(self, operation=None, paths=None):
+        """Востанавливает элементы, добавленные операцией.
+
+        Возвращает количестов востановленных файлов, их размер,
+        список востановленных объектов.
+
+        Работа возможна только во время блокировки корзины.
+
+        Непозиционные аргументы:
+        operation -- идентификатор операции (см. add). По умолчанию:
+                     последняя не отмененная операция
+        paths -- внешние пути востанавливаемых элементов операции
+                 (по умолчанию: все элементы)
+
+        Внутренние пути файлов берутся из журнала операций, поэтому
+        корзина не обходится и версии не перебираются. Файлы,
+        хранящиеся как есть, перемещаются параллельно. Уже удаленные
+        из корзины файлы пропускаются, а существующие файлы
+        заменяются. Если востановлены все элементы, операция
+        отмечается отмененной.
+
+        """
+        operation_log = self.get_operation_log()
+        if operation is None:
+            operation = operation_log.get_last()
+        if operation is None:
+            return 0, 0, []
+        records = operation_log.get_records(operation)
+        if paths is not None:
+            paths = set(utils.get_absolute_path(p) for p in paths)
+            selected = [record for record in records if record[0] in paths]
+        else:
+            selected = records
+
+        restored = []
+        moves = []
+        restored_dirs = []
+        trash_dirs = set()
+        for path, dtime, files, dirs in selected:
+            for dir_path in sorted(dirs):
+                restored.append(dir_path)
+                restored_dirs.append(dir_path)
+                for root in self.get_roots():
+                    trash_dirs.add(self.to_internal(dir_path, root))
+            for file_path in files:
+                full_path = self._find_stamped(file_path, dtime)
+                if full_path is None:
+                    continue
+                moves.append((full_path, file_path))
+                restored.append(file_path)
+                trash_dirs.add(os.path.dirname(full_path))
+
+        dsize = self._restore_entries(moves, restored_dirs)
+        dcount = len(moves)
+
+        if not self.dryrun:
+            for trash_dir in sorted(trash_dirs, reverse=True):
+                if os.path.isdir(trash_dir) and utils.is_empty(trash_dir):
+                    os.rmdir(trash_dir)
+
+        self._account_restored(dcount, dsize, restored)
+        if len(selected) == len(records) and not self.dryrun:
+            operation_log.mark_undone(operation)
+        return dcount, dsize, restored
+
+    def _find_stamped(self, path, dtime):
+        """Возвращает внутренний путь файла со штампом dtime или None.
+
+        Сначала проверяется корень, в который файл был добавлен,
+        затем остальные корни (файл мог быть перенесен на емкий
+        уровень) и индекс пакетов.
+
+        """
+        full_path = self._get_entry_path(path, dtime)
+        if os.path.lexists(full_path):
+            return full_path
+        for root in self.get_roots():
+            full_path = stamp.add_stamp(self.to_internal(path, root), dtime)
+            if os.path.lexists(full_path):
+                return full_path
+        pack_index = self.get_pack_index()
+        if pack_index is not None:
+            sec, msec = stamp.get_time_stamp(dtime)
+            if pack_index.get_object(path, sec, msec) is not None:
+                return self._get_packed_path(path, dtime)
+        return None
+
+    def _restore_entries(self, moves, dirs):
+        """Перемещает файлы из корзины. Возвращает их размер в корзине.
+
+        Позиционные аргументы:
+        moves -- список пар (внутренний путь, путь назначения)
+        dirs -- внешние пути востанавливаемых папок
+
+        Сначала создаются папки, в том числе пустые, и папки
+        назначения файлов (см. _make_restored_dirs). Файлы,
+        хранящиеся как есть (см. _is_plain), переименовываются
+        в нескольких потоках. Сжатые, упакованные, разделяющие
+        содержимое файлы и все файлы при включенных дельтах
+        извлекаются по одному.
+
+        """
+        self._make_restored_dirs(dirs, moves)
+        size = 0
+        plain = []
+        for full_path, new_path in moves:
+            if not self.delta and self._is_plain(full_path):
+                plain.append((full_path, new_path))
+                continue
+            size += self._get_entry_size(full_path)
+            if not self.dryrun:
+                if os.path.lexists(new_path):
+                    os.remove(new_path)
+                self._extract(full_path, new_path)
+
+        if len(plain) < 2:
+            sizes = [self._move_out(move) for move in plain]
+        else:
+            pool = multiprocessing.pool.ThreadPool(
+                min(purge.DEFAULT_WORKERS, len(plain)))
+            try:
+                sizes = pool.map(self._move_out, plain)
+            finally:
+                pool.close()
+                pool.join()
+        return size + sum(sizes)
+
+    def _make_restored_dirs(self, dirs, moves=()):
+        """Создает недостающие востанавливаемые папки.
+
+        Позиционные аргументы:
+        dirs -- внешние пути папок
+
+        Непозиционные аргументы:
+        moves -- список пар (внутренний путь, путь назначения):
+                 создаются и папки, в которые перемещаются файлы
+
+        """
+        parents = set(os.path.dirname(new_path) for _, new_path in moves)
+        for dir_path in sorted(parents.union(dirs)):
+            if not self.dryrun and not os.path.isdir(dir_path):
+                debug_msg = "Make dir {directory} ".format(directory=dir_path)
+                logging.debug(debug_msg)
+                os.makedirs(dir_path)
+
+    def _move_out(self, move):
+        """Переименовывает файл корзины. Возвращает его размер.
+
+        Позиционные аргументы:
+        move -- пара (внутренний путь, путь назначения)
+
+        Вызывается из нескольких потоков (см. _restore_entries).
+
+        """
+        full_path, new_path = move
+        size = os.lstat(full_path).st_size
+        debug_fmt = "Moving file {old_path} to {new_path}"
+        logging.debug(debug_fmt.format(old_path=full_path, new_path=new_path))
+        if not self.dryrun:
+            if os.path.lexists(new_path):
+                os.remove(new_path)
+            os.rename(full_path, new_path)
+        return size
+
+    def expire(self, now=None):
+        """Удаляет элементы корзины, время жизни которых истекло.
+
+        Возвращает количестов очищенных файлов и их размер.
+
+        Непозиционные аргументы:
+        now -- момент времени (по умолчанию: текущее время)
+
+        Стоимость пропорциональна числу истекших элементов.
+        Элемент, который не удалось удалить, пропускается
+        и удаляется при следующем вызове.
+
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        now_sec, _ = stamp.get_time_stamp(now)
+
+        delta_count = 0
+        delta_size = 0
+
+        if self.dryrun:
+            return delta_count, delta_size
+
+        # Записи удаляются из индекса только после удаления элементов,
+        # поэтому не удаленные из-за ошибки элементы истекут снова
+        ttl_index = self.get_ttl_index()
+        removed = []
+        for path, sec, msec in ttl_index.get_expired(now_sec):
+            dtime = stamp.get_datetime(sec, msec)
+            debug_fmt = ("Removing {path}(removed time: {dtime}) "
+                         "becouse its TTL expired.")
+            debug_msg = debug_fmt.format(path=path, dtime=dtime)
+            logging.debug(debug_msg)
+
+            try:
+                dcount, dsize = self.remove_stamped(path, dtime)
+            except EnvironmentError as error:
+                warning_fmt = "Unable to expire {path}: {error}"
+                logging.warning(warning_fmt.format(path=path, error=error))
+                continue
+            delta_count += dcount
+            delta_size += dsize
+            removed.append((path, sec, msec))
+        ttl_index.discard(now_sec, removed)
+
+        return delta_count, delta_size
+
+    def remove_buckets(self, before):
+        """Удаляет временные разделы, период которых закончился до before.
+
+        Возвращает количестов очищенных файлов и их размер.
+
+        Позиционные аргументы:
+        before -- момент времени
+
+        Раздел удаляется целиком, без разбора штампов его файлов.
+
+        """
+        trash_dir = utils.get_absolute_path(self.directory)
+
+        delta_count = 0
+        delta_size = 0
+
+        for name in self.get_buckets():
+            _, end = get_bucket_period(name)
+            if end > before:
+                continue
+
+            bucket = os.path.join(trash_dir, name)
+            debug_msg = "Removing bucket {bucket}".format(bucket=bucket)
+            logging.debug(debug_msg)
+
+            dcount, dsize = self._remove_tree(bucket)
+            delta_count += dcount
+            delta_size += dsize
+
+        pack_index = self.get_pack_index()
+        if pack_index is not None and self.partition is not None:
+            fmt = PARTITION_FORMATS[self.partition]
+            for path, sec, msec in pack_index.get_all():
+                dtime = stamp.get_datetime(sec, msec)
+                _, end = get_bucket_period(BUCKET_PREFIX + dtime.strftime(fmt))
+                if end > before:
+                    continue
+                delta_count += 1
+                delta_size += self._unlink(self._get_packed_path(path, dtime))
+
+        self._account(-delta_size, -delta_count)
+        if self.is_locked() and not self.dryrun:
+            self._roots = None
+            self._forget_versions()
+
+        self._save_quotas()
+        return delta_count, delta_size
+
+    def compress_cold(self, now=None):
+        """Сжимает элементы, удаленные больше compress_age секунд назад.
+
+        Возвращает количество сжатых файлов и сэкономленное место.
+
+        Непозиционные аргументы:
+        now -- момент времени (по умолчанию: текущее время)
+
+        Уже сжатые файлы пропускаются. Ничего не делает,
+        если кодек сжатия не задан.
+
+        """
+        if self.compression is None or self.dryrun:
+            return 0, 0
+        if now is None:
+            now = datetime.datetime.now()
+        before = now - datetime.timedelta(seconds=self.compress_age)
+
+        paths = set()
+        for path, dtime in self.get_file_time_list():
+            if dtime >= before:
+                break
+            paths.add(path)
+
+        entries = []
+        for path in paths:
+            entries.extend(full_path
+                           for dtime, full_path in self._get_versions(path)
+                           if dtime < before)
+
+        count, saved = self._compress_entries(entries)
+        self._account(-saved, 0)
+        self._save_quotas()
+        return count, saved
+
+    def pack_cold(self, now=None):
+        """Упаковывает элементы, удаленные больше pack_age секунд назад.
+
+        Возвращает количество упакованных файлов и размер пакета.
+
+        Непозиционные аргументы:
+        now -- момент времени (по умолчанию: текущее время)
+
+        Все подходящие файлы записываются в один новый пакет, после
+        чего удаляются вместе с опустевшими папками. Ссылки, дельты,
+        сжатые файлы и файлы с общим содержимым не упаковываются.
+        Ничего не делает, если pack_age не задан.
+
+        """
+        if self.pack_age is None or self.dryrun:
+            return 0, 0
+        if now is None:
+            now = datetime.datetime.now()
+        before = now - datetime.timedelta(seconds=self.pack_age)
+
+        paths = set()
+        for path, dtime in self.get_file_time_list():
+            if dtime >= before:
+                break
+            paths.add(path)
+
+        entries = []
+        for path in paths:
+            entries.extend((path, dtime, full_path)
+                           for dtime, full_path in self._get_versions(path)
+                           if (dtime < before and
+                               not self._in_capacity(full_path) and
+                               self._is_plain(full_path)))
+        if not entries:
+            return 0, 0
+
+        sec, msec = stamp.get_time_stamp(now)
+        pack = "{sec}.{msec}".format(sec=sec, msec=msec)
+        pack_path = self._get_pack_path(pack)
+        pack_index = self.get_pack_index(create=True)
+        if not os.path.exists(os.path.dirname(pack_path)):
+            os.makedirs(os.path.dirname(pack_path))
+
+        debug_fmt = "Packing {count} files to {pack}"
+        debug_msg = debug_fmt.format(count=len(entries), pack=pack_path)
+        logging.debug(debug_msg)
+
+        written = packs.write_pack(pack_path, [f for _, _, f in entries],
+                                   limiter=self.throttle)
+        for (path, dtime, full_path), (offset, size) in zip(entries, written):
+            file_stat = os.lstat(full_path)
+            sec, msec = stamp.get_time_stamp(dtime)
+            pack_index.add_member(pack, offset, path, sec, msec, size,
+                                  file_stat.st_mode, file_stat.st_mtime)
+        pack_index.commit()
+
+        roots = set(self.get_roots())
+        for _, _, full_path in entries:
+            os.remove(full_path)
+            self._remove_empty_dirs(os.path.dirname(full_path), roots)
+
+        pack_size = os.lstat(pack_path).st_size
+        self._account(pack_size - sum(size for _, size in written), 0)
+        if self.is_locked():
+            self._forget_versions()
+        # Упакованные файлы не учитываются у владельцев
+        self._mark_quotas_stale()
+        return len(entries), pack_size
+
+    def _remove_empty_dirs(self, directory, roots):
+        """Удаляет опустевшие папки, поднимаясь к корню корзины.
+        """
+        while directory not in roots and utils.is_empty(directory):
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
+
+    def _get_migration_candidates(self, now):
+        """Возвращает файлы быстрого уровня, которые пора перенести.
+
+        Элемент -- кортеж (корень, внутренний путь, размер).
+        """
+        before = None
+        if self.migrate_age is not None:
+            before = now - datetime.timedelta(seconds=self.migrate_age)
+
+        capacity_root = self.get_capacity_root()
+        result = []
+        for root in self.get_roots():
+            if root == capacity_root or not os.path.isdir(root):
+                continue
+            for name in os.listdir(root):
+                protocol_path = os.path.join(root, name)
+                if name == META_DIRECTORY:
+                    continue
+                if get_bucket_period(name) is not None:
+                    continue
+                if (protocol_path == capacity_root or
+                        not os.path.isdir(protocol_path)):
+                    continue
+                for dirpath, _, files in dirfd.walk_stats(protocol_path):
+                    for element, file_stat in files:
+                        dtime = stamp.split_stamp(element)[1]
+                        if dtime is None:
+                            continue
+                        full_path = os.path.join(dirpath, element)
+                        size = file_stat.st_size
+                        if ((before is not None and dtime < before) or
+                                (self.migrate_size is not None and
+                                 size >= self.migrate_size)):
+                            result.append((dtime, root, full_path, size))
+        result.sort()
+        return [(root, full_path, size) for _, root, full_path, size in result]
+
+    def migrate(self, now=None):
+        """Переносит файлы с быстрого уровня на емкий.
+
+        Возвращает количество перенесенных файлов и их размер.
+
+        Непозиционные аргументы:
+        now -- момент времени (по умолчанию: текущее время)
+
+        Переносятся файлы старше migrate_age или не меньше
+        migrate_size, начиная с самых старых. Перенос на другое
+        устройство идет через копирование (см. utils.move_file).
+        Перенос останавливается, когда емкий уровень заполнен.
+        Ничего не делает без емкого уровня.
+
+        """
+        capacity_root = self.get_capacity_root()
+        if capacity_root is None or self.dryrun:
+            return 0, 0
+        if now is None:
+            now = datetime.datetime.now()
+
+        count = 0
+        moved_size = 0
+        roots = set(self.get_roots())
+        for root, full_path, size in self._get_migration_candidates(now):
+            if self.get_capacity_size() + size > self.capacity_max_size:
+                debug_msg = "Capacity tier is full, stop migration"
+                logging.debug(debug_msg)
+                break
+
+            new_path = os.path.join(capacity_root,
+                                    os.path.relpath(full_path, root))
+            debug_fmt = "Migrating {old_path} to {new_path}"
+            debug_msg = debug_fmt.format(old_path=full_path,
+                                         new_path=new_path)
+            logging.debug(debug_msg)
+
+            if not os.path.exists(os.path.dirname(new_path)):
+                os.makedirs(os.path.dirname(new_path))
+            old_stat = os.lstat(full_path)
+            freed = utils.move_file(full_path, new_path,
+                                    remove=self.get_dedup_index().release,
+                                    limiter=self.throttle)
+            if freed is not None:
+                self._charge_replace(full_path, old_stat, new_path)
+            self._remove_empty_dirs(os.path.dirname(full_path), roots)
+
+            count += 1
+            moved_size += size
+            # При копировании общее содержимое может не освободиться
+            if freed is not None:
+                self._account(size - freed, 0)
+            if self.is_locked():
+                self._capacity_size = self.get_capacity_size() + size
+
+        if count and self.is_locked():
+            self._forget_versions()
+        self._save_quotas()
+        return count, moved_size
+
+    def _close_indexes(self):
+        """Закрывает открытые индексы корзины.
+        """
+        if self._packs is not None:
+            pid, pack_index = self._packs
+            if pid == os.getpid():
+                pack_index.close()
+            self._packs = None
+        if self._encoded is not None:
+            pid, encoded_index = self._encoded
+            if pid == os.getpid():
+                encoded_index.close()
+            self._encoded = None
+        if self._usage is not None:
+            pid, usage = self._usage
+            if pid == os.getpid():
+                usage.close()
+            self._usage = None
+        if self._quota_index is not None:
+            pid, quota_index = self._quota_index
+            if pid == os.getpid():
+                quota_index.close()
+            self._quota_index = None
+        with self._quota_lock:
+            self._quota_pending = {}
+
+    def _make_tombstones(self, dtime):
+        """Переносит содержимое корзины в надгробия.
+
+        Возвращает пути ко всем надгробиям корзины, в том числе
+        оставшимся от прерванных ранее очисток.
+
+        """
+        trash_dir = utils.get_absolute_path(self.directory)
+        meta_dir = self.get_meta_path()
+        tombstones_dir = self.get_meta_path(purge.TOMBSTONES_DIRECTORY)
+        tombstone = stamp.add_stamp(os.path.join(tombstones_dir,
+                                                 purge.TOMBSTONE_NAME), dtime)
+        os.makedirs(os.path.join(tombstone, META_DIRECTORY))
+
+        moves = []
+        for name in os.listdir(trash_dir):
+            path = os.path.join(trash_dir, name)
+            if path not in (meta_dir, self.get_lock_file_path()):
+                moves.append((path, os.path.join(tombstone, name)))
+        for name in os.listdir(meta_dir):
+            if name not in (purge.TOMBSTONES_DIRECTORY, PURGE_STATS_FILE,
+                            LOCK_QUEUE_DIRECTORY, SUBTREE_LOCKS_DIRECTORY,
+                            USAGE_FILE):
+                moves.append((os.path.join(meta_dir, name),
+                              os.path.join(tombstone, META_DIRECTORY, name)))
+
+        # Емкий уровень на другом устройстве переносится целиком
+        # в соседнюю папку и создается заново
+        capacity_root = self.get_capacity_root()
+        if capacity_root is not None and os.path.isdir(capacity_root):
+            moves.append((capacity_root, stamp.add_stamp(capacity_root,
+                                                         dtime)))
+
+        for path, new_path in moves:
+            debug_fmt = "Moving {path} to tombstone {new_path}"
+            debug_msg = debug_fmt.format(path=path, new_path=new_path)
+            logging.debug(debug_msg)
+            os.rename(path, new_path)
+        if capacity_root is not None:
+            os.makedirs(capacity_root)
+
+        tombstones = [os.path.join(tombstones_dir, name)
+                      for name in os.listdir(tombstones_dir)]
+        if capacity_root is not None:
+            parent = os.path.dirname(capacity_root)
+            prefix = os.path.basename(capacity_root)
+            for name in os.listdir(parent):
+                name_prefix, dtime = stamp.split_stamp(name)
+                if dtime is not None and name_prefix == prefix:
+                    tombstones.append(os.path.join(parent, name))
+        return tombstones
+
+    def purge(self, background=True):
+        """Очищает всю корзину. Возвращает кол-во файлов и размер.
+
+        Непозиционные аргументы:
+        background -- удалять файлы в фоновом процессе
+                      (по умолчанию: True)
+
+        Все элементы корзины, временные разделы, пакеты и служебные
+        индексы переименовываются в надгробие, после чего корзина
+        считается пустой. Надгробие удаляется с диска отсоединенным
+        процессом с пониженным приоритетом (см. purge.spawn), поэтому
+        функция не ждет удаления файлов.
+
+        Блокирует корзину.
+
+        """
+        with self.lock():
+            count = self.get_count()
+            size = self.get_size()
+            if self.dryrun:
+                return count, size
+
+            self._close_indexes()
+            tombstones = self._make_tombstones(datetime.datetime.now())
+
+            self._size = 0
+            self._count = 0
+            self._versions = {}
+            self._roots = None
+            self._capacity_size = None
+
+        if background:
+            limiter = throttle.Throttle(
+                self.unlink_rate, truncate_rate=self.truncate_rate,
+                stats_path=self.get_meta_path(PURGE_STATS_FILE))
+            purge.spawn(tombstones, limiter=limiter, nice=self.purge_nice,
+                        ionice=self.purge_ionice,
+                        truncate_size=self.truncate_size,
+                        truncate_step=self.truncate_step)
+        else:
+            purge.remove_tombstones(tombstones, limiter=self.throttle,
+                                    truncate_size=self.truncate_size,
+                                    truncate_step=self.truncate_step)
+        return count, size
+
     def search(self, path_mask, recursive=False, find_all=False):
         """Поиск в корзине по маске. Возвращает словарь с версиями.
 
         Маска задается в формате Unix filename pattern.
         Путь задается относительно
 
+        Поиск производится во всех корнях корзины.
+
         Позиионные аргументы:
         path_mask -- маска
 
@@ -777,15 +3822,25 @@ class Trash(object):
                 если они соответствуют маске (по-умолчанию False)
 
         """
-        path_mask = self.to_internal(path_mask)
-        directory, mask = os.path.split(path_mask)
-
-        if not os.path.exists(directory):
-            return {}
-        file_mask = stamp.extend_mask_by_stamp(mask)
-        files = utils.search(directory, mask, file_mask,
-                             recursive=recursive, find_all=find_all)
-        files = [self.to_external(f) for f in files]
+        files = set()
+        for root in self.get_roots():
+            path_mask_int = self.to_internal(path_mask, root)
+            directory, mask = os.path.split(path_mask_int)
+
+            if not os.path.exists(directory):
+                continue
+            file_mask = stamp.extend_mask_by_stamp(mask)
+            found = utils.search(directory, mask, file_mask,
+                                 recursive=recursive, find_all=find_all)
+            # Папка может присутствовать в нескольких корнях
+            files.update(self.to_external(f) for f in found)
+
+        pack_index = self.get_pack_index()
+        if pack_index is not None:
+            directory, mask = os.path.split(utils.get_absolute_path(path_mask))
+            mask_re = re.compile(fnmatch.translate(mask))
+            files.update(pack_index.search(directory, mask_re,
+                                           recursive, find_all))
         files_versions = stamp.files_to_file_dict(files)
 
         return files_versions
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит функции и класс для удаления объектов корзины по TTL.
+
+Список экспортируемых функций:
+    * parse_ttl -- преобразует строку вида "2h" в число секунд
+
+Классы модуля:
+    * TtlIndex -- хранит сроки жизни объектов корзины
+
+"""
+
+
+import os
+import json
+import logging
+
+
+DEFAULT_SLOT = 60*60
+
+TTL_UNITS = {
+    "s": 1,
+    "m": 60,
+    "h": 60*60,
+    "d": 24*60*60,
+    "w": 7*24*60*60,
+}
+
+
+def parse_ttl(text):
+    """Возвращает время жизни в секундах.
+
+    Позицонные аргументы:
+    text -- строка вида "{число}[s|m|h|d|w]". Без суффикса -- секунды.
+
+    Выбрасывает ValueError если строка имеет плохой формат.
+
+    """
+    text = str(text).strip().lower()
+    multiplier = 1
+    if text and text[-1] in TTL_UNITS:
+        multiplier = TTL_UNITS[text[-1]]
+        text = text[:-1]
+    try:
+        value = int(text)
+    except ValueError:
+        raise ValueError("Bad TTL format.")
+    if value < 0:
+        raise ValueError("TTL can't be negative.")
+    return value * multiplier
+
+
+class TtlIndex(object):
+
+    """Хранит сроки жизни объектов корзины.
+
+    Индекс устроен как колесо таймеров: записи раскладываются
+    по файлам-слотам, каждый из которых покрывает slot секунд.
+    Имя слота -- время его начала.
+
+    Запись слота -- JSON список [время_истечения, секунды_штампа,
+    микросекунды_штампа, путь].
+
+    Поиск истекших записей читает только слоты, время начала которых
+    уже наступило, поэтому его стоимость пропорциональна числу истекших
+    записей, а не размеру корзины.
+
+    Методы класса:
+    * schedule -- добавляет запись
+    * pop_expired -- извлекает истекшие записи
+    * get_expired -- истекшие записи без извлечения
+    * discard -- удаляет обработанные истекшие записи
+
+    """
+
+    def __init__(self, directory, slot=DEFAULT_SLOT):
+        """Создает индекс в заданной папке.
+
+        Позицонные аргументы:
+        directory -- папка со слотами
+
+        Непозиционные аргументы:
+        slot -- размер слота в секундах
+
+        """
+        self.directory = directory
+        self.slot = slot
+
+    def _get_slot_path(self, expire):
+        """Возвращает путь к слоту для заданного времени истечения.
+        """
+        slot_start = expire // self.slot * self.slot
+        return os.path.join(self.directory, str(slot_start))
+
+    def schedule(self, path, sec, msec, ttl):
+        """Добавляет запись в индекс.
+
+        Позицонные аргументы:
+        path -- внешний путь объекта
+        sec, msec -- штамп времени удаления (см. stamp.get_time_stamp)
+        ttl -- время жизни в секундах
+
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        expire = sec + ttl
+        line = json.dumps([expire, sec, msec, path])
+        with open(self._get_slot_path(expire), "a") as slot_file:
+            slot_file.write(line + "\n")
+
+    def pop_expired(self, now):
+        """Извлекает из индекса записи, истекшие к моменту now.
+
+        Возвращает список кортежей (путь, секунды, микросекунды).
+
+        Позицонные аргументы:
+        now -- текущее время в секундах
+
+        То же, что get_expired и discard всех найденных записей.
+
+        """
+        expired = self.get_expired(now)
+        self.discard(now, expired)
+        return expired
+
+    def get_expired(self, now):
+        """Возвращает записи, истекшие к моменту now, не удаляя их.
+
+        Возвращает список кортежей (путь, секунды, микросекунды).
+
+        Позицонные аргументы:
+        now -- текущее время в секундах
+
+        Записи удаляются вызовом discard после того, как их объекты
+        удалены из корзины, поэтому при сбое удаления они истекут
+        снова.
+
+        """
+        expired = []
+        for slot_path in self._get_due_slots(now):
+            for _, record in self._read_slot(slot_path):
+                if record is not None and record[0] <= now:
+                    expired.append(record[1:])
+        return expired
+
+    def discard(self, now, records):
+        """Удаляет из индекса истекшие к моменту now записи.
+
+        Позицонные аргументы:
+        now -- время, переданное get_expired
+        records -- удаляемые записи (путь, секунды, микросекунды)
+
+        Полностью опустевшие слоты удаляются, остальные
+        перезаписываются без удаленных записей.
+
+        """
+        records = set(records)
+        for slot_path in self._get_due_slots(now):
+            rest = []
+            for line, record in self._read_slot(slot_path):
+                if record is None:
+                    continue
+                if record[0] > now or record[1:] not in records:
+                    rest.append(line)
+
+            if rest:
+                with open(slot_path, "w") as slot_file:
+                    slot_file.writelines(rest)
+            else:
+                os.remove(slot_path)
+
+    def _get_due_slots(self, now):
+        """Возвращает пути слотов, время начала которых наступило.
+
+        Позицонные аргументы:
+        now -- текущее время в секундах
+
+        """
+        if not os.path.isdir(self.directory):
+            return []
+
+        slots = []
+        for name in os.listdir(self.directory):
+            try:
+                slot_start = int(name)
+            except ValueError:
+                continue
+            if slot_start <= now:
+                slots.append(slot_start)
+        slots.sort()
+        return [os.path.join(self.directory, str(slot_start))
+                for slot_start in slots]
+
+    def _read_slot(self, slot_path):
+        """Возвращает список пар (строка, запись) слота.
+
+        Запись -- кортеж (время_истечения, путь, секунды,
+        микросекунды) или None для испорченной строки.
+
+        """
+        result = []
+        with open(slot_path, "r") as slot_file:
+            for line in slot_file:
+                try:
+                    expire, sec, msec, path = json.loads(line)
+                except ValueError:
+                    debug_fmt = "Skip bad TTL record {line!r}"
+                    logging.debug(debug_fmt.format(line=line))
+                    result.append((line, None))
+                    continue
+                result.append((line, (expire, path.encode("utf-8"), sec,
+                                      msec)))
+        return result
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+
+"""Содержит общий для процессов счетчик размера корзины.
+
+При блокировке поддеревьев (см. Trash.lock_depth) несколько процессов
+изменяют корзину одновременно, поэтому размер и число файлов,
+посчитанные при блокировке, быстро устаревают. Счетчик хранится
+в служебной папке корзины в файле фиксированного размера, который
+отображается в память (mmap). Каждое изменение -- несколько чтений
+и записей отображения под короткой блокировкой файла, поэтому
+проверка ограничений и учет файлов атомарны и не требуют обхода
+корзины.
+
+Перед перемещением файлов процесс резервирует их размер и число
+(reserve), а после -- подтверждает (Reservation.commit) или
+освобождает (Reservation.release) резерв. Незавершенные резервы
+учитываются при проверке ограничений другими процессами.
+
+Классы модуля:
+    * UsageCounter -- счетчик размера и числа файлов
+    * Reservation -- резерв места в счетчике
+
+"""
+
+
+import os
+import mmap
+import time
+import errno
+import fcntl
+import struct
+import threading
+
+
+MAGIC = "MRMU"
+VERSION = 1
+
+# Магическое число, версия, размер, число файлов, резерв размера,
+# резерв числа файлов, время последней сверки с диском
+_LAYOUT = struct.Struct("<4sIqqqqd")
+
+
+class Reservation(object):
+
+    """Резерв места в счетчике.
+
+    Поля класса:
+    * size -- зарезервированный размер
+    * count -- зарезервированное число файлов
+
+    Методы класса:
+    * commit -- подтверждает резерв
+    * release -- освобождает резерв
+
+    Используется как менеджер контента: резерв освобождается,
+    если блок завершился исключением до подтверждения.
+
+    """
+
+    def __init__(self, counter, size, count):
+        """Создает резерв. Вызывается из UsageCounter.reserve.
+        """
+        self.size = size
+        self.count = count
+        self._counter = counter
+        self._done = False
+
+    def commit(self, size=None, count=None):
+        """Подтверждает резерв.
+
+        Непозиционные аргументы:
+        size -- итоговый размер (по умолчанию: зарезервированный)
+        count -- итоговое число файлов (по умолчанию: зарезервированное)
+
+        """
+        if self._done:
+            return
+        size = self.size if size is None else size
+        count = self.count if count is None else count
+        self._counter._apply(size, count, -self.size, -self.count)
+        self._done = True
+
+    def release(self):
+        """Освобождает резерв без изменения счетчика.
+        """
+        if self._done:
+            return
+        self._counter._apply(0, 0, -self.size, -self.count)
+        self._done = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exp_type, exp_value, traceback):
+        if exp_type is not None:
+            self.release()
+
+
+class UsageCounter(object):
+
+    """Счетчик размера и числа файлов корзины.
+
+    Поля класса:
+    * path -- файл счетчика
+
+    Методы класса:
+    * read -- подтвержденные размер и число файлов
+    * get_stats -- все поля счетчика
+    * reset -- задает значения и сбрасывает резервы
+    * invalidate -- отмечает значения как несверенные
+    * update -- изменяет значения
+    * reserve -- атомарно проверяет ограничения и резервирует место
+    * close -- закрывает файл счетчика
+
+    """
+
+    def __init__(self, path):
+        """Создает счетчик в указанном файле.
+
+        Файл открывается при первом обращении.
+
+        """
+        self.path = path
+        self._fd = None
+        self._map = None
+        self._lock = threading.Lock()
+
+    def read(self):
+        """Возвращает пару (размер, число файлов) или None.
+        """
+        stats = self.get_stats()
+        if stats is None:
+            return None
+        return stats["size"], stats["count"]
+
+    def get_stats(self):
+        """Возвращает словарь полей счетчика или None, если он не задан.
+
+        Ключи: size, count -- подтвержденные размер и число файлов,
+        reserved_size, reserved_count -- незавершенные резервы,
+        synced -- время последней сверки с диском (см. reset)
+        или 0, если значения не сверены (см. invalidate).
+
+        """
+        if self._map is None and not os.path.exists(self.path):
+            return None
+        with self._critical(fcntl.LOCK_SH):
+            fields = self._load()
+        if fields is None:
+            return None
+        return dict(zip(("size", "count", "reserved_size", "reserved_count",
+                         "synced"), fields))
+
+    def reset(self, size, count):
+        """Задает размер и число файлов, сбрасывая резервы.
+
+        Вызывается после обхода корзины под монопольной блокировкой,
+        когда незавершенных резервов быть не может.
+
+        """
+        with self._critical(fcntl.LOCK_EX):
+            self._store(size, count, 0, 0, time.time())
+
+    def invalidate(self):
+        """Отмечает значения как несверенные с диском.
+
+        Монопольная блокировка корзины изменяет ее без счетчика
+        и сверяет его при снятии (reset). Если процесс умрет раньше,
+        следующая блокировка увидит отметку и обойдет корзину.
+
+        """
+        with self._critical(fcntl.LOCK_EX):
+            fields = self._load()
+            if fields is not None:
+                self._store(*(fields[:4] + (0.0,)))
+
+    def update(self, delta_size, delta_count):
+        """Изменяет размер и число файлов.
+        """
+        self._apply(delta_size, delta_count, 0, 0)
+
+    def reserve(self, delta_size, delta_count, max_size=None, max_count=None):
+        """Резервирует место. Возвращает Reservation или None.
+
+        Позицонные аргументы:
+        delta_size -- резервируемый размер
+        delta_count -- резервируемое число файлов
+
+        Непозиционные аргументы:
+        max_size -- ограничение размера (None -- без ограничения)
+        max_count -- ограничение числа файлов
+
+        Ограничения проверяются с учетом чужих резервов. Если они
+        будут превышены, возвращает None и ничего не меняет.
+
+        """
+        with self._critical(fcntl.LOCK_EX):
+            fields = self._checked_load()
+            size, count, reserved_size, reserved_count, synced = fields
+            if ((max_size is not None and delta_size > 0 and
+                 size + reserved_size + delta_size > max_size) or
+                    (max_count is not None and delta_count > 0 and
+                     count + reserved_count + delta_count > max_count)):
+                return None
+            self._store(size, count, reserved_size + delta_size,
+                        reserved_count + delta_count, synced)
+        return Reservation(self, delta_size, delta_count)
+
+    def close(self):
+        """Закрывает файл счетчика.
+        """
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                os.close(self._fd)
+            self._map = None
+            self._fd = None
+
+    def _apply(self, delta_size, delta_count, delta_reserved_size,
+               delta_reserved_count):
+        """Атомарно изменяет поля счетчика.
+        """
+        with self._critical(fcntl.LOCK_EX):
+            size, count, reserved_size, reserved_count, synced = (
+                self._checked_load())
+            self._store(size + delta_size, count + delta_count,
+                        max(0, reserved_size + delta_reserved_size),
+                        max(0, reserved_count + delta_reserved_count),
+                        synced)
+
+    def _critical(self, operation):
+        """Возвращает менеджер контента критической секции.
+        """
+        return _CriticalSection(self, operation)
+
+    def _open(self):
+        """Открывает и отображает в память файл счетчика.
+        """
+        if self._map is not None:
+            return
+        directory = os.path.dirname(self.path)
+        try:
+            os.makedirs(directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < _LAYOUT.size:
+                # Пустой файл -- счетчик не задан (см. _load)
+                os.ftruncate(fd, _LAYOUT.size)
+            self._map = mmap.mmap(fd, _LAYOUT.size)
+        except Exception:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def _load(self):
+        """Читает поля. Возвращает кортеж или None, если счетчик не задан.
+        """
+        magic, version, size, count, reserved_size, reserved_count, synced = (
+            _LAYOUT.unpack_from(self._map, 0))
+        if magic != MAGIC or version != VERSION:
+            return None
+        return size, count, reserved_size, reserved_count, synced
+
+    def _checked_load(self):
+        """Читает поля. Выбрасывает IOError, если счетчик не задан.
+        """
+        fields = self._load()
+        if fields is None:
+            raise IOError(errno.ENOENT, "Usage counter is not set.",
+                          self.path)
+        return fields
+
+    def _store(self, size, count, reserved_size, reserved_count, synced):
+        """Записывает поля.
+        """
+        _LAYOUT.pack_into(self._map, 0, MAGIC, VERSION, size, count,
+                          reserved_size, reserved_count, synced)
+
+
+class _CriticalSection(object):
+    """Блокирует файл счетчика на время изменения отображения.
+
+    flock защищает от других процессов, а threading.Lock --
+    от других потоков процесса, разделяющих дескриптор.
+    """
+
+    def __init__(self, counter, operation):
+        self.counter = counter
+        self.operation = operation
+
+    def __enter__(self):
+        self.counter._lock.acquire()
+        try:
+            self.counter._open()
+            fcntl.flock(self.counter._fd, self.operation)
+        except Exception:
+            self.counter._lock.release()
+            raise
+
+    def __exit__(self, exp_type, exp_value, traceback):
+        try:
+            fcntl.flock(self.counter._fd, fcntl.LOCK_UN)
+        finally:
+            self.counter._lock.release()
@@ -7,15 +7,22 @@
     * search -- производит поиск объектов по маске
     * files_count -- считает количество файлов
     * files_size -- считает размер файлов
+    * get_disk_usage -- считает размер файлов с учетом жестких ссылок
     * split_path -- разбивает путь на состовляющие
+    * move_file -- перемещает файл, в том числе на другое устройство
 
 """
 
 
 import os
 import re
+import errno
+import shutil
 import fnmatch
 
+import myrm.dirfd as dirfd
+import myrm.throttle as throttle
+
 
 def search(directory, dir_mask, file_mask, recursive=False, find_all=False):
     """Производит поиск объектов по маске. Возвращает итератор.
@@ -79,7 +86,7 @@ def get_files_count(path):
     if not os.path.isdir(path):
         return 1 if os.path.exists(path) else 0
     ans = 0
-    for _, _, filenames in os.walk(path):
+    for _, _, filenames in dirfd.walk(path):
         ans += len(filenames)
     return ans
 
@@ -93,10 +100,44 @@ def get_files_size(path):
         else:
             return 0
     ans = 0
-    for dirpath, _, filenames in os.walk(path):
-        for somefile in filenames:
-            file_path = os.path.join(dirpath, somefile)
-            ans += os.lstat(file_path).st_size
+    for _, _, files in dirfd.walk_stats(path):
+        for _, file_stat in files:
+            ans += file_stat.st_size
+    return ans
+
+
+def get_disk_usage(path, exclude=()):
+    """Возвращает занимаемое на диске место данного объекта.
+
+    Позицонные аргументы:
+    path -- путь к файлу или папке
+
+    Непозиционные аргументы:
+    exclude -- пути, которые не учитываются
+
+    В отличие от get_files_size, содержимое, на которое ведут
+    несколько жестких ссылок, учитывается один раз.
+
+    """
+    if not os.path.isdir(path):
+        if os.path.exists(path) and path not in exclude:
+            return os.lstat(path).st_size
+        else:
+            return 0
+    ans = 0
+    seen = set()
+    for dirpath, dirnames, files in dirfd.walk_stats(path):
+        dirnames[:] = [d for d in dirnames
+                       if os.path.join(dirpath, d) not in exclude]
+        for somefile, file_stat in files:
+            if os.path.join(dirpath, somefile) in exclude:
+                continue
+            if file_stat.st_nlink > 1:
+                inode = (file_stat.st_dev, file_stat.st_ino)
+                if inode in seen:
+                    continue
+                seen.add(inode)
+            ans += file_stat.st_size
     return ans
 
 
@@ -113,3 +154,42 @@ def is_empty(directory):
     """
     return len(os.listdir(directory)) == 0
 
+
+def move_file(path, new_path, remove=os.remove, limiter=None):
+    """Перемещает файл, в том числе на другое устройство.
+
+    Позицонные аргументы:
+    path -- исходный путь к файлу
+    new_path -- путь назначения
+
+    Непозиционные аргументы:
+    remove -- функция удаления исходного файла после копирования
+    limiter -- ограничение скорости копирования (см. throttle.Throttle)
+
+    Если файлы лежат на разных устройствах, файл копируется во
+    временный файл рядом с new_path, сбрасывается на диск
+    и переименовывается, и лишь затем исходный файл удаляется.
+    Ссылка копируется как ссылка.
+
+    Возвращает результат remove, если файл копировался, иначе None.
+
+    """
+    try:
+        os.rename(path, new_path)
+        return None
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+
+    temp_path = new_path + ".move"
+    if os.path.islink(path):
+        os.symlink(os.readlink(path), temp_path)
+    else:
+        with open(path, "rb") as input_file:
+            with open(temp_path, "wb") as output_file:
+                throttle.copy_file_obj(input_file, output_file, limiter)
+                output_file.flush()
+                os.fsync(output_file.fileno())
+        shutil.copystat(path, temp_path)
+    os.rename(temp_path, new_path)
+    return remove(path)
@@ -140,6 +140,20 @@ class TrashTests(unittest.TestCase):
                                   'e/k/l.txt'])
         
         
+    def test_same_with_max_versions(self):
+        directory = self.files_folder
+        self.autocleaner.size = 100
+        self.autocleaner.count = 100
+        self.autocleaner.days = 1
+        self.autocleaner.same_count = 3
+        # Версии добавлены до того, как задан предел
+        self.trash.max_versions = 1
+
+        self.autocleaner.autoclean()
+
+        path = os.path.join(directory, "a.txt")
+        self.assertEquals(len(self.trash.search(path)[path]), 2)
+
     def test_old(self):
         directory = self.files_folder
         self.autocleaner.size = 100
@@ -194,3 +208,81 @@ class TrashTests(unittest.TestCase):
         files = [os.path.relpath(f, directory) for f in files]
         
         self.assertEquals(files, ['a.txt', 'e/g.txt', 'e/h.png', 'e/k/l.txt'])
+        
+    def test_rules(self):
+        directory = self.files_folder
+        self.autocleaner.configurate(size=100, count=100, days=1, 
+                                     same_count=10,
+                                     rules="a.txt:max2, *.png:0s")
+        
+        self.autocleaner.autoclean()
+        
+        path = os.path.join(directory, "*.*")
+        files_vers = self.trash.search(path, recursive=True)
+        files = []
+        for path in files_vers:
+            for dtime in files_vers[path]:
+                files.append(path)
+        files.sort()
+        files = [os.path.relpath(f, directory) for f in files]
+        
+        self.assertEquals(files, ['a.txt', 'a.txt', 'b.txt', 
+                                  'e/f.txt', 'e/g.txt', 'e/k/l.txt'])
+        
+    def test_rules_keep(self):
+        directory = self.files_folder
+        self.autocleaner.configurate(size=100, count=3, days=1, 
+                                     same_count=10,
+                                     rules=["*:keep", "**/e/**:1w"])
+        
+        self.autocleaner.autoclean()
+        
+        path = os.path.join(directory, "*.*")
+        files_vers = self.trash.search(path, recursive=True)
+        files = []
+        for path in files_vers:
+            for dtime in files_vers[path]:
+                files.append(path)
+        files.sort()
+        files = [os.path.relpath(f, directory) for f in files]
+        
+        self.assertEquals(files, ['a.txt', 'a.txt', 'a.txt', 'a.txt', 'a.txt',
+                                  'b.txt', 'c.png'])
+        
+    def test_old_buckets(self):
+        directory = self.files_folder
+        self.autocleaner.configurate(size=100, count=100, days=1, 
+                                     same_count=10)
+        
+        trash_dir = self.trash.get_roots()[0]
+        os.makedirs(os.path.join(trash_dir, "@19900101"))
+        path_int = os.path.join(self.files_folder, "b.txt")
+        path_int = self.trash.to_internal(path_int, 
+                                          os.path.join(trash_dir, "@19900101"))
+        os.makedirs(os.path.dirname(path_int))
+        path_stamp = stamp.add_stamp(path_int, datetime.datetime(1990, 1, 1))
+        with open(path_stamp, "w") as f:
+            f.write("123")
+        
+        self.assertEquals(self.trash.get_count(), 12)
+        self.autocleaner.autoclean()
+        self.assertEquals(self.trash.get_count(), 11)
+        self.assertEquals(self.trash.get_buckets(), [])
+
+    def test_quotas(self):
+        prefix = os.path.join(self.files_folder, "e")
+        self.trash.configurate(directory=self.trash.directory,
+                               lock_file="lock", max_size=1024, max_count=100,
+                               quotas={"prefix": {prefix: {"max_count": 1}}})
+        count = self.trash.get_count()
+
+        self.autocleaner.autoclean_by_quotas()
+
+        with self.trash.lock():
+            self.assertEquals(self.trash.get_quota_usage(("prefix", prefix)),
+                              (0, 1))
+        self.assertEquals(self.trash.get_count(), count - 3)
+        files = self.trash.search(os.path.join(prefix, "*.*"),
+                                  recursive=True)
+        files = [os.path.relpath(f, self.files_folder) for f in files]
+        self.assertEquals(files, ["e/k/l.txt"])
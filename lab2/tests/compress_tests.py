@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import os
+
+import myrm.compress as compress
+
+
+class CompressTests(unittest.TestCase):
+
+    def setUp(self):
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        self.folder = os.path.join(script_dir, "test_folder", "compress_test")
+        os.makedirs(self.folder)
+        self.path = os.path.join(self.folder, "a.txt")
+        self.new_path = os.path.join(self.folder, "b.txt")
+
+    def tearDown(self):
+        for element in os.listdir(self.folder):
+            os.remove(os.path.join(self.folder, element))
+        os.rmdir(self.folder)
+
+    def test_codecs(self):
+        data = "".join(str(i % 7) * 100 for i in xrange(1000))
+        for codec in compress.CODECS:
+            with open(self.path, "w") as f:
+                f.write(data)
+
+            saved = compress.compress_file(self.path, codec, chunk_size=1000)
+            self.assertTrue(saved > 0)
+            self.assertEquals(os.path.getsize(self.path), len(data) - saved)
+            self.assertEquals(compress.get_codec(self.path), codec)
+
+            compress.decompress_file(self.path, self.new_path,
+                                     chunk_size=1000)
+            with open(self.new_path, "r") as f:
+                self.assertEquals(f.read(), data)
+            self.assertEquals(compress.get_codec(self.new_path), None)
+
+    def test_incompressible(self):
+        with open(self.path, "w") as f:
+            f.write("1234567890")
+
+        self.assertEquals(compress.compress_file(self.path), 0)
+        self.assertEquals(compress.get_codec(self.path), None)
+        with open(self.path, "r") as f:
+            self.assertEquals(f.read(), "1234567890")
+        self.assertEquals(os.listdir(self.folder), ["a.txt"])
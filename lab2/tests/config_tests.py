@@ -33,6 +33,7 @@ class ConfigTests(unittest.TestCase):
                 "count" : 1000*1000,
                 "days" : 90,
                 "samename" : 10,
+                "rules" : ["*.log:1d", "*.iso:max1"],
             }
         }
         self.maxDiff = 10000
@@ -46,11 +47,25 @@ class ConfigTests(unittest.TestCase):
         new_cfg = config.load_from_cfg(path)
         self.assertEquals(new_cfg, self.cfg)
     
+    def test_cfg_comma(self):
+        self.cfg["trash"]["dir"] = "/data/a,b/trash"
+        self.cfg["autoclean"]["rules"] = ["*.log:1d"]
+        path = os.path.join(self.folder, "comma.cfg")
+        try:
+            config.save_to_cfg(self.cfg, path)
+            new_cfg = config.load_from_cfg(path)
+        finally:
+            os.remove(path)
+        self.assertEquals(new_cfg, self.cfg)
+
     def test_cfg_load(self):
         path = os.path.join(self.folder, "test.cfg")
         new_cfg = config.load_from_cfg(path)
         self.assertFalse(new_cfg["verbose"])
         self.assertEquals(new_cfg["autoclean"]["count"], 54321)
+        self.assertEquals(new_cfg["autoclean"]["rules"],
+                          ["*.log:1d", "*.iso:max1", 
+                           "/home/*/important/**:keep"])
         
     def test_cfg_error(self):
         path = os.path.join(self.folder, "bad.cfg")
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import os
+
+import myrm.delta as delta
+
+
+class DeltaTests(unittest.TestCase):
+
+    def setUp(self):
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        self.folder = os.path.join(script_dir, "test_folder", "delta_test")
+        os.makedirs(self.folder)
+        self.base_path = os.path.join(self.folder, "base")
+        self.target_path = os.path.join(self.folder, "target")
+        self.delta_path = os.path.join(self.folder, "delta")
+        self.new_path = os.path.join(self.folder, "new")
+
+    def tearDown(self):
+        for element in os.listdir(self.folder):
+            os.remove(os.path.join(self.folder, element))
+        os.rmdir(self.folder)
+
+    def write(self, path, data):
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def rebuild(self):
+        delta.apply_delta(self.base_path, self.delta_path, self.new_path)
+        with open(self.new_path, "rb") as f:
+            return f.read()
+
+    def test_delta(self):
+        lines = ["line {0}\n".format(i) for i in xrange(1000)]
+        target = "".join(lines)
+        lines[10] = "changed\n"
+        del lines[500:510]
+        lines.insert(700, "inserted\n")
+        self.write(self.base_path, "".join(lines))
+        self.write(self.target_path, target)
+
+        size = delta.make_delta(self.base_path, self.target_path,
+                                self.delta_path, (100, 5))
+        self.assertTrue(size < len(target) // 10)
+        self.assertEquals(os.path.getsize(self.delta_path), size)
+        self.assertEquals(delta.get_base_stamp(self.delta_path), (100, 5))
+        self.assertEquals(delta.get_base_stamp(self.target_path), None)
+        self.assertEquals(self.rebuild(), target)
+
+    def test_different(self):
+        self.write(self.base_path, "".join(chr(i % 256) for i in xrange(5000)))
+        self.write(self.target_path, "1234567890" * 500)
+
+        size = delta.make_delta(self.base_path, self.target_path,
+                                self.delta_path, (1, 0))
+        self.assertEquals(size, None)
+        self.assertFalse(os.path.exists(self.delta_path))
+
+    def test_empty(self):
+        self.write(self.base_path, "")
+        self.write(self.target_path, "")
+
+        delta.make_delta(self.base_path, self.target_path,
+                         self.delta_path, (1, 0))
+        self.assertEquals(self.rebuild(), "")
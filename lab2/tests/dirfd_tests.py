@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import os
+import shutil
+
+import myrm.dirfd as dirfd
+
+
+@unittest.skipUnless(dirfd.SUPPORTED, "dir_fd calls are unsupported")
+class DirFdTests(unittest.TestCase):
+
+    def setUp(self):
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        self.folder = os.path.join(script_dir, "test_folder", "dirfd_test")
+        os.makedirs(os.path.join(self.folder, "a", "b"))
+        with open(os.path.join(self.folder, "a", "f.txt"), "w") as f:
+            f.write("12345")
+        with open(os.path.join(self.folder, "a", "b", "g.txt"), "w"):
+            pass
+        os.symlink(os.path.join(self.folder, "a"),
+                   os.path.join(self.folder, "link"))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_calls(self):
+        dir_fd = dirfd.open_dir(os.path.join(self.folder, "a"))
+        try:
+            self.assertEquals(sorted(dirfd.listdir(dir_fd)), ["b", "f.txt"])
+            self.assertEquals(dirfd.lstat("f.txt", dir_fd).st_size, 5)
+
+            sub_fd = dirfd.open_dir("b", dir_fd)
+            try:
+                dirfd.rename("f.txt", dir_fd, u"h.txt", sub_fd)
+                dirfd.unlink("g.txt", sub_fd)
+                self.assertEquals(dirfd.listdir(sub_fd), ["h.txt"])
+                dirfd.unlink("h.txt", sub_fd)
+            finally:
+                os.close(sub_fd)
+            dirfd.rmdir("b", dir_fd)
+            self.assertEquals(dirfd.listdir(dir_fd), [])
+
+            with self.assertRaises(OSError):
+                dirfd.unlink("missing", dir_fd)
+        finally:
+            os.close(dir_fd)
+
+        with self.assertRaises(OSError):
+            dirfd.open_dir(os.path.join(self.folder, "link"))
+
+    def test_walk(self):
+        result = [(os.path.relpath(dirpath, self.folder), sorted(dirnames),
+                   sorted(filenames))
+                  for dirpath, dirnames, filenames in dirfd.walk(self.folder)]
+        self.assertEquals(result, [(".", ["a"], ["link"]),
+                                   ("a", ["b"], ["f.txt"]),
+                                   (os.path.join("a", "b"), [], ["g.txt"])])
+
+        result = [os.path.relpath(dirpath, self.folder)
+                  for dirpath, _, _ in dirfd.walk(self.folder, topdown=False)]
+        self.assertEquals(result, [os.path.join("a", "b"), "a", "."])
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import os
+
+from myrm.encoded import EncodedIndex
+
+
+class EncodedIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        self.filename = os.path.join(script_dir, "test_folder", "encoded.db")
+        self.index = EncodedIndex(self.filename)
+
+    def tearDown(self):
+        self.index.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.filename + suffix):
+                os.remove(self.filename + suffix)
+
+    def test_compressed(self):
+        self.assertEquals(self.index.get("/a", 100, 5), None)
+        self.index.set_compressed("/a", 100, 5, "zlib")
+        self.assertEquals(self.index.get("/a", 100, 5), ("zlib", None))
+        self.assertEquals(self.index.get("/a", 100, 6), None)
+
+        self.index.remove("/a", 100, 5)
+        self.assertEquals(self.index.get("/a", 100, 5), None)
+        self.index.remove("/a", 100, 5)
+
+    def test_delta(self):
+        self.index.set_delta("/a", 100, 5, 200, 7)
+        self.assertEquals(self.index.get("/a", 100, 5), (None, (200, 7)))
+
+        self.index.remove("/a", 100, 5)
+        self.assertEquals(self.index.get("/a", 100, 5), None)
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import os
+import shutil
+
+import myrm.locking as locking
+
+from myrm.locking import LockQueue
+
+
+class LockingTests(unittest.TestCase):
+
+    def setUp(self):
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        self.folder = os.path.join(script_dir, "test_folder", "locking_test")
+        self.queue = LockQueue(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_order(self):
+        first = self.queue.enter()
+        reader_a = self.queue.enter(shared=True)
+        reader_b = self.queue.enter(shared=True)
+        last = self.queue.enter()
+
+        self.assertTrue(self.queue.is_turn(first))
+        self.assertFalse(self.queue.is_turn(reader_a))
+        self.queue.leave(first)
+        self.assertTrue(self.queue.is_turn(reader_a))
+        self.assertTrue(self.queue.is_turn(reader_b))
+        self.assertFalse(self.queue.is_turn(last))
+
+        self.queue.leave(reader_a)
+        self.queue.leave(reader_b)
+        self.assertTrue(self.queue.is_turn(last))
+        self.queue.leave(last)
+        self.assertEquals(os.listdir(self.folder), [locking.COUNTER_FILE])
+
+    def test_waiters(self):
+        self.assertFalse(self.queue.has_waiters())
+        ticket = self.queue.enter()
+        self.assertTrue(self.queue.has_waiters())
+        os.close(ticket[1])
+        self.assertFalse(self.queue.has_waiters())
+        self.assertFalse(os.path.exists(ticket[0]))
+
+    def test_dead_ticket(self):
+        dead = self.queue.enter()
+        waiter = self.queue.enter()
+        self.assertFalse(self.queue.is_turn(waiter))
+
+        # Билет остается, но его блокировку снимает ядро
+        os.close(dead[1])
+        self.assertTrue(self.queue.is_turn(waiter))
+        self.assertFalse(os.path.exists(dead[0]))
+        self.queue.leave(waiter)
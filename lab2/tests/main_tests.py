@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+
+from myrm.__main__ import _get_argument_parcer
+
+
+class ArgumentParcerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = _get_argument_parcer()
+
+    def test_option_first(self):
+        args = self.parser.parse_args(["rm", "-r", "w/d"])
+        self.assertEquals(args.command, "rm")
+        self.assertEquals(args.filemasks, ["w/d"])
+        self.assertTrue(args.recursive)
+
+        args = self.parser.parse_args(["rs", "--as-of", "1d", "path"])
+        self.assertEquals(args.command, "rs")
+        self.assertEquals(args.filemasks, ["path"])
+        self.assertEquals(args.as_of, "1d")
+
+        args = self.parser.parse_args(["ls", "-r", "-a", "mask"])
+        self.assertEquals(args.filemasks, ["mask"])
+        self.assertTrue(args.versions)
+
+    def test_option_last(self):
+        args = self.parser.parse_args(["rm", "w/d", "-r"])
+        self.assertEquals(args.filemasks, ["w/d"])
+        self.assertTrue(args.recursive)
+
+    def test_option_before_command(self):
+        args = self.parser.parse_args(["-s", "rm", "-r", "w/d"])
+        self.assertTrue(args.silence)
+        self.assertTrue(args.recursive)
+        self.assertEquals(args.how_old, 0)
+
+    def test_optional_masks(self):
+        for command in ("clear", "stats", "undo"):
+            args = self.parser.parse_args([command])
+            self.assertEquals(args.filemasks, [])
+
+    def test_required_masks(self):
+        for command in ("rm", "rs", "ls", "du"):
+            self.assertRaises(SystemExit, self.parser.parse_args,
+                              [command, "-r"])
+
+    def test_remove_only(self):
+        parser = _get_argument_parcer(remove_only=True)
+        args = parser.parse_args(["-r", "w/d"])
+        self.assertEquals(args.filemasks, ["w/d"])
+        self.assertTrue(args.recursive)
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import os
+import datetime
+
+import myrm.objects
+import myrm.stamp as stamp
+import myrm.utils as utils
+
+from myrm.objects import ObjectTrash
+
+
+def unify(files, directory):
+    result = [os.path.relpath(f, directory) for f in files]
+    result.sort()
+    return result
+
+class ObjectTrashTests(unittest.TestCase):
+
+    def setUp(self):
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        self.folder = os.path.join(script_dir,"test_folder","objects_test")
+        self.files_folder = os.path.join(self.folder, "files")
+
+        os.makedirs(self.files_folder)
+        with open(os.path.join(self.files_folder, "a.txt"), "w") as f:
+            f.write("1234567890")
+        with open(os.path.join(self.files_folder, "b.txt"), "w") as f:
+            f.write("12345")
+        with open(os.path.join(self.files_folder, "c.png"), "w"):
+            pass
+
+        os.makedirs(os.path.join(self.files_folder, "e"))
+        with open(os.path.join(self.files_folder, "e", "f.txt"), "w") as f:
+            f.write("1234567890")
+        with open(os.path.join(self.files_folder, "e", "g.txt"), "w") as f:
+            f.write("12345")
+        os.makedirs(os.path.join(self.files_folder, "e", "k"))
+        os.makedirs(os.path.join(self.files_folder, "e", "m"))
+        with open(os.path.join(self.files_folder, "e", "k","l.txt"), "w"):
+            pass
+
+        cfg = {
+            "directory" : os.path.join(self.folder, ".trash"),
+            "lock_file" : "lock",
+
+            "max_size" : 300,
+            "max_count": 10
+        }
+
+        self.trash = ObjectTrash(**cfg)
+
+    def tearDown(self):
+        for dirpath, dirnames, filenames in os.walk(self.folder, topdown=False):
+            for element in filenames:
+                element_path = os.path.join(dirpath, element)
+                os.remove(element_path)
+            if not os.path.samefile(dirpath, self.folder):
+                os.rmdir(dirpath)
+
+    def test_partition(self):
+        with self.assertRaises(ValueError):
+            ObjectTrash(partition="day")
+
+    def test_layout(self):
+        directory = self.files_folder
+        path = os.path.join(directory, "a.txt")
+
+        with self.trash.lock():
+            self.trash.add(path)
+            self.trash.add(os.path.join(directory, "e"))
+
+            versions = self.trash.get_index().get_versions(path)
+            (sec, msec, object_id, size), = versions
+            object_path = self.trash.get_object_path(object_id)
+            self.assertTrue(os.path.isfile(object_path))
+            self.assertEquals(size, 10)
+
+            objects_dir = os.path.join(self.trash.directory,
+                                       myrm.objects.OBJECTS_DIRECTORY)
+            shard = os.path.relpath(os.path.dirname(object_path), objects_dir)
+            self.assertEquals(shard, os.path.join(object_id[:2],
+                                                  object_id[2:4]))
+            self.assertEquals(self.trash.get_count(), 4)
+            self.assertEquals(self.trash.get_size(), 25)
+
+        self.assertEquals(self.trash.get_count(), 4)
+        self.assertEquals(self.trash.get_size(), 25)
+        path_first, dtime = self.trash.get_file_time_list()[0]
+        self.assertEquals(path_first, path)
+        self.assertEquals(stamp.get_time_stamp(dtime), (sec, msec))
+
+    def test_simple(self):
+        directory = os.path.join(self.files_folder, "e")
+        path = os.path.join(directory, "f.txt")
+
+        with self.trash.lock():
+            count, size, delta_files = self.trash.add(path)
+            self.assertEquals((count, size), (1, 10))
+            self.assertFalse(os.path.exists(path))
+
+            files = self.trash.search(os.path.join(directory, "*"))
+            self.assertEquals(unify(files, directory), ["f.txt"])
+
+        with self.trash.lock():
+            count, size, delta_files = self.trash.restore(path)
+            self.assertEquals((count, size), (1, 10))
+            self.assertEquals(unify(delta_files, directory), ["f.txt"])
+            with open(path, "r") as f:
+                self.assertEquals(f.read(), "1234567890")
+
+            self.assertEquals(self.trash.search(path), {})
+            self.assertEquals(self.trash.get_count(), 0)
+
+    def test_dir(self):
+        directory = self.files_folder
+        path = os.path.join(directory, "e")
+
+        with self.trash.lock():
+            count, size, delta_files = self.trash.add(path)
+            self.assertEquals((count, size), (3, 15))
+            delta_files = unify(delta_files, directory)
+            self.assertEquals(delta_files, ["e", "e/f.txt", "e/g.txt",
+                                            "e/k", "e/k/l.txt", "e/m"])
+            self.assertFalse(os.path.exists(path))
+
+            files = self.trash.search(os.path.join(directory, "*"),
+                                      recursive=True, find_all=True)
+            self.assertEquals(unify(files, directory),
+                              ["e", "e/f.txt", "e/g.txt", "e/k", "e/k/l.txt",
+                               "e/m"])
+
+            count, size, delta_files = self.trash.restore(path)
+            self.assertEquals((count, size), (3, 15))
+
+            files = list(utils.search(directory, "*", "*", recursive=True,
+                                      find_all=True))
+            self.assertEquals(unify(files, directory),
+                              ["a.txt", "b.txt", "c.png", "e", "e/f.txt",
+                               "e/g.txt", "e/k", "e/k/l.txt", "e/m"])
+            self.assertEquals(self.trash.search(os.path.join(directory, "*")),
+                              {})
+
+    def test_stats(self):
+        directory = self.files_folder
+        path_e = os.path.join(directory, "e")
+
+        with self.trash.lock():
+            self.trash.add(os.path.join(directory, "a.txt"))
+            self.trash.add(path_e)
+
+            summary = self.trash.collect_stats(top=1)
+            self.assertEquals((summary.count, summary.size), (4, 25))
+            self.assertEquals(summary.versions, {1: 4})
+            self.assertEquals(self.trash.get_tree_usage(path_e), (15, 3))
+
+            summary = self.trash.collect_stats(path_e)
+            self.assertEquals((summary.count, summary.size), (3, 15))
+
+    def test_undo(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_e = os.path.join(directory, "e")
+
+        with self.trash.lock():
+            self.trash.add(path_e, operation="op1")
+            self.trash.add(path_a, operation="op1")
+
+            count, size, _ = self.trash.undo()
+            self.assertEquals((count, size), (4, 25))
+            self.assertTrue(os.path.exists(path_a))
+            self.assertTrue(os.path.exists(os.path.join(path_e, "k",
+                                                        "l.txt")))
+            self.assertTrue(os.path.isdir(os.path.join(path_e, "m")))
+            files = self.trash.search(os.path.join(directory, "*"))
+            self.assertEquals(list(files), [])
+
+    def test_missing_version(self):
+        path_a = os.path.join(self.files_folder, "a.txt")
+        with self.trash.lock():
+            with self.assertRaises(OSError):
+                self.trash.restore_file(path_a)
+            with self.assertRaises(OSError):
+                self.trash.remove(path_a, how_old=0)
+            self.assertEquals(self.trash.remove(path_a)[:2], (0, 0))
+
+    def test_restore_as_of(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_e = os.path.join(directory, "e")
+        path_f = os.path.join(path_e, "f.txt")
+        before = datetime.datetime.now()
+
+        with self.trash.lock():
+            self.trash.add(path_a)
+            self.trash.add(path_e)
+            as_of = datetime.datetime.now()
+            os.makedirs(path_e)
+            for path in (path_a, path_f):
+                with open(path, "w") as f:
+                    f.write("1th\n")
+            self.trash.add(path_a)
+            self.trash.add(path_e)
+
+            self.assertRaises(OSError, self.trash.restore, path_e,
+                              as_of=before)
+            self.assertFalse(os.path.exists(path_e))
+            count, size, _ = self.trash.restore(path_e, as_of=as_of)
+            self.assertEquals((count, size), (3, 15))
+            count, size, _ = self.trash.restore(path_a, as_of=as_of)
+            self.assertEquals((count, size), (1, 10))
+            for path in (path_a, path_f):
+                with open(path) as f:
+                    self.assertEquals(f.read(), "1234567890")
+            self.assertEquals(len(self.trash.get_index().get_versions(path_a)),
+                              1)
+
+    def test_remove_dir(self):
+        directory = self.files_folder
+        path = os.path.join(directory, "e")
+
+        with self.trash.lock():
+            self.trash.add(path)
+            self.trash.add(os.path.join(directory, "a.txt"))
+
+            count, size, delta_files = self.trash.remove(path)
+            self.assertEquals((count, size), (3, 15))
+            delta_files = unify([f for f, _ in delta_files], directory)
+            self.assertEquals(delta_files, ["e", "e/f.txt", "e/g.txt",
+                                            "e/k", "e/k/l.txt", "e/m"])
+
+            files = self.trash.search(os.path.join(directory, "*"))
+            self.assertEquals(unify(files, directory), ["a.txt"])
+            self.assertEquals(self.trash.get_count(), 1)
+            self.assertEquals(self.trash.get_size(), 10)
+
+    def test_multi(self):
+        directory = self.files_folder
+        path = os.path.join(directory, "a.txt")
+
+        with self.trash.lock():
+            self.trash.add(path)
+            for i in xrange(1, 4):
+                with open(path, "w") as f:
+                    f.write("{i}th\n".format(i=i))
+                self.trash.add(path)
+
+            self.assertEquals(len(self.trash.get_versions_list(path)), 4)
+
+            count, size, delta_files = self.trash.remove(path, how_old=1)
+            self.assertEquals((count, size), (1, 4))
+
+            self.trash.restore(path, how_old=1)
+            with open(path, "r") as f:
+                self.assertEquals(f.read(), "1th\n")
+
+            count, size, delta_files = self.trash.remove(path)
+            self.assertEquals((count, size), (2, 14))
+            self.assertEquals(self.trash.get_versions_list(path), [])
+
+    def test_max_versions(self):
+        directory = self.files_folder
+        path = os.path.join(directory, "a.txt")
+
+        self.trash.max_versions = 2
+        with self.trash.lock():
+            for i in xrange(4):
+                with open(path, "w") as f:
+                    f.write("{i}th\n".format(i=i))
+                self.trash.add(path)
+
+            self.assertEquals(len(self.trash.get_versions_list(path)), 2)
+            self.assertEquals(self.trash.get_count(), 2)
+
+            self.trash.restore(path, how_old=1)
+            with open(path, "r") as f:
+                self.assertEquals(f.read(), "2th\n")
+
+    def test_ttl(self):
+        directory = self.files_folder
+
+        with self.trash.lock():
+            self.trash.add(os.path.join(directory, "a.txt"), ttl=60)
+            self.trash.add(os.path.join(directory, "e"), ttl=60*60)
+            self.trash.add(os.path.join(directory, "b.txt"))
+
+            now = datetime.datetime.now() + datetime.timedelta(hours=2)
+            count, size = self.trash.expire(now)
+            self.assertEquals((count, size), (4, 25))
+
+            files = self.trash.search(os.path.join(directory, "*"))
+            self.assertEquals(unify(files, directory), ["b.txt"])
+
+    def test_session(self):
+        path = os.path.join(self.files_folder, "a.txt")
+        index_path = self.trash.get_meta_path(myrm.objects.INDEX_FILE)
+        with self.trash.session() as session:
+            session.add(path)
+            other = myrm.objects.ObjectIndex(index_path)
+            self.assertEquals(other.get_count(), 0)
+            other.close()
+            self.trash.flush()
+            other = myrm.objects.ObjectIndex(index_path)
+            self.assertEquals(other.get_count(), 1)
+            other.close()
+
+    def test_search(self):
+        directory = self.files_folder
+
+        with self.trash.lock():
+            self.trash.add(os.path.join(directory, "a.txt"))
+            self.trash.add(os.path.join(directory, "c.png"))
+            self.trash.add(os.path.join(directory, "e/f.txt"))
+
+            path = os.path.join(directory, "*.txt")
+            files = self.trash.search(path, recursive=True)
+            self.assertEquals(unify(files, directory), ["a.txt", "e/f.txt"])
+
+            path = os.path.join(directory, "[ac].*")
+            files = self.trash.search(path)
+            self.assertEquals(unify(files, directory), ["a.txt", "c.png"])
+
+            path = os.path.join(directory, "*")
+            files = self.trash.search(path)
+            self.assertEquals(unify(files, directory), ["a.txt", "c.png", "e"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import os
+import datetime
+
+from myrm.oplog import OperationLog
+from myrm.oplog import new_operation_id
+
+
+class OperationLogTests(unittest.TestCase):
+
+    def setUp(self):
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        self.folder = os.path.join(script_dir, "test_folder", "oplog_test")
+        self.filename = os.path.join(self.folder, "operations.log")
+        self.dtime = datetime.datetime(2017, 12, 31, 10, 20, 30, 123456)
+
+    def tearDown(self):
+        for dirpath, dirnames, filenames in os.walk(self.folder,
+                                                    topdown=False):
+            for element in filenames:
+                os.remove(os.path.join(dirpath, element))
+            os.rmdir(dirpath)
+
+    def test_operation_id(self):
+        first = new_operation_id()
+        second = new_operation_id()
+        self.assertTrue(first.endswith("-{0}".format(os.getpid())))
+        self.assertTrue(first <= second)
+
+    def test_records(self):
+        log = OperationLog(self.filename)
+        self.assertEquals(log.get_records("op1"), [])
+        self.assertEquals(log.get_last(), None)
+
+        log.append("op1", "/a/b", self.dtime, ["/a/b/c", "/a/b/d/e"],
+                   ["/a/b", "/a/b/d"])
+        log.append("op2", "/a/f", self.dtime, ["/a/f"], [])
+        log.append("op1", "/a/g", self.dtime, ["/a/g"], [])
+
+        records = log.get_records("op1")
+        self.assertEquals(records, [
+            ("/a/b", self.dtime, ["/a/b/c", "/a/b/d/e"], ["/a/b", "/a/b/d"]),
+            ("/a/g", self.dtime, ["/a/g"], []),
+        ])
+        self.assertEquals(log.get_last(), "op1")
+
+    def test_mark_undone(self):
+        log = OperationLog(self.filename)
+        log.append("op1", "/a", self.dtime, ["/a"], [])
+        log.append("op2", "/b", self.dtime, ["/b"], [])
+
+        log.mark_undone("op2")
+        self.assertEquals(log.get_last(), "op1")
+        log.mark_undone("op1")
+        self.assertEquals(log.get_last(), None)
+
+    def test_rotation(self):
+        log = OperationLog(self.filename, max_size=200)
+        for number in range(6):
+            log.append("op{0}".format(number), "/a", self.dtime, ["/a"], [])
+
+        self.assertTrue(os.path.exists(self.filename + ".1"))
+        self.assertTrue(os.path.getsize(self.filename) <= 200)
+        self.assertEquals(log.get_last(), "op5")
+        self.assertEquals(log.get_records("op0"), [])
+
+    def test_broken_line(self):
+        log = OperationLog(self.filename)
+        log.append("op1", "/a", self.dtime, ["/a"], [])
+        with open(self.filename, "a") as log_file:
+            log_file.write('{"op": "op2", "pa')
+        self.assertEquals(log.get_last(), "op1")
+
+
+if __name__ == "__main__":
+    unittest.main()
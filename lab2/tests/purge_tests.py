@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import os
+import shutil
+
+import myrm.purge as purge
+import myrm.throttle as throttle
+
+
+class PurgeTests(unittest.TestCase):
+
+    def setUp(self):
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        self.folder = os.path.join(script_dir, "test_folder", "purge_test")
+        self.tree = os.path.join(self.folder, "tree")
+        self.make_tree()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def make_tree(self):
+        for i in xrange(4):
+            for j in xrange(3):
+                directory = os.path.join(self.tree, str(i), str(j))
+                os.makedirs(directory)
+                with open(os.path.join(directory, "file"), "w") as f:
+                    f.write("12345")
+        with open(os.path.join(self.tree, "top"), "w") as f:
+            f.write("1234567890")
+        os.symlink(os.path.join(self.tree, "0"),
+                   os.path.join(self.tree, "1", "link"))
+
+    def test_remove_tree(self):
+        for workers, use_dir_fd in ((1, True), (2, True), (16, True),
+                                    (1, False), (4, False)):
+            removed = []
+            count, size = purge.remove_tree(self.tree, workers=workers,
+                                            removed=removed,
+                                            use_dir_fd=use_dir_fd)
+            self.assertEquals(count, 14)
+            self.assertEquals(size, 70 + len(os.path.join(self.tree, "0")))
+            self.assertFalse(os.path.exists(self.tree))
+            self.assertEquals(len(removed), 14 + 17)
+            self.make_tree()
+
+    def test_keep_dirs(self):
+        sizes = []
+
+        def release(path, file_stat, remove):
+            sizes.append(file_stat.st_size)
+            return 1
+
+        count, size = purge.remove_tree(self.tree, release=release,
+                                        workers=4, remove_dirs=False)
+        self.assertEquals((count, size), (14, 14))
+        self.assertEquals(sum(sizes), 70 + len(os.path.join(self.tree, "0")))
+        self.assertTrue(os.path.isdir(os.path.join(self.tree, "3", "2")))
+
+    def test_truncate(self):
+        shared = os.path.join(self.folder, "shared")
+        with open(shared, "w") as f:
+            f.write("1234567890")
+        os.link(shared, os.path.join(self.tree, "2", "hard"))
+
+        path = os.path.join(self.tree, "top")
+        file_stat = os.lstat(path)
+        self.assertEquals(purge.truncate_file(path, file_stat, step=3), 4)
+        self.assertEquals(os.path.getsize(path), 0)
+        with open(path, "w") as f:
+            f.write("1234567890")
+
+        limiter = throttle.Throttle()
+        count, size = purge.remove_tree(self.tree, workers=4,
+                                        limiter=limiter, truncate_size=5,
+                                        truncate_step=2)
+        self.assertEquals(count, 15)
+        self.assertEquals(size, 80 + len(os.path.join(self.tree, "0")))
+        self.assertEquals(limiter.get_stats()["truncated"], 70)
+        self.assertFalse(os.path.exists(self.tree))
+        with open(shared, "r") as f:
+            self.assertEquals(f.read(), "1234567890")
+        os.remove(shared)
+
+    def test_tombstones(self):
+        other = os.path.join(self.folder, "other")
+        with open(other, "w") as f:
+            f.write("123")
+
+        count, size = purge.remove_tombstones([self.tree, other])
+        self.assertEquals(count, 15)
+        self.assertEquals(os.listdir(self.folder), [])
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import os
+import shutil
+
+import myrm.quotas as quotas
+
+from myrm.quotas import QuotaIndex
+
+
+class QuotasTests(unittest.TestCase):
+
+    def setUp(self):
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        self.folder = os.path.join(script_dir, "test_folder", "quotas_test")
+        os.makedirs(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_parse(self):
+        limits = quotas.parse_quotas({
+            "uid": {"1000": {"max_size": 10}},
+            "prefix": {"/srv/build/": {"max_count": 5}}})
+        self.assertEquals(limits, {("uid", "1000"): (10, None),
+                                   ("prefix", "/srv/build"): (None, 5)})
+        self.assertEquals(quotas.parse_quotas(None), {})
+        with self.assertRaises(ValueError):
+            quotas.parse_quotas({"gid": {"0": {"max_size": 1}}})
+        with self.assertRaises(ValueError):
+            quotas.parse_quotas({"uid": {"0": {"size": 1}}})
+
+    def test_tenants(self):
+        prefixes = ["/srv/build", "/srv/build/cache", "/srv/b"]
+        self.assertEquals(quotas.get_tenants("/srv/build/cache/x", 7,
+                                             prefixes),
+                          [("uid", "7"), ("prefix", "/srv/build"),
+                           ("prefix", "/srv/build/cache")])
+        self.assertEquals(quotas.get_tenants("/srv/build", None, prefixes),
+                          [("prefix", "/srv/build")])
+
+    def test_rollup(self):
+        self.assertEquals(quotas.get_tenants("/srv/build/x", None, [],
+                                             rollup=True),
+                          [("dir", "/srv/build"), ("dir", "/srv"),
+                           ("dir", "/")])
+
+    def test_collect(self):
+        directory = os.path.join(self.folder, "data")
+        os.makedirs(os.path.join(directory, "sub"))
+        with open(os.path.join(directory, "a"), "w") as f:
+            f.write("12345")
+        with open(os.path.join(directory, "sub", "b"), "w") as f:
+            f.write("123")
+
+        usage = quotas.collect_usage(directory,
+                                     [os.path.join(directory, "sub")])
+        uid = ("uid", str(os.getuid()))
+        self.assertEquals(usage, {
+            uid: [8, 2],
+            ("prefix", os.path.join(directory, "sub")): [3, 1]})
+
+    def test_index(self):
+        index = QuotaIndex(os.path.join(self.folder, quotas.INDEX_FILE))
+        self.assertEquals(index.get_prefixes(), None)
+        self.assertEquals(index.get_usage(("uid", "0")), (0, 0))
+
+        index.replace({("uid", "0"): (10, 2)}, ["/b", "/a"])
+        index.update({("uid", "0"): (-4, -1), ("prefix", "/a"): (3, 1)})
+        self.assertEquals(index.get_usage(("uid", "0")), (6, 1))
+        self.assertEquals(index.get_all(), {("uid", "0"): (6, 1),
+                                            ("prefix", "/a"): (3, 1)})
+        self.assertEquals(index.get_prefixes(), ["/a", "/b"])
+
+        self.assertFalse(index.is_stale())
+        index.set_stale()
+        index.close()
+        index = QuotaIndex(os.path.join(self.folder, quotas.INDEX_FILE))
+        self.assertTrue(index.is_stale())
+        index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
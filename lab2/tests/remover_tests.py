@@ -3,11 +3,13 @@
 
 import unittest
 import os
+import time
 
 import myrm
 import myrm.stamp as stamp
 import myrm.utils as utils
 import myrm.config as config
+import myrm.purge as purge
 
 from myrm.remover import Remover
 
@@ -293,6 +295,33 @@ class TrashTests(unittest.TestCase):
 
         self.assertEquals(files, ["b.txt"])
 
+    def test_du(self):
+        directory = os.path.join(self.files_folder)
+        path = os.path.join(directory, "*")
+        self.mrm.remove(path)
+
+        path = os.path.join(directory, "[ae]*")
+        result = self.mrm.du(path)
+        result = [(os.path.relpath(f, directory), size, count)
+                  for f, size, count in result]
+
+        self.assertEquals(result, [("a.txt", 10, 1), ("e", 15, 5)])
+
+    def test_undo(self):
+        directory = os.path.join(self.files_folder)
+        self.mrm.remove(os.path.join(directory, "[ab]*"))
+        first = self.mrm.last_operation
+        self.mrm.remove(os.path.join(directory, "e"))
+
+        count, size, _ = self.mrm.undo()
+        self.assertEquals((count, size), (5, 15))
+        self.assertTrue(os.path.exists(os.path.join(directory, "e", "f.txt")))
+
+        count, size, _ = self.mrm.undo(first)
+        self.assertEquals((count, size), (2, 15))
+        self.assertEquals(self.mrm.lst(os.path.join(directory, "*")), [])
+        self.assertRaises(ValueError, self.mrm.undo)
+
     def test_clean1(self):
         directory = os.path.join(self.files_folder)
         path = os.path.join(directory, "*")
@@ -334,3 +363,44 @@ class TrashTests(unittest.TestCase):
         files = [os.path.relpath(f, directory) for f in files]
 
         self.assertEquals(files, ["b.txt", "e/g.txt", "e/k/l.txt"])
+
+    def test_clean_all(self):
+        directory = os.path.join(self.files_folder)
+        path = os.path.join(directory, "*")
+        self.mrm.remove(path)
+
+        count, size, files = self.mrm.clean()
+        self.assertEquals((count, size), (9, 30))
+        self.assertEquals(files, [(self.mrm.trash.directory, None)])
+        self.assertEquals(self.mrm.lst(path), [])
+        self.assertEquals(self.mrm.trash.get_count(), 0)
+
+        tombstones = self.mrm.trash.get_meta_path(purge.TOMBSTONES_DIRECTORY)
+        for _ in xrange(500):
+            if not os.listdir(tombstones):
+                break
+            time.sleep(0.01)
+        self.assertEquals(os.listdir(tombstones), [])
+
+    def test_objects_layout(self):
+        directory = os.path.join(self.files_folder)
+        trash_cfg = {
+            "directory" : os.path.join(self.folder, ".trash"),
+            "layout" : "objects"
+        }
+        self.mrm.configurate(trash=trash_cfg)
+        self.assertIs(self.mrm.autocleaner.trash, self.mrm.trash)
+
+        self.mrm.remove(os.path.join(directory, "e"), recursive=True)
+        path = os.path.join(directory, "e", "*.txt")
+        files_vers = self.mrm.lst(path)
+        files = [os.path.relpath(f[0], directory) for f in files_vers]
+        self.assertEquals(files, ["e/f.txt", "e/g.txt"])
+
+        path = os.path.join(directory, "e")
+        count, size, delta_files = self.mrm.restore(path)
+        self.assertEquals(count, 5)
+        self.assertEquals(size, 15)
+
+        with self.assertRaises(ValueError):
+            self.mrm.configurate(trash={"layout" : "unknown"})
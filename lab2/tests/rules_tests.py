@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+
+import myrm.rules as rules
+
+from myrm.rules import RulesMatcher
+
+
+class ParseRuleTests(unittest.TestCase):
+
+    def test_keep(self):
+        self.assertEquals(rules.parse_rule(" /a/**:keep "),
+                          ("/a/**", rules.KEEP, None))
+
+    def test_max(self):
+        self.assertEquals(rules.parse_rule("*.iso:max2"),
+                          ("*.iso", rules.MAX_VERSIONS, 2))
+
+    def test_age(self):
+        self.assertEquals(rules.parse_rule("*.log:1d"),
+                          ("*.log", rules.MAX_AGE, 24*60*60))
+
+    def test_bad(self):
+        with self.assertRaises(ValueError):
+            rules.parse_rule("*.log")
+        with self.assertRaises(ValueError):
+            rules.parse_rule("*.log:maxx")
+        with self.assertRaises(ValueError):
+            rules.parse_rule(":keep")
+
+
+class RulesMatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = RulesMatcher("*.log:1d, *.iso:max1, "
+                                    "/home/*/important/**:keep")
+
+    def test_name(self):
+        self.assertEquals(self.matcher.classify("/var/log/a.log"),
+                          (rules.MAX_AGE, 24*60*60))
+        self.assertEquals(self.matcher.classify("/b.iso"),
+                          (rules.MAX_VERSIONS, 1))
+
+    def test_path(self):
+        self.assertEquals(self.matcher.classify("/home/u/important/a/b"),
+                          (rules.KEEP, None))
+        self.assertEquals(self.matcher.classify("/home/u/v/important/b"),
+                          (None, None))
+
+    def test_last_wins(self):
+        self.assertEquals(self.matcher.classify("/home/u/important/a.log"),
+                          (rules.KEEP, None))
+
+    def test_star(self):
+        matcher = RulesMatcher(["/a/*:keep", "/b/**/c.txt:keep", "[xy]?:1h"])
+        self.assertEquals(matcher.classify("/a/b")[0], rules.KEEP)
+        self.assertEquals(matcher.classify("/a/b/c")[0], None)
+        self.assertEquals(matcher.classify("/b/c.txt")[0], rules.KEEP)
+        self.assertEquals(matcher.classify("/b/d/e/c.txt")[0], rules.KEEP)
+        self.assertEquals(matcher.classify("/q/y1")[0], rules.MAX_AGE)
+        self.assertEquals(matcher.classify("/q/z1")[0], None)
+
+    def test_many(self):
+        matcher = RulesMatcher(["/x/{num}:{num}s".format(num=num)
+                                for num in xrange(1, 300)])
+        self.assertEquals(matcher.classify("/x/5"), (rules.MAX_AGE, 5))
+        self.assertEquals(matcher.classify("/x/299"), (rules.MAX_AGE, 299))
+        self.assertEquals(matcher.classify("/x/300"), (None, None))
+
+    def test_empty(self):
+        matcher = RulesMatcher()
+        self.assertEquals(len(matcher), 0)
+        self.assertEquals(matcher.classify("/a"), (None, None))
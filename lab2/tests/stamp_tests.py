@@ -143,6 +143,15 @@ class StampTimesTests(unittest.TestCase):
         vers = stamp.get_version(self.path, 3)
         self.assertEqual(vers, self.new_path1)
         
+    def test_version_as_of(self):
+        vers = [(dtime, None) for dtime in stamp.get_versions_list(self.path)]
+        self.assertEqual(stamp.find_version_as_of(vers, self.dtime3), 0)
+        self.assertEqual(stamp.find_version_as_of(vers, self.dtime2), 1)
+        before = self.dtime1 - datetime.timedelta(microseconds=1)
+        self.assertEqual(stamp.find_version_as_of(vers, before), None)
+        after = self.dtime1 + datetime.timedelta(microseconds=1)
+        self.assertEqual(stamp.find_version_as_of(vers, after), 2)
+
     def test_dict(self):
         mask = stamp.extend_mask_by_stamp(self.path)
         dircetory, file_mask = os.path.split(mask)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import datetime
+
+import myrm.stats as stats
+
+from myrm.stats import Histogram
+from myrm.stats import TrashStats
+
+
+class StatsTests(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram((10, 100))
+        for value in (0, 9, 10, 50, 1000):
+            histogram.add(value, value)
+        self.assertEquals(histogram.get_buckets(),
+                          [(0, 10, 2, 9), (10, 100, 2, 60),
+                           (100, None, 1, 1000)])
+
+    def test_summary(self):
+        now = datetime.datetime(2017, 12, 31)
+        summary = TrashStats(top=2, now=now, growth_period=2*stats.DAY)
+        summary.add("/a", now - datetime.timedelta(hours=1), 10)
+        summary.add("/b", now - datetime.timedelta(days=3), 30)
+        summary.add("/c", now - datetime.timedelta(days=40), 20)
+        summary.add("/d", now, 5)
+
+        report = summary.get_report()
+        self.assertEquals(report["count"], 4)
+        self.assertEquals(report["size"], 65)
+        self.assertEquals(report["oldest"], now - datetime.timedelta(days=40))
+        self.assertEquals(report["newest"], now)
+        self.assertEquals([path for path, _, _ in report["largest"]],
+                          ["/b", "/c"])
+        self.assertEquals([count for _, _, count, _ in report["ages"]],
+                          [1, 1, 1, 0, 1, 0])
+        self.assertEquals(report["growth_rate"], 7.5)
+
+    def test_index_objects(self):
+        summary = TrashStats(top=0)
+        rows = [("/a", 2, 0, 1), ("/a", 1, 0, 1), ("/b", 1, 0, 1),
+                ("/c", 3, 0, 1), ("/c", 2, 0, 1), ("/c", 1, 0, 1)]
+        stats.add_index_objects(summary, iter(rows))
+        self.assertEquals(summary.count, 6)
+        self.assertEquals(summary.versions, {1: 1, 2: 1, 3: 1})
+        self.assertEquals(summary.get_largest(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
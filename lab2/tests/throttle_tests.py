@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import os
+import StringIO
+
+import myrm.throttle as throttle
+
+
+class ThrottleTests(unittest.TestCase):
+
+    def setUp(self):
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        self.folder = os.path.join(script_dir, "test_folder", "throttle_test")
+        os.makedirs(self.folder)
+        self.stats_path = os.path.join(self.folder, "stats.json")
+
+    def tearDown(self):
+        for element in os.listdir(self.folder):
+            os.remove(os.path.join(self.folder, element))
+        os.rmdir(self.folder)
+
+    def test_token_bucket(self):
+        bucket = throttle.TokenBucket(rate=100, burst=10)
+        self.assertEquals(bucket.consume(10), 0)
+        wait = bucket.consume(5)
+        self.assertTrue(0 < wait <= 0.05)
+        self.assertEquals(bucket.consumed, 15)
+        self.assertEquals(bucket.throttled_time, wait)
+
+        unlimited = throttle.TokenBucket()
+        self.assertEquals(unlimited.consume(10 ** 9), 0)
+        self.assertEquals(unlimited.throttled_time, 0)
+
+    def test_copy(self):
+        limiter = throttle.Throttle(io_rate=10 ** 9)
+        output_file = StringIO.StringIO()
+        size = throttle.copy_file_obj(StringIO.StringIO("x" * 2500),
+                                      output_file, limiter, chunk_size=1000)
+        self.assertEquals(size, 2500)
+        self.assertEquals(output_file.getvalue(), "x" * 2500)
+        self.assertEquals(limiter.get_stats()["transferred"], 2500)
+
+    def test_stats(self):
+        self.assertEquals(throttle.load_stats(self.stats_path), None)
+
+        limiter = throttle.Throttle(unlink_rate=1000,
+                                    stats_path=self.stats_path)
+        for _ in xrange(3):
+            limiter.unlink()
+        limiter.save_stats(done=True)
+
+        stats = throttle.load_stats(self.stats_path)
+        self.assertEquals(stats["unlinked"], 3)
+        self.assertEquals(stats["transferred"], 0)
+        self.assertEquals(stats["pid"], os.getpid())
+        self.assertTrue(stats["done"])
+        self.assertEquals(os.listdir(self.folder), ["stats.json"])
+
+    def test_io_priority(self):
+        self.assertRaises(ValueError, throttle.set_io_priority, 8)
+        self.assertRaises(ValueError, throttle.set_io_priority, "low")
@@ -3,13 +3,41 @@
 
 import unittest
 import os
+import errno
+import time
+import datetime
+import threading
+import multiprocessing
 
 import myrm.trash
 import myrm.stamp as stamp
+import myrm.delta as delta
+import myrm.packs as packs
+import myrm.purge as purge
+import myrm.throttle as throttle
+import myrm.compress as compress
 import myrm.utils as utils
 import myrm.config as config
 
 from myrm.trash import Trash
+from myrm.trash import LimitExcessException
+from myrm.trash import QuotaExcessException
+
+
+def hold_lock(directory, lock_file, hold):
+    trash = Trash(directory=directory, lock_file=lock_file, lock_timeout=None)
+    with trash.lock():
+        time.sleep(hold)
+
+
+def start_waiter(trash, hold=0):
+    waiter = multiprocessing.Process(target=hold_lock,
+                                     args=(trash.directory, trash.lock_file,
+                                           hold))
+    waiter.start()
+    while not trash.has_lock_waiters():
+        time.sleep(0.01)
+    return waiter
 
 
 def unify(files, directory):
@@ -101,6 +129,199 @@ class TrashTests(unittest.TestCase):
         with self.assertRaises(IOError):
             self.trash.set_lock()
 
+    def test_shared_lock(self):
+        lock_file = self.trash.get_lock_file_path()
+        other = Trash(directory=self.trash.directory)
+        self.trash.set_lock(shared=True)
+        other.set_lock(shared=True)
+        self.assertTrue(self.trash.is_shared())
+        with self.assertRaises(IOError):
+            with self.trash.lock():
+                pass
+
+        self.trash.unset_lock()
+        self.assertTrue(os.path.exists(lock_file))
+        with self.assertRaises(IOError):
+            self.trash.set_lock()
+        other.unset_lock()
+        self.assertFalse(os.path.exists(lock_file))
+
+    def test_lock_timeout(self):
+        other = Trash(directory=self.trash.directory)
+        other.set_lock()
+
+        self.trash.lock_timeout = 0.1
+        with self.assertRaises(IOError):
+            self.trash.set_lock()
+        self.assertEquals(self.trash.get_lock_stats()["timeouts"], 1)
+
+        self.trash.lock_timeout = 5
+        timer = threading.Timer(0.1, other.unset_lock)
+        timer.start()
+        with self.trash.lock():
+            stats = self.trash.get_lock_stats()
+            self.assertEquals((stats["acquired"], stats["waited"]), (1, 1))
+            self.assertTrue(0.1 <= stats["max_wait"] < 5)
+        timer.join()
+
+    def test_subtree_lock(self):
+        path_a = os.path.join(self.files_folder, "a.txt")
+        path_b = os.path.join(self.files_folder, "b.txt")
+        path_e = os.path.join(self.files_folder, "e")
+        other_folder = os.path.join(self.folder, "other")
+        depth = len(utils.split_path(self.folder))
+
+        self.trash.lock_depth = depth
+        self.trash.max_count = 6
+        other = Trash(directory=self.trash.directory, lock_depth=depth)
+        with other.lock(subtree=other_folder):
+            with self.trash.lock(subtree=self.files_folder):
+                self.assertEquals(self.trash.get_subtree(),
+                                  self.trash.get_subtree_key(path_e))
+                self.trash.add(path_e)
+                self.trash.add(path_a)
+                with self.assertRaises(LimitExcessException):
+                    self.trash.add(path_b)
+                with self.assertRaises(IOError):
+                    with self.trash.lock():
+                        pass
+            self.assertEquals(other.get_usage_counter().read(), (25, 6))
+
+            with self.assertRaises(IOError):
+                self.trash.set_lock()
+            with self.assertRaises(IOError):
+                self.trash.set_lock(subtree=other_folder)
+
+        with self.trash.lock(subtree=path_e):
+            self.trash.remove(path_e)
+        self.assertEquals(self.trash.get_usage_counter().read(), (10, 1))
+        with self.trash.lock():
+            self.assertEquals((self.trash.get_size(),
+                               self.trash.get_count()), (10, 1))
+
+    def test_session(self):
+        path_a = os.path.join(self.files_folder, "a.txt")
+        path_b = os.path.join(self.files_folder, "b.txt")
+        with self.trash.session(flush_interval=0) as session:
+            self.assertTrue(self.trash.is_locked())
+            session.add(path_a)
+            session.add(path_b)
+            self.assertEquals(self.trash.get_size(), 15)
+
+            # Папка из кэша удалена востановлением последнего файла
+            session.restore(path_a)
+            session.restore(path_b)
+            session.add(path_a)
+            self.assertEquals((self.trash.get_size(),
+                               self.trash.get_count()), (10, 1))
+            with self.trash.lock():
+                self.trash.add(path_b)
+            self.assertTrue(self.trash.is_locked())
+            self.assertEquals(session.search(path_b).keys(), [path_b])
+        self.assertFalse(self.trash.is_locked())
+        self.assertFalse(session.is_open())
+        self.assertEquals(session.get_stats(),
+                          {"operations": 6, "flushes": 7, "renewals": 0})
+        with self.assertRaises(IOError):
+            session.add(path_a)
+
+    def test_session_lease(self):
+        path_a = os.path.join(self.files_folder, "a.txt")
+        path_b = os.path.join(self.files_folder, "b.txt")
+        with self.trash.session(flush_interval=0, lease=0) as session:
+            waiter = start_waiter(self.trash)
+            session.add(path_a)
+            waiter.join()
+            self.assertEquals(waiter.exitcode, 0)
+            self.assertTrue(self.trash.is_locked())
+            self.assertTrue(session.is_open())
+            self.assertEquals(session.get_stats()["renewals"], 1)
+            session.add(path_b)
+        self.assertFalse(self.trash.is_locked())
+
+        # Не дождавшись блокировки, сессия закрывается
+        session = self.trash.session(flush_interval=0, lease=0,
+                                     renew_timeout=0)
+        session.open()
+        waiter = start_waiter(self.trash, hold=0.5)
+        with self.assertRaises(IOError):
+            session.restore(path_a)
+        self.assertFalse(self.trash.is_locked())
+        self.assertFalse(session.is_open())
+        session.close()
+        self.trash.unset_lock()
+        waiter.join()
+        self.assertEquals(waiter.exitcode, 0)
+        self.assertTrue(os.path.exists(path_a))
+
+    def test_usage_counter(self):
+        self.trash.lock_depth = 1
+        with self.trash.lock():
+            size = self.trash.get_size()
+        usage = self.trash.get_usage_counter()
+        self.assertEquals(usage.read(), (size, self.trash.get_count()))
+
+        # Сверенный счетчик без резервов заменяет обход корзины
+        usage.reset(size + 1, 100)
+        with self.trash.lock():
+            self.assertEquals(self.trash.get_size(), size + 1)
+            self.assertEquals(usage.get_stats()["synced"], 0)
+
+        # Резерв умершего процесса -- повод обойти корзину
+        usage.reserve(1, 1)
+        with self.trash.lock():
+            self.assertEquals(self.trash.get_size(), size)
+
+    def test_usage_counter_remove_stamped(self):
+        path_a = os.path.join(self.files_folder, "a.txt")
+        self.trash.lock_depth = 1
+        with self.trash.lock(subtree=path_a):
+            self.trash.add(path_a)
+            dtime = self.trash.get_versions_list(path_a)[0]
+            count, size = self.trash.remove_stamped(path_a, dtime)
+            self.assertEquals((count, size), (1, 10))
+            self.assertEquals((self.trash.get_size(), self.trash.get_count()),
+                              (0, 0))
+        usage = self.trash.get_usage_counter()
+        self.assertEquals(usage.read(), (0, 0))
+
+    def test_remove_stamped_dir(self):
+        path_e = os.path.join(self.files_folder, "e")
+        path_m = os.path.join(path_e, "m")
+        with self.trash.lock():
+            self.trash.add(path_e)
+            dtime = self.trash.get_versions_list(
+                os.path.join(path_e, "f.txt"))[0]
+            os.makedirs(path_m)
+            self.trash.add(path_m)
+
+            count, size = self.trash.remove_stamped(path_e, dtime)
+            self.assertEquals((count, size), (5, 15))
+            self.assertTrue(os.path.isdir(self.trash.to_internal(path_m)))
+            self.assertFalse(os.path.exists(
+                self.trash.to_internal(os.path.join(path_e, "k"))))
+
+    def test_unlink_without_dedup(self):
+        path_a = os.path.join(self.files_folder, "a.txt")
+
+        def fail_dedup_index():
+            raise AssertionError("dedup index used without dedup")
+
+        with self.trash.lock():
+            self.trash.add(path_a)
+            self.trash.get_dedup_index = fail_dedup_index
+            count, size, _ = self.trash.remove(path_a)
+            self.assertEquals((count, size), (1, 10))
+
+    def test_stale_lock(self):
+        lock_file = self.trash.get_lock_file_path()
+        os.makedirs(os.path.dirname(lock_file))
+        with open(lock_file, "w"):
+            pass
+        with self.trash.lock():
+            self.assertTrue(self.trash.is_locked())
+        self.assertFalse(os.path.exists(lock_file))
+
     def test_simple(self):
         directory = os.path.join(self.files_folder, "e")
         path = os.path.join(directory, "f.txt")
@@ -339,6 +560,674 @@ class TrashTests(unittest.TestCase):
             self.assertTrue(len(stamp.get_versions_list(path)) == 0)
 
         
+    def test_max_versions(self):
+        directory = self.files_folder
+        path = os.path.join(directory, "a.txt")
+        
+        self.trash.max_versions = 2
+        with self.trash.lock():
+            for i in xrange(4):
+                with open(path, "w") as f:
+                    f.write("{}th\n".format(i))
+                self.trash.add(path)
+            
+            path_int = self.trash.to_internal(path)
+            self.assertEquals(len(stamp.get_versions_list(path_int)), 2)
+            self.assertEquals(self.trash.get_count(), 2)
+            self.assertEquals(self.trash.get_size(), 8)
+            
+            self.trash.restore(path, how_old=1)
+            f = open(path, "r")
+            line = f.read();
+            self.assertEquals(line, "2th\n")
+        
+    def test_max_versions_dir(self):
+        directory = self.files_folder
+        path = os.path.join(directory, "e")
+        
+        self.trash.max_versions = 1
+        with self.trash.lock():
+            self.trash.add(path)
+            os.makedirs(path)
+            with open(os.path.join(path, "f.txt"), "w") as f:
+                f.write("12")
+            self.trash.add(path)
+            
+            path_int = self.trash.to_internal(os.path.join(path, "f.txt"))
+            self.assertEquals(len(stamp.get_versions_list(path_int)), 1)
+            self.assertEquals(self.trash.get_count(), 5)
+            self.assertEquals(self.trash.get_size(), 7)
+
+    def test_dedup(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_e = os.path.join(directory, "e")
+        path_f = os.path.join(path_e, "f.txt")
+
+        self.trash.dedup = True
+        with self.trash.lock():
+            self.trash.add(path_a)
+            self.trash.add(path_e)
+            self.trash.add(os.path.join(directory, "b.txt"))
+            self.assertEquals(self.trash.get_count(), 7)
+            self.assertEquals(self.trash.get_size(), 15)
+
+            path_int = stamp.get_version(self.trash.to_internal(path_f), 0)
+            self.assertEquals(os.lstat(path_int).st_nlink, 3)
+
+            count, size, _ = self.trash.remove(path_a)
+            self.assertEquals((count, size), (1, 0))
+            self.assertEquals(self.trash.get_size(), 15)
+
+            count, size, _ = self.trash.restore(path_e)
+            self.assertEquals((count, size), (5, 15))
+            self.assertEquals(os.lstat(path_f).st_nlink, 1)
+            with open(path_f, "r") as f:
+                self.assertEquals(f.read(), "1234567890")
+            self.assertEquals(self.trash.get_size(), 5)
+
+        self.assertEquals(self.trash.get_size(), 5)
+        dedup_dir = self.trash.get_meta_path(myrm.trash.DEDUP_DIRECTORY)
+        self.assertEquals(os.listdir(dedup_dir), ["5"])
+
+    def test_dedup_subtree(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_f = os.path.join(directory, "e", "f.txt")
+
+        self.trash.dedup = True
+        self.trash.lock_depth = 1
+        for path in (path_a, path_f):
+            with self.trash.lock(subtree=path):
+                self.trash.add(path)
+        with self.trash.lock(subtree=path_a):
+            self.trash.restore(path_a)
+
+        # Освобожденное место неизвестно: счетчик не сверен
+        self.assertEquals(self.trash.get_usage_counter().get_stats()["synced"],
+                          0)
+        with self.trash.lock():
+            self.assertEquals(self.trash.get_size(), 10)
+
+    def test_compression(self):
+        directory = self.files_folder
+        path_big = os.path.join(directory, "big.txt")
+        path_b = os.path.join(directory, "b.txt")
+        with open(path_big, "w") as f:
+            f.write("a" * 1000)
+        with open(path_b, "w") as f:
+            f.write("b" * 100)
+
+        self.trash.max_size = 10000
+        self.trash.compression = "zlib"
+        self.trash.compress_min_size = 500
+        with self.trash.lock():
+            self.trash.add(path_big)
+            self.trash.add(path_b)
+            self.trash.add(os.path.join(directory, "a.txt"))
+
+            path_int = stamp.get_version(self.trash.to_internal(path_big), 0)
+            self.assertEquals(compress.get_codec(path_int), "zlib")
+            size = self.trash.get_size()
+            self.assertTrue(size < 200)
+
+            now = datetime.datetime.now() + datetime.timedelta(days=8)
+            count, saved = self.trash.compress_cold(now)
+            self.assertEquals(count, 1)
+            self.assertEquals(self.trash.get_size(), size - saved)
+
+            self.trash.restore(path_big)
+            self.trash.restore(path_b)
+            with open(path_big, "r") as f:
+                self.assertEquals(f.read(), "a" * 1000)
+            with open(path_b, "r") as f:
+                self.assertEquals(f.read(), "b" * 100)
+            self.assertEquals(self.trash.get_size(), 10)
+
+        self.assertEquals(self.trash.get_size(), 10)
+
+    def test_compression_header(self):
+        path = os.path.join(self.files_folder, "fake.txt")
+        data = compress.MAGIC + "zlib\n" + "not compressed"
+        with open(path, "w") as f:
+            f.write(data)
+
+        self.trash.compression = "zlib"
+        with self.trash.lock():
+            self.trash.add(path)
+            self.trash.restore(path)
+        with open(path, "r") as f:
+            self.assertEquals(f.read(), data)
+
+        with open(path, "w") as f:
+            f.write("a" * 1000)
+        self.trash.max_size = 10000
+        self.trash.compress_min_size = 0
+        with self.trash.lock():
+            self.trash.add(path)
+            path_int = stamp.get_version(self.trash.to_internal(path), 0)
+            with open(path_int, "r+") as f:
+                f.seek(len(compress.MAGIC) + len("zlib\n"))
+                f.write("broken")
+            self.assertRaises(Exception, self.trash.restore, path)
+            self.assertFalse(os.path.lexists(path))
+
+    def test_delta(self):
+        path = os.path.join(self.files_folder, "data.txt")
+        lines = ["line {0}\n".format(i) for i in xrange(300)]
+        versions = []
+
+        self.trash.max_size = 100000
+        self.trash.delta = True
+        with self.trash.lock():
+            for i in xrange(4):
+                lines[i * 50] = "version {0}\n".format(i)
+                versions.insert(0, "".join(lines))
+                with open(path, "w") as f:
+                    f.write(versions[0])
+                self.trash.add(path)
+
+            full_paths = [f for _, f in self.trash._get_versions(path)]
+            self.assertEquals(delta.get_base_stamp(full_paths[0]), None)
+            for full_path in full_paths[1:]:
+                self.assertNotEqual(delta.get_base_stamp(full_path), None)
+            self.assertTrue(self.trash.get_size() < 2 * len(versions[0]))
+
+            self.trash.remove(path, how_old=1)
+            del versions[1]
+            self.assertEquals(self.trash.get_count(), 3)
+
+            self.trash.restore(path, how_old=2)
+            with open(path, "r") as f:
+                self.assertEquals(f.read(), versions[2])
+            self.trash.restore(path, how_old=0)
+            with open(path, "r") as f:
+                self.assertEquals(f.read(), versions[0])
+            self.trash.restore(path)
+            with open(path, "r") as f:
+                self.assertEquals(f.read(), versions[1])
+            self.assertEquals(self.trash.get_size(), 0)
+
+    def test_delta_header(self):
+        path = os.path.join(self.files_folder, "fake.txt")
+        data = delta.MAGIC + "100.5\nnot a delta"
+
+        self.trash.delta = True
+        with self.trash.lock():
+            for content in (data, "other"):
+                with open(path, "w") as f:
+                    f.write(content)
+                self.trash.add(path)
+
+            full_paths = [f for _, f in self.trash._get_versions(path)]
+            self.assertEquals(self.trash._detach_dependent(full_paths[0]), 0)
+            self.trash.restore(path, how_old=1)
+            with open(path, "r") as f:
+                self.assertEquals(f.read(), data)
+
+    def test_packs(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_e = os.path.join(directory, "e")
+        path_f = os.path.join(path_e, "f.txt")
+        path_b = os.path.join(directory, "b.txt")
+        packs_dir = self.trash.get_meta_path(packs.PACKS_DIRECTORY)
+
+        self.trash.pack_age = 60
+        with self.trash.lock():
+            self.trash.add(path_a)
+            self.trash.add(path_e)
+            self.trash.add(path_b)
+            size = self.trash.get_size()
+
+            now = datetime.datetime.now() + datetime.timedelta(minutes=2)
+            count, pack_size = self.trash.pack_cold(now)
+            self.assertEquals(count, 7)
+            self.assertEquals(pack_size, 30)
+            self.assertEquals(len(os.listdir(packs_dir)), 1)
+            self.assertFalse(os.path.exists(self.trash.to_internal(path_e)))
+            self.assertEquals(self.trash.get_size(), size)
+
+            files = list(self.trash.search(os.path.join(directory, "*")))
+            files = unify(files, directory)
+            self.assertEquals(files, ["a.txt", "b.txt", "e"])
+
+            count, size, _ = self.trash.restore(path_f)
+            self.assertEquals((count, size), (1, 10))
+            with open(path_f, "r") as f:
+                self.assertEquals(f.read(), "1234567890")
+
+            self.trash.restore(path_e)
+            self.assertEquals(sorted(os.listdir(path_e)),
+                              ["f.txt", "g.txt", "h.png", "j", "k"])
+            self.trash.remove(path_a)
+            self.assertEquals(len(os.listdir(packs_dir)), 1)
+            self.trash.remove(path_b)
+            self.assertEquals(os.listdir(packs_dir), [])
+            self.assertEquals(self.trash.get_size(), 0)
+
+        self.assertEquals(self.trash.get_count(), 0)
+        self.assertEquals(self.trash.get_size(), 0)
+
+    def test_tiers(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_e = os.path.join(directory, "e")
+        path_f = os.path.join(path_e, "f.txt")
+        path_b = os.path.join(directory, "b.txt")
+        capacity_dir = os.path.join(self.folder, "capacity")
+
+        self.trash.capacity_directory = capacity_dir
+        self.trash.migrate_age = 60
+        with self.trash.lock():
+            self.trash.add(path_a)
+            self.trash.add(path_e)
+            self.trash.add(path_b)
+            size = self.trash.get_size()
+            self.assertEquals(self.trash.get_capacity_size(), 0)
+
+            self.assertEquals(self.trash.migrate(), (0, 0))
+            now = datetime.datetime.now() + datetime.timedelta(minutes=2)
+            count, moved_size = self.trash.migrate(now)
+            self.assertEquals((count, moved_size), (7, 30))
+            self.assertFalse(os.path.exists(self.trash.to_internal(path_e)))
+            self.assertEquals(self.trash.get_capacity_size(), 30)
+            self.assertEquals(self.trash.get_size(), size)
+            self.assertEquals(self.trash.get_count(), 7)
+
+            files = list(self.trash.search(os.path.join(directory, "*")))
+            files = unify(files, directory)
+            self.assertEquals(files, ["a.txt", "b.txt", "e"])
+
+            count, size, _ = self.trash.restore(path_f)
+            self.assertEquals((count, size), (1, 10))
+            with open(path_f, "r") as f:
+                self.assertEquals(f.read(), "1234567890")
+            self.assertEquals(self.trash.get_capacity_size(), 20)
+
+            self.trash.restore(path_e)
+            self.assertEquals(sorted(os.listdir(path_e)),
+                              ["f.txt", "g.txt", "h.png", "j", "k"])
+            self.trash.remove(path_a)
+            self.trash.remove(path_b)
+
+        self.assertEquals(self.trash.get_count(), 0)
+        self.assertEquals(self.trash.get_size(), 0)
+        self.assertEquals(self.trash.get_capacity_size(), 0)
+
+    def test_tiers_limit(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_b = os.path.join(directory, "b.txt")
+
+        self.trash.capacity_directory = os.path.join(self.folder, "capacity")
+        self.trash.capacity_max_size = 12
+        self.trash.migrate_size = 5
+        with self.trash.lock():
+            self.trash.add(path_a)
+            self.trash.add(path_b)
+            self.assertEquals(self.trash.migrate(), (1, 10))
+            self.assertEquals(self.trash.get_capacity_size(), 10)
+            self.assertEquals(self.trash.get_count(), 2)
+
+    def test_purge(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_e = os.path.join(directory, "e")
+        capacity_dir = os.path.join(self.folder, "capacity")
+        tombstones = self.trash.get_meta_path(purge.TOMBSTONES_DIRECTORY)
+
+        self.trash.capacity_directory = capacity_dir
+        self.trash.migrate_size = 10
+        with self.trash.lock():
+            self.trash.add(path_a, ttl=60)
+            self.trash.add(path_e)
+            self.trash.migrate()
+
+            count, size = self.trash.purge(background=False)
+            self.assertEquals((count, size), (6, 25))
+            self.assertEquals(self.trash.get_count(), 0)
+            self.assertEquals(self.trash.get_size(), 0)
+            self.assertEquals(list(self.trash.search(path_e)), [])
+
+        self.assertEquals(os.listdir(tombstones), [])
+        self.assertEquals(os.listdir(capacity_dir), [])
+        self.assertEquals(os.listdir(self.trash.directory), [".meta"])
+        self.assertEquals(self.trash.get_count(), 0)
+        self.assertEquals(self.trash.get_size(), 0)
+
+    def test_throttle(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_e = os.path.join(directory, "e")
+
+        self.trash.throttle = throttle.Throttle(unlink_rate=10000)
+        with self.trash.lock():
+            self.trash.add(path_a)
+            self.trash.add(path_e)
+            self.trash.remove(path_a)
+            self.trash.remove(path_e)
+        self.assertEquals(self.trash.throttle.get_stats()["unlinked"], 6)
+
+        self.assertRaises(ValueError, self.trash.configurate,
+                          purge_ionice="low")
+
+    def test_truncate(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_e = os.path.join(directory, "e")
+
+        self.trash.truncate_size = 5
+        self.trash.truncate_step = 3
+        with self.trash.lock():
+            self.trash.add(path_a)
+            self.trash.add(path_e)
+            size = self.trash.get_size()
+            self.trash.remove(path_a)
+            self.assertEquals(self.trash.get_size(), size - 10)
+            self.trash.remove(path_e)
+            self.assertEquals(self.trash.get_size(), size - 25)
+            self.assertEquals(self.trash.get_count(), 0)
+        self.assertEquals(self.trash.throttle.get_stats()["truncated"], 25)
+        self.assertEquals(self.trash.get_size(), size - 25)
+
+    def test_ttl(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_e = os.path.join(directory, "e")
+        path_b = os.path.join(directory, "b.txt")
+        
+        with self.trash.lock():
+            self.trash.add(path_a, ttl=60)
+            self.trash.add(path_e, ttl=60*60)
+            self.trash.add(path_b)
+            self.assertEquals(self.trash.get_count(), 7)
+            
+            now = datetime.datetime.now() + datetime.timedelta(minutes=2)
+            count, size = self.trash.expire(now)
+            self.assertEquals(count, 1)
+            self.assertEquals(size, 10)
+            self.assertEquals(self.trash.get_count(), 6)
+            
+            now = datetime.datetime.now() + datetime.timedelta(hours=2)
+            count, size = self.trash.expire(now)
+            self.assertEquals(count, 5)
+            self.assertEquals(size, 15)
+            
+            files = list(self.trash.search(os.path.join(directory, "*")))
+            files = unify(files, directory)
+            self.assertEquals(files, ["b.txt"])
+        
+        self.assertEquals(self.trash.get_count(), 1)
+        self.assertEquals(self.trash.get_size(), 5)
+        
+    def test_ttl_failed_remove(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_b = os.path.join(directory, "b.txt")
+        remove_stamped = self.trash.remove_stamped
+
+        def fail_remove(path, dtime):
+            if path == path_a:
+                raise OSError(errno.EACCES, "Permission denied", path)
+            return remove_stamped(path, dtime)
+
+        with self.trash.lock():
+            self.trash.add(path_a, ttl=60)
+            self.trash.add(path_b, ttl=60)
+            now = datetime.datetime.now() + datetime.timedelta(minutes=2)
+
+            self.trash.remove_stamped = fail_remove
+            self.assertEquals(self.trash.expire(now), (1, 5))
+            del self.trash.remove_stamped
+            self.assertEquals(self.trash.get_count(), 1)
+
+            count, size = self.trash.expire(now)
+            self.assertEquals(count, 1)
+            self.assertEquals(size, 10)
+            self.assertEquals(self.trash.get_count(), 0)
+
+    def test_bucket_period(self):
+        start, end = myrm.trash.get_bucket_period("@20171231")
+        self.assertEquals(start, datetime.datetime(2017, 12, 31))
+        self.assertEquals(end, datetime.datetime(2018, 1, 1))
+        
+        start, end = myrm.trash.get_bucket_period("@2017123123")
+        self.assertEquals(start, datetime.datetime(2017, 12, 31, 23))
+        self.assertEquals(end, datetime.datetime(2018, 1, 1))
+        
+        self.assertIsNone(myrm.trash.get_bucket_period("47"))
+        self.assertIsNone(myrm.trash.get_bucket_period("@2017"))
+        
+    def test_partition(self):
+        directory = self.files_folder
+        path = os.path.join(directory, "a.txt")
+        
+        with self.trash.lock():
+            self.trash.add(path)
+            with open(path, "w") as f:
+                f.write("1th\n")
+            
+            self.trash.partition = "day"
+            self.trash.add(path)
+            self.trash.add(os.path.join(directory, "e"))
+            
+            self.assertEquals(len(self.trash.get_buckets()), 1)
+            self.assertEquals(len(self.trash.get_versions_list(path)), 2)
+            
+            files = self.trash.search(os.path.join(directory, "*"))
+            files = unify(files, directory)
+            self.assertEquals(files, ["a.txt", "e"])
+            
+            count, size, delta_files = self.trash.restore(path, how_old=1)
+            self.assertEquals(size, 10)
+            count, size, delta_files = self.trash.remove(path)
+            self.assertEquals(count, 1)
+            self.assertEquals(size, 4)
+            
+            count, size, delta_files = self.trash.restore(
+                os.path.join(directory, "e"))
+            self.assertEquals(count, 5)
+            self.assertEquals(size, 15)
+            self.assertEquals(self.trash.get_count(), 0)
+        
+        self.assertEquals(self.trash.get_file_time_list(), [])
+        
+    def test_remove_buckets(self):
+        directory = self.files_folder
+        
+        self.trash.partition = "hour"
+        with self.trash.lock():
+            self.trash.add(os.path.join(directory, "a.txt"))
+            self.trash.add(os.path.join(directory, "e"))
+            self.trash.partition = None
+            self.trash.add(os.path.join(directory, "b.txt"))
+            
+            now = datetime.datetime.now()
+            count, size = self.trash.remove_buckets(now)
+            self.assertEquals((count, size), (0, 0))
+            
+            now += datetime.timedelta(hours=1)
+            count, size = self.trash.remove_buckets(now)
+            self.assertEquals((count, size), (6, 25))
+            self.assertEquals(self.trash.get_buckets(), [])
+            self.assertEquals(self.trash.get_count(), 1)
+            self.assertEquals(self.trash.get_size(), 5)
+        
+    def test_quotas(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_b = os.path.join(directory, "b.txt")
+        path_e = os.path.join(directory, "e")
+        uid = ("uid", str(os.getuid()))
+        prefix = ("prefix", path_e)
+
+        trash = Trash(directory=self.trash.directory, lock_file="lock",
+                      quotas={"uid": {os.getuid(): {"max_size": 28}},
+                              "prefix": {path_e: {"max_count": 5}}})
+        with trash.lock():
+            trash.add(path_e)
+            trash.add(path_a)
+            self.assertEquals(trash.get_quota_usage(uid), (25, 6))
+            self.assertEquals(trash.get_quota_usage(prefix), (15, 5))
+
+            with self.assertRaises(QuotaExcessException) as context:
+                trash.add(path_b)
+            self.assertEquals(context.exception.tenant, uid)
+            self.assertEquals(context.exception.size, 5)
+            self.assertTrue(os.path.exists(path_b))
+
+            trash.restore(os.path.join(path_e, "f.txt"))
+            self.assertEquals(trash.get_quota_usage(prefix), (5, 4))
+            trash.remove(path_a)
+            self.assertEquals(trash.get_quota_usage(uid), (5, 4))
+            trash.add(path_b)
+            self.assertEquals(trash.get_quota_usage(uid), (10, 5))
+            self.assertEquals(trash.get_over_quota(), [])
+
+            usage = trash.get_quota_index().get_all()
+            trash.rebuild_quotas()
+            self.assertEquals(trash.get_quota_index().get_all(), usage)
+
+        path_k = os.path.join(path_e, "k")
+        trash = Trash(directory=self.trash.directory, lock_file="lock",
+                      quotas={"uid": {os.getuid(): {"max_size": 5}},
+                              "prefix": {path_k: {"max_count": 1}}})
+        with trash.lock():
+            self.assertEquals(trash.get_quota_usage(("prefix", path_k)),
+                              (0, 1))
+            self.assertEquals(trash.get_over_quota(), [(uid, 5, 0)])
+
+    def test_rollup(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_e = os.path.join(directory, "e")
+        path_k = os.path.join(path_e, "k")
+
+        trash = Trash(directory=self.trash.directory, lock_file="lock",
+                      rollup=True)
+        with trash.lock():
+            trash.add(path_e)
+            trash.add(path_a)
+            self.assertEquals(trash.get_tree_usage(path_e), (15, 5))
+            self.assertEquals(trash.get_tree_usage(path_k), (0, 1))
+            self.assertEquals(trash.get_tree_usage(path_a), (10, 1))
+            self.assertEquals(trash.get_tree_usage(directory), (25, 6))
+
+            trash.restore(os.path.join(path_e, "f.txt"))
+            trash.remove(path_k)
+            self.assertEquals(trash.get_tree_usage(path_e), (5, 3))
+            self.assertEquals(trash.get_tree_usage(directory), (15, 4))
+
+        with self.trash.lock(shared=True):
+            self.assertEquals(self.trash.get_tree_usage(path_e), (5, 3))
+            self.assertEquals(self.trash.get_tree_usage(directory), (15, 4))
+
+    def test_stats(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_e = os.path.join(directory, "e")
+
+        with self.trash.lock():
+            self.trash.add(path_a)
+            with open(path_a, "w") as f:
+                f.write("1th\n")
+            self.trash.add(path_a)
+            self.trash.add(path_e)
+
+            summary = self.trash.collect_stats(top=2)
+            self.assertEquals(summary.count, 7)
+            self.assertEquals(summary.size, 29)
+            self.assertEquals(summary.versions, {1: 5, 2: 1})
+            largest = [(os.path.relpath(path, directory), size)
+                       for path, _, size in summary.get_largest()]
+            self.assertEquals(largest, [("e/f.txt", 10), ("a.txt", 10)])
+            self.assertEquals(summary.ages.counts[0], 7)
+
+            summary = self.trash.collect_stats(path_e)
+            self.assertEquals((summary.count, summary.size), (5, 15))
+
+    def test_undo(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_b = os.path.join(directory, "b.txt")
+        path_e = os.path.join(directory, "e")
+
+        with self.trash.lock():
+            self.trash.add(path_e, operation="op1")
+            self.trash.add(path_a, operation="op1")
+            self.trash.add(path_b, operation="op2")
+
+            count, size, _ = self.trash.undo()
+            self.assertEquals((count, size), (1, 5))
+            self.assertTrue(os.path.exists(path_b))
+
+            count, size, restored = self.trash.undo("op1")
+            self.assertEquals((count, size), (6, 25))
+            restored = sorted(os.path.relpath(p, directory) for p in restored)
+            self.assertEquals(restored, ["a.txt", "e", "e/f.txt", "e/g.txt",
+                                         "e/h.png", "e/j", "e/k",
+                                         "e/k/l.txt"])
+            self.assertTrue(os.path.exists(os.path.join(path_e, "k",
+                                                        "l.txt")))
+            self.assertEquals(self.trash.get_count(), 0)
+            self.assertEquals(self.trash.get_size(), 0)
+            self.assertEquals(self.trash.undo(), (0, 0, []))
+
+    def test_undo_missing_parent(self):
+        path_e = os.path.join(self.files_folder, "e")
+        path_f = os.path.join(path_e, "f.txt")
+
+        with self.trash.lock():
+            self.trash.add(path_f, operation="op1")
+            self.trash.add(path_e)
+            count, size, _ = self.trash.undo("op1")
+            self.assertEquals((count, size), (1, 10))
+            self.assertTrue(os.path.exists(path_f))
+
+    def test_missing_version(self):
+        path_a = os.path.join(self.files_folder, "a.txt")
+        with self.trash.lock():
+            with self.assertRaises(OSError):
+                self.trash.restore_file(path_a)
+            with self.assertRaises(OSError):
+                self.trash.remove(path_a, how_old=0)
+            self.assertEquals(self.trash.remove(path_a)[:2], (0, 0))
+
+    def test_restore_as_of(self):
+        directory = self.files_folder
+        path_a = os.path.join(directory, "a.txt")
+        path_e = os.path.join(directory, "e")
+        path_f = os.path.join(path_e, "f.txt")
+        before = datetime.datetime.now()
+
+        with self.trash.lock():
+            self.trash.add(path_a)
+            self.trash.add(path_e)
+            as_of = datetime.datetime.now()
+            os.makedirs(path_e)
+            for path in (path_a, path_f):
+                with open(path, "w") as f:
+                    f.write("1th\n")
+            self.trash.add(path_a)
+            self.trash.add(path_e)
+
+            self.assertEquals(self.trash.restore(path_a, as_of=before),
+                              (0, 0, []))
+            self.assertRaises(OSError, self.trash.restore, path_e,
+                              as_of=before)
+            self.assertFalse(os.path.exists(path_e))
+            count, size, _ = self.trash.restore(path_e, as_of=as_of)
+            self.assertEquals((count, size), (5, 15))
+            count, size, _ = self.trash.restore(path_a, as_of=as_of)
+            self.assertEquals((count, size), (1, 10))
+            for path in (path_a, path_f):
+                with open(path) as f:
+                    self.assertEquals(f.read(), "1234567890")
+
+            self.assertEquals(len(self.trash.get_versions_list(path_a)), 1)
+            self.assertEquals(len(self.trash.get_versions_list(path_f)), 1)
+
     def test_search1(self):
         directory = self.files_folder
         path = os.path.join(directory, "*")
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import os
+
+import myrm.ttl as ttl
+
+from myrm.ttl import TtlIndex
+
+
+class ParseTtlTests(unittest.TestCase):
+
+    def test_seconds(self):
+        self.assertEquals(ttl.parse_ttl("90"), 90)
+        self.assertEquals(ttl.parse_ttl("90s"), 90)
+
+    def test_units(self):
+        self.assertEquals(ttl.parse_ttl("30m"), 30*60)
+        self.assertEquals(ttl.parse_ttl("2h"), 2*60*60)
+        self.assertEquals(ttl.parse_ttl("1D"), 24*60*60)
+        self.assertEquals(ttl.parse_ttl("1w"), 7*24*60*60)
+
+    def test_bad(self):
+        with self.assertRaises(ValueError):
+            ttl.parse_ttl("2x")
+        with self.assertRaises(ValueError):
+            ttl.parse_ttl("h")
+        with self.assertRaises(ValueError):
+            ttl.parse_ttl("-1h")
+
+
+class TtlIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        self.folder = os.path.join(script_dir, "test_folder", "ttl_test")
+        self.index = TtlIndex(self.folder, slot=100)
+
+    def tearDown(self):
+        if os.path.exists(self.folder):
+            for path in os.listdir(self.folder):
+                os.unlink(os.path.join(self.folder, path))
+            os.rmdir(self.folder)
+
+    def test_empty(self):
+        self.assertEquals(self.index.pop_expired(1000), [])
+
+    def test_pop(self):
+        self.index.schedule("/a", 1000, 1, 10)
+        self.index.schedule("/b", 1000, 2, 150)
+        self.index.schedule("/c", 1000, 3, 500)
+
+        self.assertEquals(self.index.pop_expired(1009), [])
+        self.assertEquals(self.index.pop_expired(1010), [("/a", 1000, 1)])
+        self.assertEquals(self.index.pop_expired(1010), [])
+        self.assertEquals(self.index.pop_expired(2000),
+                          [("/b", 1000, 2), ("/c", 1000, 3)])
+        self.assertEquals(os.listdir(self.folder), [])
+
+    def test_discard(self):
+        self.index.schedule("/a", 1000, 1, 10)
+        self.index.schedule("/b", 1000, 2, 20)
+
+        expired = self.index.get_expired(1050)
+        self.assertEquals(expired, [("/a", 1000, 1), ("/b", 1000, 2)])
+        self.index.discard(1050, expired[:1])
+        self.assertEquals(self.index.get_expired(1050), [("/b", 1000, 2)])
+        self.index.discard(1050, [("/b", 1000, 2)])
+        self.assertEquals(os.listdir(self.folder), [])
+
+    def test_partial_slot(self):
+        self.index.schedule("/a", 1000, 1, 10)
+        self.index.schedule("/b", 1000, 2, 50)
+
+        self.assertEquals(self.index.pop_expired(1020), [("/a", 1000, 1)])
+        self.assertEquals(len(os.listdir(self.folder)), 1)
+        self.assertEquals(self.index.pop_expired(1050), [("/b", 1000, 2)])
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import os
+import shutil
+
+from myrm.usage import UsageCounter
+
+
+class UsageTests(unittest.TestCase):
+
+    def setUp(self):
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        self.folder = os.path.join(script_dir, "test_folder", "usage_test")
+        self.counter = UsageCounter(os.path.join(self.folder, "usage"))
+
+    def tearDown(self):
+        self.counter.close()
+        if os.path.exists(self.folder):
+            shutil.rmtree(self.folder)
+
+    def test_unset(self):
+        self.assertEquals(self.counter.read(), None)
+        with self.assertRaises(IOError):
+            self.counter.update(1, 1)
+        self.assertEquals(self.counter.read(), None)
+
+    def test_reserve(self):
+        self.counter.reset(10, 1)
+        first = self.counter.reserve(20, 2, max_size=40, max_count=4)
+        self.assertEquals(self.counter.get_stats()["reserved_size"], 20)
+
+        # Чужой резерв учитывается при проверке ограничений
+        self.assertEquals(self.counter.reserve(20, 1, max_size=40), None)
+        second = self.counter.reserve(10, 1, max_size=40, max_count=4)
+
+        first.commit(size=15)
+        second.release()
+        second.commit()
+        stats = self.counter.get_stats()
+        self.assertEquals((stats["size"], stats["count"]), (25, 3))
+        self.assertEquals((stats["reserved_size"], stats["reserved_count"]),
+                          (0, 0))
+
+    def test_context(self):
+        self.counter.reset(0, 0)
+        with self.assertRaises(OSError):
+            with self.counter.reserve(5, 1):
+                raise OSError()
+        self.assertEquals(self.counter.get_stats()["reserved_size"], 0)
+        self.assertEquals(self.counter.read(), (0, 0))
+
+    def test_invalidate(self):
+        self.counter.reset(5, 1)
+        self.counter.reserve(5, 1)
+        self.counter.invalidate()
+        stats = self.counter.get_stats()
+        self.assertEquals(stats["synced"], 0)
+        self.assertEquals(stats["reserved_size"], 5)
+
+        self.counter.reset(5, 1)
+        stats = self.counter.get_stats()
+        self.assertTrue(stats["synced"] > 0)
+        self.assertEquals(stats["reserved_size"], 0)
+
+    def test_shared(self):
+        self.counter.reset(0, 0)
+        other = UsageCounter(self.counter.path)
+        try:
+            other.update(7, 2)
+            self.assertEquals(self.counter.read(), (7, 2))
+        finally:
+            other.close()
+
+
+if __name__ == '__main__':
+    unittest.main()